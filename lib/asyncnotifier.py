@@ -106,7 +106,10 @@ class SingleFileEventHandler(pyinotify.ProcessEvent):
 
     """
     if self.watch_handle is None:
-      result = self.watch_manager.add_watch(self.file, self.mask)
+      # passing ourselves as processing function allows multiple handlers
+      # to share a watch manager
+      result = self.watch_manager.add_watch(self.file, self.mask,
+                                            proc_fun=self)
       if not self.file in result or result[self.file] <= 0:
         raise errors.InotifyError("Could not add inotify watcher")
       else:
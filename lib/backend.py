@@ -59,7 +59,10 @@ from ganeti import objects
 from ganeti import ssconf
 from ganeti import serializer
 from ganeti import netutils
+from ganeti import lvminventory
 from ganeti import runtime
+from ganeti import compat
+from ganeti import jstore
 
 
 _BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
@@ -563,7 +566,7 @@ def VerifyNode(what, cluster_name):
     result[constants.NV_INSTANCELIST] = val
 
   if constants.NV_VGLIST in what:
-    result[constants.NV_VGLIST] = utils.ListVolumeGroups()
+    result[constants.NV_VGLIST] = ListVolumeGroups()
 
   if constants.NV_PVLIST in what:
     result[constants.NV_PVLIST] = \
@@ -634,21 +637,26 @@ def GetVolumeList(vg_name):
 
   """
   lvs = {}
-  sep = '|'
-  result = utils.RunCmd(["lvs", "--noheadings", "--units=m", "--nosuffix",
-                         "--separator=%s" % sep,
-                         "-olv_name,lv_size,lv_attr", vg_name])
-  if result.failed:
-    _Fail("Failed to list logical volumes, lvs output: %s", result.output)
-
-  valid_line_re = re.compile("^ *([^|]+)\|([0-9.]+)\|([^|]{6})\|?$")
-  for line in result.stdout.splitlines():
-    line = line.strip()
-    match = valid_line_re.match(line)
-    if not match:
-      logging.error("Invalid line returned from lvs output: '%s'", line)
+  try:
+    snapshot = lvminventory.GetSnapshot()
+    vg_names = [vg["vg_name"] for vg in snapshot.GetVolumeGroups()]
+    lv_list = snapshot.Query(lvminventory.KIND_LV,
+                             ["vg_name", "lv_name", "lv_size", "lv_attr"])
+  except errors.CommandError, err:
+    _Fail("Failed to list logical volumes: %s", err)
+
+  if vg_name not in vg_names:
+    _Fail("Failed to list logical volumes, volume group '%s' not found",
+          vg_name)
+
+  valid_size_re = re.compile("^[0-9.]+$")
+  for (lv_vg, name, size, attr) in lv_list:
+    if lv_vg != vg_name:
+      continue
+    if not (valid_size_re.match(size) and len(attr) == 6):
+      logging.error("Invalid logical volume information: %s, %s, %s",
+                    name, size, attr)
       continue
-    name, size, attr = match.groups()
     inactive = attr[4] == '-'
     online = attr[5] == 'o'
     virtual = attr[0] == 'v'
@@ -669,7 +677,21 @@ def ListVolumeGroups():
       size of the volume
 
   """
-  return utils.ListVolumeGroups()
+  try:
+    vgs = lvminventory.GetSnapshot().Query(lvminventory.KIND_VG,
+                                           ["vg_name", "vg_size"])
+  except errors.CommandError, err:
+    logging.error("Can't list volume groups: %s", err)
+    return {}
+
+  result = {}
+  for (name, size) in vgs:
+    try:
+      result[name] = int(float(size))
+    except ValueError, err:
+      logging.error("Invalid size of volume group %s (%s): %s",
+                    name, err, size)
+  return result
 
 
 def NodeVolumes():
@@ -691,12 +713,12 @@ def NodeVolumes():
     multiple times.
 
   """
-  result = utils.RunCmd(["lvs", "--noheadings", "--units=m", "--nosuffix",
-                         "--separator=|",
-                         "--options=lv_name,lv_size,devices,vg_name"])
-  if result.failed:
-    _Fail("Failed to list logical volumes, lvs output: %s",
-          result.output)
+  try:
+    lv_list = lvminventory.GetSnapshot().Query(lvminventory.KIND_LV,
+                                               ["lv_name", "lv_size",
+                                                "devices", "vg_name"])
+  except errors.CommandError, err:
+    _Fail("Failed to list logical volumes: %s", err)
 
   def parse_dev(dev):
     return dev.split('(')[0]
@@ -705,16 +727,12 @@ def NodeVolumes():
     return [parse_dev(x) for x in dev.split(",")]
 
   def map_line(line):
-    line = [v.strip() for v in line]
     return [{'name': line[0], 'size': line[1],
              'dev': dev, 'vg': line[3]} for dev in handle_dev(line[2])]
 
   all_devs = []
-  for line in result.stdout.splitlines():
-    if line.count('|') >= 3:
-      all_devs.extend(map_line(line.split('|')))
-    else:
-      logging.warning("Strange line in the output from lvs: '%s'", line)
+  for line in lv_list:
+    all_devs.extend(map_line(line))
   return all_devs
 
 
@@ -1223,6 +1241,40 @@ def MigrateInstance(instance, target, live):
     _Fail("Failed to migrate instance: %s", err, exc=True)
 
 
+def _RunMulti(fn, args_list, stop_on_error=False):
+  """Runs a backend function for several sets of arguments.
+
+  Errors are reported per entry, in the format used by the node daemon
+  for whole RPC calls.
+
+  @param fn: the function to run
+  @type args_list: list of tuples
+  @param args_list: the arguments for every invocation
+  @type stop_on_error: boolean
+  @param stop_on_error: whether to skip the remaining entries after the
+      first failure
+  @rtype: list of tuples
+  @return: (success, result or error message) for every entry run
+
+  """
+  result = []
+  for args in args_list:
+    try:
+      entry = (True, fn(*args)) # pylint: disable-msg=W0142
+    except RPCFail, err:
+      entry = (False, str(err))
+    except Exception, err: # pylint: disable-msg=W0703
+      logging.exception("Error while executing backend function")
+      entry = (False, "Error while executing backend function: %s" % str(err))
+
+    result.append(entry)
+
+    if stop_on_error and not entry[0]:
+      break
+
+  return result
+
+
 def BlockdevCreate(disk, size, owner, on_primary, info):
   """Creates a block device for an instance.
 
@@ -1287,6 +1339,26 @@ def BlockdevCreate(disk, size, owner, on_primary, info):
   return device.unique_id
 
 
+def BlockdevCreateMulti(devices, owner, on_primary, info):
+  """Creates several block devices for an instance.
+
+  The devices are created in the given order, children must therefore
+  be listed before their parents. Creation stops at the first failure.
+
+  @type devices: list of tuples
+  @param devices: (L{objects.Disk}, size) for every device
+  @see: L{BlockdevCreate} for the other parameters
+  @rtype: list of tuples
+  @return: (success, new unique_id or error message) for every device
+      up to and including the first failed one
+
+  """
+  return _RunMulti(BlockdevCreate,
+                   [(disk, size, owner, on_primary, info)
+                    for (disk, size) in devices],
+                   stop_on_error=True)
+
+
 def BlockdevRemove(disk):
   """Remove a block device.
 
@@ -1400,6 +1472,21 @@ def BlockdevAssemble(disk, owner, as_primary):
   return result
 
 
+def BlockdevAssembleMulti(disks, owner, as_primary):
+  """Activates several block devices for an instance.
+
+  @type disks: list of L{objects.Disk}
+  @param disks: the disks to activate
+  @see: L{BlockdevAssemble} for the other parameters
+  @rtype: list of tuples
+  @return: (success, result of L{BlockdevAssemble} or error message) for
+      every disk
+
+  """
+  return _RunMulti(BlockdevAssemble,
+                   [(disk, owner, as_primary) for disk in disks])
+
+
 def BlockdevShutdown(disk):
   """Shut down a block device.
 
@@ -1438,6 +1525,18 @@ def BlockdevShutdown(disk):
     _Fail("; ".join(msgs))
 
 
+def BlockdevShutdownMulti(disks):
+  """Shuts down several block devices.
+
+  @type disks: list of L{objects.Disk}
+  @param disks: the disks to shut down
+  @rtype: list of tuples
+  @return: (success, None or error message) for every disk
+
+  """
+  return _RunMulti(BlockdevShutdown, [(disk, ) for disk in disks])
+
+
 def BlockdevAddchildren(parent_cdev, new_cdevs):
   """Extend a mirrored block device.
 
@@ -1569,6 +1668,19 @@ def BlockdevFind(disk):
   return rbd.GetSyncStatus()
 
 
+def BlockdevFindMulti(disks):
+  """Checks if several devices are activated.
+
+  @type disks: list of L{objects.Disk}
+  @param disks: the disks to find
+  @rtype: list of tuples
+  @return: (success, result of L{BlockdevFind} or error message) for
+      every disk
+
+  """
+  return _RunMulti(BlockdevFind, [(disk, ) for disk in disks])
+
+
 def BlockdevGetsize(disks):
   """Computes the size of the given disks.
 
@@ -1675,6 +1787,71 @@ def UploadFile(file_name, data, mode, uid, gid, atime, mtime):
                   atime=atime, mtime=mtime)
 
 
+def _ApplyConfigDelta(data, delta):
+  """Applies a configuration delta to the serialized configuration.
+
+  @type data: dict
+  @param data: the configuration data, will be modified in place
+  @type delta: dict
+  @param delta: the delta as built by the master daemon
+  @raise RPCFail: if the delta was built for another configuration
+
+  """
+  if data.get("serial_no", None) != delta["base_serial"]:
+    _Fail("Configuration serial number mismatch, have %s, delta is for %s",
+          data.get("serial_no", None), delta["base_serial"])
+
+  data.update(delta["set"])
+
+  for (key, objs) in delta["update"].items():
+    data.setdefault(key, {}).update(objs)
+
+  for (key, names) in delta["remove"].items():
+    container = data.get(key, {})
+    for name in names:
+      container.pop(name, None)
+
+
+def UploadConfigDelta(file_name, delta, mode, uid, gid):
+  """Applies a delta to the cluster configuration file.
+
+  The delta is applied to the local copy of the configuration, which
+  is then checked against the hash of the master's copy before being
+  written. Any failure must make the master upload the whole file.
+
+  @type file_name: str
+  @param file_name: the configuration file name
+  @type delta: dict
+  @param delta: the configuration delta
+  @type mode: int
+  @param mode: the mode to give the file
+  @type uid: int
+  @param uid: the owner of the file
+  @type gid: int
+  @param gid: the group of the file
+  @rtype: None
+
+  """
+  if file_name != constants.CLUSTER_CONF_FILE:
+    _Fail("Filename passed to UploadConfigDelta is not the cluster"
+          " configuration file: '%s'", file_name)
+
+  try:
+    data = serializer.Load(utils.ReadFile(file_name))
+  except EnvironmentError, err:
+    _Fail("Can't read configuration file: %s", err)
+  except ValueError, err:
+    _Fail("Can't parse configuration file: %s", err)
+
+  _ApplyConfigDelta(data, delta)
+
+  txt = serializer.Dump(data)
+  if compat.sha1_hash(txt).hexdigest() != delta["hash"]:
+    _Fail("Configuration hash mismatch after applying delta")
+
+  utils.WriteFile(file_name, data=txt, mode=mode, uid=uid, gid=gid)
+
+
 def WriteSsconfFiles(values):
   """Update all ssconf files.
 
@@ -2357,7 +2534,7 @@ def _EnsureJobQueueFile(file_name):
           " the queue directory '%s'", file_name, queue_dir)
 
 
-def JobQueueUpdate(file_name, content):
+def JobQueueUpdate(file_name, content, append=False):
   """Updates a file in the queue directory.
 
   This is just a wrapper over L{utils.WriteFile}, with proper
@@ -2367,11 +2544,19 @@ def JobQueueUpdate(file_name, content):
   @param file_name: the job file name
   @type content: str
   @param content: the new job contents
+  @type append: bool
+  @param append: whether to append the contents to the file instead of
+      replacing it
   @rtype: boolean
   @return: the success of the operation
 
   """
   _EnsureJobQueueFile(file_name)
+
+  if append:
+    jstore.AppendQueueFile(file_name, _Decompress(content))
+    return
+
   getents = runtime.GetEnts()
 
   # Write and replace the file atomically
@@ -2397,6 +2582,12 @@ def JobQueueRename(old, new):
 
   utils.RenameFile(old, new, mkdir=True)
 
+  # keep the index of archived jobs up to date, in case this node
+  # becomes the master
+  job_id = jstore.GetArchivedJobIDFromPath(new)
+  if job_id is not None:
+    jstore.AppendArchiveIndex([job_id])
+
 
 def BlockdevClose(instance_name, disks):
   """Closes the given block devices.
@@ -3063,12 +3254,18 @@ class HooksRunner(object):
   on the master side.
 
   """
-  def __init__(self, hooks_base_dir=None):
+  def __init__(self, hooks_base_dir=None, max_parallel=1, timeout=None):
     """Constructor for hooks runner.
 
     @type hooks_base_dir: str or None
     @param hooks_base_dir: if not None, this overrides the
         L{constants.HOOKS_BASE_DIR} (useful for unittests)
+    @type max_parallel: int
+    @param max_parallel: how many scripts of a directory may run at the
+        same time (1 to run them one after another)
+    @type timeout: number or None
+    @param timeout: if not None, scripts still running after this many
+        seconds are killed and reported as failed
 
     """
     if hooks_base_dir is None:
@@ -3076,6 +3273,8 @@ class HooksRunner(object):
     # yeah, _BASE_DIR is not valid for attributes, we use it like a
     # constant
     self._BASE_DIR = hooks_base_dir # pylint: disable-msg=C0103
+    self._max_parallel = max_parallel
+    self._timeout = timeout
 
   def RunHooks(self, hpath, phase, env):
     """Run the scripts in the hooks directory.
@@ -3089,11 +3288,12 @@ class HooksRunner(object):
     @type env: dict
     @param env: dictionary with the environment for the hook
     @rtype: list
-    @return: list of 3-element tuples:
+    @return: list of 4-element tuples:
       - script path
       - script result, either L{constants.HKR_SUCCESS} or
         L{constants.HKR_FAIL}
       - output of the script
+      - how long the script ran in seconds, None if it wasn't run
 
     @raise errors.ProgrammerError: for invalid input
         parameters
@@ -3117,9 +3317,12 @@ class HooksRunner(object):
       # warning at every operation
       return results
 
-    runparts_results = utils.RunParts(dir_name, env=env, reset_env=True)
+    runparts_results = utils.RunParts(dir_name, env=env, reset_env=True,
+                                      max_parallel=self._max_parallel,
+                                      timeout=self._timeout)
 
     for (relname, relstatus, runresult)  in runparts_results:
+      duration = None
       if relstatus == constants.RUNPARTS_SKIP:
         rrval = constants.HKR_SKIP
         output = ""
@@ -3131,8 +3334,13 @@ class HooksRunner(object):
           rrval = constants.HKR_FAIL
         else:
           rrval = constants.HKR_SUCCESS
-        output = utils.SafeEncode(runresult.output.strip())
-      results.append(("%s/%s" % (subdir, relname), rrval, output))
+        output = runresult.output.strip()
+        if runresult.timeout is not None:
+          output = ("%s\nHook script %s" %
+                    (output, runresult.fail_reason)).lstrip()
+        output = utils.SafeEncode(output)
+        duration = runresult.duration
+      results.append(("%s/%s" % (subdir, relname), rrval, output, duration))
 
     return results
 
@@ -34,6 +34,7 @@ from ganeti import constants
 from ganeti import objects
 from ganeti import compat
 from ganeti import netutils
+from ganeti import lvminventory
 
 
 # Size of reads in _CanReadDevice
@@ -408,48 +409,19 @@ class LogicalVolume(BlockDev):
     # create an optimally-striped volume; in that case, we want to try
     # with N, N-1, ..., 2, and finally 1 (non-stripped) number of
     # stripes
-    for stripes_arg in range(stripes, 0, -1):
-      result = utils.RunCmd(cmd + ["-i%d" % stripes_arg] + [vg_name] + pvlist)
-      if not result.failed:
-        break
+    try:
+      for stripes_arg in range(stripes, 0, -1):
+        result = utils.RunCmd(cmd + ["-i%d" % stripes_arg] + [vg_name] +
+                              pvlist)
+        if not result.failed:
+          break
+    finally:
+      lvminventory.Invalidate()
     if result.failed:
       _ThrowError("LV create failed (%s): %s",
                   result.fail_reason, result.output)
     return LogicalVolume(unique_id, children, size)
 
-  @staticmethod
-  def _GetVolumeInfo(lvm_cmd, fields):
-    """Returns LVM Volumen infos using lvm_cmd
-
-    @param lvm_cmd: Should be one of "pvs", "vgs" or "lvs"
-    @param fields: Fields to return
-    @return: A list of dicts each with the parsed fields
-
-    """
-    if not fields:
-      raise errors.ProgrammerError("No fields specified")
-
-    sep = "|"
-    cmd = [lvm_cmd, "--noheadings", "--nosuffix", "--units=m", "--unbuffered",
-           "--separator=%s" % sep, "-o%s" % ",".join(fields)]
-
-    result = utils.RunCmd(cmd)
-    if result.failed:
-      raise errors.CommandError("Can't get the volume information: %s - %s" %
-                                (result.fail_reason, result.output))
-
-    data = []
-    for line in result.stdout.splitlines():
-      splitted_fields = line.strip().split(sep)
-
-      if len(fields) != len(splitted_fields):
-        raise errors.CommandError("Can't parse %s output: line '%s'" %
-                                  (lvm_cmd, line))
-
-      data.append(splitted_fields)
-
-    return data
-
   @classmethod
   def GetPVInfo(cls, vg_names, filter_allocatable=True):
     """Get the free space info for PVs in a volume group.
@@ -462,8 +434,9 @@ class LogicalVolume(BlockDev):
 
     """
     try:
-      info = cls._GetVolumeInfo("pvs", ["pv_name", "vg_name", "pv_free",
-                                        "pv_attr"])
+      info = lvminventory.GetSnapshot().Query(lvminventory.KIND_PV,
+                                              ["pv_name", "vg_name", "pv_free",
+                                               "pv_attr"])
     except errors.GenericError, err:
       logging.error("Can't get PV information: %s", err)
       return None
@@ -493,8 +466,9 @@ class LogicalVolume(BlockDev):
 
     """
     try:
-      info = cls._GetVolumeInfo("vgs", ["vg_name", "vg_free", "vg_attr",
-                                        "vg_size"])
+      info = lvminventory.GetSnapshot().Query(lvminventory.KIND_VG,
+                                              ["vg_name", "vg_free", "vg_attr",
+                                               "vg_size"])
     except errors.GenericError, err:
       logging.error("Can't get VG information: %s", err)
       return None
@@ -534,6 +508,7 @@ class LogicalVolume(BlockDev):
       return
     result = utils.RunCmd(["lvremove", "-f", "%s/%s" %
                            (self._vg_name, self._lv_name)])
+    lvminventory.Invalidate()
     if result.failed:
       _ThrowError("Can't lvremove: %s - %s", result.fail_reason, result.output)
 
@@ -549,6 +524,7 @@ class LogicalVolume(BlockDev):
                                    " volume groups (from %s to to %s)" %
                                    (self._vg_name, new_vg))
     result = utils.RunCmd(["lvrename", new_vg, self._lv_name, new_name])
+    lvminventory.Invalidate()
     if result.failed:
       _ThrowError("Failed to rename the logical volume: %s", result.output)
     self._lv_name = new_name
@@ -628,6 +604,7 @@ class LogicalVolume(BlockDev):
 
     """
     result = utils.RunCmd(["lvchange", "-ay", self.dev_path])
+    lvminventory.Invalidate()
     if result.failed:
       _ThrowError("Can't activate lv %s: %s", self.dev_path, result.output)
 
@@ -711,6 +688,7 @@ class LogicalVolume(BlockDev):
 
     result = utils.RunCmd(["lvcreate", "-L%dm" % size, "-s",
                            "-n%s" % snap_name, self.dev_path])
+    lvminventory.Invalidate()
     if result.failed:
       _ThrowError("command: %s error: %s - %s",
                   result.cmd, result.fail_reason, result.output)
@@ -755,6 +733,7 @@ class LogicalVolume(BlockDev):
       result = utils.RunCmd(["lvextend", "--alloc", alloc_policy,
                              "-L", "+%dm" % amount, self.dev_path])
       if not result.failed:
+        lvminventory.Invalidate()
         return
     _ThrowError("Can't grow LV %s: %s", self.dev_path, result.output)
 
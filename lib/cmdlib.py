@@ -217,6 +217,9 @@ def _TDictOf(key_type, val_type):
 #: output fields for a query operation
 _POutputFields = ("output_fields", _NoDefault, _TListOf(_TNonEmptyString))
 
+#: Maximum age of cached runtime data in seconds, None for fresh data
+_PMaxAge = ("max_age", None, _TOr(_TNone, _TPositiveInt))
+
 
 #: the shutdown timeout
 _PShutdownTimeout = ("shutdown_timeout", constants.DEFAULT_SHUTDOWN_TIMEOUT,
@@ -241,6 +244,43 @@ _PMigrationLive = ("live", None, _TMaybeBool)
 
 
 # End types
+def _CheckOpParams(op, op_params):
+  """Fills in default values and checks the types of opcode parameters.
+
+  @type op: L{opcodes.OpCode}
+  @param op: the opcode
+  @type op_params: list
+  @param op_params: parameter definitions (see L{LogicalUnit._OP_PARAMS})
+  @raise errors.OpPrereqError: if a parameter is missing or has a wrong type
+
+  """
+  op_id = op.OP_ID
+  for attr_name, aval, test in op_params:
+    if not hasattr(op, attr_name):
+      if aval == _NoDefault:
+        raise errors.OpPrereqError("Required parameter '%s.%s' missing" %
+                                   (op_id, attr_name), errors.ECODE_INVAL)
+      else:
+        if callable(aval):
+          dval = aval()
+        else:
+          dval = aval
+        setattr(op, attr_name, dval)
+    attr_val = getattr(op, attr_name)
+    if test == _NoType:
+      # no tests here
+      continue
+    if not callable(test):
+      raise errors.ProgrammerError("Validation for parameter '%s.%s' failed,"
+                                   " given type is not a proper type (%s)" %
+                                   (op_id, attr_name, test))
+    if not test(attr_val):
+      logging.error("OpCode %s, parameter %s, has invalid type %s/value %s",
+                    op.OP_ID, attr_name, type(attr_val), attr_val)
+      raise errors.OpPrereqError("Parameter '%s.%s' fails validation" %
+                                 (op_id, attr_name), errors.ECODE_INVAL)
+
+
 class LogicalUnit(object):
   """Logical Unit base class.
 
@@ -303,31 +343,7 @@ class LogicalUnit(object):
     self.tasklets = None
 
     # The new kind-of-type-system
-    op_id = self.op.OP_ID
-    for attr_name, aval, test in self._OP_PARAMS:
-      if not hasattr(op, attr_name):
-        if aval == _NoDefault:
-          raise errors.OpPrereqError("Required parameter '%s.%s' missing" %
-                                     (op_id, attr_name), errors.ECODE_INVAL)
-        else:
-          if callable(aval):
-            dval = aval()
-          else:
-            dval = aval
-          setattr(self.op, attr_name, dval)
-      attr_val = getattr(op, attr_name)
-      if test == _NoType:
-        # no tests here
-        continue
-      if not callable(test):
-        raise errors.ProgrammerError("Validation for parameter '%s.%s' failed,"
-                                     " given type is not a proper type (%s)" %
-                                     (op_id, attr_name, test))
-      if not test(attr_val):
-        logging.error("OpCode %s, parameter %s, has invalid type %s/value %s",
-                      self.op.OP_ID, attr_name, type(attr_val), attr_val)
-        raise errors.OpPrereqError("Parameter '%s.%s' fails validation" %
-                                   (op_id, attr_name), errors.ECODE_INVAL)
+    _CheckOpParams(self.op, self._OP_PARAMS)
 
     self.CheckArguments()
 
@@ -2295,7 +2311,9 @@ class LUVerifyCluster(LogicalUnit):
           # overrides self.bad
           lu_result = 1
           continue
-        for script, hkr, output in res.payload:
+        for entry in res.payload:
+          # Nodes running an older version don't report durations
+          (script, hkr, output) = entry[:3]
           test = hkr == constants.HKR_FAIL
           self._ErrorIf(test, self.ENODEHOOKS, node_name,
                         "Script %s failed, output:", script)
@@ -3289,6 +3307,7 @@ class LUQueryNodes(NoHooksLU):
     _POutputFields,
     ("names", _EmptyList, _TListOf(_TNonEmptyString)),
     ("use_locking", False, _TBool),
+    _PMaxAge,
     ]
   REQ_BGL = False
 
@@ -3353,8 +3372,14 @@ class LUQueryNodes(NoHooksLU):
 
     if self.do_node_query:
       live_data = {}
-      node_data = self.rpc.call_node_info(nodenames, self.cfg.GetVGName(),
-                                          self.cfg.GetHypervisorType())
+      vg_name = self.cfg.GetVGName()
+      hv_name = self.cfg.GetHypervisorType()
+      if self.op.max_age is None:
+        node_data = self.rpc.call_node_info(nodenames, vg_name, hv_name)
+      else:
+        node_data = self.context.livedata.GetNodeInfo(nodenames, vg_name,
+                                                      hv_name,
+                                                      self.op.max_age)
       for name in nodenames:
         nodeinfo = node_data[name]
         if not nodeinfo.fail_msg and nodeinfo.payload:
@@ -3395,11 +3420,70 @@ class LUQueryNodes(NoHooksLU):
 
     # end data gathering
 
+    return self._ComputeOutput(nodelist, self.op.output_fields, live_data,
+                               node_to_primary, node_to_secondary, master_node)
+
+  @classmethod
+  def IsStaticQuery(cls, output_fields):
+    """Whether all given fields are static (see L{QuerySnapshot}).
+
+    """
+    return not cls._FIELDS_STATIC.NonMatching(output_fields)
+
+  @classmethod
+  def QuerySnapshot(cls, snapshot, op):
+    """Computes static fields of nodes from a configuration snapshot.
+
+    This doesn't acquire any locks.
+
+    @type snapshot: L{config.ConfigSnapshot}
+    @param snapshot: the configuration snapshot
+    @type op: L{opcodes.OpQueryNodes}
+    @param op: the query opcode, only selecting static fields
+
+    """
+    _CheckOpParams(op, cls._OP_PARAMS)
+    _CheckOutputFields(static=cls._FIELDS_STATIC,
+                       dynamic=cls._FIELDS_DYNAMIC,
+                       selected=op.output_fields)
+    if cls._FIELDS_STATIC.NonMatching(op.output_fields):
+      raise errors.ProgrammerError("Dynamic fields can't be queried from a"
+                                   " configuration snapshot")
+
+    all_info = snapshot.GetAllNodesInfo()
+    if op.names:
+      nodenames = [_ExpandNodeName(snapshot, name) for name in op.names]
+    else:
+      nodenames = all_info.keys()
+
+    nodenames = utils.NiceSort(nodenames)
+
+    node_to_primary = dict([(name, set()) for name in nodenames])
+    node_to_secondary = dict([(name, set()) for name in nodenames])
+
+    for inst in snapshot.GetAllInstancesInfo().values():
+      if inst.primary_node in node_to_primary:
+        node_to_primary[inst.primary_node].add(inst.name)
+      for secnode in inst.secondary_nodes:
+        if secnode in node_to_secondary:
+          node_to_secondary[secnode].add(inst.name)
+
+    return cls._ComputeOutput([all_info[name] for name in nodenames],
+                              op.output_fields,
+                              dict.fromkeys(nodenames, {}), node_to_primary,
+                              node_to_secondary, snapshot.GetMasterNode())
+
+  @classmethod
+  def _ComputeOutput(cls, nodelist, output_fields, live_data, node_to_primary,
+                     node_to_secondary, master_node):
+    """Computes the query result from the gathered data.
+
+    """
     output = []
     for node in nodelist:
       node_output = []
-      for field in self.op.output_fields:
-        if field in self._SIMPLE_FIELDS:
+      for field in output_fields:
+        if field in cls._SIMPLE_FIELDS:
           val = getattr(node, field)
         elif field == "pinst_list":
           val = list(node_to_primary[node.name])
@@ -3417,7 +3501,7 @@ class LUQueryNodes(NoHooksLU):
           val = list(node.GetTags())
         elif field == "master":
           val = node.name == master_node
-        elif self._FIELDS_DYNAMIC.Matches(field):
+        elif cls._FIELDS_DYNAMIC.Matches(field):
           val = live_data[node.name].get(field, None)
         elif field == "role":
           if node.name == master_node:
@@ -4237,6 +4321,81 @@ class LUActivateInstanceDisks(NoHooksLU):
     return disks_info
 
 
+def _SplitMultiResult(result, count):
+  """Splits the result of an RPC call acting on several disks.
+
+  @type result: L{rpc.RpcResult}
+  @param result: the result of a C{call_blockdev_*_multi} call
+  @type count: int
+  @param count: the number of disks passed to the call
+  @rtype: list of tuples
+  @return: (error message or None, payload) for every disk; if the call
+      as a whole failed, its error is reported for all disks
+
+  """
+  if result.fail_msg:
+    return [(result.fail_msg, None)] * count
+
+  split = []
+  for (success, payload) in result.payload:
+    if success:
+      split.append((None, payload))
+    else:
+      split.append((payload, None))
+  return split
+
+
+def _GroupDisksByNode(instance, disks):
+  """Computes the node disks of some instance disks, grouped by node.
+
+  @type instance: L{objects.Instance}
+  @param instance: the instance owning the disks
+  @type disks: list of L{objects.Disk}
+  @param disks: the instance disks
+  @rtype: list of tuples
+  @return: (node, list of (instance disk, node disk)) for every node, in
+      the order the nodes are first returned by
+      L{objects.Disk.ComputeNodeTree}
+
+  """
+  result = []
+  by_node = {}
+  for inst_disk in disks:
+    for (node, node_disk) in inst_disk.ComputeNodeTree(instance.primary_node):
+      entries = by_node.get(node, None)
+      if entries is None:
+        entries = by_node[node] = []
+        result.append((node, entries))
+      entries.append((inst_disk, node_disk))
+  return result
+
+
+def _AssembleNodeDisks(lu, node, instance, entries, as_primary, ignore_size):
+  """Assembles several disks on a node in a single RPC call.
+
+  @type entries: list of tuples
+  @param entries: (instance disk, node disk) as returned by
+      L{_GroupDisksByNode}
+  @rtype: list of tuples
+  @return: (instance disk, error message or None, payload) for every entry
+
+  """
+  node_disks = []
+  for (_, node_disk) in entries:
+    if ignore_size:
+      node_disk = node_disk.Copy()
+      node_disk.UnsetSize()
+    lu.cfg.SetDiskID(node_disk, node)
+    node_disks.append(node_disk)
+
+  result = lu.rpc.call_blockdev_assemble_multi(node, node_disks,
+                                               instance.name, as_primary)
+
+  return [(inst_disk, msg, payload)
+          for ((inst_disk, _), (msg, payload)) in
+            zip(entries, _SplitMultiResult(result, len(entries)))]
+
+
 def _AssembleInstanceDisks(lu, instance, disks=None, ignore_secondaries=False,
                            ignore_size=False):
   """Prepare the block devices for an instance.
@@ -4263,8 +4422,8 @@ def _AssembleInstanceDisks(lu, instance, disks=None, ignore_secondaries=False,
   """
   device_info = []
   disks_ok = True
-  iname = instance.name
   disks = _ExpandCheckDisks(instance, disks)
+  by_node = _GroupDisksByNode(instance, disks)
 
   # With the two passes mechanism we try to reduce the window of
   # opportunity for the race condition of switching DRBD to primary
@@ -4275,15 +4434,12 @@ def _AssembleInstanceDisks(lu, instance, disks=None, ignore_secondaries=False,
   # into any other network-connected state (Connected, SyncTarget,
   # SyncSource, etc.)
 
+  # All disks of a node are assembled in one call per pass
+
   # 1st pass, assemble on all nodes in secondary mode
-  for inst_disk in disks:
-    for node, node_disk in inst_disk.ComputeNodeTree(instance.primary_node):
-      if ignore_size:
-        node_disk = node_disk.Copy()
-        node_disk.UnsetSize()
-      lu.cfg.SetDiskID(node_disk, node)
-      result = lu.rpc.call_blockdev_assemble(node, node_disk, iname, False)
-      msg = result.fail_msg
+  for (node, entries) in by_node:
+    for (inst_disk, msg, _) in _AssembleNodeDisks(lu, node, instance, entries,
+                                                  False, ignore_size):
       if msg:
         lu.proc.LogWarning("Could not prepare block device %s on node %s"
                            " (is_primary=False, pass=1): %s",
@@ -4294,27 +4450,24 @@ def _AssembleInstanceDisks(lu, instance, disks=None, ignore_secondaries=False,
   # FIXME: race condition on drbd migration to primary
 
   # 2nd pass, do only the primary node
-  for inst_disk in disks:
-    dev_path = None
-
-    for node, node_disk in inst_disk.ComputeNodeTree(instance.primary_node):
-      if node != instance.primary_node:
-        continue
-      if ignore_size:
-        node_disk = node_disk.Copy()
-        node_disk.UnsetSize()
-      lu.cfg.SetDiskID(node_disk, node)
-      result = lu.rpc.call_blockdev_assemble(node, node_disk, iname, True)
-      msg = result.fail_msg
+  dev_paths = {}
+  for (node, entries) in by_node:
+    if node != instance.primary_node:
+      continue
+    for (inst_disk, msg, payload) in _AssembleNodeDisks(lu, node, instance,
+                                                        entries, True,
+                                                        ignore_size):
       if msg:
         lu.proc.LogWarning("Could not prepare block device %s on node %s"
                            " (is_primary=True, pass=2): %s",
                            inst_disk.iv_name, node, msg)
         disks_ok = False
       else:
-        dev_path = result.payload
+        dev_paths[inst_disk.iv_name] = payload
 
-    device_info.append((instance.primary_node, inst_disk.iv_name, dev_path))
+  for inst_disk in disks:
+    device_info.append((instance.primary_node, inst_disk.iv_name,
+                        dev_paths.get(inst_disk.iv_name, None)))
 
   # leave the disks configured for the primary node
   # this is a workaround that would be fixed better by
@@ -4417,11 +4570,13 @@ def _ShutdownInstanceDisks(lu, instance, disks=None, ignore_primary=False):
   all_result = True
   disks = _ExpandCheckDisks(instance, disks)
 
-  for disk in disks:
-    for node, top_disk in disk.ComputeNodeTree(instance.primary_node):
+  for (node, entries) in _GroupDisksByNode(instance, disks):
+    top_disks = [top_disk for (_, top_disk) in entries]
+    for top_disk in top_disks:
       lu.cfg.SetDiskID(top_disk, node)
-      result = lu.rpc.call_blockdev_shutdown(node, top_disk)
-      msg = result.fail_msg
+    result = lu.rpc.call_blockdev_shutdown_multi(node, top_disks)
+    for ((disk, _), (msg, _)) in zip(entries,
+                                     _SplitMultiResult(result, len(entries))):
       if msg:
         lu.LogWarning("Could not shutdown block device %s on node %s: %s",
                       disk.iv_name, node, msg)
@@ -5071,6 +5226,7 @@ class LUQueryInstances(NoHooksLU):
     ("output_fields", _NoDefault, _TListOf(_TNonEmptyString)),
     ("names", _EmptyList, _TListOf(_TNonEmptyString)),
     ("use_locking", False, _TBool),
+    _PMaxAge,
     ]
   REQ_BGL = False
   _SIMPLE_FIELDS = ["name", "os", "network_port", "hypervisor",
@@ -5130,8 +5286,6 @@ class LUQueryInstances(NoHooksLU):
     """Computes the list of nodes and their attributes.
 
     """
-    # pylint: disable-msg=R0912
-    # way too many branches here
     all_info = self.cfg.GetAllInstancesInfo()
     if self.wanted == locking.ALL_SET:
       # caller didn't specify instance names, so ordering is not important
@@ -5163,7 +5317,16 @@ class LUQueryInstances(NoHooksLU):
     off_nodes = []
     if self.do_node_query:
       live_data = {}
-      node_data = self.rpc.call_all_instances_info(nodes, hv_list)
+      if self.op.max_age is None:
+        node_data = self.rpc.call_all_instances_info(nodes, hv_list)
+      else:
+        # Cached data is shared between queries, hence all enabled
+        # hypervisors are queried
+        cluster = self.cfg.GetClusterInfo()
+        node_data = \
+          self.context.livedata.GetAllInstancesInfo(nodes,
+                                                    cluster.enabled_hypervisors,
+                                                    self.op.max_age)
       for name in nodes:
         result = node_data[name]
         if result.offline:
@@ -5180,18 +5343,69 @@ class LUQueryInstances(NoHooksLU):
 
     # end data gathering
 
+    return self._ComputeOutput(self.cfg.GetClusterInfo(), instance_list,
+                               self.op.output_fields, live_data, bad_nodes,
+                               off_nodes)
+
+  @classmethod
+  def IsStaticQuery(cls, output_fields):
+    """Whether all given fields are static (see L{QuerySnapshot}).
+
+    """
+    return not cls._FIELDS_STATIC.NonMatching(output_fields)
+
+  @classmethod
+  def QuerySnapshot(cls, snapshot, op):
+    """Computes static fields of instances from a configuration snapshot.
+
+    This doesn't acquire any locks.
+
+    @type snapshot: L{config.ConfigSnapshot}
+    @param snapshot: the configuration snapshot
+    @type op: L{opcodes.OpQueryInstances}
+    @param op: the query opcode, only selecting static fields
+
+    """
+    _CheckOpParams(op, cls._OP_PARAMS)
+    _CheckOutputFields(static=cls._FIELDS_STATIC,
+                       dynamic=cls._FIELDS_DYNAMIC,
+                       selected=op.output_fields)
+    if cls._FIELDS_STATIC.NonMatching(op.output_fields):
+      raise errors.ProgrammerError("Dynamic fields can't be queried from a"
+                                   " configuration snapshot")
+
+    all_info = snapshot.GetAllInstancesInfo()
+    if op.names:
+      # caller did specify names, so we must keep the ordering
+      instance_names = [_ExpandInstanceName(snapshot, name)
+                        for name in op.names]
+    else:
+      instance_names = utils.NiceSort(all_info.keys())
+
+    return cls._ComputeOutput(snapshot.GetClusterInfo(),
+                              [all_info[name] for name in instance_names],
+                              op.output_fields,
+                              dict.fromkeys(instance_names, {}), [], [])
+
+  @classmethod
+  def _ComputeOutput(cls, cluster, instance_list, output_fields, live_data,
+                     bad_nodes, off_nodes):
+    """Computes the query result from the gathered data.
+
+    """
+    # pylint: disable-msg=R0912
+    # way too many branches here
     HVPREFIX = "hv/"
     BEPREFIX = "be/"
     output = []
-    cluster = self.cfg.GetClusterInfo()
     for instance in instance_list:
       iout = []
       i_hv = cluster.FillHV(instance, skip_globals=True)
       i_be = cluster.FillBE(instance)
       i_nicp = [cluster.SimpleFillNIC(nic.nicparams) for nic in instance.nics]
-      for field in self.op.output_fields:
-        st_match = self._FIELDS_STATIC.Matches(field)
-        if field in self._SIMPLE_FIELDS:
+      for field in output_fields:
+        st_match = cls._FIELDS_STATIC.Matches(field)
+        if field in cls._SIMPLE_FIELDS:
           val = getattr(instance, field)
         elif field == "pnode":
           val = instance.primary_node
@@ -6180,19 +6394,76 @@ def _CreateBlockDev(lu, node, instance, device, force_create,
       whether we run on primary or not, and it affects both
       the child assembly and the device own Open() execution
 
+  """
+  _CreateBlockDevs(lu, node, instance,
+                   _GetBlockDevsToCreate(device, force_create),
+                   info, force_open)
+
+
+def _GetBlockDevsToCreate(device, force_create):
+  """Computes which devices of a tree have to be created on a node.
+
+  @type device: L{objects.Disk}
+  @param device: the device to create
+  @type force_create: boolean
+  @param force_create: whether to force creation of this device
+  @rtype: list of L{objects.Disk}
+  @return: the devices to create, children before their parents
+  @see: L{_CreateBlockDev}
+
   """
   if device.CreateOnSecondary():
     force_create = True
 
+  result = []
+
   if device.children:
     for child in device.children:
-      _CreateBlockDev(lu, node, instance, child, force_create,
-                      info, force_open)
+      result.extend(_GetBlockDevsToCreate(child, force_create))
+
+  if force_create:
+    result.append(device)
+
+  return result
+
+
+def _CreateBlockDevs(lu, node, instance, devices, info, force_open):
+  """Create several block devices on a given node in a single RPC call.
 
-  if not force_create:
+  The devices are created in the given order, so children must be listed
+  before their parents. Creation stops at the first failure.
+
+  @param lu: the lu on whose behalf we execute
+  @param node: the node on which to create the devices
+  @type instance: L{objects.Instance}
+  @param instance: the instance which owns the devices
+  @type devices: list of L{objects.Disk}
+  @param devices: the devices to create
+  @param info: the extra 'metadata' we should attach to the devices
+  @type force_open: boolean
+  @param force_open: see L{_CreateSingleBlockDev}
+
+  """
+  if not devices:
     return
 
-  _CreateSingleBlockDev(lu, node, instance, device, info, force_open)
+  for device in devices:
+    lu.cfg.SetDiskID(device, node)
+
+  result = lu.rpc.call_blockdev_create_multi(node,
+                                             [(device, device.size)
+                                              for device in devices],
+                                             instance.name, force_open, info)
+
+  for (device, (msg, payload)) in zip(devices,
+                                      _SplitMultiResult(result,
+                                                        len(devices))):
+    if msg:
+      raise errors.OpExecError("Can't create block device %s on"
+                               " node %s for instance %s: %s" %
+                               (device, node, instance.name, msg))
+    if device.physical_id is None:
+      device.physical_id = payload
 
 
 def _CreateSingleBlockDev(lu, node, instance, device, info, force_open):
@@ -6368,15 +6639,22 @@ def _CreateDisks(lu, instance, to_skip=None, target_node=None):
 
   # Note: this needs to be kept in sync with adding of disks in
   # LUSetInstanceParams
+  disks = []
   for idx, device in enumerate(instance.disks):
     if to_skip and idx in to_skip:
       continue
     logging.info("Creating volume %s for instance %s",
                  device.iv_name, instance.name)
-    #HARDCODE
-    for node in all_nodes:
-      f_create = node == pnode
-      _CreateBlockDev(lu, node, instance, device, f_create, info, f_create)
+    disks.append(device)
+
+  # All devices of a node are created in one call
+  #HARDCODE
+  for node in all_nodes:
+    f_create = node == pnode
+    devices = []
+    for device in disks:
+      devices.extend(_GetBlockDevsToCreate(device, f_create))
+    _CreateBlockDevs(lu, node, instance, devices, info, f_create)
 
 
 def _RemoveDisks(lu, instance, target_node=None):
@@ -7828,18 +8106,21 @@ class TLReplaceDisks(Tasklet):
 
   def _CheckDisksExistence(self, nodes):
     # Check disk existence
-    for idx, dev in enumerate(self.instance.disks):
-      if idx not in self.disks:
-        continue
+    disks = [(idx, dev) for (idx, dev) in enumerate(self.instance.disks)
+             if idx in self.disks]
 
-      for node in nodes:
+    for node in nodes:
+      for (idx, dev) in disks:
         self.lu.LogInfo("Checking disk/%d on %s" % (idx, node))
         self.cfg.SetDiskID(dev, node)
 
-        result = self.rpc.call_blockdev_find(node, dev)
+      result = self.rpc.call_blockdev_find_multi(node,
+                                                 [dev for (_, dev) in disks])
 
-        msg = result.fail_msg
-        if msg or not result.payload:
+      for ((idx, _), (msg, status)) in zip(disks,
+                                           _SplitMultiResult(result,
+                                                             len(disks))):
+        if msg or not status:
           if not msg:
             msg = "disk not found"
           raise errors.OpExecError("Can't find disk/%d on node %s: %s" %
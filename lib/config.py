@@ -38,6 +38,7 @@ import os
 import random
 import logging
 import time
+import threading
 
 from ganeti import errors
 from ganeti import locking
@@ -49,6 +50,7 @@ from ganeti import serializer
 from ganeti import uidpool
 from ganeti import netutils
 from ganeti import runtime
+from ganeti import compat
 
 
 _config_lock = locking.SharedLock("ConfigWriter")
@@ -56,6 +58,42 @@ _config_lock = locking.SharedLock("ConfigWriter")
 # job id used for resource management at config upgrade time
 _UPGRADE_CONFIG_JID = "jid-cfg-upgrade"
 
+# configuration object containers which are sent per-object in deltas
+_DELTA_CONTAINERS = frozenset(["nodes", "instances", "nodegroups"])
+
+# object classes of the containers in configuration snapshots
+_SNAPSHOT_CLASSES = {
+  "nodes": objects.Node,
+  "instances": objects.Instance,
+  "nodegroups": objects.NodeGroup,
+  }
+
+# resource types kept in the instance resource index
+_INDEX_RESOURCES = frozenset(["mac", "lv", "secret", "uuid", "drbd"])
+
+# interval (in seconds) between full configuration verifications on
+# write; in between, only the modified objects are verified
+_FULL_VERIFY_INTERVAL = 300
+
+
+def _ConfigWriteSync(fn):
+  """Decorator for functions modifying the configuration.
+
+  The function is called with the configuration lock held in exclusive
+  mode. If group commit is enabled, L{ConfigWriter._WriteConfig} only
+  schedules the write, and the caller waits (after releasing the lock)
+  until the modification has been written and distributed.
+
+  """
+  locked_fn = locking.ssynchronized(_config_lock)(fn)
+
+  def wrapper(self, *args, **kwargs):
+    try:
+      return locked_fn(self, *args, **kwargs)
+    finally:
+      self._WaitForPendingWrite() # pylint: disable-msg=W0212
+  return wrapper
+
 
 def _ValidateConfig(data):
   """Verifies that a configuration objects looks valid.
@@ -114,12 +152,12 @@ class TemporaryReservationManager:
     """
     assert callable(generate_one_fn)
 
-    all_elems = self.GetReserved()
-    all_elems.update(existing)
+    reserved = self.GetReserved()
     retries = 64
     while retries > 0:
       new_resource = generate_one_fn()
-      if new_resource is not None and new_resource not in all_elems:
+      if (new_resource is not None and new_resource not in reserved and
+          new_resource not in existing):
         break
     else:
       raise errors.ConfigurationError("Not able generate new resource"
@@ -128,14 +166,425 @@ class TemporaryReservationManager:
     return new_resource
 
 
+class _ContainerUnion(object):
+  """Read-only union of several containers.
+
+  Only membership tests are supported; this avoids copying large
+  containers into a new set just to check for an item.
+
+  """
+  def __init__(self, *containers):
+    self._containers = containers
+
+  def __contains__(self, item):
+    for container in self._containers:
+      if item in container:
+        return True
+    return False
+
+
+def _ComputeInstanceResources(instance):
+  """Computes the resources used by an instance.
+
+  @type instance: L{objects.Instance}
+  @rtype: dict
+  @return: dictionary of resource type (one of L{_INDEX_RESOURCES}) to
+      the list of resources of that type used by the instance; DRBD
+      minors are given as (node, minor) tuples
+
+  """
+  secrets = []
+  minors = []
+
+  def _Helper(disk):
+    if disk.dev_type == constants.LD_DRBD8:
+      if len(disk.logical_id) > 5:
+        secrets.append(disk.logical_id[5])
+      if len(disk.logical_id) >= 5:
+        (node_a, node_b, _, minor_a, minor_b) = disk.logical_id[:5]
+        minors.append((node_a, minor_a))
+        minors.append((node_b, minor_b))
+    if disk.children:
+      for child in disk.children:
+        _Helper(child)
+
+  for disk in instance.disks:
+    _Helper(disk)
+
+  lvs = []
+  for lv_list in instance.MapLVsByNode().values():
+    lvs.extend(lv_list)
+
+  uuids = []
+  if instance.uuid:
+    uuids.append(instance.uuid)
+
+  return {
+    "mac": [nic.mac for nic in instance.nics],
+    "lv": lvs,
+    "secret": secrets,
+    "uuid": uuids,
+    "drbd": minors,
+    }
+
+
+class _InstanceResourceIndex:
+  """Index of the resources used by instances.
+
+  For every resource (MAC address, LV name, DRBD secret, UUID and DRBD
+  minor) the index keeps the list of instances using it, so that
+  uniqueness checks and allocations don't need to walk all instances
+  and their disks. The index must be updated, via L{Update}, whenever
+  an instance is added, removed, renamed or modified.
+
+  @ivar used: dictionary of resource type to dictionary of resource to
+      list of instance names; for DRBD minors, the keys are (node,
+      minor) tuples
+  @ivar drbd_minors: dictionary of node name to dictionary of minor to
+      list of instance names
+
+  """
+  def __init__(self):
+    self.Clear()
+
+  def Clear(self):
+    """Removes all instances from the index.
+
+    """
+    self._resources = {}
+    self.used = dict((kind, {}) for kind in _INDEX_RESOURCES)
+    self.drbd_minors = {}
+
+  def Rebuild(self, instances):
+    """Rebuilds the index.
+
+    @type instances: dict
+    @param instances: dictionary of instance name to L{objects.Instance}
+
+    """
+    self.Clear()
+    for (name, instance) in instances.items():
+      self.Update(name, instance)
+
+  def Update(self, name, instance):
+    """Updates the resources used by an instance.
+
+    @type name: string
+    @param name: the instance name
+    @type instance: L{objects.Instance} or None
+    @param instance: the instance object, or None if the instance has
+        been removed
+
+    """
+    old = self._resources.pop(name, None)
+    if old is not None:
+      for (kind, values) in old.items():
+        for value in values:
+          self._Remove(kind, value, name)
+
+    if instance is not None:
+      new = _ComputeInstanceResources(instance)
+      for (kind, values) in new.items():
+        for value in values:
+          self._Add(kind, value, name)
+      self._resources[name] = new
+
+  def GetResources(self, name):
+    """Returns the indexed resources of an instance.
+
+    @rtype: dict
+    @return: see L{_ComputeInstanceResources}
+
+    """
+    return self._resources[name]
+
+  def _Add(self, kind, value, name):
+    self.used[kind].setdefault(value, []).append(name)
+    if kind == "drbd":
+      (node, minor) = value
+      self.drbd_minors.setdefault(node, {}).setdefault(minor, []).append(name)
+
+  def _Remove(self, kind, value, name):
+    owners = self.used[kind][value]
+    owners.remove(name)
+    if not owners:
+      del self.used[kind][value]
+    if kind == "drbd":
+      (node, minor) = value
+      node_minors = self.drbd_minors[node]
+      owners = node_minors[minor]
+      owners.remove(name)
+      if not owners:
+        del node_minors[minor]
+      if not node_minors:
+        del self.drbd_minors[node]
+
+
+class _ConfigDirtyTracker:
+  """Keeps track of configuration objects modified since the last write.
+
+  The information is used to build configuration deltas; whenever the
+  exact set of modified objects is not known (e.g. after reading the
+  configuration from disk), the tracker is marked as I{full} and no
+  delta can be computed.
+
+  @ivar full: whether the whole configuration must be considered modified
+  @ivar cluster: whether the cluster object was modified
+  @ivar objects: dictionary of container name (one of
+      L{_DELTA_CONTAINERS}) to the set of modified object names; names
+      which no longer exist in the container denote removed objects
+
+  """
+  def __init__(self):
+    self.Reset(full=True)
+
+  def Reset(self, full=False):
+    """Forget about all modifications.
+
+    """
+    self.full = full
+    self.cluster = False
+    self.objects = dict((key, set()) for key in _DELTA_CONTAINERS)
+
+  def MarkAll(self):
+    """Marks the whole configuration as modified.
+
+    """
+    self.full = True
+
+  def MarkCluster(self):
+    """Marks the cluster object as modified.
+
+    """
+    self.cluster = True
+
+  def Mark(self, container, name):
+    """Marks an object as modified (or added, or removed).
+
+    @type container: string
+    @param container: one of L{_DELTA_CONTAINERS}
+    @type name: string
+    @param name: the object's key in the container
+
+    """
+    self.objects[container].add(name)
+
+
+def _BuildConfigDelta(data, txt, base_serial, dirty):
+  """Computes a configuration delta.
+
+  @type data: dict
+  @param data: the serialized form (as returned by
+      L{objects.ConfigData.ToDict}) of the new configuration
+  @type txt: string
+  @param txt: the new configuration file contents
+  @type base_serial: int
+  @param base_serial: the serial number of the configuration the delta
+      applies to
+  @type dirty: L{_ConfigDirtyTracker}
+  @param dirty: the tracker holding the modified objects
+  @rtype: dict or None
+  @return: the delta, or None if it can't be computed
+
+  """
+  if dirty.full:
+    return None
+
+  # Top-level values (serial number, timestamps, etc.) are always sent
+  top = dict((key, value) for (key, value) in data.items()
+             if key != "cluster" and key not in _DELTA_CONTAINERS)
+  if dirty.cluster:
+    top["cluster"] = data["cluster"]
+
+  update = {}
+  remove = {}
+  for key in _DELTA_CONTAINERS:
+    container = data[key]
+    update[key] = dict((name, container[name])
+                       for name in dirty.objects[key] if name in container)
+    remove[key] = [name for name in dirty.objects[key]
+                   if name not in container]
+
+  return {
+    "base_serial": base_serial,
+    "hash": compat.sha1_hash(txt).hexdigest(),
+    "set": top,
+    "update": update,
+    "remove": remove,
+    }
+
+
+def _CopyConfigData(data):
+  """Returns a deep copy of serialized configuration data.
+
+  """
+  return serializer.LoadJson(serializer.DumpJson(data, indent=False))
+
+
+class ConfigSnapshot(object):
+  """Read-only copy of the configuration.
+
+  Snapshots are never modified after creation. L{ConfigWriter} creates a new
+  one after every write, sharing all objects which weren't modified with the
+  previous snapshot. They can therefore be used without holding the
+  configuration lock, e.g. for queries. The objects returned must not be
+  modified.
+
+  Node groups in snapshots don't have their list of members.
+
+  @ivar serial_no: the configuration serial number
+
+  """
+  def __init__(self, serial_no, cluster, containers):
+    """Initializes this class.
+
+    @type serial_no: int
+    @param serial_no: the configuration serial number
+    @type cluster: L{objects.Cluster}
+    @param cluster: the cluster object
+    @type containers: dict
+    @param containers: dictionary of container name (one of
+        L{_DELTA_CONTAINERS}) to a dictionary of object name to object
+
+    """
+    self.serial_no = serial_no
+    self._cluster = cluster
+    self._containers = containers
+
+  @classmethod
+  def FromDict(cls, data):
+    """Creates a snapshot from serialized configuration data.
+
+    @type data: dict
+    @param data: the configuration, as returned by
+        L{objects.ConfigData.ToDict}
+
+    """
+    data = _CopyConfigData(data)
+
+    containers = {}
+    for key in _DELTA_CONTAINERS:
+      obj_class = _SNAPSHOT_CLASSES[key]
+      containers[key] = dict((name, obj_class.FromDict(value))
+                             for (name, value) in data[key].items())
+
+    return cls(data["serial_no"], objects.Cluster.FromDict(data["cluster"]),
+               containers)
+
+  def Update(self, data, dirty):
+    """Creates a new snapshot with modifications applied.
+
+    Only the modified objects are copied from the configuration data.
+
+    @type data: dict
+    @param data: the configuration, as returned by
+        L{objects.ConfigData.ToDict}
+    @type dirty: L{_ConfigDirtyTracker}
+    @param dirty: the tracker holding the modified objects
+    @rtype: L{ConfigSnapshot}
+
+    """
+    if dirty.full:
+      return self.FromDict(data)
+
+    if dirty.cluster:
+      cluster = objects.Cluster.FromDict(_CopyConfigData(data["cluster"]))
+    else:
+      cluster = self._cluster
+
+    containers = {}
+    for key in _DELTA_CONTAINERS:
+      names = dirty.objects[key]
+      if not names:
+        containers[key] = self._containers[key]
+        continue
+
+      obj_class = _SNAPSHOT_CLASSES[key]
+      container = self._containers[key].copy()
+      for name in names:
+        if name in data[key]:
+          container[name] = \
+            obj_class.FromDict(_CopyConfigData(data[key][name]))
+        else:
+          container.pop(name, None)
+      containers[key] = container
+
+    return self.__class__(data["serial_no"], cluster, containers)
+
+  def GetClusterInfo(self):
+    """Returns the cluster object.
+
+    @rtype: L{objects.Cluster}
+
+    """
+    return self._cluster
+
+  def GetMasterNode(self):
+    """Returns the name of the master node.
+
+    """
+    return self._cluster.master_node
+
+  def GetInstanceList(self):
+    """Returns the names of all instances.
+
+    """
+    return self._containers["instances"].keys()
+
+  def GetAllInstancesInfo(self):
+    """Returns a dictionary of instance name to instance object.
+
+    """
+    return self._containers["instances"].copy()
+
+  def ExpandInstanceName(self, short_name):
+    """Attempt to expand an incomplete instance name.
+
+    """
+    return utils.MatchNameComponent(short_name,
+                                    self._containers["instances"].keys(),
+                                    case_sensitive=False)
+
+  def GetNodeList(self):
+    """Returns the names of all nodes.
+
+    """
+    return self._containers["nodes"].keys()
+
+  def GetAllNodesInfo(self):
+    """Returns a dictionary of node name to node object.
+
+    """
+    return self._containers["nodes"].copy()
+
+  def ExpandNodeName(self, short_name):
+    """Attempt to expand an incomplete node name.
+
+    """
+    return utils.MatchNameComponent(short_name,
+                                    self._containers["nodes"].keys(),
+                                    case_sensitive=False)
+
+
 class ConfigWriter:
   """The interface to the cluster configuration.
 
   @ivar _temporary_lvs: reservation manager for temporary LVs
   @ivar _all_rms: a list of all temporary reservation managers
+  @ivar _write_gen: number of the last scheduled write (group commit)
+  @ivar _flushed_gen: number of the last completed write (group commit)
 
   """
-  def __init__(self, cfg_file=None, offline=False, _getents=runtime.GetEnts):
+  def __init__(self, cfg_file=None, offline=False, _getents=runtime.GetEnts,
+               group_commit_delay=None):
+    """Initializes this class.
+
+    @type group_commit_delay: number or None
+    @param group_commit_delay: if not None, enables group commit;
+        modifications made within this many seconds of each other are
+        written and distributed together
+
+    """
     self.write_count = 0
     self._lock = _config_lock
     self._config_data = None
@@ -152,13 +601,27 @@ class ConfigWriter:
     self._temporary_lvs = TemporaryReservationManager()
     self._all_rms = [self._temporary_ids, self._temporary_macs,
                      self._temporary_secrets, self._temporary_lvs]
+    self._index = _InstanceResourceIndex()
     # Note: in order to prevent errors when resolving our name in
     # _DistributeConfig, we compute it here once and reuse it; it's
     # better to raise an error before starting to modify the config
     # file than after it was modified
     self._my_hostname = netutils.Hostname.GetSysName()
     self._last_cluster_serial = -1
+    self._dirty = _ConfigDirtyTracker()
+    self._snapshot = None
+    self._last_full_verify = 0
+    self._group_commit_delay = None
+    self._write_gen = 0
+    self._flushed_gen = 0
+    self._flushing = False
+    self._flush_cond = threading.Condition(threading.Lock())
+    self._pending_feedback = []
+    self._thread_state = threading.local()
     self._OpenConfig()
+    # Group commit is only enabled after the initial configuration upgrade,
+    # which writes the configuration without holding the lock
+    self._group_commit_delay = group_commit_delay
 
   # this method needs to be static, so that we can call it on the class
   @staticmethod
@@ -229,33 +692,34 @@ class ConfigWriter:
                                             ec_id)
 
   def _AllLVs(self):
-    """Compute the list of all LVs.
+    """Return all LVs used by instances.
+
+    @rtype: dict
+    @return: the LV index, with the LV names as keys
 
     """
-    lvnames = set()
-    for instance in self._config_data.instances.values():
-      node_data = instance.MapLVsByNode()
-      for lv_list in node_data.values():
-        lvnames.update(lv_list)
-    return lvnames
+    return self._index.used["lv"]
 
   def _AllIDs(self, include_temporary):
     """Compute the list of all UUIDs and names we have.
 
     @type include_temporary: boolean
     @param include_temporary: whether to include the _temporary_ids set
-    @rtype: set
-    @return: a set of IDs
+    @rtype: L{_ContainerUnion}
+    @return: a container of IDs, only supporting membership tests
 
     """
-    existing = set()
+    data = self._config_data
+    # instance UUIDs are indexed, the others are few
+    other_uuids = set(obj.uuid for obj in (data.nodes.values() +
+                                           data.nodegroups.values() +
+                                           [data.cluster])
+                      if obj.uuid)
+    containers = [self._AllLVs(), data.instances, data.nodes,
+                  self._index.used["uuid"], other_uuids]
     if include_temporary:
-      existing.update(self._temporary_ids.GetReserved())
-    existing.update(self._AllLVs())
-    existing.update(self._config_data.instances.keys())
-    existing.update(self._config_data.nodes.keys())
-    existing.update([i.uuid for i in self._AllUUIDObjects() if i.uuid])
-    return existing
+      containers.append(self._temporary_ids.GetReserved())
+    return _ContainerUnion(*containers)
 
   def _GenerateUniqueID(self, ec_id):
     """Generate an unique UUID.
@@ -285,38 +749,20 @@ class ConfigWriter:
   def _AllMACs(self):
     """Return all MACs present in the config.
 
-    @rtype: list
-    @return: the list of all MACs
+    @rtype: dict
+    @return: the MAC index, with the MACs as keys
 
     """
-    result = []
-    for instance in self._config_data.instances.values():
-      for nic in instance.nics:
-        result.append(nic.mac)
-
-    return result
+    return self._index.used["mac"]
 
   def _AllDRBDSecrets(self):
     """Return all DRBD secrets present in the config.
 
-    @rtype: list
-    @return: the list of all DRBD secrets
+    @rtype: dict
+    @return: the DRBD secret index, with the secrets as keys
 
     """
-    def helper(disk, result):
-      """Recursively gather secrets from this disk."""
-      if disk.dev_type == constants.DT_DRBD8:
-        result.append(disk.logical_id[5])
-      if disk.children:
-        for child in disk.children:
-          helper(child, result)
-
-    result = []
-    for instance in self._config_data.instances.values():
-      for disk in instance.disks:
-        helper(disk, result)
-
-    return result
+    return self._index.used["secret"]
 
   def _CheckDiskIDs(self, disk, l_ids, p_ids):
     """Compute duplicate disk IDs
@@ -357,48 +803,25 @@ class ConfigWriter:
 
     """
     result = []
-    seen_macs = []
+    seen_macs = set()
     ports = {}
     data = self._config_data
     seen_lids = []
     seen_pids = []
 
     # global cluster checks
-    if not data.cluster.enabled_hypervisors:
-      result.append("enabled hypervisors list doesn't have any entries")
-    invalid_hvs = set(data.cluster.enabled_hypervisors) - constants.HYPER_TYPES
-    if invalid_hvs:
-      result.append("enabled hypervisors contains invalid entries: %s" %
-                    invalid_hvs)
-    missing_hvp = (set(data.cluster.enabled_hypervisors) -
-                   set(data.cluster.hvparams.keys()))
-    if missing_hvp:
-      result.append("hypervisor parameters missing for the enabled"
-                    " hypervisor(s) %s" % utils.CommaJoin(missing_hvp))
-
-    if data.cluster.master_node not in data.nodes:
-      result.append("cluster has invalid primary node '%s'" %
-                    data.cluster.master_node)
+    result.extend(self._UnlockedVerifyGlobals())
 
     # per-instance checks
     for instance_name in data.instances:
       instance = data.instances[instance_name]
-      if instance.name != instance_name:
-        result.append("instance '%s' is indexed by wrong name '%s'" %
-                      (instance.name, instance_name))
-      if instance.primary_node not in data.nodes:
-        result.append("instance '%s' has invalid primary node '%s'" %
-                      (instance_name, instance.primary_node))
-      for snode in instance.secondary_nodes:
-        if snode not in data.nodes:
-          result.append("instance '%s' has invalid secondary node '%s'" %
-                        (instance_name, snode))
+      result.extend(self._UnlockedVerifyInstance(instance_name, instance))
       for idx, nic in enumerate(instance.nics):
         if nic.mac in seen_macs:
           result.append("instance '%s' has NIC %d mac %s duplicate" %
                         (instance_name, idx, nic.mac))
         else:
-          seen_macs.append(nic.mac)
+          seen_macs.add(nic.mac)
 
       # gather the drbd ports for duplicate checks
       for dsk in instance.disks:
@@ -415,9 +838,7 @@ class ConfigWriter:
         ports[net_port].append((instance.name, "network port"))
 
       # instance disk verify
-      for idx, disk in enumerate(instance.disks):
-        result.extend(["instance '%s' disk %d error: %s" %
-                       (instance.name, idx, msg) for msg in disk.Verify()])
+      for disk in instance.disks:
         result.extend(self._CheckDiskIDs(disk, seen_lids, seen_pids))
 
     # cluster-wide pool of free ports
@@ -441,37 +862,12 @@ class ConfigWriter:
         result.append("Highest used port mismatch, saved %s, computed %s" %
                       (data.cluster.highest_used_port, keys[-1]))
 
-    if not data.nodes[data.cluster.master_node].master_candidate:
-      result.append("Master node is not a master candidate")
-
-    # master candidate checks
-    mc_now, mc_max, _ = self._UnlockedGetMasterCandidateStats()
-    if mc_now < mc_max:
-      result.append("Not enough master candidates: actual %d, target %d" %
-                    (mc_now, mc_max))
-
     # node checks
     for node_name, node in data.nodes.items():
-      if node.name != node_name:
-        result.append("Node '%s' is indexed by wrong name '%s'" %
-                      (node.name, node_name))
-      if [node.master_candidate, node.drained, node.offline].count(True) > 1:
-        result.append("Node %s state is invalid: master_candidate=%s,"
-                      " drain=%s, offline=%s" %
-                      (node.name, node.master_candidate, node.drain,
-                       node.offline))
+      result.extend(self._UnlockedVerifyNode(node_name, node))
 
     # nodegroups checks
-    nodegroups_names = set()
-    for nodegroup_uuid in data.nodegroups:
-      nodegroup = data.nodegroups[nodegroup_uuid]
-      if nodegroup.uuid != nodegroup_uuid:
-        result.append("nodegroup '%s' (uuid: '%s') indexed by wrong uuid '%s'"
-                      % (nodegroup.name, nodegroup.uuid, nodegroup_uuid))
-      if nodegroup.name in nodegroups_names:
-        result.append("duplicate nodegroup name '%s'" % nodegroup.name)
-      else:
-        nodegroups_names.add(nodegroup.name)
+    result.extend(self._UnlockedVerifyNodeGroups())
 
     # drbd minors check
     _, duplicates = self._UnlockedComputeDRBDMap()
@@ -519,6 +915,171 @@ class ConfigWriter:
 
     return result
 
+  def _UnlockedVerifyGlobals(self):
+    """Verifies the cluster-wide settings.
+
+    @rtype: list
+    @return: a list of error messages
+
+    """
+    result = []
+    data = self._config_data
+
+    if not data.cluster.enabled_hypervisors:
+      result.append("enabled hypervisors list doesn't have any entries")
+    invalid_hvs = set(data.cluster.enabled_hypervisors) - constants.HYPER_TYPES
+    if invalid_hvs:
+      result.append("enabled hypervisors contains invalid entries: %s" %
+                    invalid_hvs)
+    missing_hvp = (set(data.cluster.enabled_hypervisors) -
+                   set(data.cluster.hvparams.keys()))
+    if missing_hvp:
+      result.append("hypervisor parameters missing for the enabled"
+                    " hypervisor(s) %s" % utils.CommaJoin(missing_hvp))
+
+    if data.cluster.master_node not in data.nodes:
+      result.append("cluster has invalid primary node '%s'" %
+                    data.cluster.master_node)
+    elif not data.nodes[data.cluster.master_node].master_candidate:
+      result.append("Master node is not a master candidate")
+
+    # master candidate checks
+    mc_now, mc_max, _ = self._UnlockedGetMasterCandidateStats()
+    if mc_now < mc_max:
+      result.append("Not enough master candidates: actual %d, target %d" %
+                    (mc_now, mc_max))
+
+    return result
+
+  def _UnlockedVerifyInstance(self, instance_name, instance):
+    """Verifies a single instance.
+
+    Only the checks not involving other instances are done.
+
+    @rtype: list
+    @return: a list of error messages
+
+    """
+    result = []
+    nodes = self._config_data.nodes
+
+    if instance.name != instance_name:
+      result.append("instance '%s' is indexed by wrong name '%s'" %
+                    (instance.name, instance_name))
+    if instance.primary_node not in nodes:
+      result.append("instance '%s' has invalid primary node '%s'" %
+                    (instance_name, instance.primary_node))
+    for snode in instance.secondary_nodes:
+      if snode not in nodes:
+        result.append("instance '%s' has invalid secondary node '%s'" %
+                      (instance_name, snode))
+
+    for idx, disk in enumerate(instance.disks):
+      result.extend(["instance '%s' disk %d error: %s" %
+                     (instance.name, idx, msg) for msg in disk.Verify()])
+
+    return result
+
+  @staticmethod
+  def _UnlockedVerifyNode(node_name, node):
+    """Verifies a single node.
+
+    @rtype: list
+    @return: a list of error messages
+
+    """
+    result = []
+    if node.name != node_name:
+      result.append("Node '%s' is indexed by wrong name '%s'" %
+                    (node.name, node_name))
+    if [node.master_candidate, node.drained, node.offline].count(True) > 1:
+      result.append("Node %s state is invalid: master_candidate=%s,"
+                    " drain=%s, offline=%s" %
+                    (node.name, node.master_candidate, node.drain,
+                     node.offline))
+    return result
+
+  def _UnlockedVerifyNodeGroups(self):
+    """Verifies the node groups.
+
+    @rtype: list
+    @return: a list of error messages
+
+    """
+    result = []
+    nodegroups_names = set()
+    for nodegroup_uuid, nodegroup in self._config_data.nodegroups.items():
+      if nodegroup.uuid != nodegroup_uuid:
+        result.append("nodegroup '%s' (uuid: '%s') indexed by wrong uuid '%s'"
+                      % (nodegroup.name, nodegroup.uuid, nodegroup_uuid))
+      if nodegroup.name in nodegroups_names:
+        result.append("duplicate nodegroup name '%s'" % nodegroup.name)
+      else:
+        nodegroups_names.add(nodegroup.name)
+    return result
+
+  def _UnlockedVerifyInstanceResources(self, instance_name):
+    """Checks an instance's resources against the resource index.
+
+    @type instance_name: string
+    @param instance_name: the instance name
+    @rtype: list
+    @return: a list of error messages
+
+    """
+    result = []
+    used = self._index.used
+
+    resources = self._index.GetResources(instance_name)
+    for mac in utils.UniqueSequence(resources["mac"]):
+      owners = used["mac"][mac]
+      if len(owners) > 1:
+        result.append("instance %s has duplicate mac %s (used by %s)" %
+                      (instance_name, mac, utils.CommaJoin(owners)))
+    for (node, minor) in utils.UniqueSequence(resources["drbd"]):
+      owners = used["drbd"][(node, minor)]
+      if len(owners) > 1:
+        result.append("DRBD minor %d on node %s is assigned twice to"
+                      " instances %s" % (minor, node, utils.CommaJoin(owners)))
+
+    return result
+
+  def _UnlockedVerifyModified(self, dirty):
+    """Verifies the modified parts of the configuration.
+
+    Only the objects recorded in the dirty tracker, together with the
+    cluster-wide settings, are checked; duplicate MACs and DRBD minors
+    are looked up in the resource index, while the other checks
+    across instances (e.g. for duplicate IPs) are left to
+    L{_UnlockedVerifyConfig}.
+
+    @type dirty: L{_ConfigDirtyTracker}
+    @param dirty: the tracker holding the modified objects
+    @rtype: list
+    @return: a list of error messages; a non-empty list signifies
+        configuration errors
+
+    """
+    data = self._config_data
+
+    result = self._UnlockedVerifyGlobals()
+
+    for instance_name in dirty.objects["instances"]:
+      instance = data.instances.get(instance_name, None)
+      if instance is not None:
+        result.extend(self._UnlockedVerifyInstance(instance_name, instance))
+        result.extend(self._UnlockedVerifyInstanceResources(instance_name))
+
+    for node_name in dirty.objects["nodes"]:
+      node = data.nodes.get(node_name, None)
+      if node is not None:
+        result.extend(self._UnlockedVerifyNode(node_name, node))
+
+    if dirty.objects["nodegroups"]:
+      result.extend(self._UnlockedVerifyNodeGroups())
+
+    return result
+
   @locking.ssynchronized(_config_lock, shared=1)
   def VerifyConfig(self):
     """Verify function.
@@ -583,7 +1144,7 @@ class ConfigWriter:
     """
     return self._UnlockedSetDiskID(disk, node_name)
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def AddTcpUdpPort(self, port):
     """Adds a new port to the available port pool.
 
@@ -592,6 +1153,7 @@ class ConfigWriter:
       raise errors.ProgrammerError("Invalid type passed for port")
 
     self._config_data.cluster.tcpudp_port_pool.add(port)
+    self._dirty.MarkCluster()
     self._WriteConfig()
 
   @locking.ssynchronized(_config_lock, shared=1)
@@ -601,7 +1163,7 @@ class ConfigWriter:
     """
     return self._config_data.cluster.tcpudp_port_pool.copy()
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def AllocatePort(self):
     """Allocate a port.
 
@@ -621,12 +1183,15 @@ class ConfigWriter:
                                         constants.LAST_DRBD_PORT)
       self._config_data.cluster.highest_used_port = port
 
+    self._dirty.MarkCluster()
     self._WriteConfig()
     return port
 
-  def _UnlockedComputeDRBDMap(self):
+  def _UnlockedComputeDRBDMap(self, nodes=None):
     """Compute the used DRBD minor/nodes.
 
+    @type nodes: list or None
+    @param nodes: if given, restrict the computation to these nodes
     @rtype: (dict, list)
     @return: dictionary of node_name: dict of minor: instance_name;
         the returned dict will have all the nodes in it (even if with
@@ -635,28 +1200,23 @@ class ConfigWriter:
         should raise an exception
 
     """
-    def _AppendUsedPorts(instance_name, disk, used):
-      duplicates = []
-      if disk.dev_type == constants.LD_DRBD8 and len(disk.logical_id) >= 5:
-        node_a, node_b, _, minor_a, minor_b = disk.logical_id[:5]
-        for node, port in ((node_a, minor_a), (node_b, minor_b)):
-          assert node in used, ("Node '%s' of instance '%s' not found"
-                                " in node list" % (node, instance_name))
-          if port in used[node]:
-            duplicates.append((node, port, instance_name, used[node][port]))
-          else:
-            used[node][port] = instance_name
-      if disk.children:
-        for child in disk.children:
-          duplicates.extend(_AppendUsedPorts(instance_name, child, used))
-      return duplicates
+    if nodes is None:
+      nodes = self._config_data.nodes.keys()
+      for node in self._index.drbd_minors:
+        assert node in self._config_data.nodes, \
+          "Node '%s' of DRBD disks not found in node list" % node
 
     duplicates = []
-    my_dict = dict((node, {}) for node in self._config_data.nodes)
-    for instance in self._config_data.instances.itervalues():
-      for disk in instance.disks:
-        duplicates.extend(_AppendUsedPorts(instance.name, disk, my_dict))
+    my_dict = {}
+    for node in nodes:
+      node_minors = my_dict[node] = {}
+      for (minor, owners) in self._index.drbd_minors.get(node, {}).items():
+        node_minors[minor] = owners[0]
+        for instance in owners[1:]:
+          duplicates.append((node, minor, instance, owners[0]))
     for (node, minor), instance in self._temporary_drbds.iteritems():
+      if node not in my_dict:
+        continue
       if minor in my_dict[node] and my_dict[node][minor] != instance:
         duplicates.append((node, minor, instance, my_dict[node][minor]))
       else:
@@ -696,7 +1256,8 @@ class ConfigWriter:
     assert isinstance(instance, basestring), \
            "Invalid argument '%s' passed to AllocateDRBDMinor" % instance
 
-    d_map, duplicates = self._UnlockedComputeDRBDMap()
+    d_map, duplicates = \
+      self._UnlockedComputeDRBDMap(nodes=utils.UniqueSequence(nodes))
     if duplicates:
       raise errors.ConfigurationError("Duplicate DRBD ports detected: %s" %
                                       str(duplicates))
@@ -874,7 +1435,7 @@ class ConfigWriter:
         return nodegroup.uuid
     raise errors.OpPrereqError("Nodegroup '%s' not found", target)
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def AddInstance(self, instance, ec_id):
     """Add an instance to the config.
 
@@ -904,9 +1465,27 @@ class ConfigWriter:
     instance.ctime = instance.mtime = time.time()
     self._config_data.instances[instance.name] = instance
     self._config_data.cluster.serial_no += 1
+    self._UnlockedInstanceModified(instance.name)
+    self._dirty.MarkCluster()
     self._UnlockedReleaseDRBDMinors(instance.name)
     self._WriteConfig()
 
+  def _UnlockedInstanceModified(self, instance_name):
+    """Records the modification of an instance.
+
+    This marks the instance as dirty and updates the resource index
+    from its current state in the configuration (or removes it from
+    the index, if the instance no longer exists).
+
+    @type instance_name: string
+    @param instance_name: the name of the added, modified or removed
+        instance
+
+    """
+    self._dirty.Mark("instances", instance_name)
+    self._index.Update(instance_name,
+                       self._config_data.instances.get(instance_name, None))
+
   def _EnsureUUID(self, item, ec_id):
     """Ensures a given object has a valid UUID.
 
@@ -935,16 +1514,17 @@ class ConfigWriter:
       instance.admin_up = status
       instance.serial_no += 1
       instance.mtime = time.time()
+      self._dirty.Mark("instances", instance_name)
       self._WriteConfig()
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def MarkInstanceUp(self, instance_name):
     """Mark the instance status to up in the config.
 
     """
     self._SetInstanceStatus(instance_name, True)
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def RemoveInstance(self, instance_name):
     """Remove the instance from the configuration.
 
@@ -953,9 +1533,11 @@ class ConfigWriter:
       raise errors.ConfigurationError("Unknown instance '%s'" % instance_name)
     del self._config_data.instances[instance_name]
     self._config_data.cluster.serial_no += 1
+    self._UnlockedInstanceModified(instance_name)
+    self._dirty.MarkCluster()
     self._WriteConfig()
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def RenameInstance(self, old_name, new_name):
     """Rename an instance.
 
@@ -980,9 +1562,11 @@ class ConfigWriter:
                                                              disk.iv_name))
 
     self._config_data.instances[inst.name] = inst
+    self._UnlockedInstanceModified(old_name)
+    self._UnlockedInstanceModified(inst.name)
     self._WriteConfig()
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def MarkInstanceDown(self, instance_name):
     """Mark the status of an instance to down in the configuration.
 
@@ -1056,7 +1640,7 @@ class ConfigWriter:
                     for instance in self._UnlockedGetInstanceList()])
     return my_dict
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def AddNode(self, node, ec_id):
     """Add a node to the configuration.
 
@@ -1073,9 +1657,11 @@ class ConfigWriter:
     self._UnlockedAddNodeToGroup(node.name, node.nodegroup)
     self._config_data.nodes[node.name] = node
     self._config_data.cluster.serial_no += 1
+    self._dirty.Mark("nodes", node.name)
+    self._dirty.MarkCluster()
     self._WriteConfig()
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def RemoveNode(self, node_name):
     """Remove a node from the configuration.
 
@@ -1088,6 +1674,8 @@ class ConfigWriter:
     self._UnlockedRemoveNodeFromGroup(self._config_data.nodes[node_name])
     del self._config_data.nodes[node_name]
     self._config_data.cluster.serial_no += 1
+    self._dirty.Mark("nodes", node_name)
+    self._dirty.MarkCluster()
     self._WriteConfig()
 
   @locking.ssynchronized(_config_lock, shared=1)
@@ -1210,7 +1798,7 @@ class ConfigWriter:
     """
     return self._UnlockedGetMasterCandidateStats(exceptions)
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def MaintainCandidatePool(self, exceptions):
     """Try to grow the candidate pool to the desired size.
 
@@ -1235,6 +1823,7 @@ class ConfigWriter:
         mod_list.append(node)
         node.master_candidate = True
         node.serial_no += 1
+        self._dirty.Mark("nodes", node.name)
         mc_now += 1
       if mc_now != mc_max:
         # this should not happen
@@ -1242,6 +1831,7 @@ class ConfigWriter:
                         " fill the candidate pool (%d/%d)", mc_now, mc_max)
       if mod_list:
         self._config_data.cluster.serial_no += 1
+        self._dirty.MarkCluster()
         self._WriteConfig()
 
     return mod_list
@@ -1313,13 +1903,21 @@ class ConfigWriter:
     data.UpgradeConfig()
 
     self._config_data = data
+    self._index.Rebuild(data.instances)
     # reset the last serial as -1 so that the next write will cause
     # ssconf update
     self._last_cluster_serial = -1
+    # the configuration on other nodes is in an unknown state, so the
+    # next write must distribute the whole file
+    self._dirty.MarkAll()
 
     # And finally run our (custom) config upgrade sequence
     self._UpgradeConfig()
 
+    if (self._snapshot is None or
+        self._snapshot.serial_no != self._config_data.serial_no):
+      self._snapshot = ConfigSnapshot.FromDict(self._config_data.ToDict())
+
   def _UpgradeConfig(self):
     """Run upgrade steps that cannot be done purely in the objects.
 
@@ -1338,6 +1936,9 @@ class ConfigWriter:
       if item.uuid is None:
         item.uuid = self._GenerateUniqueID(_UPGRADE_CONFIG_JID)
         modified = True
+    if modified:
+      # instance UUIDs are part of the resource index
+      self._index.Rebuild(self._config_data.instances)
     if not self._config_data.nodegroups:
       default_nodegroup_uuid = self._GenerateUniqueID(_UPGRADE_CONFIG_JID)
       default_nodegroup = objects.NodeGroup(
@@ -1362,11 +1963,16 @@ class ConfigWriter:
       # only called at config init time, without the lock held
       self.DropECReservations(_UPGRADE_CONFIG_JID)
 
-  def _DistributeConfig(self, feedback_fn):
+  def _DistributeConfig(self, feedback_fn, delta=None):
     """Distribute the configuration to the other nodes.
 
-    Currently, this only copies the configuration file. In the future,
-    it could be used to encapsulate the 2/3-phase update mechanism.
+    If a delta is given, it is sent first; nodes which fail to apply it
+    (e.g. because their copy of the configuration has a different
+    serial number) will then receive the whole file.
+
+    @type delta: dict or None
+    @param delta: the configuration delta, as computed by
+        L{_BuildConfigDelta}
 
     """
     if self._offline:
@@ -1390,6 +1996,25 @@ class ConfigWriter:
       node_list.append(node_info.name)
       addr_list.append(node_info.primary_ip)
 
+    if delta is not None and node_list:
+      result = rpc.RpcRunner.call_upload_config_delta(node_list,
+                                                      self._cfg_file, delta,
+                                                      address_list=addr_list)
+      retry = []
+      for (to_node, address) in zip(node_list, addr_list):
+        msg = result[to_node].fail_msg
+        if msg:
+          logging.info("Applying configuration delta on node %s failed (%s),"
+                       " uploading whole file", to_node, msg)
+          retry.append((to_node, address))
+      if retry:
+        (node_list, addr_list) = map(list, zip(*retry))
+      else:
+        (node_list, addr_list) = ([], [])
+
+    if not node_list:
+      return True
+
     result = rpc.RpcRunner.call_upload_file(node_list, self._cfg_file,
                                             address_list=addr_list)
     for to_node, to_result in result.items():
@@ -1409,14 +2034,108 @@ class ConfigWriter:
   def _WriteConfig(self, destination=None, feedback_fn=None):
     """Write the configuration data to persistent storage.
 
+    If group commit is enabled, the write is only scheduled; it will be
+    done, together with other pending ones, by L{_WaitForPendingWrite}.
+    Callers must therefore use the L{_ConfigWriteSync} decorator.
+
     """
     assert feedback_fn is None or callable(feedback_fn)
 
+    if self._group_commit_delay is None or destination is not None:
+      self._WriteConfigFile(destination=destination, feedback_fn=feedback_fn)
+      return
+
+    self._flush_cond.acquire()
+    try:
+      self._write_gen += 1
+      self._thread_state.pending_gen = self._write_gen
+      if feedback_fn:
+        self._pending_feedback.append(feedback_fn)
+    finally:
+      self._flush_cond.release()
+
+  def _WaitForPendingWrite(self):
+    """Waits until the write scheduled by the current thread is done.
+
+    The first waiting thread becomes responsible for writing the
+    configuration, after waiting for the group commit delay in order to
+    allow more modifications to be included in the same write.
+
+    """
+    gen = getattr(self._thread_state, "pending_gen", None)
+    if gen is None:
+      return
+
+    self._thread_state.pending_gen = None
+
+    self._flush_cond.acquire()
+    try:
+      while self._flushed_gen < gen:
+        if self._flushing:
+          self._flush_cond.wait()
+          continue
+
+        self._flushing = True
+        self._flush_cond.release()
+        try:
+          time.sleep(self._group_commit_delay)
+          self._FlushConfig()
+        finally:
+          self._flush_cond.acquire()
+          self._flushing = False
+          self._flush_cond.notifyAll()
+    finally:
+      self._flush_cond.release()
+
+  @locking.ssynchronized(_config_lock)
+  def _FlushConfig(self):
+    """Writes all scheduled modifications.
+
+    """
+    self._flush_cond.acquire()
+    try:
+      gen = self._write_gen
+      feedback_fns = self._pending_feedback
+      self._pending_feedback = []
+    finally:
+      self._flush_cond.release()
+
+    if gen <= self._flushed_gen:
+      return
+
+    if feedback_fns:
+      def feedback_fn(msg):
+        for fn in feedback_fns:
+          fn(msg)
+    else:
+      feedback_fn = None
+
+    self._WriteConfigFile(feedback_fn=feedback_fn)
+
+    self._flush_cond.acquire()
+    try:
+      self._flushed_gen = gen
+    finally:
+      self._flush_cond.release()
+
+  def _WriteConfigFile(self, destination=None, feedback_fn=None):
+    """Writes and distributes the configuration file.
+
+    """
     # Warn on config errors, but don't abort the save - the
     # configuration has already been modified, and we can't revert;
     # the best we can do is to warn the user and save as is, leaving
     # recovery to the user
-    config_errors = self._UnlockedVerifyConfig()
+    now = time.time()
+    full_verify = (self._dirty.full or
+                   now - self._last_full_verify >= _FULL_VERIFY_INTERVAL)
+    if full_verify:
+      # catch any instance modified in place without a call to Update
+      self._index.Rebuild(self._config_data.instances)
+      config_errors = self._UnlockedVerifyConfig()
+      self._last_full_verify = now
+    else:
+      config_errors = self._UnlockedVerifyModified(self._dirty)
     if config_errors:
       errmsg = ("Configuration data is not consistent: %s" %
                 (utils.CommaJoin(config_errors)))
@@ -1426,16 +2145,29 @@ class ConfigWriter:
 
     if destination is None:
       destination = self._cfg_file
+    base_serial = self._config_data.serial_no
     self._BumpSerialNo()
-    txt = serializer.Dump(self._config_data.ToDict())
+    data = self._config_data.ToDict()
+    txt = serializer.Dump(data)
 
     getents = self._getents()
     utils.WriteFile(destination, data=txt, gid=getents.confd_gid, mode=0640)
 
     self.write_count += 1
 
+    delta = _BuildConfigDelta(data, txt, base_serial, self._dirty)
+
+    if self._snapshot is None or full_verify:
+      # as for verification, objects modified in place without a call to
+      # Update are only picked up by a full copy
+      self._snapshot = ConfigSnapshot.FromDict(data)
+    else:
+      self._snapshot = self._snapshot.Update(data, self._dirty)
+
+    self._dirty.Reset()
+
     # and redistribute the config file to master candidates
-    self._DistributeConfig(feedback_fn)
+    self._DistributeConfig(feedback_fn, delta=delta)
 
     # Write ssconf files on all nodes (including locally)
     if self._last_cluster_serial < self._config_data.cluster.serial_no:
@@ -1531,13 +2263,14 @@ class ConfigWriter:
     """
     return self._config_data.cluster.volume_group_name
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def SetVGName(self, vg_name):
     """Set the volume group name.
 
     """
     self._config_data.cluster.volume_group_name = vg_name
     self._config_data.cluster.serial_no += 1
+    self._dirty.MarkCluster()
     self._WriteConfig()
 
   @locking.ssynchronized(_config_lock, shared=1)
@@ -1547,13 +2280,14 @@ class ConfigWriter:
     """
     return self._config_data.cluster.drbd_usermode_helper
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def SetDRBDHelper(self, drbd_helper):
     """Set DRBD usermode helper.
 
     """
     self._config_data.cluster.drbd_usermode_helper = drbd_helper
     self._config_data.cluster.serial_no += 1
+    self._dirty.MarkCluster()
     self._WriteConfig()
 
   @locking.ssynchronized(_config_lock, shared=1)
@@ -1563,6 +2297,18 @@ class ConfigWriter:
     """
     return self._config_data.cluster.mac_prefix
 
+  def GetSnapshot(self):
+    """Returns a read-only snapshot of the configuration.
+
+    This doesn't acquire the configuration lock. The snapshot reflects the
+    configuration as of the last write; with group commit, modifications
+    become visible once they have been written.
+
+    @rtype: L{ConfigSnapshot}
+
+    """
+    return self._snapshot
+
   @locking.ssynchronized(_config_lock, shared=1)
   def GetClusterInfo(self):
     """Returns information about the cluster
@@ -1580,7 +2326,7 @@ class ConfigWriter:
     """
     return self._config_data.HasAnyDiskOfType(dev_type)
 
-  @locking.ssynchronized(_config_lock)
+  @_ConfigWriteSync
   def Update(self, target, feedback_fn):
     """Notify function to be called after updates.
 
@@ -1602,11 +2348,14 @@ class ConfigWriter:
     update_serial = False
     if isinstance(target, objects.Cluster):
       test = target == self._config_data.cluster
+      dirty_container = None
     elif isinstance(target, objects.Node):
       test = target in self._config_data.nodes.values()
+      dirty_container = "nodes"
       update_serial = True
     elif isinstance(target, objects.Instance):
       test = target in self._config_data.instances.values()
+      dirty_container = "instances"
     else:
       raise errors.ProgrammerError("Invalid object type (%s) passed to"
                                    " ConfigWriter.Update" % type(target))
@@ -1616,10 +2365,19 @@ class ConfigWriter:
     target.serial_no += 1
     target.mtime = now = time.time()
 
+    if dirty_container is None:
+      self._dirty.MarkCluster()
+    elif dirty_container == "instances":
+      # the instance's disks and NICs might have changed
+      self._UnlockedInstanceModified(target.name)
+    else:
+      self._dirty.Mark(dirty_container, target.name)
+
     if update_serial:
       # for node updates, we need to increase the cluster serial too
       self._config_data.cluster.serial_no += 1
       self._config_data.cluster.mtime = now
+      self._dirty.MarkCluster()
 
     if isinstance(target, objects.Instance):
       self._UnlockedReleaseDRBDMinors(target.name)
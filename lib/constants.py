@@ -110,6 +110,10 @@ CRYPTO_KEYS_DIR = RUN_GANETI_DIR + "/crypto"
 CRYPTO_KEYS_DIR_MODE = SECURE_DIR_MODE
 IMPORT_EXPORT_DIR = RUN_GANETI_DIR + "/import-export"
 IMPORT_EXPORT_DIR_MODE = 0755
+# changed whenever LVM volumes are modified by Ganeti
+LVM_INVENTORY_STAMP_FILE = RUN_GANETI_DIR + "/lvm-inventory.stamp"
+# for how many seconds a snapshot of the LVM volumes is used
+LVM_INVENTORY_MAX_AGE = 10
 # keep RUN_GANETI_DIR first here, to make sure all get created when the node
 # daemon is started (this takes care of RUN_DIR being tmpfs)
 SUB_RUN_DIRS = [ RUN_GANETI_DIR, BDEV_CACHE_DIR, DISK_LINKS_DIR ]
@@ -164,6 +168,23 @@ DEFAULT_RAPI_PORT = DAEMONS_PORTS[RAPI][1]
 # used in the ganeti-nbma project
 DEFAULT_NLD_PORT = DAEMONS_PORTS[NLD][1]
 
+# number of node daemon worker processes started in advance (0 to fork for
+# every connection)
+NODED_WORKERS = 8
+# after how many seconds a node daemon worker still handling a request is
+# killed, for RPC procedures without a fixed timeout; longer than the longest
+# RPC timeout
+NODED_REQUEST_TIMEOUT = 25 * 3600
+# how long a node daemon worker may keep handling a request after the RPC
+# client has timed out, before it's killed
+NODED_REQUEST_TIMEOUT_MARGIN = 60
+# interval in seconds for logging the statistics of the node daemon workers,
+# e.g. the number of connections waiting to be accepted
+NODED_WORKER_STATS_INTERVAL = 5 * 60
+# how many hook scripts of a directory the node daemon runs at the same time
+# by default (1 to run them one after another)
+NODED_HOOKS_MAX_PARALLEL = 1
+
 FIRST_DRBD_PORT = 11000
 LAST_DRBD_PORT = 14999
 MASTER_SCRIPT = "ganeti-master"
@@ -191,6 +212,9 @@ PROC_MOUNTS = "/proc/mounts"
 
 # luxi related constants
 LUXI_EOM = "\3"
+# struct format of the length prefix used instead of LUXI_EOM when
+# negotiated by the client
+LUXI_LENGTH_PREFIX_FORMAT = ">I"
 
 # one of 'no', 'yes', 'only'
 SYSLOG_USAGE = _autoconf.SYSLOG_USAGE
@@ -472,6 +496,20 @@ NODE_MAX_CLOCK_SKEW = 150
 # Time for an intra-cluster disk transfer to wait for a connection
 DISK_TRANSFER_CONNECT_TIMEOUT = 30
 
+# Time (in seconds) the master daemon waits for more configuration
+# modifications before writing and distributing the configuration
+CONFIG_GROUP_COMMIT_DELAY = 0.05
+
+# Upper bounds (in seconds) of the buckets used for lock wait and hold time
+# histograms; an additional bucket holds all larger values
+LOCK_STATS_HISTOGRAM_BOUNDS = [0.001, 0.01, 0.1, 1.0, 10.0, 60.0]
+
+# Interval (in seconds) in which the master daemon refreshes cached runtime
+# data of nodes and instances, and time after which data no longer requested
+# by queries is dropped from the cache
+LIVE_DATA_REFRESH_INTERVAL = 10.0
+LIVE_DATA_IDLE_TIMEOUT = 300.0
+
 # runparts results
 (RUNPARTS_SKIP,
  RUNPARTS_RUN,
@@ -803,6 +841,7 @@ JOB_QUEUE_LOCK_FILE = QUEUE_DIR + "/lock"
 JOB_QUEUE_VERSION_FILE = QUEUE_DIR + "/version"
 JOB_QUEUE_SERIAL_FILE = QUEUE_DIR + "/serial"
 JOB_QUEUE_ARCHIVE_DIR = QUEUE_DIR + "/archive"
+JOB_QUEUE_ARCHIVE_INDEX_FILE = JOB_QUEUE_ARCHIVE_DIR + "/index"
 JOB_QUEUE_DRAIN_FILE = QUEUE_DIR + "/drain"
 JOB_QUEUE_SIZE_HARD_LIMIT = 5000
 JOB_QUEUE_DIRS = [QUEUE_DIR, JOB_QUEUE_ARCHIVE_DIR]
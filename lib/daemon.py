@@ -32,6 +32,7 @@ import sched
 import time
 import socket
 import select
+import struct
 import sys
 
 from ganeti import utils
@@ -148,13 +149,55 @@ class AsyncStreamServer(GanetiBaseAsyncoreDispatcher):
     raise NotImplementedError
 
 
+class _MessageProducer:
+  """asynchat producer for a sequence of messages.
+
+  Messages are only retrieved from the iterator once the previous ones have
+  been sent, so that they don't need to be kept in memory all at once.
+
+  """
+  def __init__(self, messages, frame_fn):
+    """Initializes this class.
+
+    @param messages: iterator returning messages
+    @type frame_fn: callable
+    @param frame_fn: function returning the framed form of a message as a list
+        of non-empty strings (an empty string would end the producer)
+
+    """
+    self._messages = iter(messages)
+    self._frame_fn = frame_fn
+    self._parts = collections.deque()
+
+  def more(self):
+    """Returns the next part of data to send, or an empty string when done.
+
+    """
+    while not self._parts:
+      try:
+        message = self._messages.next()
+      except StopIteration:
+        return ""
+      self._parts.extend(self._frame_fn(message))
+
+    return self._parts.popleft()
+
+
 class AsyncTerminatedMessageStream(asynchat.async_chat):
   """A terminator separated message stream asyncore module.
 
   Handles a stream connection receiving messages terminated by a defined
   separator. For each complete message handle_message is called.
 
+  After a call to L{use_length_prefix}, messages in both directions are
+  instead prefixed by their length, which avoids scanning the data for the
+  terminator.
+
   """
+  # Read and write in bigger chunks than asynchat's default of 4 KB
+  ac_in_buffer_size = 64 * 1024
+  ac_out_buffer_size = 64 * 1024
+
   def __init__(self, connected_socket, peer_address, terminator, family,
                unhandled_limit):
     """AsyncTerminatedMessageStream constructor.
@@ -182,6 +225,9 @@ class AsyncTerminatedMessageStream(asynchat.async_chat):
     self.terminator = terminator
     self.unhandled_limit = unhandled_limit
     self.set_terminator(terminator)
+    self.length_prefix = None
+    self._length_prefix_size = None
+    self._message_length = None
     self.ibuffer = []
     self.receive_count = 0
     self.send_count = 0
@@ -197,10 +243,58 @@ class AsyncTerminatedMessageStream(asynchat.async_chat):
             (self.receive_count < self.send_count + self.unhandled_limit) and
              not self.iqueue)
 
+  def use_length_prefix(self, prefix_format):
+    """Switches to length-prefixed messages.
+
+    This must only be called when no partial message has been received, e.g.
+    after replying to a request (see the C{sent_fn} parameter of
+    L{send_message}).
+
+    @type prefix_format: string
+    @param prefix_format: C{struct} format of the message length prefix
+
+    """
+    self.length_prefix = prefix_format
+    self._length_prefix_size = struct.calcsize(prefix_format)
+    self._message_length = None
+    self.set_terminator(self._length_prefix_size)
+
+  def _frame_message(self, message):
+    """Returns the framed form of a message as a list of strings.
+
+    """
+    if self.length_prefix:
+      header = struct.pack(self.length_prefix, len(message))
+      if len(message) > self.ac_out_buffer_size:
+        # Not concatenating to avoid copying large messages
+        return [header, message]
+      return [header + message]
+    else:
+      return [message + self.terminator]
+
   # this method is overriding an asynchat.async_chat method
   def found_terminator(self):
-    message = "".join(self.ibuffer)
+    data = "".join(self.ibuffer)
     self.ibuffer = []
+
+    if self.length_prefix:
+      if self._message_length is None:
+        # Received message header
+        (length, ) = struct.unpack(self.length_prefix, data)
+        if length > 0:
+          self._message_length = length
+          self.set_terminator(length)
+          return
+        # Empty message (asynchat can't wait for zero bytes)
+        data = ""
+
+      # Wait for next header
+      self._message_length = None
+      self.set_terminator(self._length_prefix_size)
+
+    self._handle_received_message(data)
+
+  def _handle_received_message(self, message):
     message_id = self.receive_count
     # We need to increase the receive_count after checking if the message can
     # be handled, but before calling handle_message
@@ -224,11 +318,17 @@ class AsyncTerminatedMessageStream(asynchat.async_chat):
     # TODO: move this method to raise NotImplementedError
     # raise NotImplementedError
 
-  def send_message(self, message):
+  def send_message(self, message, sent_fn=None):
     """Send a message to the remote peer. This function is thread-safe.
 
-    @type message: string
-    @param message: message to send, without the terminator
+    @type message: string or iterator
+    @param message: message to send, without the terminator; if an iterator
+        is given, the messages returned by it are sent one after the other
+        and count as a single reply (they are only retrieved when the
+        previous ones have been sent)
+    @type sent_fn: callable
+    @param sent_fn: function called in the main loop after the message has
+        been queued for sending
 
     @warning: If calling this function from a thread different than the one
     performing the main asyncore loop, remember that you have to wake that one
@@ -240,7 +340,7 @@ class AsyncTerminatedMessageStream(asynchat.async_chat):
     # we don't need locking, since deques are thread safe. handle_write in the
     # asyncore thread will handle the next input message if there are any
     # enqueued.
-    self.oqueue.append(message)
+    self.oqueue.append((message, sent_fn))
 
   # this method is overriding an asyncore.dispatcher method
   def readable(self):
@@ -260,9 +360,15 @@ class AsyncTerminatedMessageStream(asynchat.async_chat):
       # if we have data in the output queue, then send_message was called.
       # this means we can process one more message from the input queue, if
       # there are any.
-      data = self.oqueue.popleft()
-      self.push(data + self.terminator)
+      (data, sent_fn) = self.oqueue.popleft()
+      if isinstance(data, basestring):
+        for part in self._frame_message(data):
+          self.push(part)
+      else:
+        self.push_with_producer(_MessageProducer(data, self._frame_message))
       self.send_count += 1
+      if sent_fn is not None:
+        sent_fn()
       if self.iqueue:
         self.handle_message(*self.iqueue.popleft())
     self.initiate_send()
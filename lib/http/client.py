@@ -24,6 +24,8 @@
 
 import logging
 import pycurl
+import threading
+import time
 from cStringIO import StringIO
 
 from ganeti import http
@@ -167,6 +169,13 @@ class _HttpClient(object):
     """
     return self._curl
 
+  def Close(self):
+    """Closes the cURL object and its connections.
+
+    """
+    assert not self._req, "Request is still running"
+    self._curl.close()
+
   def GetCurrentRequest(self):
     """Returns the current request.
 
@@ -260,7 +269,7 @@ class _PooledHttpClient:
     """
     self.identity = identity
     self.client = client
-    self.lastused = 0
+    self.lastused = None
 
   def __repr__(self):
     status = ["%s.%s" % (self.__class__.__module__, self.__class__.__name__),
@@ -274,14 +283,20 @@ class _PooledHttpClient:
 class HttpClientPool:
   """A simple HTTP client pool.
 
-  Supports one pooled connection per identity (see
-  L{HttpClientRequest.identity}).
+  Supports any number of pooled clients per identity (see
+  L{HttpClientRequest.identity}). The pool can be shared between
+  threads; a client is only used by one request at a time.
+
+  As cURL keeps the open connections in the multi handle used to run
+  requests, the multi handles are pooled as well. Multi handles and
+  clients which weren't used for some time are closed, so that the
+  servers don't have to keep idle connections open.
 
   """
-  #: After how many generations to drop unused clients
-  _MAX_GENERATIONS_DROP = 25
+  #: After how many seconds of not being used to drop clients
+  _MAX_IDLE_TIME = 5.0
 
-  def __init__(self, curl_config_fn):
+  def __init__(self, curl_config_fn, _time_fn=time.time):
     """Initializes this class.
 
     @type curl_config_fn: callable
@@ -290,9 +305,15 @@ class HttpClientPool:
 
     """
     self._curl_config_fn = curl_config_fn
-    self._generation = 0
+    self._time_fn = _time_fn
+    self._lock = threading.Lock()
+
+    # Identity -> list of idle clients, most recently used last
     self._pool = {}
 
+    # Idle multi handles as (last use, handle), most recently used last
+    self._multi_pool = []
+
   @staticmethod
   def _GetHttpClientCreator():
     """Returns callable to create HTTP client.
@@ -307,9 +328,21 @@ class HttpClientPool:
     @param identity: Client identifier
 
     """
+    self._lock.acquire()
     try:
-      pclient  = self._pool.pop(identity)
-    except KeyError:
+      pclients = self._pool.get(identity, None)
+      if pclients:
+        # The most recently used client is the most likely to still have an
+        # open connection
+        pclient = pclients.pop()
+        if not pclients:
+          del self._pool[identity]
+      else:
+        pclient = None
+    finally:
+      self._lock.release()
+
+    if pclient is None:
       # Need to create new client
       client = self._GetHttpClientCreator()(self._curl_config_fn)
       pclient = _PooledHttpClient(identity, client)
@@ -331,34 +364,89 @@ class HttpClientPool:
     logging.debug("Starting request %r", req)
     pclient = self._Get(req.identity)
 
-    assert req.identity not in self._pool
-
     pclient.client.StartRequest(req)
-    pclient.lastused = self._generation
 
     return pclient
 
-  def _Return(self, pclients):
-    """Returns HTTP clients to the pool.
+  def _Return(self, pclients, multi=None):
+    """Returns HTTP clients and a multi handle to the pool.
 
     """
+    now = self._time_fn()
+
+    self._lock.acquire()
+    try:
+      for pc in pclients:
+        logging.debug("Returning client %s to pool", pc)
+        pc.lastused = now
+        self._pool.setdefault(pc.identity, []).append(pc)
+
+      if multi is not None:
+        self._multi_pool.append((now, multi))
+
+      (expired, expired_multi) = self._ExpireUnlocked(now)
+    finally:
+      self._lock.release()
+
+    for pc in expired:
+      logging.debug("Removing client %s which hasn't been used"
+                    " for %s seconds", pc, self._MAX_IDLE_TIME)
+      pc.client.Close()
+
+    for multi in expired_multi:
+      multi.close()
+
+  def _ExpireUnlocked(self, now):
+    """Removes clients which weren't used recently from the pool.
+
+    @rtype: tuple; (list, list)
+    @return: the removed clients and multi handles
+
+    """
+    expired = []
+
+    for (identity, pclients) in self._pool.items():
+      keep = [pc for pc in pclients
+              if (pc.lastused + self._MAX_IDLE_TIME) >= now]
+      if len(keep) == len(pclients):
+        continue
+
+      expired.extend(pc for pc in pclients if pc not in keep)
+
+      if keep:
+        self._pool[identity] = keep
+      else:
+        del self._pool[identity]
+
+    expired_multi = [multi for (lastused, multi) in self._multi_pool
+                     if (lastused + self._MAX_IDLE_TIME) < now]
+    if expired_multi:
+      self._multi_pool = [(lastused, multi)
+                          for (lastused, multi) in self._multi_pool
+                          if (lastused + self._MAX_IDLE_TIME) >= now]
+
+    return (expired, expired_multi)
+
+  def Reset(self):
+    """Closes all idle clients and their connections.
+
+    Clients used by running requests are not affected.
+
+    """
+    self._lock.acquire()
+    try:
+      pclients = [pc for i in self._pool.values() for pc in i]
+      multis = [multi for (_, multi) in self._multi_pool]
+      self._pool = {}
+      self._multi_pool = []
+    finally:
+      self._lock.release()
+
     for pc in pclients:
-      logging.debug("Returning client %s to pool", pc)
-      assert pc.identity not in self._pool
-      assert pc not in self._pool.values()
-      self._pool[pc.identity] = pc
-
-    # Check for unused clients
-    for pc in self._pool.values():
-      if (pc.lastused + self._MAX_GENERATIONS_DROP) < self._generation:
-        logging.debug("Removing client %s which hasn't been used"
-                      " for %s generations",
-                      pc, self._MAX_GENERATIONS_DROP)
-        self._pool.pop(pc.identity, None)
-
-    assert compat.all(pc.lastused >= (self._generation -
-                                      self._MAX_GENERATIONS_DROP)
-                      for pc in self._pool.values())
+      pc.client.Close()
+
+    for multi in multis:
+      multi.close()
 
   @staticmethod
   def _CreateCurlMultiHandle():
@@ -367,6 +455,22 @@ class HttpClientPool:
     """
     return pycurl.CurlMulti()
 
+  def _GetMulti(self):
+    """Gets a cURL multi handle from the pool.
+
+    """
+    self._lock.acquire()
+    try:
+      if self._multi_pool:
+        # The most recently used handle is the most likely to still have
+        # open connections
+        (_, multi) = self._multi_pool.pop()
+        return multi
+    finally:
+      self._lock.release()
+
+    return self._CreateCurlMultiHandle()
+
   def ProcessRequests(self, requests):
     """Processes any number of HTTP client requests using pooled objects.
 
@@ -374,10 +478,7 @@ class HttpClientPool:
     @param requests: List of all requests
 
     """
-    multi = self._CreateCurlMultiHandle()
-
-    # For client cleanup
-    self._generation += 1
+    multi = self._GetMulti()
 
     assert compat.all((req.error is None and
                        req.success is None and
@@ -392,7 +493,6 @@ class HttpClientPool:
       curl_to_pclient[curl] = pclient
       multi.add_handle(curl)
       assert pclient.client.GetCurrentRequest() == req
-      assert pclient.lastused >= 0
 
     assert len(curl_to_pclient) == len(requests)
 
@@ -443,7 +543,7 @@ class HttpClientPool:
                       for pclient in curl_to_pclient.values())
 
     # Return clients to pool
-    self._Return(curl_to_pclient.values())
+    self._Return(curl_to_pclient.values(), multi)
 
     assert done_count == len(requests)
     assert compat.all(req.error is not None or
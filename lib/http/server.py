@@ -24,12 +24,16 @@
 
 import BaseHTTPServer
 import cgi
+import errno
 import logging
 import os
 import socket
+import struct
 import time
 import signal
+import select
 import asyncore
+import mmap
 
 from ganeti import http
 from ganeti import utils
@@ -57,6 +61,16 @@ DEFAULT_ERROR_MESSAGE = """\
 </html>
 """
 
+# Beginning of Linux' "struct tcp_info", up to tcpi_unacked, which for
+# listening sockets contains the number of connections waiting to be accepted
+_TCP_INFO_FORMAT = "8xIIIII"
+
+# Status table entry of a worker process: the time since when it's busy
+# handling a request (0 if it's idle), the time after which it's killed (0 if
+# the request wasn't dispatched yet) and the number of handled requests
+_WORKER_STATUS_FORMAT = "ddI"
+_WORKER_STATUS_SIZE = struct.calcsize(_WORKER_STATUS_FORMAT)
+
 
 def _DateTimeHeader(gmnow=None):
   """Return the current date and time formatted for a message header.
@@ -98,6 +112,27 @@ class _HttpServerRequest(object):
     return "<%s at %#x>" % (" ".join(status), id(self))
 
 
+def _GetListenQueueLength(sock):
+  """Returns the number of connections waiting to be accepted.
+
+  @type sock: socket
+  @param sock: listening TCP socket
+  @rtype: int or None
+  @return: the accept queue length, None if it can't be determined
+
+  """
+  size = struct.calcsize(_TCP_INFO_FORMAT)
+  try:
+    info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, size)
+  except (AttributeError, socket.error):
+    return None
+
+  if len(info) < size:
+    return None
+
+  return struct.unpack(_TCP_INFO_FORMAT, info[:size])[-1]
+
+
 class _HttpServerToClientMessageWriter(http.HttpMessageWriter):
   """Writes an HTTP response to client.
 
@@ -220,7 +255,8 @@ class HttpServerRequestExecutor(object):
   This class implements the server side of HTTP. It's based on code of
   Python's BaseHTTPServer, from both version 2.4 and 3k. It does not
   support non-ASCII character encodings. Keep-alive connections are
-  not supported.
+  supported for HTTP/1.1 clients if enabled by the server (see
+  L{HttpServer.keep_alive}), pipelining is not.
 
   """
   # The default request version.  This only affects responses up until
@@ -240,6 +276,12 @@ class HttpServerRequestExecutor(object):
   READ_TIMEOUT = 10
   CLOSE_TIMEOUT = 1
 
+  # How long to wait for the next request on a keep-alive connection
+  KEEP_ALIVE_TIMEOUT = 10
+
+  # Maximum number of requests served on a single connection
+  KEEP_ALIVE_MAX_REQUESTS = 100
+
   def __init__(self, server, sock, client_addr):
     """Initializes this class.
 
@@ -248,12 +290,8 @@ class HttpServerRequestExecutor(object):
     self.sock = sock
     self.client_addr = client_addr
 
-    self.request_msg = http.HttpMessage()
-    self.response_msg = http.HttpMessage()
-
-    self.response_msg.start_line = \
-      http.HttpServerToClientStartLine(version=self.default_request_version,
-                                       code=None, reason=None)
+    self.request_msg = None
+    self.response_msg = None
 
     # Disable Python's timeout
     self.sock.settimeout(None)
@@ -275,26 +313,24 @@ class HttpServerRequestExecutor(object):
             # Ignore rest
             return
 
-        try:
+        count = 0
+        while True:
           try:
-            request_msg_reader = self._ReadRequest()
-
-            # RFC2616, 14.23: All Internet-based HTTP/1.1 servers MUST respond
-            # with a 400 (Bad Request) status code to any HTTP/1.1 request
-            # message which lacks a Host header field.
-            if (self.request_msg.start_line.version == http.HTTP_1_1 and
-                http.HTTP_HOST not in self.request_msg.headers):
-              raise http.HttpBadRequest(message="Missing Host header")
-
-            self._HandleRequest()
-
-            # Only wait for client to close if we didn't have any exception.
-            force_close = False
-          except http.HttpException, err:
-            self._SetErrorStatus(err)
-        finally:
-          # Try to send a response
-          self._SendResponse()
+            (request_msg_reader, force_close, keep_alive) = \
+              self._ServeRequest(count)
+          except http.HttpError:
+            if count > 0 and self.request_msg.start_line is None:
+              # The client closed the idle keep-alive connection
+              logging.debug("Connection closed by %s:%s",
+                            client_addr[0], client_addr[1])
+              force_close = True
+              break
+            raise
+
+          count += 1
+
+          if not (keep_alive and self._WaitForNextRequest()):
+            break
       finally:
         http.ShutdownConnection(sock, self.CLOSE_TIMEOUT, self.WRITE_TIMEOUT,
                                 request_msg_reader, force_close)
@@ -304,6 +340,80 @@ class HttpServerRequestExecutor(object):
     finally:
       logging.debug("Disconnected %s:%s", client_addr[0], client_addr[1])
 
+  def _ServeRequest(self, count):
+    """Reads a request, handles it and sends the response.
+
+    @type count: int
+    @param count: number of requests already served on this connection
+    @rtype: tuple; (L{_HttpClientToServerMessageReader} or None, bool, bool)
+    @return: the request reader, whether the connection should be closed
+        without waiting for the client and whether it can be kept alive
+
+    """
+    self.request_msg = http.HttpMessage()
+    self.response_msg = http.HttpMessage()
+
+    self.response_msg.start_line = \
+      http.HttpServerToClientStartLine(version=self.default_request_version,
+                                       code=None, reason=None)
+
+    request_msg_reader = None
+    force_close = True
+    keep_alive = False
+    try:
+      try:
+        request_msg_reader = self._ReadRequest()
+
+        # RFC2616, 14.23: All Internet-based HTTP/1.1 servers MUST respond
+        # with a 400 (Bad Request) status code to any HTTP/1.1 request
+        # message which lacks a Host header field.
+        if (self.request_msg.start_line.version == http.HTTP_1_1 and
+            http.HTTP_HOST not in self.request_msg.headers):
+          raise http.HttpBadRequest(message="Missing Host header")
+
+        self._HandleRequest()
+
+        # Only wait for client to close if we didn't have any exception.
+        force_close = False
+
+        keep_alive = self._CanKeepAlive(request_msg_reader, count)
+      except http.HttpException, err:
+        self._SetErrorStatus(err)
+    finally:
+      # Try to send a response
+      self._SendResponse(keep_alive)
+
+    return (request_msg_reader, force_close, keep_alive)
+
+  def _CanKeepAlive(self, request_msg_reader, count):
+    """Decides whether the connection is kept open after a response.
+
+    @type request_msg_reader: L{_HttpClientToServerMessageReader}
+    @param request_msg_reader: the reader of the current request
+    @type count: int
+    @param count: number of requests served before the current one
+
+    """
+    hdr_connection = self.response_msg.headers.get(http.HTTP_CONNECTION, None)
+
+    return bool(self.server.keep_alive and
+                self.request_msg.start_line.version == http.HTTP_1_1 and
+                not request_msg_reader.peer_will_close and
+                not (hdr_connection and "close" in hdr_connection.lower()) and
+                count + 1 < self.KEEP_ALIVE_MAX_REQUESTS)
+
+  def _WaitForNextRequest(self):
+    """Waits for the client to send another request on the connection.
+
+    @rtype: bool
+    @return: whether there is data to be read
+
+    """
+    if self.server.using_ssl and self.sock.pending():
+      return True
+
+    return self.server.WaitForNextRequest(self.sock, self.KEEP_ALIVE_TIMEOUT)
+
   def _ReadRequest(self):
     """Reads a request sent by client.
 
@@ -337,6 +447,9 @@ class HttpServerRequestExecutor(object):
         # Authentication, etc.
         self.server.PreHandleRequest(handler_context)
 
+        # Workers still handling the request after its timeout are killed
+        self.server.SetRequestDeadline(handler_context)
+
         # Call actual request handler
         result = self.server.HandleRequest(handler_context)
       except (http.HttpException, KeyboardInterrupt, SystemExit):
@@ -358,9 +471,13 @@ class HttpServerRequestExecutor(object):
       # No reason to keep this any longer, even for exceptions
       handler_context.private = None
 
-  def _SendResponse(self):
+  def _SendResponse(self, keep_alive):
     """Sends the response to the client.
 
+    @type keep_alive: bool
+    @param keep_alive: whether the connection is kept open after the
+        response
+
     """
     if self.response_msg.start_line.code is None:
       return
@@ -369,12 +486,17 @@ class HttpServerRequestExecutor(object):
       self.response_msg.headers = {}
 
     self.response_msg.headers.update({
-      # TODO: Keep-alive is not supported
-      http.HTTP_CONNECTION: "close",
       http.HTTP_DATE: _DateTimeHeader(),
       http.HTTP_SERVER: http.HTTP_GANETI_VERSION,
       })
 
+    if keep_alive:
+      # The client can only find the end of the response by its length
+      self.response_msg.headers[http.HTTP_CONTENT_LENGTH] = \
+        len(self.response_msg.body or "")
+    else:
+      self.response_msg.headers[http.HTTP_CONNECTION] = "close"
+
     # Get response reason based on code
     response_code = self.response_msg.start_line.code
     if response_code in self.responses:
@@ -439,17 +561,56 @@ class HttpServerRequestExecutor(object):
     return self.error_message_format % values
 
 
+class _HttpServerWorker(object):
+  """Parent side data of a pre-forked worker process.
+
+  """
+  def __init__(self, pid, slot, extra):
+    """Initializes this class.
+
+    @type pid: int
+    @param pid: process ID of the worker
+    @type slot: int
+    @param slot: index of the worker's entry in the status table
+    @type extra: bool
+    @param extra: whether the worker was started in addition to the
+        configured number of workers
+
+    """
+    self.pid = pid
+    self.slot = slot
+    self.extra = extra
+    self.killed = False
+
+
 class HttpServer(http.HttpBase, asyncore.dispatcher):
   """Generic HTTP server class
 
   Users of this class must subclass it and override the HandleRequest function.
 
+  By default a child process is forked for every connection. Alternatively a
+  number of worker processes can be forked in advance, which accept and handle
+  connections one after another. Workers publish whether they're busy in a
+  status table in shared memory. Using it, the parent process kills workers
+  busy with a request for too long and starts additional workers while
+  connections are waiting to be accepted. Workers which exited are replaced.
+
   """
   MAX_CHILDREN = 20
 
+  # Maximum number of children which may keep their connection open
+  MAX_KEEP_ALIVE_CHILDREN = MAX_CHILDREN / 2
+
+  # How often the parent process checks the workers (seconds)
+  WORKER_CHECK_INTERVAL = 1.0
+
+  # How long additional workers wait for a connection before exiting
+  WORKER_IDLE_TIMEOUT = 60.0
+
   def __init__(self, mainloop, local_address, port,
                ssl_params=None, ssl_verify_peer=False,
-               request_executor_class=None):
+               request_executor_class=None, keep_alive=False,
+               workers=0, request_timeout=None):
     """Initializes the HTTP server
 
     @type mainloop: ganeti.daemon.Mainloop
@@ -466,6 +627,19 @@ class HttpServer(http.HttpBase, asyncore.dispatcher):
     @type request_executor_class: class
     @param request_executor_class: an class derived from the
         HttpServerRequestExecutor class
+    @type keep_alive: bool
+    @param keep_alive: Whether to keep connections open for further
+        requests; when forking for every connection, at most
+        L{MAX_KEEP_ALIVE_CHILDREN} connections are kept open, while
+        workers give up idle connections when others are waiting
+    @type workers: int
+    @param workers: Number of worker processes to fork in advance, up to
+        L{MAX_CHILDREN} are started if needed; if zero, a child process is
+        forked for every connection
+    @type request_timeout: number or None
+    @param request_timeout: Time after which workers which are still
+        handling a request are killed (only used with workers); see also
+        L{GetRequestTimeout}
 
     """
     http.HttpBase.__init__(self)
@@ -476,6 +650,9 @@ class HttpServer(http.HttpBase, asyncore.dispatcher):
     else:
       self.request_executor = request_executor_class
 
+    self._keep_alive = keep_alive
+    self.keep_alive = keep_alive
+
     self.mainloop = mainloop
     self.local_address = local_address
     self.port = port
@@ -486,6 +663,26 @@ class HttpServer(http.HttpBase, asyncore.dispatcher):
     self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
     self._children = []
+
+    assert workers >= 0 and workers <= self.MAX_CHILDREN
+    self._workers = workers
+    self._request_timeout = request_timeout
+    self._worker_procs = {}
+    self._worker_check = None
+    self._status_table = None
+    self._stopping = False
+    self._stats = {
+      "killed": 0,
+      "queue_length": None,
+      "max_queue_length": 0,
+      }
+
+    # Worker side
+    self._worker_slot = None
+    self._worker_requests = 0
+    self._worker_stop = None
+    self._pending_connection = None
+
     self.set_socket(self.socket)
     self.accepting = True
     mainloop.RegisterSignal(self)
@@ -494,15 +691,409 @@ class HttpServer(http.HttpBase, asyncore.dispatcher):
     self.socket.bind((self.local_address, self.port))
     self.socket.listen(1024)
 
+    if self._workers:
+      # Workers wait for connections using poll(2) and race for them
+      self.socket.setblocking(0)
+
+      # Anonymous mappings are shared with forked processes
+      self._status_table = mmap.mmap(-1, self.MAX_CHILDREN *
+                                     _WORKER_STATUS_SIZE)
+
+      for _ in range(self._workers):
+        self._StartWorker(False)
+
+      self._ScheduleWorkerCheck()
+
   def Stop(self):
+    if self._workers:
+      self._stopping = True
+
+      if self._worker_check is not None:
+        try:
+          self.mainloop.scheduler.cancel(self._worker_check)
+        except ValueError:
+          pass
+        self._worker_check = None
+
+      # Workers exit once they're done with their current connection
+      for pid in self._worker_procs.keys():
+        self._KillWorker(pid, signal.SIGTERM)
+
     self.socket.close()
 
+  # this method is overriding an asyncore.dispatcher method
+  def readable(self):
+    # With workers, connections are never accepted by the parent process
+    return not self._workers
+
   def handle_accept(self):
     self._IncomingConnection()
 
   def OnSignal(self, signum):
     if signum == signal.SIGCHLD:
-      self._CollectChildren(True)
+      if self._workers:
+        self._CollectWorkers()
+      else:
+        self._CollectChildren(True)
+
+  def GetWorkerStats(self):
+    """Returns statistics about the worker processes.
+
+    @rtype: dict
+    @return: the number of workers, how many of them are busy, how many
+        requests they handled, how many were killed, the current and the
+        maximum observed number of connections waiting to be accepted
+
+    """
+    status = [self._GetWorkerStatus(w) for w in self._worker_procs.values()]
+
+    result = self._stats.copy()
+    result.update({
+      "workers": len(status),
+      "busy": len([busy_since for (busy_since, _, _) in status
+                   if busy_since]),
+      "requests": sum([requests for (_, _, requests) in status]),
+      })
+
+    return result
+
+  def _GetWorkerStatus(self, worker):
+    """Reads the status table entry of a worker.
+
+    @type worker: L{_HttpServerWorker}
+    @rtype: tuple; (float or None, float or None, int)
+    @return: since when the worker is busy (None if idle), when it is
+        killed (None if not known yet) and the number of handled requests
+
+    """
+    offset = worker.slot * _WORKER_STATUS_SIZE
+    (busy_since, deadline, requests) = \
+      struct.unpack(_WORKER_STATUS_FORMAT,
+                    self._status_table[offset:offset + _WORKER_STATUS_SIZE])
+
+    if not busy_since:
+      busy_since = None
+
+    if not deadline:
+      deadline = None
+
+    return (busy_since, deadline, requests)
+
+  def _SetWorkerStatus(self, busy, deadline=0):
+    """Updates the status table entry of this worker.
+
+    @type busy: bool
+    @param busy: whether the worker starts handling a request
+    @type deadline: float
+    @param deadline: when the worker is to be killed if it's still busy, 0
+        if not known yet
+
+    """
+    if busy:
+      self._worker_requests += 1
+      busy_since = time.time()
+    else:
+      busy_since = 0
+
+    self._WriteWorkerStatus(busy_since, deadline)
+
+  def _WriteWorkerStatus(self, busy_since, deadline):
+    """Writes the status table entry of this worker.
+
+    """
+    offset = self._worker_slot * _WORKER_STATUS_SIZE
+    self._status_table[offset:offset + _WORKER_STATUS_SIZE] = \
+      struct.pack(_WORKER_STATUS_FORMAT, busy_since, deadline,
+                  self._worker_requests)
+
+  def GetRequestTimeout(self, req):
+    """Returns the time after which a worker handling a request is killed.
+
+    Can be overridden by a subclass, e.g. to use different timeouts per
+    request path.
+
+    @type req: L{_HttpServerRequest}
+    @param req: the request
+    @rtype: number or None
+    @return: the timeout in seconds, None to use the server's request
+        timeout measured from the start of the request
+
+    """
+    # pylint: disable-msg=W0613
+    return self._request_timeout
+
+  def SetRequestDeadline(self, req):
+    """Sets the time after which this worker is killed.
+
+    Called once a request has been read and is about to be handled.
+
+    @type req: L{_HttpServerRequest}
+    @param req: the request
+
+    """
+    if self._worker_slot is None:
+      # Forked for this connection only
+      return
+
+    timeout = self.GetRequestTimeout(req)
+    if timeout is None:
+      return
+
+    offset = self._worker_slot * _WORKER_STATUS_SIZE
+    (busy_since, _, _) = \
+      struct.unpack(_WORKER_STATUS_FORMAT,
+                    self._status_table[offset:offset + _WORKER_STATUS_SIZE])
+
+    self._WriteWorkerStatus(busy_since, time.time() + timeout)
+
+  def _ScheduleWorkerCheck(self):
+    """Schedules the next check of the workers.
+
+    """
+    self._worker_check = \
+      self.mainloop.scheduler.enter(self.WORKER_CHECK_INTERVAL, 1,
+                                    self._CheckWorkers, [])
+
+  def _CheckWorkers(self):
+    """Kills stuck workers and starts additional ones if needed.
+
+    """
+    now = time.time()
+
+    workers = self._worker_procs.values()
+    busy = []
+
+    for worker in workers:
+      (busy_since, deadline, _) = self._GetWorkerStatus(worker)
+      if busy_since is None:
+        continue
+
+      busy.append(worker)
+
+      if deadline is None and self._request_timeout is not None:
+        # The request wasn't dispatched yet, e.g. it's still being read
+        deadline = busy_since + self._request_timeout
+
+      if deadline is not None and not worker.killed and now > deadline:
+        logging.error("Worker %s exceeded its request deadline (busy for %.1f"
+                      " seconds), killing it", worker.pid, now - busy_since)
+        self._KillWorker(worker.pid, signal.SIGKILL)
+        self._stats["killed"] += 1
+        worker.killed = True
+
+    queue_length = _GetListenQueueLength(self.socket)
+    self._stats["queue_length"] = queue_length
+
+    if queue_length:
+      self._stats["max_queue_length"] = max(self._stats["max_queue_length"],
+                                            queue_length)
+      logging.info("%s of %s workers busy, %s connections waiting",
+                   len(busy), len(workers), queue_length)
+
+      if len(busy) == len(workers) and len(workers) < self.MAX_CHILDREN:
+        self._StartWorker(True)
+
+    self._ScheduleWorkerCheck()
+
+  @staticmethod
+  def _KillWorker(pid, signum):
+    """Sends a signal to a worker, ignoring already exited ones.
+
+    """
+    try:
+      os.kill(pid, signum)
+    except EnvironmentError, err:
+      if err.errno != errno.ESRCH:
+        raise
+
+  def _CollectWorkers(self):
+    """Collects exited workers and replaces them if needed.
+
+    """
+    for pid in self._worker_procs.keys():
+      try:
+        (result, status) = os.waitpid(pid, os.WNOHANG)
+      except os.error:
+        result = pid
+        status = None
+
+      if not result:
+        continue
+
+      worker = self._worker_procs.pop(pid)
+
+      if worker.extra or self._stopping:
+        logging.debug("Worker %s exited with status %s", pid, status)
+      else:
+        logging.warning("Worker %s exited with status %s, replacing it",
+                        pid, status)
+        self._StartWorker(False)
+
+  def _StartWorker(self, extra):
+    """Forks a new worker process.
+
+    @type extra: bool
+    @param extra: whether the worker should exit after having been idle for
+        L{WORKER_IDLE_TIMEOUT} seconds
+
+    """
+    used = frozenset([w.slot for w in self._worker_procs.values()])
+    slot = [i for i in range(self.MAX_CHILDREN) if i not in used][0]
+
+    offset = slot * _WORKER_STATUS_SIZE
+    self._status_table[offset:offset + _WORKER_STATUS_SIZE] = \
+      struct.pack(_WORKER_STATUS_FORMAT, 0, 0, 0)
+
+    pid = os.fork()
+    if pid == 0:
+      # Worker process
+      try:
+        # In case the handler code uses temporary files
+        utils.ResetTempfileModule()
+
+        self._RunWorker(slot, extra)
+      except Exception: # pylint: disable-msg=W0703
+        logging.exception("Error in worker process")
+        os._exit(1)
+      os._exit(0)
+
+    self._worker_procs[pid] = _HttpServerWorker(pid, slot, extra)
+
+    logging.debug("Started worker %s", pid)
+
+  def _HandleWorkerStop(self, signum, frame):
+    """Stops accepting connections once the worker was asked to exit.
+
+    The listening socket is closed right away, so that a restarted server
+    can bind to the port even while this worker is still busy.
+
+    """
+    # pylint: disable-msg=W0613
+    try:
+      self.socket.close()
+    except socket.error:
+      pass
+
+  def _RunWorker(self, slot, extra):
+    """Main loop of a worker process.
+
+    @type slot: int
+    @param slot: index of the worker's entry in the status table
+    @type extra: bool
+    @param extra: see L{_StartWorker}
+
+    """
+    self._worker_slot = slot
+    self._worker_stop = utils.SignalHandler([signal.SIGTERM],
+                                            handler_fn=self._HandleWorkerStop)
+    try:
+      idle_since = time.time()
+
+      while not self._worker_stop.called:
+        if self._pending_connection:
+          (connection, client_addr) = self._pending_connection
+          self._pending_connection = None
+        else:
+          if extra and (time.time() - idle_since) > self.WORKER_IDLE_TIMEOUT:
+            logging.debug("Worker was idle for %s seconds, exiting",
+                          self.WORKER_IDLE_TIMEOUT)
+            break
+
+          # Wake up regularly to check whether the worker should exit
+          if not utils.SingleWaitForFdCondition(self.socket, select.POLLIN,
+                                                1.0):
+            continue
+
+          result = self._TryAccept()
+          if result is None:
+            continue
+
+          (connection, client_addr) = result
+
+        self._SetWorkerStatus(True)
+        try:
+          self.request_executor(self, connection, client_addr)
+        except Exception: # pylint: disable-msg=W0703
+          logging.exception("Error while handling request from %s:%s",
+                            client_addr[0], client_addr[1])
+        self._SetWorkerStatus(False)
+
+        idle_since = time.time()
+    finally:
+      self._worker_stop.Reset()
+
+  def _TryAccept(self):
+    """Accepts a connection without blocking.
+
+    @rtype: tuple or None
+    @return: the connection and the client address, or None if another
+        worker was faster
+
+    """
+    try:
+      return self.socket.accept()
+    except socket.error, err:
+      if err.args and err.args[0] in (errno.EAGAIN, errno.EINTR):
+        return None
+      raise
+
+  def WaitForNextRequest(self, sock, timeout):
+    """Waits for the next request on a keep-alive connection.
+
+    Workers give up the idle connection if they can accept a new one
+    instead, as otherwise the new connection might have to wait for the
+    keep-alive timeout of all workers.
+
+    @type sock: socket
+    @param sock: the connection
+    @type timeout: number
+    @param timeout: how long to wait for the next request
+    @rtype: bool
+    @return: whether there is data to be read on the connection
+
+    """
+    if self._worker_slot is None:
+      # Forked for this connection only
+      return bool(utils.WaitForFdCondition(sock, select.POLLIN, timeout))
+
+    self._SetWorkerStatus(False)
+
+    if self._worker_stop.called:
+      return False
+
+    listen_fd = self.socket.fileno()
+
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    poller.register(listen_fd, select.POLLIN)
+
+    end_time = time.time() + timeout
+
+    while not self._worker_stop.called:
+      remaining = end_time - time.time()
+      if remaining <= 0:
+        break
+
+      try:
+        io_events = poller.poll(1000 * min(remaining, 1.0))
+      except select.error, err:
+        if err[0] != errno.EINTR:
+          raise
+        continue
+
+      fds = [fd for (fd, _) in io_events]
+
+      if sock.fileno() in fds:
+        self._SetWorkerStatus(True)
+        return True
+
+      # The listening socket is closed once the worker should stop
+      if listen_fd in fds and not self._worker_stop.called:
+        self._pending_connection = self._TryAccept()
+        if self._pending_connection:
+          break
+
+    return False
 
   def _CollectChildren(self, quick):
     """Checks whether any child processes are done
@@ -542,6 +1133,11 @@ class HttpServer(http.HttpBase, asyncore.dispatcher):
 
     self._CollectChildren(False)
 
+    # Children holding idle connections would delay new connections once
+    # too many of them are running
+    keep_alive = (self._keep_alive and
+                  len(self._children) < self.MAX_KEEP_ALIVE_CHILDREN)
+
     pid = os.fork()
     if pid == 0:
       # Child process
@@ -556,6 +1152,8 @@ class HttpServer(http.HttpBase, asyncore.dispatcher):
           pass
         self.socket = None
 
+        self.keep_alive = keep_alive
+
         # In case the handler code uses temporary files
         utils.ResetTempfileModule()
 
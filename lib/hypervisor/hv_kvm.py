@@ -31,6 +31,9 @@ import tempfile
 import time
 import logging
 import pwd
+import errno
+import select
+import socket
 from cStringIO import StringIO
 
 from ganeti import utils
@@ -46,6 +49,245 @@ from ganeti import netutils
 
 _KVM_NETWORK_SCRIPT = constants.SYSCONFDIR + "/ganeti/kvm-vif-bridge"
 
+#: Prompt printed by the KVM monitor when it's ready for the next command
+_MONITOR_PROMPT = "\n(qemu) "
+
+
+class _MonitorResponseParser(object):
+  """Incremental parser for responses of the KVM monitor.
+
+  The human monitor echoes each command, prints its output and then the
+  prompt. Received data is fed to the parser as it arrives; only the newly
+  received part is searched for the prompt.
+
+  """
+  def __init__(self):
+    """Initializes this class.
+
+    """
+    self._buf = []
+    self._tail = ""
+
+  def Feed(self, data):
+    """Adds received data.
+
+    @type data: string
+    @rtype: bool
+    @return: Whether the response is complete
+
+    """
+    self._buf.append(data)
+
+    # Only the end of the previous data can contain the start of the prompt
+    self._tail = (self._tail + data)[-len(_MONITOR_PROMPT):]
+
+    return self._tail == _MONITOR_PROMPT
+
+  def GetOutput(self):
+    """Returns the output of the command.
+
+    The echoed command line and the prompt are removed, line endings are
+    normalized.
+
+    """
+    data = "".join(self._buf).replace("\r\n", "\n")
+    assert data.endswith(_MONITOR_PROMPT)
+
+    output = data[:-len(_MONITOR_PROMPT)]
+
+    # Remove echoed command line
+    lines = output.split("\n", 1)
+    if len(lines) < 2 or not lines[1]:
+      return ""
+
+    return lines[1] + "\n"
+
+
+class _MonitorConnection(object):
+  """Connection to the human monitor of a KVM instance.
+
+  """
+  def __init__(self, path, timeout):
+    """Connects to the monitor socket and waits for the prompt.
+
+    @type path: string
+    @param path: Path to the monitor's UNIX socket
+    @type timeout: float
+    @param timeout: Timeout for connecting and each command
+
+    """
+    self._path = path
+    self._timeout = timeout
+
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      self._sock.settimeout(timeout)
+      self._sock.connect(path)
+
+      # Skip greeting
+      self._Receive(_MonitorResponseParser())
+    except:
+      self.Close()
+      raise
+
+  def _Receive(self, parser):
+    """Receives data until the parser has got a complete response.
+
+    """
+    while True:
+      data = self._sock.recv(4096)
+      if not data:
+        raise errors.HypervisorError("Monitor socket %s closed unexpectedly" %
+                                     self._path)
+
+      if parser.Feed(data):
+        break
+
+  def IsUsable(self):
+    """Returns whether the connection can be used for the next command.
+
+    The monitor doesn't send any data while waiting for a command, hence a
+    readable socket means the connection has been closed (e.g. because the
+    instance was restarted).
+
+    """
+    if self._sock is None:
+      return False
+
+    poller = select.poll()
+    poller.register(self._sock.fileno(), select.POLLIN)
+    return not poller.poll(0)
+
+  def Call(self, command):
+    """Runs a command and returns its output.
+
+    @type command: string
+    @param command: Monitor command
+
+    """
+    assert "\n" not in command
+
+    parser = _MonitorResponseParser()
+
+    self._sock.sendall(command + "\n")
+    self._Receive(parser)
+
+    return parser.GetOutput()
+
+  def Close(self):
+    """Closes the connection.
+
+    """
+    if self._sock is not None:
+      self._sock.close()
+      self._sock = None
+
+
+def _GetProcessStartTime(pid):
+  """Returns the start time of a process.
+
+  Together with the process ID the start time identifies a process, even if
+  its ID has been reused.
+
+  @type pid: int
+  @param pid: Process ID
+  @rtype: string or None
+  @return: Start time in clock ticks since system boot, C{None} if the
+    process doesn't exist
+
+  """
+  try:
+    stat = utils.ReadFile("/proc/%d/stat" % pid)
+  except EnvironmentError, err:
+    if err.errno in (errno.ENOENT, errno.ESRCH):
+      return None
+    raise errors.HypervisorError("Can't read stat file for pid %s: %s" %
+                                 (pid, err))
+
+  # The command name can contain spaces and parentheses
+  fields = stat[stat.rfind(")") + 1:].split()
+  try:
+    return fields[19]
+  except IndexError:
+    raise errors.HypervisorError("Can't parse stat file for pid %s" % pid)
+
+
+def _ParseKVMCmdline(cmdline):
+  """Extracts instance information from a KVM command line.
+
+  @type cmdline: string
+  @param cmdline: Contents of C{/proc/<pid>/cmdline}
+  @rtype: tuple
+  @return: (instance_name, memory, vcpus); instance_name is C{None} if the
+    command line doesn't belong to an instance
+
+  """
+  instance = None
+  memory = 0
+  vcpus = 0
+
+  args = iter(cmdline.split("\x00"))
+  try:
+    for arg in args:
+      if arg == "-name":
+        instance = args.next()
+      elif arg == "-m":
+        memory = int(args.next())
+      elif arg == "-smp":
+        vcpus = int(args.next())
+  except StopIteration:
+    pass
+
+  return (instance, memory, vcpus)
+
+
+class _InstanceInfoCache(object):
+  """Cache for information parsed from KVM command lines.
+
+  Entries are identified by process ID and start time, hence they're never
+  used for another process reusing the same ID. The cache lives as long as
+  the node daemon process, so that querying unchanged instances doesn't
+  need to parse their command lines again.
+
+  """
+  def __init__(self):
+    """Initializes this class.
+
+    """
+    # pid -> (start time, (instance_name, memory, vcpus))
+    self._entries = {}
+
+  def Get(self, pid, start_time):
+    """Returns the cached information for a process, if any.
+
+    """
+    entry = self._entries.get(pid, None)
+    if entry is None or entry[0] != start_time:
+      return None
+    return entry[1]
+
+  def Add(self, pid, start_time, info):
+    """Stores the information for a process.
+
+    """
+    self._entries[pid] = (start_time, info)
+
+  def RemoveInstance(self, instance_name):
+    """Removes all entries for an instance.
+
+    """
+    for (pid, (_, info)) in self._entries.items():
+      if info[0] == instance_name:
+        del self._entries[pid]
+
+  def Prune(self, pids):
+    """Removes all entries not belonging to one of the given processes.
+
+    """
+    for pid in self._entries.keys():
+      if pid not in pids:
+        del self._entries[pid]
+
 
 def _WriteNetScript(instance, nic, index):
   """Write a script to connect a net interface to the proper bridge.
@@ -213,6 +455,11 @@ class KVMHypervisor(hv_base.BaseHypervisor):
   _MIGRATION_INFO_MAX_BAD_ANSWERS = 5
   _MIGRATION_INFO_RETRY_DELAY = 2
 
+  _MONITOR_TIMEOUT = 60.0
+
+  # Shared by all hypervisor objects of a process
+  _info_cache = _InstanceInfoCache()
+
   ANCILLARY_FILES = [
     _KVM_NETWORK_SCRIPT,
     ]
@@ -224,6 +471,11 @@ class KVMHypervisor(hv_base.BaseHypervisor):
     dirs = [(dname, constants.RUN_DIRS_MODE) for dname in self._DIRS]
     utils.EnsureDirs(dirs)
 
+    # Monitor connections by instance name. The monitor accepts only one
+    # client at a time, so they're only kept for the lifetime of this object
+    # (e.g. one node daemon request) and not shared with other processes.
+    self._monitors = {}
+
   @classmethod
   def _InstancePidFile(cls, instance_name):
     """Returns the instance pidfile.
@@ -245,17 +497,26 @@ class KVMHypervisor(hv_base.BaseHypervisor):
     Check that a pid file is associated with an instance, and retrieve
     information from its command line.
 
-    @type pid: string or int
+    The information is cached as long as the process is running.
+
+    @type pid: int
     @param pid: process id of the instance to check
     @rtype: tuple
     @return: (instance_name, memory, vcpus)
     @raise errors.HypervisorError: when an instance cannot be found
 
     """
-    alive = utils.IsProcessAlive(pid)
-    if not alive:
+    if pid <= 0:
       raise errors.HypervisorError("Cannot get info for pid %s" % pid)
 
+    start_time = _GetProcessStartTime(pid)
+    if start_time is None:
+      raise errors.HypervisorError("Cannot get info for pid %s" % pid)
+
+    info = cls._info_cache.Get(pid, start_time)
+    if info is not None:
+      return info
+
     cmdline_file = utils.PathJoin("/proc", str(pid), "cmdline")
     try:
       cmdline = utils.ReadFile(cmdline_file)
@@ -263,25 +524,21 @@ class KVMHypervisor(hv_base.BaseHypervisor):
       raise errors.HypervisorError("Can't open cmdline file for pid %s: %s" %
                                    (pid, err))
 
-    instance = None
-    memory = 0
-    vcpus = 0
-
-    arg_list = cmdline.split('\x00')
-    while arg_list:
-      arg =  arg_list.pop(0)
-      if arg == "-name":
-        instance = arg_list.pop(0)
-      elif arg == "-m":
-        memory = int(arg_list.pop(0))
-      elif arg == "-smp":
-        vcpus = int(arg_list.pop(0))
+    try:
+      info = _ParseKVMCmdline(cmdline)
+    except ValueError, err:
+      raise errors.HypervisorError("Can't parse cmdline of pid %s: %s" %
+                                   (pid, err))
 
-    if instance is None:
+    if info[0] is None:
       raise errors.HypervisorError("Pid %s doesn't contain a ganeti kvm"
                                    " instance" % pid)
 
-    return (instance, memory, vcpus)
+    # The command line could have changed while reading it
+    if _GetProcessStartTime(pid) == start_time:
+      cls._info_cache.Add(pid, start_time, info)
+
+    return info
 
   def _InstancePidAlive(self, instance_name):
     """Returns the instance pidfile, pid, and liveness.
@@ -469,13 +726,21 @@ class KVMHypervisor(hv_base.BaseHypervisor):
 
     """
     data = []
+    pids = set()
     for name in os.listdir(self._PIDS_DIR):
+      pid = utils.ReadPidFile(self._InstancePidFile(name))
       try:
-        info = self.GetInstanceInfo(name)
+        (cmd_instance, memory, vcpus) = self._InstancePidInfo(pid)
       except errors.HypervisorError:
         continue
-      if info:
-        data.append(info)
+      if cmd_instance != name:
+        continue
+      pids.add(pid)
+      data.append((name, pid, memory, vcpus, "---b-", "0"))
+
+    # Forget about processes which are gone
+    self._info_cache.Prune(pids)
+
     return data
 
   def _GenerateKVMRuntime(self, instance, block_devices):
@@ -794,27 +1059,41 @@ class KVMHypervisor(hv_base.BaseHypervisor):
 
     """
     self._CheckDown(instance.name)
+    self._info_cache.RemoveInstance(instance.name)
     kvm_runtime = self._GenerateKVMRuntime(instance, block_devices)
     self._SaveKVMRuntime(instance, kvm_runtime)
     self._ExecuteKVMRuntime(instance, kvm_runtime)
 
+  def _CloseMonitor(self, instance_name):
+    """Closes the monitor connection of an instance, if any.
+
+    """
+    conn = self._monitors.pop(instance_name, None)
+    if conn is not None:
+      conn.Close()
+
   def _CallMonitorCommand(self, instance_name, command):
     """Invoke a command on the instance monitor.
 
-    """
-    socat = ("echo %s | %s STDIO UNIX-CONNECT:%s" %
-             (utils.ShellQuote(command),
-              constants.SOCAT_PATH,
-              utils.ShellQuote(self._InstanceMonitor(instance_name))))
-    result = utils.RunCmd(socat)
-    if result.failed:
-      msg = ("Failed to send command '%s' to instance %s."
-             " output: %s, error: %s, fail_reason: %s" %
-             (command, instance_name,
-              result.stdout, result.stderr, result.fail_reason))
-      raise errors.HypervisorError(msg)
+    The connection to the monitor is kept open for further commands.
 
-    return result
+    @rtype: string
+    @return: Output of the command
+
+    """
+    conn = self._monitors.get(instance_name, None)
+    try:
+      if conn is None or not conn.IsUsable():
+        self._CloseMonitor(instance_name)
+        conn = _MonitorConnection(self._InstanceMonitor(instance_name),
+                                  self._MONITOR_TIMEOUT)
+        self._monitors[instance_name] = conn
+
+      return conn.Call(command)
+    except (EnvironmentError, errors.HypervisorError), err:
+      self._CloseMonitor(instance_name)
+      raise errors.HypervisorError("Failed to send command '%s' to instance"
+                                   " %s: %s" % (command, instance_name, err))
 
   def StopInstance(self, instance, force=False, retry=False, name=None):
     """Stop an instance.
@@ -830,7 +1109,9 @@ class KVMHypervisor(hv_base.BaseHypervisor):
     _, pid, alive = self._InstancePidAlive(name)
     if pid > 0 and alive:
       if force or not acpi:
+        self._CloseMonitor(name)
         utils.KillProcess(pid)
+        self._info_cache.RemoveInstance(name)
       else:
         self._CallMonitorCommand(name, 'system_powerdown')
 
@@ -943,14 +1224,13 @@ class KVMHypervisor(hv_base.BaseHypervisor):
     broken_answers = 0
     while not done:
       result = self._CallMonitorCommand(instance_name, info_command)
-      match = self._MIGRATION_STATUS_RE.search(result.stdout)
+      match = self._MIGRATION_STATUS_RE.search(result)
       if not match:
         broken_answers += 1
-        if not result.stdout:
+        if not result:
           logging.info("KVM: empty 'info migrate' result")
         else:
-          logging.warning("KVM: unknown 'info migrate' result: %s",
-                          result.stdout)
+          logging.warning("KVM: unknown 'info migrate' result: %s", result)
         time.sleep(self._MIGRATION_INFO_RETRY_DELAY)
       else:
         status = match.group(1)
@@ -972,7 +1252,9 @@ class KVMHypervisor(hv_base.BaseHypervisor):
       if broken_answers >= self._MIGRATION_INFO_MAX_BAD_ANSWERS:
         raise errors.HypervisorError("Too many 'info migrate' broken answers")
 
+    self._CloseMonitor(instance_name)
     utils.KillProcess(pid)
+    self._info_cache.RemoveInstance(instance_name)
     self._RemoveInstanceRuntimeFiles(pidfile, instance_name)
 
   def GetNodeInfo(self):
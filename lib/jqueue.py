@@ -26,6 +26,10 @@ used by all other classes in this module.
 
 @var JOBQUEUE_THREADS: the number of worker threads we start for
     processing jobs
+@var JOBQUEUE_MAX_THREADS: the maximum number of worker threads, used when
+    jobs are waiting for locks or queued jobs can't be started otherwise
+@var JOBQUEUE_PRIORITY_AGING: time in seconds after which the priority of a
+    job waiting in the queue is increased by one
 
 """
 
@@ -35,6 +39,9 @@ import errno
 import re
 import time
 import weakref
+import bisect
+import threading
+import collections
 
 try:
   # pylint: disable-msg=E0611
@@ -59,8 +66,25 @@ from ganeti import compat
 
 
 JOBQUEUE_THREADS = 25
+JOBQUEUE_MAX_THREADS = 100
+JOBQUEUE_PRIORITY_AGING = 60.0
 JOBS_PER_ARCHIVE_DIRECTORY = 10000
 
+# maximum number and estimated total size (in bytes) of finished jobs kept
+# in memory
+FINISHED_JOBS_CACHE_COUNT = 1000
+FINISHED_JOBS_CACHE_MEMORY = 32 * 1024 * 1024
+
+# maximum delay (in seconds) before deferred job file updates are replicated
+REPLICATION_DELAY = 1.0
+
+# suffix of the files holding the log entries of jobs
+LOG_SEGMENT_SUFFIX = ".log"
+
+# number of jobs archived at once by L{JobQueue.AutoArchiveJobs}, between
+# which the queue lock is released
+AUTOARCHIVE_CHUNK_SIZE = 100
+
 # member lock names to be passed to @ssynchronized decorator
 _LOCK = "_lock"
 _QUEUE = "_queue"
@@ -82,6 +106,134 @@ def TimeStampNow():
   return utils.SplitTime(time.time())
 
 
+def _GetLogSegmentPath(job_path):
+  """Returns the path of the log segment for a job file.
+
+  @type job_path: string
+  @param job_path: the path of the job file
+  @rtype: string
+
+  """
+  return job_path + LOG_SEGMENT_SUFFIX
+
+
+def _FormatLogEntries(entries):
+  """Formats log entries for a log segment.
+
+  A log segment holds one entry per line, each encoded as a JSON list
+  made of the opcode index followed by the log entry itself.
+
+  @type entries: list
+  @param entries: list of (opcode index, log entry) tuples
+  @rtype: string
+
+  """
+  return "".join([serializer.DumpJson([op_idx] + list(entry), indent=False)
+                  for (op_idx, entry) in entries])
+
+
+def _ParseLogLine(line):
+  """Parses one line of a log segment.
+
+  @rtype: tuple or None
+  @return: (opcode index, log entry) tuple, or None for an invalid line
+      (e.g. one whose writing was interrupted)
+
+  """
+  try:
+    data = serializer.LoadJson(line)
+  except ValueError:
+    logging.warning("Ignoring invalid log segment line %r", line)
+    return None
+  return (data[0], data[1:])
+
+
+def _ParseLogSegment(data):
+  """Parses the contents of a log segment.
+
+  @type data: string
+  @param data: the segment contents
+  @rtype: list
+  @return: list of (opcode index, log entry) tuples
+
+  """
+  result = []
+  for line in data.splitlines():
+    if line:
+      entry = _ParseLogLine(line)
+      if entry is not None:
+        result.append(entry)
+  return result
+
+
+def _ReadLogSegment(path, newer_than=None, _block_size=4096):
+  """Reads the log entries of a job from its log segment.
+
+  If C{newer_than} is given, the segment is read backwards from its end
+  until an entry with a lower or equal serial is found, so that only the
+  new entries (and not the whole segment) are read.
+
+  @type path: string
+  @param path: the path of the log segment
+  @type newer_than: None or int
+  @param newer_than: if given, only return the entries with a higher
+      serial
+  @rtype: (list, int)
+  @return: the list of (opcode index, log entry) tuples ordered by their
+      serial, and the number of bytes read
+
+  """
+  try:
+    fd = open(path, "r")
+  except EnvironmentError, err:
+    if err.errno in (errno.ENOENT, ):
+      return ([], 0)
+    raise
+
+  try:
+    if newer_than is None:
+      data = fd.read()
+      return (_ParseLogSegment(data), len(data))
+
+    fd.seek(0, 2)
+    pos = fd.tell()
+    read_size = 0
+    entries = []
+    buf = ""
+    done = False
+    while not done:
+      if pos == 0:
+        # the remaining buffer is the first line
+        lines = [buf]
+        done = True
+      else:
+        size = min(_block_size, pos)
+        pos -= size
+        fd.seek(pos)
+        buf = fd.read(size) + buf
+        read_size += size
+        # the first line might be incomplete
+        lines = buf.split("\n")
+        buf = lines.pop(0)
+
+      lines.reverse()
+      for line in lines:
+        if not line:
+          continue
+        entry = _ParseLogLine(line)
+        if entry is None:
+          continue
+        if entry[1][0] <= newer_than:
+          done = True
+          break
+        entries.append(entry)
+
+    entries.reverse()
+    return (entries, read_size)
+  finally:
+    fd.close()
+
+
 class _QueuedOpCode(object):
   """Encapsulates an opcode object.
 
@@ -138,18 +290,25 @@ class _QueuedOpCode(object):
     obj.priority = state.get("priority", constants.OP_PRIO_DEFAULT)
     return obj
 
-  def Serialize(self):
+  def Serialize(self, include_log=True):
     """Serializes this _QueuedOpCode.
 
+    @type include_log: bool
+    @param include_log: whether to include the log entries
     @rtype: dict
     @return: the dictionary holding the serialized state
 
     """
+    if include_log:
+      log = self.log
+    else:
+      log = []
+
     return {
       "input": self.input.__getstate__(),
       "status": self.status,
       "result": self.result,
-      "log": self.log,
+      "log": log,
       "start_timestamp": self.start_timestamp,
       "exec_timestamp": self.exec_timestamp,
       "end_timestamp": self.end_timestamp,
@@ -251,16 +410,36 @@ class _QueuedJob(object):
 
     return obj
 
-  def Serialize(self):
+  def RestoreLogEntries(self, entries):
+    """Adds log entries read from a log segment.
+
+    Entries already present in the job (i.e. stored in the job file
+    itself by an older version) are ignored.
+
+    @type entries: list
+    @param entries: list of (opcode index, log entry) tuples, ordered
+        by their serial
+
+    """
+    last_serial = self.log_serial
+    for (op_idx, entry) in entries:
+      if entry[0] > last_serial:
+        self.ops[op_idx].log.append(entry)
+        self.log_serial = max(self.log_serial, entry[0])
+
+  def Serialize(self, include_log=True):
     """Serialize the _JobQueue instance.
 
+    @type include_log: bool
+    @param include_log: whether to include the log entries; they are
+        stored separately in the job queue
     @rtype: dict
     @return: the serialized state
 
     """
     return {
       "id": self.id,
-      "ops": [op.Serialize() for op in self.ops],
+      "ops": [op.Serialize(include_log=include_log) for op in self.ops],
       "start_timestamp": self.start_timestamp,
       "end_timestamp": self.end_timestamp,
       "received_timestamp": self.received_timestamp,
@@ -451,7 +630,7 @@ class _QueuedJob(object):
 
 
 class _OpExecCallbacks(mcpu.OpExecCbBase):
-  def __init__(self, queue, job, op):
+  def __init__(self, queue, job, op, lock_wait_fn=None):
     """Initializes this class.
 
     @type queue: L{JobQueue}
@@ -460,6 +639,9 @@ class _OpExecCallbacks(mcpu.OpExecCbBase):
     @param job: Job object
     @type op: L{_QueuedOpCode}
     @param op: OpCode
+    @type lock_wait_fn: callable or None
+    @param lock_wait_fn: Called with C{False} once the opcode's locks have
+      been acquired
 
     """
     assert queue, "Queue is missing"
@@ -469,6 +651,7 @@ class _OpExecCallbacks(mcpu.OpExecCbBase):
     self._queue = queue
     self._job = job
     self._op = op
+    self._lock_wait_fn = lock_wait_fn
 
   def _CheckCancel(self):
     """Raises an exception to cancel the job if asked to.
@@ -498,6 +681,9 @@ class _OpExecCallbacks(mcpu.OpExecCbBase):
 
     logging.debug("Opcode is now running")
 
+    if self._lock_wait_fn:
+      self._lock_wait_fn(False)
+
     self._op.status = constants.OP_STATUS_RUNNING
     self._op.exec_timestamp = TimeStampNow()
 
@@ -510,8 +696,10 @@ class _OpExecCallbacks(mcpu.OpExecCbBase):
 
     """
     self._job.log_serial += 1
-    self._op.log.append((self._job.log_serial, timestamp, log_type, log_msg))
-    self._queue.UpdateJobUnlocked(self._job, replicate=False)
+    entry = (self._job.log_serial, timestamp, log_type, log_msg)
+    self._op.log.append(entry)
+    self._queue.AppendJobLogUnlocked(self._job,
+                                     [(self._job.ops.index(self._op), entry)])
 
   def Feedback(self, *args):
     """Append a log entry.
@@ -577,8 +765,10 @@ class _JobChangesChecker(object):
     # the job info and log entries are compatible to avoid this further step.
     # TODO: Doing something like in testutils.py:UnifyValueType might be more
     # efficient, though floats will be tricky
-    job_info = serializer.LoadJson(serializer.DumpJson(job_info))
-    log_entries = serializer.LoadJson(serializer.DumpJson(log_entries))
+    job_info = serializer.LoadJson(serializer.DumpJson(job_info,
+                                                       indent=False))
+    log_entries = serializer.LoadJson(serializer.DumpJson(log_entries,
+                                                          indent=False))
 
     # Don't even try to wait if the job is no longer running, there will be
     # no changes.
@@ -597,29 +787,39 @@ class _JobFileChangesWaiter(object):
   def __init__(self, filename):
     """Initializes this class.
 
+    Both the job file and, if it exists, its log segment are watched.
+
     @type filename: string
     @param filename: Path to job file
     @raises errors.InotifyError: if the notifier cannot be setup
 
     """
     self._wm = pyinotify.WatchManager()
-    self._inotify_handler = \
-      asyncnotifier.SingleFileEventHandler(self._wm, self._OnInotify, filename)
+    self._inotify_handlers = []
+    for path in [filename, _GetLogSegmentPath(filename)]:
+      if self._inotify_handlers and not os.path.exists(path):
+        continue
+      handler = asyncnotifier.SingleFileEventHandler(self._wm, None, path)
+      handler.callback = compat.partial(self._OnInotify, handler)
+      self._inotify_handlers.append(handler)
     self._notifier = \
-      pyinotify.Notifier(self._wm, default_proc_fun=self._inotify_handler)
+      pyinotify.Notifier(self._wm,
+                         default_proc_fun=self._inotify_handlers[0])
     try:
-      self._inotify_handler.enable()
+      for handler in self._inotify_handlers:
+        handler.enable()
     except Exception:
       # pyinotify doesn't close file descriptors automatically
       self._notifier.stop()
       raise
 
-  def _OnInotify(self, notifier_enabled):
+  @staticmethod
+  def _OnInotify(handler, notifier_enabled):
     """Callback for inotify.
 
     """
     if not notifier_enabled:
-      self._inotify_handler.enable()
+      handler.enable()
 
   def Wait(self, timeout):
     """Waits for the job file to change.
@@ -825,14 +1025,26 @@ class _OpExecContext:
 
 
 class _JobProcessor(object):
-  def __init__(self, queue, opexec_fn, job,
+  def __init__(self, queue, opexec_fn, job, lock_wait_fn=None,
+               pool_priority=None,
                _timeout_strategy_factory=mcpu.LockAttemptTimeoutStrategy):
     """Initializes this class.
 
+    @type lock_wait_fn: callable or None
+    @param lock_wait_fn: Called with C{True} before an opcode starts waiting
+      for its locks and with C{False} once it stopped waiting (see
+      L{workerpool.BaseWorker.SetWaitingForLocks})
+    @type pool_priority: int or None
+    @param pool_priority: Priority with which the worker pool started the
+      job, including aging; locks are acquired with this priority if it's
+      higher than the opcode's
+
     """
     self.queue = queue
     self.opexec_fn = opexec_fn
     self.job = job
+    self._lock_wait_fn = lock_wait_fn
+    self._pool_priority = pool_priority
     self._timeout_strategy_factory = _timeout_strategy_factory
 
   @staticmethod
@@ -912,11 +1124,24 @@ class _JobProcessor(object):
 
     timeout = opctx.GetNextLockTimeout()
 
+    priority = op.priority
+    if self._pool_priority is not None and self._pool_priority < priority:
+      # The job has gained priority while waiting in the queue
+      priority = max(self._pool_priority, constants.OP_PRIO_HIGHEST)
+
+    if self._lock_wait_fn:
+      self._lock_wait_fn(True)
+
     try:
-      # Make sure not to hold queue lock while calling ExecOpCode
-      result = self.opexec_fn(op.input,
-                              _OpExecCallbacks(self.queue, self.job, op),
-                              timeout=timeout, priority=op.priority)
+      try:
+        # Make sure not to hold queue lock while calling ExecOpCode
+        result = self.opexec_fn(op.input,
+                                _OpExecCallbacks(self.queue, self.job, op,
+                                                 self._lock_wait_fn),
+                                timeout=timeout, priority=priority)
+      finally:
+        if self._lock_wait_fn:
+          self._lock_wait_fn(False)
     except mcpu.LockAcquireTimeout:
       assert timeout is not None, "Received timeout for blocking acquire"
       logging.debug("Couldn't acquire locks in %0.6fs", timeout)
@@ -1102,7 +1327,9 @@ class _JobQueueWorker(workerpool.BaseWorker):
 
     proc = mcpu.Processor(queue.context, job.id)
 
-    if not _JobProcessor(queue, proc.ExecOpCode, job)():
+    if not _JobProcessor(queue, proc.ExecOpCode, job,
+                         lock_wait_fn=self.SetWaitingForLocks,
+                         pool_priority=self.GetCurrentPriority())():
       # Schedule again
       raise workerpool.DeferTask(priority=job.CalcPriority())
 
@@ -1112,12 +1339,537 @@ class _JobQueueWorkerPool(workerpool.WorkerPool):
 
   """
   def __init__(self, queue):
-    super(_JobQueueWorkerPool, self).__init__("JobQueue",
-                                              JOBQUEUE_THREADS,
-                                              _JobQueueWorker)
+    super(_JobQueueWorkerPool, self).__init__(
+      "JobQueue", JOBQUEUE_THREADS, _JobQueueWorker,
+      max_workers=JOBQUEUE_MAX_THREADS, aging_interval=JOBQUEUE_PRIORITY_AGING)
     self.queue = queue
 
 
+class _JobIdIndex(object):
+  """Sorted index of job IDs.
+
+  Job IDs are kept sorted by their numeric value, which is the order
+  in which they were allocated. As new jobs always get the highest ID,
+  adding them is cheap.
+
+  """
+  def __init__(self, job_ids=None):
+    """Initializes this class.
+
+    @type job_ids: list
+    @param job_ids: initial job IDs
+
+    """
+    self._keys = []
+    self._ids = []
+    if job_ids:
+      for job_id in utils.NiceSort(job_ids):
+        self._keys.append(int(job_id))
+        self._ids.append(job_id)
+
+  def __len__(self):
+    return len(self._ids)
+
+  def __contains__(self, job_id):
+    key = int(job_id)
+    idx = bisect.bisect_left(self._keys, key)
+    return idx < len(self._keys) and self._keys[idx] == key
+
+  def Add(self, job_id):
+    """Adds a job ID to the index.
+
+    @type job_id: string
+    @param job_id: the job ID
+
+    """
+    key = int(job_id)
+    if self._keys and key > self._keys[-1]:
+      # the common case
+      idx = len(self._keys)
+    else:
+      idx = bisect.bisect_left(self._keys, key)
+      if idx < len(self._keys) and self._keys[idx] == key:
+        return
+    self._keys.insert(idx, key)
+    self._ids.insert(idx, job_id)
+
+  def Remove(self, job_id):
+    """Removes a job ID from the index, if present.
+
+    @type job_id: string
+    @param job_id: the job ID
+
+    """
+    key = int(job_id)
+    idx = bisect.bisect_left(self._keys, key)
+    if idx < len(self._keys) and self._keys[idx] == key:
+      del self._keys[idx]
+      del self._ids[idx]
+
+  def GetAll(self):
+    """Returns all job IDs in ascending order.
+
+    @rtype: list
+
+    """
+    return self._ids[:]
+
+
+class _JobAgeIndex(object):
+  """Index of finished jobs ordered by their age.
+
+  The age of a job is given by its end timestamp or, if missing, by its
+  start or receive timestamp (in seconds).
+
+  """
+  def __init__(self):
+    # job ID -> timestamp
+    self._timestamps = {}
+    # sorted list of (timestamp, numeric job ID, job ID)
+    self._sorted = []
+
+  def __len__(self):
+    return len(self._timestamps)
+
+  @staticmethod
+  def GetJobAge(job):
+    """Returns the timestamp determining a job's age.
+
+    @type job: L{_QueuedJob}
+    @rtype: number
+
+    """
+    if job.end_timestamp is not None:
+      return job.end_timestamp[0]
+    elif job.start_timestamp is not None:
+      return job.start_timestamp[0]
+    else:
+      return job.received_timestamp[0]
+
+  def Add(self, job):
+    """Adds a finished job to the index.
+
+    @type job: L{_QueuedJob}
+    @param job: the job
+
+    """
+    self.Remove(job.id)
+    timestamp = self.GetJobAge(job)
+    self._timestamps[job.id] = timestamp
+    bisect.insort(self._sorted, (timestamp, int(job.id), job.id))
+
+  def Remove(self, job_id):
+    """Removes a job from the index, if present.
+
+    @type job_id: string
+    @param job_id: the job ID
+
+    """
+    timestamp = self._timestamps.pop(job_id, None)
+    if timestamp is not None:
+      key = (timestamp, int(job_id), job_id)
+      idx = bisect.bisect_left(self._sorted, key)
+      assert self._sorted[idx] == key
+      del self._sorted[idx]
+
+  def GetOlderThan(self, timestamp):
+    """Returns the jobs older than the given timestamp.
+
+    @type timestamp: number or None
+    @param timestamp: the timestamp; if None, all jobs are returned
+    @rtype: list
+    @return: the job IDs, oldest first
+
+    """
+    if timestamp is None:
+      end = len(self._sorted)
+    else:
+      end = bisect.bisect_left(self._sorted, (timestamp, ))
+    return [job_id for (_, _, job_id) in self._sorted[:end]]
+
+
+class _FinishedJobsCache(object):
+  """LRU cache of finished jobs.
+
+  Finished jobs no longer change (until they are archived), so they can
+  be kept in memory instead of being re-read from disk on every query.
+  The cache is bounded both by the number of jobs and by their size,
+  estimated from the length of their serialized form.
+
+  Unlike the rest of the job queue, the cache has its own lock, as it
+  is also used by the unlocked query functions.
+
+  """
+  def __init__(self, max_count, max_size):
+    """Initializes this class.
+
+    @type max_count: int
+    @param max_count: maximum number of jobs in the cache
+    @type max_size: int
+    @param max_size: maximum estimated size of all cached jobs
+
+    """
+    self._max_count = max_count
+    self._max_size = max_size
+    self._lock = threading.Lock()
+    # job ID -> (job, size, tick)
+    self._jobs = {}
+    # (tick, job ID) in order of use; entries whose tick doesn't match the
+    # one in L{_jobs} are stale and skipped on eviction
+    self._order = collections.deque()
+    self._tick = 0
+    self._size = 0
+    self.hits = 0
+    self.misses = 0
+
+  def _Touch(self, job_id, job, size):
+    self._tick += 1
+    self._jobs[job_id] = (job, size, self._tick)
+    self._order.append((self._tick, job_id))
+
+    if len(self._order) > 2 * len(self._jobs) + 16:
+      # drop stale entries
+      self._order = collections.deque(item for item in self._order
+                                      if self._IsCurrent(item))
+
+  def _IsCurrent(self, item):
+    (tick, job_id) = item
+    entry = self._jobs.get(job_id, None)
+    return entry is not None and entry[2] == tick
+
+  def Get(self, job_id):
+    """Returns a cached job.
+
+    @type job_id: string
+    @param job_id: the job ID
+    @rtype: L{_QueuedJob} or None
+
+    """
+    self._lock.acquire()
+    try:
+      entry = self._jobs.get(job_id, None)
+      if entry is None:
+        self.misses += 1
+        return None
+
+      self.hits += 1
+      (job, size, _) = entry
+      self._Touch(job_id, job, size)
+      return job
+    finally:
+      self._lock.release()
+
+  def Add(self, job, size):
+    """Adds a finished job to the cache.
+
+    @type job: L{_QueuedJob}
+    @param job: the job
+    @type size: int
+    @param size: the estimated size of the job
+
+    """
+    if size > self._max_size:
+      return
+
+    self._lock.acquire()
+    try:
+      self._RemoveUnlocked(job.id)
+      self._size += size
+      self._Touch(job.id, job, size)
+
+      while len(self._jobs) > self._max_count or self._size > self._max_size:
+        item = self._order.popleft()
+        if self._IsCurrent(item):
+          self._RemoveUnlocked(item[1])
+    finally:
+      self._lock.release()
+
+  def _RemoveUnlocked(self, job_id):
+    entry = self._jobs.pop(job_id, None)
+    if entry is not None:
+      self._size -= entry[1]
+
+  def Remove(self, job_id):
+    """Removes a job from the cache.
+
+    @type job_id: string
+    @param job_id: the job ID
+
+    """
+    self._lock.acquire()
+    try:
+      self._RemoveUnlocked(job_id)
+    finally:
+      self._lock.release()
+
+  def GetStats(self):
+    """Returns statistics about the cache.
+
+    @rtype: dict
+
+    """
+    self._lock.acquire()
+    try:
+      return {
+        "count": len(self._jobs),
+        "size": self._size,
+        "max_count": self._max_count,
+        "max_size": self._max_size,
+        "hits": self.hits,
+        "misses": self.misses,
+        }
+    finally:
+      self._lock.release()
+
+
+class _QueueFileReplicator(object):
+  """Batches the replication of job queue files.
+
+  Updates which don't need to be on the other nodes immediately (e.g.
+  log messages) are deferred and sent in batches, either by a background
+  thread at most L{REPLICATION_DELAY} seconds later or together with
+  the next synchronous update. Multiple deferred updates of the same
+  file are coalesced, as only the latest contents need to be sent;
+  appends to a file are concatenated, or merged into a pending full
+  update of the file.
+
+  All replication RPCs are made while holding an internal lock, so that
+  an older version of a file can't overwrite a newer one on the remote
+  nodes.
+
+  Nodes which missed an update of a file are remembered. Whole files
+  heal with their next successful update, but appended files need to be
+  sent in full again (see L{Send}).
+
+  """
+  def __init__(self, send_fn, delay):
+    """Initializes this class.
+
+    @type send_fn: callable
+    @param send_fn: function replicating a list of (file name, contents,
+        append) tuples in a single RPC, to all nodes or to the nodes given
+        as second argument; returns the nodes on which it failed
+    @type delay: float
+    @param delay: the maximum delay for deferred updates
+
+    """
+    self._send_fn = send_fn
+    self._delay = delay
+    self._send_lock = threading.Lock()
+    self._pending_lock = threading.Lock()
+    self._pending_cond = threading.Condition(self._pending_lock)
+    # file name -> (contents, append)
+    self._pending = {}
+    # file name -> set of nodes which missed updates of the file
+    self._stale = {}
+    self._stop = False
+    self._thread = threading.Thread(target=self._Run,
+                                    name="JobQueueReplicator")
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def _Run(self):
+    """Background thread sending deferred updates.
+
+    """
+    while True:
+      self._pending_lock.acquire()
+      try:
+        while not (self._pending or self._stop):
+          self._pending_cond.wait()
+
+        # give other updates the chance to be batched
+        end_time = time.time() + self._delay
+        while not self._stop:
+          remaining = end_time - time.time()
+          if remaining <= 0:
+            break
+          self._pending_cond.wait(remaining)
+
+        if self._stop:
+          return
+      finally:
+        self._pending_lock.release()
+
+      try:
+        self.Flush()
+      except Exception: # pylint: disable-msg=W0703
+        logging.exception("Error while replicating job queue files")
+
+  def Defer(self, file_name, data, append=False):
+    """Schedules the replication of a file.
+
+    @type file_name: str
+    @param file_name: the path of the file to be replicated
+    @type data: str
+    @param data: the new contents of the file, or the data to append
+    @type append: bool
+    @param append: whether to append the data to the file
+
+    """
+    self._pending_lock.acquire()
+    try:
+      if append and file_name in self._pending:
+        (old_data, old_append) = self._pending[file_name]
+        self._pending[file_name] = (old_data + data, old_append)
+      else:
+        self._pending[file_name] = (data, append)
+      self._pending_cond.notifyAll()
+    finally:
+      self._pending_lock.release()
+
+  def Send(self, files=None, resend=None):
+    """Replicates all deferred updates, and optionally more files, now.
+
+    @type files: list of (str, str)
+    @param files: list of (file name, contents) tuples to be replicated
+        together with the deferred updates
+    @type resend: list of (str, str)
+    @param resend: list of (file name, contents) tuples with the complete
+        contents of files to be written on the nodes which missed updates
+        of them (see L{HasStaleNodes}); the files must not be changed
+        concurrently
+
+    """
+    self._send_lock.acquire()
+    try:
+      self._pending_lock.acquire()
+      try:
+        pending = self._pending
+        self._pending = {}
+      finally:
+        self._pending_lock.release()
+
+      if files:
+        for (file_name, data) in files:
+          pending[file_name] = (data, False)
+
+      if pending:
+        names = pending.keys()
+        names.sort()
+        batch = [(name, ) + pending[name] for name in names]
+        try:
+          failed = self._send_fn(batch)
+        except: # pylint: disable-msg=W0702
+          # Don't lose the updates, especially appends
+          self._RestorePending(pending)
+          raise
+        self._UpdateStaleUnlocked(batch, failed)
+
+      if resend:
+        for (file_name, data) in resend:
+          nodes = self._stale.get(file_name, None)
+          if nodes:
+            logging.info("Sending %s again to %s", file_name,
+                         utils.CommaJoin(nodes))
+            batch = [(file_name, data, False)]
+            failed = self._send_fn(batch, utils.NiceSort(nodes))
+            self._UpdateStaleUnlocked(batch, failed)
+    finally:
+      self._send_lock.release()
+
+  def _UpdateStaleUnlocked(self, files, failed):
+    """Records the nodes which missed updates of files.
+
+    @type files: list of (str, str, bool)
+    @param files: list of (file name, contents, append) tuples sent
+    @type failed: list
+    @param failed: the nodes on which sending the files failed
+
+    """
+    for (file_name, _, append) in files:
+      nodes = set(failed)
+      if append:
+        # Nodes missing an earlier update are still outdated
+        nodes.update(self._stale.get(file_name, []))
+      if nodes:
+        self._stale[file_name] = nodes
+      else:
+        self._stale.pop(file_name, None)
+
+  def HasStaleNodes(self, file_name):
+    """Returns whether nodes missed updates of a file.
+
+    @type file_name: str
+    @param file_name: the path of the file
+
+    """
+    self._send_lock.acquire()
+    try:
+      return bool(self._stale.get(file_name, None))
+    finally:
+      self._send_lock.release()
+
+  def Forget(self, file_names=None, node=None):
+    """Stops tracking missed updates of files or of a node.
+
+    Used after files have been renamed or removed, or after a node has
+    been removed or received all files.
+
+    @type file_names: list of str
+    @param file_names: the paths of the files
+    @type node: str
+    @param node: the name of the node
+
+    """
+    self._send_lock.acquire()
+    try:
+      if file_names:
+        for file_name in file_names:
+          self._stale.pop(file_name, None)
+
+      if node is not None:
+        for (file_name, nodes) in self._stale.items():
+          nodes.discard(node)
+          if not nodes:
+            del self._stale[file_name]
+    finally:
+      self._send_lock.release()
+
+  def _RestorePending(self, pending):
+    """Schedules updates again after they couldn't be sent.
+
+    Updates deferred in the meantime are newer and take precedence;
+    appends are merged into the restored update.
+
+    @type pending: dict
+    @param pending: file name -> (contents, append)
+
+    """
+    self._pending_lock.acquire()
+    try:
+      for (file_name, (data, append)) in pending.items():
+        if file_name in self._pending:
+          (new_data, new_append) = self._pending[file_name]
+          if not new_append:
+            continue
+          data += new_data
+        self._pending[file_name] = (data, append)
+      self._pending_cond.notifyAll()
+    finally:
+      self._pending_lock.release()
+
+  def Flush(self):
+    """Replicates all deferred updates now.
+
+    """
+    self.Send()
+
+  def Stop(self):
+    """Stops the background thread after sending pending updates.
+
+    """
+    self._pending_lock.acquire()
+    try:
+      self._stop = True
+      self._pending_cond.notifyAll()
+    finally:
+      self._pending_lock.release()
+
+    self._thread.join()
+    self.Flush()
+
+
 def _RequireOpenQueue(fn):
   """Decorator for "public" functions.
 
@@ -1166,6 +1918,12 @@ class JobQueue(object):
     """
     self.context = context
     self._memcache = weakref.WeakValueDictionary()
+    self._finished_jobs = _FinishedJobsCache(FINISHED_JOBS_CACHE_COUNT,
+                                             FINISHED_JOBS_CACHE_MEMORY)
+    self._job_ids = _JobIdIndex()
+    self._job_ages = _JobAgeIndex()
+    self._archived_job_ids = set()
+    self._autoarchive_progress = None
     self._my_hostname = netutils.Hostname.GetSysName()
 
     # The Big JobQueue lock. If a code block or method acquires it in shared
@@ -1198,15 +1956,18 @@ class JobQueue(object):
     # TODO: Check consistency across nodes
 
     self._queue_size = 0
-    self._UpdateQueueSizeUnlocked()
     self._drained = self._IsQueueMarkedDrain()
 
+    self._replicator = _QueueFileReplicator(self._SendQueueFiles,
+                                            REPLICATION_DELAY)
+
     # Setup worker pool
     self._wpool = _JobQueueWorkerPool(self)
     try:
       self._InspectQueue()
     except:
       self._wpool.TerminateWorkers()
+      self._replicator.Stop()
       raise
 
   @locking.ssynchronized(_LOCK)
@@ -1222,6 +1983,13 @@ class JobQueue(object):
 
     restartjobs = []
 
+    # this is the only place where the job IDs are read from disk; the age
+    # index is filled while loading the jobs below
+    self._job_ids = _JobIdIndex(self._ScanJobIDsUnlocked())
+    self._job_ages = _JobAgeIndex()
+    self._UpdateQueueSizeUnlocked()
+    self._archived_job_ids = jstore.ReadArchiveIndex()
+
     all_job_ids = self._GetJobIDsUnlocked()
     jobs_count = len(all_job_ids)
     lastinfo = time.time()
@@ -1280,11 +2048,22 @@ class JobQueue(object):
     if not node.master_candidate:
       # remove if existing, ignoring errors
       self._nodes.pop(node_name, None)
+      self._replicator.Forget(node=node_name)
       # and skip the replication of the job ids
       return
 
+    # Deferred updates must not be replicated to the new node, as they're
+    # already part of the files uploaded below
+    self._replicator.Flush()
+
     # Upload the whole queue excluding archived jobs
-    files = [self._GetJobPath(job_id) for job_id in self._GetJobIDsUnlocked()]
+    files = []
+    for job_id in self._GetJobIDsUnlocked():
+      job_path = self._GetJobPath(job_id)
+      log_path = _GetLogSegmentPath(job_path)
+      if os.path.exists(log_path):
+        files.append(log_path)
+      files.append(job_path)
 
     # Upload current serial file
     files.append(constants.JOB_QUEUE_SERIAL_FILE)
@@ -1301,6 +2080,9 @@ class JobQueue(object):
         logging.error("Failed to upload file %s to node %s: %s",
                       file_name, node_name, msg)
 
+    # The node received the complete files
+    self._replicator.Forget(node=node_name)
+
     self._nodes[node_name] = node.primary_ip
 
   @locking.ssynchronized(_LOCK)
@@ -1313,6 +2095,7 @@ class JobQueue(object):
 
     """
     self._nodes.pop(node_name, None)
+    self._replicator.Forget(node=node_name)
 
   @staticmethod
   def _CheckRpcResult(result, nodes, failmsg):
@@ -1327,6 +2110,8 @@ class JobQueue(object):
     @param nodes: the list of nodes we made the call to
     @type failmsg: str
     @param failmsg: the identifier to be used for logging
+    @rtype: list
+    @return: the nodes on which the call failed
 
     """
     failed = []
@@ -1346,6 +2131,8 @@ class JobQueue(object):
       # TODO: Handle failing nodes
       logging.error("More than half of the nodes failed")
 
+    return failed
+
   def _GetNodeIp(self):
     """Helper for returning the node name/ip list.
 
@@ -1354,52 +2141,118 @@ class JobQueue(object):
         names and the second one with the node addresses
 
     """
-    # TODO: Change to "tuple(map(list, zip(*self._nodes.items())))"?
-    name_list = self._nodes.keys()
-    addr_list = [self._nodes[name] for name in name_list]
+    # Nodes can be added or removed concurrently while files are
+    # replicated in the background, hence the list is built from one copy
+    nodes = self._nodes.items()
+    name_list = [name for (name, _) in nodes]
+    addr_list = [addr for (_, addr) in nodes]
     return name_list, addr_list
 
-  def _UpdateJobQueueFile(self, file_name, data, replicate):
-    """Writes a file locally and then replicates it to all nodes.
+  def _UpdateJobQueueFiles(self, files, replicate, resend=None):
+    """Writes files locally and then replicates them to all nodes.
 
-    This function will replace the contents of a file on the local
-    node and then replicate it to all the other nodes we have.
+    This function will replace the contents of the files on the local
+    node and then replicate them to all the other nodes we have.
 
-    @type file_name: str
-    @param file_name: the path of the file to be replicated
-    @type data: str
-    @param data: the new contents of the file
+    @type files: list of (str, str)
+    @param files: list of (file name, contents) tuples
     @type replicate: boolean
     @param replicate: whether to spread the changes to the remote nodes
+        immediately, together with any deferred updates; otherwise the
+        replication is deferred and batched with other updates
+    @type resend: list of (str, str)
+    @param resend: complete contents of files to be sent again to nodes
+        which missed updates of them, see L{_QueueFileReplicator.Send}
 
     """
     getents = runtime.GetEnts()
-    utils.WriteFile(file_name, data=data, uid=getents.masterd_uid,
-                    gid=getents.masterd_gid)
+    for (file_name, data) in files:
+      utils.WriteFile(file_name, data=data, uid=getents.masterd_uid,
+                      gid=getents.masterd_gid)
 
     if replicate:
-      names, addrs = self._GetNodeIp()
-      result = rpc.RpcRunner.call_jobqueue_update(names, addrs, file_name, data)
-      self._CheckRpcResult(result, self._nodes, "Updating %s" % file_name)
+      self._replicator.Send(files, resend=resend)
+    else:
+      for (file_name, data) in files:
+        self._replicator.Defer(file_name, data)
+
+  def _AppendJobQueueFile(self, file_name, data):
+    """Appends to a file locally and defers its replication.
+
+    @type file_name: str
+    @param file_name: the path of the file
+    @type data: str
+    @param data: the data to append
+
+    """
+    jstore.AppendQueueFile(file_name, data)
+    self._replicator.Defer(file_name, data, append=True)
+
+  def _SendQueueFiles(self, files, nodes=None):
+    """Replicates files to all nodes in a single RPC.
+
+    @type files: list of (str, str, bool)
+    @param files: list of (file name, contents, append) tuples
+    @type nodes: list or None
+    @param nodes: only send the files to these nodes, if they're still
+        part of the queue's node list
+    @rtype: list
+    @return: the nodes on which the update failed
+
+    """
+    names, addrs = self._GetNodeIp()
+    if nodes is not None:
+      selected = [(name, addr) for (name, addr) in zip(names, addrs)
+                  if name in nodes]
+      names = [name for (name, _) in selected]
+      addrs = [addr for (_, addr) in selected]
+
+    if not names:
+      return []
+
+    result = rpc.RpcRunner.call_jobqueue_update_many(names, addrs, files)
+    return self._CheckRpcResult(result, names,
+                                "Updating %s" %
+                                utils.CommaJoin(name for (name, _, _) in files))
 
   def _RenameFilesUnlocked(self, rename):
     """Renames a file locally and then replicate the change.
 
     This function will rename a file in the local queue directory
     and then replicate this rename to all the other nodes we have.
+    Renamed job files are removed from the job ID index, and jobs
+    moved to the archive are added to the archive index.
 
     @type rename: list of (old, new)
     @param rename: List containing tuples mapping old to new names
 
     """
     # Rename them locally
-    for old, new in rename:
-      utils.RenameFile(old, new, mkdir=True)
+    archived = []
+    try:
+      for old, new in rename:
+        utils.RenameFile(old, new, mkdir=True)
+
+        m = self._RE_JOB_FILE.match(os.path.basename(old))
+        if m and os.path.dirname(old) == constants.QUEUE_DIR:
+          self._job_ids.Remove(m.group(1))
+          self._job_ages.Remove(m.group(1))
+          self._finished_jobs.Remove(m.group(1))
+
+        job_id = jstore.GetArchivedJobIDFromPath(new)
+        if job_id is not None:
+          archived.append(job_id)
+    finally:
+      self._UpdateQueueSizeUnlocked()
+      self._archived_job_ids.update(archived)
+      jstore.AppendArchiveIndex(archived)
 
-    # ... and on all nodes
+    # ... and on all nodes, after any deferred update of the files
+    self._replicator.Flush()
+    self._replicator.Forget(file_names=[old for (old, _) in rename])
     names, addrs = self._GetNodeIp()
     result = rpc.RpcRunner.call_jobqueue_rename(names, addrs, rename)
-    self._CheckRpcResult(result, self._nodes, "Renaming files (%r)" % rename)
+    self._CheckRpcResult(result, names, "Renaming files (%r)" % rename)
 
   @staticmethod
   def _FormatJobID(job_id):
@@ -1450,8 +2303,8 @@ class JobQueue(object):
     serial = self._last_serial + count
 
     # Write to file
-    self._UpdateJobQueueFile(constants.JOB_QUEUE_SERIAL_FILE,
-                             "%s\n" % serial, True)
+    self._UpdateJobQueueFiles([(constants.JOB_QUEUE_SERIAL_FILE,
+                                "%s\n" % serial)], True)
 
     result = [self._FormatJobID(v)
               for v in range(self._last_serial, serial + 1)]
@@ -1472,6 +2325,26 @@ class JobQueue(object):
     """
     return utils.PathJoin(constants.QUEUE_DIR, "job-%s" % job_id)
 
+  @staticmethod
+  def _GetJobFilesRename(old, new):
+    """Returns the renames needed to move a job's files.
+
+    @type old: str
+    @param old: the current path of the job file
+    @type new: str
+    @param new: the new path of the job file
+    @rtype: list of (old, new)
+    @return: the renames for the job file and, if it exists, its log
+        segment; the job file is renamed last
+
+    """
+    result = []
+    old_log = _GetLogSegmentPath(old)
+    if os.path.exists(old_log):
+      result.append((old_log, _GetLogSegmentPath(new)))
+    result.append((old, new))
+    return result
+
   @classmethod
   def _GetArchivedJobPath(cls, job_id):
     """Returns the archived job file for a give job id.
@@ -1485,17 +2358,23 @@ class JobQueue(object):
     return utils.PathJoin(constants.JOB_QUEUE_ARCHIVE_DIR,
                           cls._GetArchiveDirectory(job_id), "job-%s" % job_id)
 
-  def _GetJobIDsUnlocked(self, sort=True):
+  def _GetJobIDsUnlocked(self):
     """Return all known job IDs.
 
-    The method only looks at disk because it's a requirement that all
-    jobs are present on disk (so in the _memcache we don't have any
-    extra IDs).
+    The IDs are taken from the in-memory index, which is kept in sync
+    with the job files in the queue directory.
 
-    @type sort: boolean
-    @param sort: perform sorting on the returned job ids
     @rtype: list
-    @return: the list of job IDs
+    @return: the sorted list of job IDs
+
+    """
+    return self._job_ids.GetAll()
+
+  def _ScanJobIDsUnlocked(self):
+    """Lists the job IDs present in the queue directory.
+
+    @rtype: list
+    @return: the unsorted list of job IDs
 
     """
     jlist = []
@@ -1503,10 +2382,17 @@ class JobQueue(object):
       m = self._RE_JOB_FILE.match(filename)
       if m:
         jlist.append(m.group(1))
-    if sort:
-      jlist = utils.NiceSort(jlist)
     return jlist
 
+  def _GetArchivedJobIDsUnlocked(self):
+    """Return the IDs of all archived jobs.
+
+    @rtype: list
+    @return: the sorted list of archived job IDs
+
+    """
+    return utils.NiceSort(self._archived_job_ids)
+
   def _LoadJobUnlocked(self, job_id):
     """Loads a job from the disk or memory.
 
@@ -1524,8 +2410,17 @@ class JobQueue(object):
       logging.debug("Found job %s in memcache", job_id)
       return job
 
+    # the unlocked query functions can add a job to the cache of finished
+    # jobs while it's being archived
+    if job_id in self._job_ids:
+      job = self._finished_jobs.Get(job_id)
+      if job:
+        logging.debug("Found job %s in the finished jobs cache", job_id)
+        self._memcache[job_id] = job
+        return job
+
     try:
-      job = self._LoadJobFromDisk(job_id)
+      (job, size) = self._LoadJobAndSizeFromDisk(job_id)
       if job is None:
         return job
     except errors.JobFileCorrupted:
@@ -1537,42 +2432,121 @@ class JobQueue(object):
       else:
         # non-archived case
         logging.exception("Can't parse job %s, will archive.", job_id)
-        self._RenameFilesUnlocked([(old_path, new_path)])
+        self._RenameFilesUnlocked(self._GetJobFilesRename(old_path, new_path))
       return None
 
     self._memcache[job_id] = job
     logging.debug("Added job %s to the cache", job_id)
+    if job.CalcStatus() in constants.JOBS_FINALIZED:
+      self._job_ages.Add(job)
+      self._finished_jobs.Add(job, size)
+    return job
+
+  def _CacheIfFinished(self, job, size):
+    """Adds a job to the cache of finished jobs if it's finalized.
+
+    @type job: L{_QueuedJob}
+    @param job: the job
+    @type size: int
+    @param size: the size of the serialized job
+
+    """
+    if job.CalcStatus() in constants.JOBS_FINALIZED:
+      self._finished_jobs.Add(job, size)
+
+  def _SafeLoadJobCached(self, job_id, log_newer_than=None):
+    """Loads a job, using the cache of finished jobs.
+
+    This function doesn't need the queue lock and never returns jobs
+    which are not yet finished from memory, as they can change.
+
+    @type job_id: string
+    @param job_id: job identifier
+    @type log_newer_than: None or int
+    @param log_newer_than: if given and the job is not in the cache, only
+        read the log entries with a higher serial from disk (see
+        L{_LoadJobAndSizeFromDisk})
+    @rtype: L{_QueuedJob} or None
+    @return: either None or the job object
+
+    """
+    job = self._finished_jobs.Get(job_id)
+    if job is not None:
+      return job
+
+    try:
+      (job, size) = self._LoadJobAndSizeFromDisk(job_id,
+                                                 log_newer_than=log_newer_than)
+    except (errors.JobFileCorrupted, EnvironmentError):
+      logging.exception("Can't load/parse job %s", job_id)
+      return None
+
+    # only complete jobs can be cached
+    if job is not None and log_newer_than is None:
+      self._CacheIfFinished(job, size)
+
     return job
 
-  def _LoadJobFromDisk(self, job_id):
+  def _LoadJobFromDisk(self, job_id, try_archived=False):
     """Load the given job file from disk.
 
     Given a job file, read, load and restore it in a _QueuedJob format.
 
     @type job_id: string
     @param job_id: job identifier
+    @type try_archived: bool
+    @param try_archived: whether to look for the job in the archive if
+        it's not in the queue directory
     @rtype: L{_QueuedJob} or None
     @return: either None or the job object
 
     """
-    filepath = self._GetJobPath(job_id)
-    logging.debug("Loading job from %s", filepath)
-    try:
-      raw_data = utils.ReadFile(filepath)
-    except EnvironmentError, err:
-      if err.errno in (errno.ENOENT, ):
-        return None
-      raise
+    return self._LoadJobAndSizeFromDisk(job_id, try_archived=try_archived)[0]
+
+  def _LoadJobAndSizeFromDisk(self, job_id, try_archived=False,
+                              log_newer_than=None):
+    """Load the given job file from disk and returns its size.
+
+    See L{_LoadJobFromDisk}.
+
+    @type log_newer_than: None or int
+    @param log_newer_than: if given, only the log entries with a higher
+        serial are read from the job's log segment; the returned job must
+        then only be used for looking at these entries and its status
+    @rtype: tuple; (L{_QueuedJob} or None, int)
+    @return: the job object (or None) and the size of the job files read
+
+    """
+    filepaths = [self._GetJobPath(job_id)]
+    if try_archived and job_id in self._archived_job_ids:
+      filepaths.append(self._GetArchivedJobPath(job_id))
+
+    raw_data = None
+    for filepath in filepaths:
+      logging.debug("Loading job from %s", filepath)
+      try:
+        raw_data = utils.ReadFile(filepath)
+        break
+      except EnvironmentError, err:
+        if err.errno not in (errno.ENOENT, ):
+          raise
+
+    if raw_data is None:
+      return (None, 0)
+
+    (log_entries, log_size) = _ReadLogSegment(_GetLogSegmentPath(filepath),
+                                              newer_than=log_newer_than)
 
     try:
       data = serializer.LoadJson(raw_data)
       job = _QueuedJob.Restore(self, data)
+      job.RestoreLogEntries(log_entries)
     except Exception, err: # pylint: disable-msg=W0703
       raise errors.JobFileCorrupted(err)
 
-    return job
+    return (job, len(raw_data) + log_size)
 
-  def SafeLoadJobFromDisk(self, job_id):
+  def SafeLoadJobFromDisk(self, job_id, try_archived=False):
     """Load the given job file from disk.
 
     Given a job file, read, load and restore it in a _QueuedJob format.
@@ -1581,12 +2555,15 @@ class JobQueue(object):
 
     @type job_id: string
     @param job_id: job identifier
+    @type try_archived: bool
+    @param try_archived: whether to look for the job in the archive if
+        it's not in the queue directory
     @rtype: L{_QueuedJob} or None
     @return: either None or the job object
 
     """
     try:
-      return self._LoadJobFromDisk(job_id)
+      return self._LoadJobFromDisk(job_id, try_archived=try_archived)
     except (errors.JobFileCorrupted, EnvironmentError):
       logging.exception("Can't load/parse job %s", job_id)
       return None
@@ -1608,7 +2585,7 @@ class JobQueue(object):
     """Update the queue size.
 
     """
-    self._queue_size = len(self._GetJobIDsUnlocked(sort=False))
+    self._queue_size = len(self._job_ids)
 
   @locking.ssynchronized(_LOCK)
   @_RequireOpenQueue
@@ -1669,6 +2646,7 @@ class JobQueue(object):
     # Write to disk
     self.UpdateJobUnlocked(job)
 
+    self._job_ids.Add(job_id)
     self._queue_size += 1
 
     logging.debug("Adding new job %s to the cache", job_id)
@@ -1678,21 +2656,26 @@ class JobQueue(object):
 
   @locking.ssynchronized(_LOCK)
   @_RequireOpenQueue
-  def SubmitJob(self, ops):
+  def SubmitJob(self, ops, submitter=None):
     """Create and store a new job.
 
+    @param submitter: Identifier of the client submitting the job, see
+      L{workerpool.WorkerPool.AddTask}
     @see: L{_SubmitJobUnlocked}
 
     """
     job_id = self._NewSerialsUnlocked(1)[0]
-    self._EnqueueJobs([self._SubmitJobUnlocked(job_id, ops)])
+    self._EnqueueJobs([self._SubmitJobUnlocked(job_id, ops)],
+                      submitter=submitter)
     return job_id
 
   @locking.ssynchronized(_LOCK)
   @_RequireOpenQueue
-  def SubmitManyJobs(self, jobs):
+  def SubmitManyJobs(self, jobs, submitter=None):
     """Create and store multiple jobs.
 
+    @param submitter: Identifier of the client submitting the jobs, see
+      L{workerpool.WorkerPool.AddTask}
     @see: L{_SubmitJobUnlocked}
 
     """
@@ -1709,19 +2692,21 @@ class JobQueue(object):
         status = False
       results.append((status, data))
 
-    self._EnqueueJobs(added_jobs)
+    self._EnqueueJobs(added_jobs, submitter=submitter)
 
     return results
 
-  def _EnqueueJobs(self, jobs):
+  def _EnqueueJobs(self, jobs, submitter=None):
     """Helper function to add jobs to worker pool's queue.
 
     @type jobs: list
     @param jobs: List of all jobs
+    @param submitter: Identifier of the client submitting the jobs
 
     """
     self._wpool.AddManyTasks([(job, ) for job in jobs],
-                             priority=[job.CalcPriority() for job in jobs])
+                             priority=[job.CalcPriority() for job in jobs],
+                             submitter=submitter)
 
   @_RequireOpenQueue
   def UpdateJobUnlocked(self, job, replicate=True):
@@ -1731,16 +2716,63 @@ class JobQueue(object):
     order to write the changes to disk and replicate them to the other
     nodes.
 
+    The log entries are not part of the job file, but are stored in a
+    separate log segment (see L{AppendJobLogUnlocked}). The segment is
+    only written here if it doesn't exist yet, e.g. for new jobs. When
+    replicating, it is also sent in full to nodes which missed appends
+    to it, at the latest when the job is finalized.
+
     @type job: L{_QueuedJob}
     @param job: the changed job
     @type replicate: boolean
     @param replicate: whether to replicate the change to remote nodes
+        immediately; this must be done for status changes
 
     """
     filename = self._GetJobPath(job.id)
-    data = serializer.DumpJson(job.Serialize(), indent=False)
+    log_filename = _GetLogSegmentPath(filename)
+    data = serializer.DumpJson(job.Serialize(include_log=False), indent=False)
+
+    files = []
+    resend = []
+    if not os.path.exists(log_filename):
+      log_data = _FormatLogEntries([(op_idx, entry)
+                                    for (op_idx, op) in enumerate(job.ops)
+                                    for entry in op.log])
+      files.append((log_filename, log_data))
+    elif replicate and self._replicator.HasStaleNodes(log_filename):
+      # The job's log isn't changed concurrently, entries are only added
+      # by the job itself
+      resend.append((log_filename, utils.ReadFile(log_filename)))
+    # the job file must be written last, so that the log entries are
+    # never lost when converting a job file still holding them
+    files.append((filename, data))
+
     logging.debug("Writing job %s to %s", job.id, filename)
-    self._UpdateJobQueueFile(filename, data, replicate)
+    self._UpdateJobQueueFiles(files, replicate, resend=resend)
+
+    if job.CalcStatus() in constants.JOBS_FINALIZED:
+      self._job_ages.Add(job)
+      self._finished_jobs.Add(job, len(data) + os.path.getsize(log_filename))
+
+  def AppendJobLogUnlocked(self, job, entries):
+    """Appends log entries to a job's log segment.
+
+    This is much cheaper than rewriting the whole job, and the
+    replication of the new entries is deferred.
+
+    @type job: L{_QueuedJob}
+    @param job: the job, already holding the new entries
+    @type entries: list
+    @param entries: list of (opcode index, log entry) tuples
+
+    """
+    log_filename = _GetLogSegmentPath(self._GetJobPath(job.id))
+    if not os.path.exists(log_filename):
+      # job written by an older version, with the log in the job file
+      self.UpdateJobUnlocked(job, replicate=False)
+    else:
+      self._AppendJobQueueFile(log_filename, _FormatLogEntries(entries))
 
   def WaitForJobChanges(self, job_id, fields, prev_job_info, prev_log_serial,
                         timeout):
@@ -1766,7 +2798,14 @@ class JobQueue(object):
         as such by the clients
 
     """
-    load_fn = compat.partial(self.SafeLoadJobFromDisk, job_id)
+    if "oplog" in fields:
+      # the complete log is needed
+      log_newer_than = None
+    else:
+      log_newer_than = prev_log_serial
+
+    load_fn = compat.partial(self._SafeLoadJobCached, job_id,
+                             log_newer_than=log_newer_than)
 
     helper = _WaitForJobChangesHelper()
 
@@ -1808,31 +2847,39 @@ class JobQueue(object):
     @return: Number of archived jobs
 
     """
-    archive_jobs = []
-    rename_files = []
+    job_ids = []
     for job in jobs:
       if job.CalcStatus() not in constants.JOBS_FINALIZED:
         logging.debug("Job %s is not yet done", job.id)
         continue
 
-      archive_jobs.append(job)
+      job_ids.append(job.id)
+
+    return self._ArchiveJobIDsUnlocked(job_ids)
+
+  def _ArchiveJobIDsUnlocked(self, job_ids):
+    """Archives finished jobs given by their IDs.
 
-      old = self._GetJobPath(job.id)
-      new = self._GetArchivedJobPath(job.id)
-      rename_files.append((old, new))
+    @type job_ids: list of strings
+    @param job_ids: the IDs of finished jobs
+    @rtype: int
+    @return: Number of archived jobs
+
+    """
+    rename_files = []
+    for job_id in job_ids:
+      old = self._GetJobPath(job_id)
+      new = self._GetArchivedJobPath(job_id)
+      rename_files.extend(self._GetJobFilesRename(old, new))
 
     # TODO: What if 1..n files fail to rename?
     self._RenameFilesUnlocked(rename_files)
 
-    logging.debug("Successfully archived job(s) %s",
-                  utils.CommaJoin(job.id for job in archive_jobs))
+    logging.debug("Successfully archived job(s) %s", utils.CommaJoin(job_ids))
 
-    # Since we haven't quite checked, above, if we succeeded or failed renaming
-    # the files, we update the cached queue size from the filesystem. When we
-    # get around to fix the TODO: above, we can use the number of actually
-    # archived jobs to fix this.
-    self._UpdateQueueSizeUnlocked()
-    return len(archive_jobs)
+    # The queue size is updated from the job ID index while renaming
+    # the files, so it accounts for renames which failed
+    return len(job_ids)
 
   @locking.ssynchronized(_LOCK)
   @_RequireOpenQueue
@@ -1856,8 +2903,31 @@ class JobQueue(object):
 
     return self._ArchiveJobsUnlocked([job]) == 1
 
+  @locking.ssynchronized(_LOCK, shared=1)
+  @_RequireOpenQueue
+  def _GetJobsOlderThan(self, timestamp):
+    """Returns the finished jobs older than a timestamp.
+
+    See L{_JobAgeIndex.GetOlderThan}.
+
+    """
+    return self._job_ages.GetOlderThan(timestamp)
+
   @locking.ssynchronized(_LOCK)
   @_RequireOpenQueue
+  def _AutoArchiveChunk(self, job_ids):
+    """Archives a chunk of jobs selected by L{AutoArchiveJobs}.
+
+    @type job_ids: list of strings
+    @param job_ids: the IDs of finished jobs
+    @rtype: int
+    @return: Number of archived jobs
+
+    """
+    # jobs might have been archived since they were selected
+    job_ids = [job_id for job_id in job_ids if job_id in self._job_ids]
+    return self._ArchiveJobIDsUnlocked(job_ids)
+
   def AutoArchiveJobs(self, age, timeout):
     """Archives all jobs based on age.
 
@@ -1866,51 +2936,55 @@ class JobQueue(object):
     timestamp will be considered. The special '-1' age will cause
     archival of all jobs (that are not running or queued).
 
+    The jobs are selected using the in-memory age index, oldest first,
+    and archived in chunks of L{AUTOARCHIVE_CHUNK_SIZE} jobs; the queue
+    lock is released between chunks, so that e.g. job submissions are
+    not blocked for long.
+
     @type age: int
     @param age: the minimum age in seconds
+    @type timeout: number
+    @param timeout: the maximum time to spend archiving
+    @rtype: tuple; (int, int)
+    @return: the number of archived jobs and the number of jobs which
+        were not archived because the timeout was reached
 
     """
     logging.info("Archiving jobs with age more than %s seconds", age)
 
     now = time.time()
     end_time = now + timeout
-    archived_count = 0
-    last_touched = 0
-
-    all_job_ids = self._GetJobIDsUnlocked()
-    pending = []
-    for idx, job_id in enumerate(all_job_ids):
-      last_touched = idx + 1
 
-      # Not optimal because jobs could be pending
-      # TODO: Measure average duration for job archival and take number of
-      # pending jobs into account.
-      if time.time() > end_time:
-        break
+    if age == -1:
+      pending = self._GetJobsOlderThan(None)
+    else:
+      pending = self._GetJobsOlderThan(now - age)
 
-      # Returns None if the job failed to load
-      job = self._LoadJobUnlocked(job_id)
-      if job:
-        if job.end_timestamp is None:
-          if job.start_timestamp is None:
-            job_age = job.received_timestamp
-          else:
-            job_age = job.start_timestamp
-        else:
-          job_age = job.end_timestamp
+    total = len(pending)
+    archived_count = 0
+    self._autoarchive_progress = {
+      "running": True,
+      "archived": 0,
+      "total": total,
+      }
+    try:
+      while pending:
+        # TODO: Measure average duration for job archival and take number of
+        # pending jobs into account.
+        if time.time() > end_time:
+          break
 
-        if age == -1 or now - job_age[0] > age:
-          pending.append(job)
+        chunk = pending[:AUTOARCHIVE_CHUNK_SIZE]
+        del pending[:AUTOARCHIVE_CHUNK_SIZE]
 
-          # Archive 10 jobs at a time
-          if len(pending) >= 10:
-            archived_count += self._ArchiveJobsUnlocked(pending)
-            pending = []
+        archived_count += self._AutoArchiveChunk(chunk)
 
-    if pending:
-      archived_count += self._ArchiveJobsUnlocked(pending)
+        self._autoarchive_progress["archived"] = archived_count
+        logging.info("Archived %s of %s jobs", archived_count, total)
+    finally:
+      self._autoarchive_progress["running"] = False
 
-    return (archived_count, len(all_job_ids) - last_touched)
+    return (archived_count, len(pending))
 
   def QueryJobs(self, job_ids, fields):
     """Returns a list of jobs in queue.
@@ -1927,13 +3001,17 @@ class JobQueue(object):
     jobs = []
     list_all = False
     if not job_ids:
-      # Since files are added to/removed from the queue atomically, there's no
-      # risk of getting the job ids in an inconsistent state.
+      # The job ID index returns a copy of its contents and is updated
+      # together with the job files, so there's no risk of getting the job
+      # ids in an inconsistent state.
       job_ids = self._GetJobIDsUnlocked()
       list_all = True
 
     for job_id in job_ids:
-      job = self.SafeLoadJobFromDisk(job_id)
+      job = self._SafeLoadJobCached(job_id)
+      if job is None and not list_all:
+        # explicitly requested jobs can be looked up in the archive
+        job = self.SafeLoadJobFromDisk(job_id, try_archived=True)
       if job is not None:
         jobs.append(job.GetInfo(fields))
       elif not list_all:
@@ -1941,6 +3019,29 @@ class JobQueue(object):
 
     return jobs
 
+  def QueryStats(self):
+    """Returns statistics about the job queue.
+
+    @rtype: dict
+    @return: dictionary with the queue size, the statistics of the cache
+        of finished jobs (under the "finished_cache" key), the
+        progress of the last job auto-archival (under the "autoarchive"
+        key, None if there hasn't been one) and the size and task
+        statistics of the worker pool (under the "workers" key, see
+        L{workerpool.WorkerPool.GetStats})
+
+    """
+    progress = self._autoarchive_progress
+    if progress is not None:
+      progress = progress.copy()
+
+    return {
+      "size": self._queue_size,
+      "finished_cache": self._finished_jobs.GetStats(),
+      "autoarchive": progress,
+      "workers": self._wpool.GetStats(),
+      }
+
   @locking.ssynchronized(_LOCK)
   @_RequireOpenQueue
   def Shutdown(self):
@@ -1950,6 +3051,7 @@ class JobQueue(object):
 
     """
     self._wpool.TerminateWorkers()
+    self._replicator.Stop()
 
     self._queue_filelock.Close()
     self._queue_filelock = None
@@ -22,6 +22,8 @@
 """Module implementing the job queue handling."""
 
 import errno
+import os
+import re
 
 from ganeti import constants
 from ganeti import errors
@@ -62,6 +64,161 @@ def ReadVersion():
   return _ReadNumericFile(constants.JOB_QUEUE_VERSION_FILE)
 
 
+_RE_ARCHIVED_JOB_FILE = re.compile(r"^job-(%s)$" % constants.JOB_ID_TEMPLATE)
+
+
+def _ParseArchiveIndex(data):
+  """Parses the contents of the archive index.
+
+  @type data: string
+  @param data: the index contents, one job ID per line
+  @rtype: set
+  @return: the set of job IDs
+
+  """
+  return set(line for line in data.splitlines() if line)
+
+
+def ScanArchivedJobs(archive_dir=None):
+  """Lists the archived jobs by scanning the archive directories.
+
+  @type archive_dir: string
+  @param archive_dir: the archive directory, defaults to
+      L{constants.JOB_QUEUE_ARCHIVE_DIR}
+  @rtype: set
+  @return: the set of archived job IDs
+
+  """
+  if archive_dir is None:
+    archive_dir = constants.JOB_QUEUE_ARCHIVE_DIR
+
+  result = set()
+  for subdir in utils.ListVisibleFiles(archive_dir):
+    path = utils.PathJoin(archive_dir, subdir)
+    if not os.path.isdir(path):
+      continue
+    for filename in utils.ListVisibleFiles(path):
+      m = _RE_ARCHIVED_JOB_FILE.match(filename)
+      if m:
+        result.add(m.group(1))
+  return result
+
+
+def ReadArchiveIndex(index_file=None, archive_dir=None,
+                     _getents=runtime.GetEnts):
+  """Reads the index of archived jobs.
+
+  If the index doesn't exist yet, it is created by scanning the archive
+  directories.
+
+  @type index_file: string
+  @param index_file: the index file, defaults to
+      L{constants.JOB_QUEUE_ARCHIVE_INDEX_FILE}
+  @type archive_dir: string
+  @param archive_dir: the archive directory, defaults to
+      L{constants.JOB_QUEUE_ARCHIVE_DIR}
+  @rtype: set
+  @return: the set of archived job IDs
+
+  """
+  if index_file is None:
+    index_file = constants.JOB_QUEUE_ARCHIVE_INDEX_FILE
+
+  try:
+    return _ParseArchiveIndex(utils.ReadFile(index_file))
+  except EnvironmentError, err:
+    if err.errno not in (errno.ENOENT, ):
+      raise
+
+  job_ids = ScanArchivedJobs(archive_dir=archive_dir)
+
+  getents = _getents()
+  utils.WriteFile(index_file, uid=getents.masterd_uid, gid=getents.masterd_gid,
+                  data="".join("%s\n" % job_id
+                               for job_id in utils.NiceSort(job_ids)))
+
+  return job_ids
+
+
+def AppendArchiveIndex(job_ids, index_file=None):
+  """Adds jobs to the index of archived jobs.
+
+  The index is only updated if it exists; otherwise it will be created
+  from the archive directories on the next call to L{ReadArchiveIndex}.
+
+  @type job_ids: list
+  @param job_ids: the IDs of the newly archived jobs
+  @type index_file: string
+  @param index_file: the index file, defaults to
+      L{constants.JOB_QUEUE_ARCHIVE_INDEX_FILE}
+
+  """
+  if not job_ids:
+    return
+
+  if index_file is None:
+    index_file = constants.JOB_QUEUE_ARCHIVE_INDEX_FILE
+
+  try:
+    fd = os.open(index_file, os.O_WRONLY | os.O_APPEND)
+  except EnvironmentError, err:
+    if err.errno in (errno.ENOENT, ):
+      return
+    raise
+
+  index = os.fdopen(fd, "a")
+  try:
+    index.write("".join("%s\n" % job_id for job_id in job_ids))
+  finally:
+    index.close()
+
+
+def AppendQueueFile(file_name, data):
+  """Appends data to a file in the queue directory.
+
+  The file is created if it doesn't exist yet.
+
+  @type file_name: string
+  @param file_name: the file name
+  @type data: string
+  @param data: the data to append
+
+  """
+  getents = runtime.GetEnts()
+
+  fd = os.open(file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+  try:
+    os.fchown(fd, getents.masterd_uid, getents.masterd_gid)
+  except:
+    os.close(fd)
+    raise
+
+  fh = os.fdopen(fd, "a")
+  try:
+    fh.write(data)
+  finally:
+    fh.close()
+
+
+def GetArchivedJobIDFromPath(path):
+  """Returns the job ID for a path in the archive directory.
+
+  @type path: string
+  @param path: the file path
+  @rtype: string or None
+  @return: the job ID, or None if the path is not an archived job file
+
+  """
+  (dirname, filename) = os.path.split(os.path.normpath(path))
+  if (os.path.dirname(dirname) !=
+      os.path.normpath(constants.JOB_QUEUE_ARCHIVE_DIR)):
+    return None
+  m = _RE_ARCHIVED_JOB_FILE.match(filename)
+  if m:
+    return m.group(1)
+  return None
+
+
 def InitAndVerifyQueue(must_lock):
   """Open and lock job queue.
 
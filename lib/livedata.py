@@ -0,0 +1,283 @@
+#
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Cache for runtime data of nodes and instances.
+
+Queries for dynamic fields (e.g. the operational state of instances or the
+free memory of nodes) need to contact every node involved. On large
+clusters polled by monitoring systems this means a lot of identical RPC
+calls in short succession. The L{LiveDataCache} keeps the per-node results
+of these calls together with the time they were retrieved, allowing
+queries to accept data up to a given age. Concurrent queries needing the
+same data share a single RPC call. A L{LiveDataCollector} thread refreshes
+the data which has been used recently in the background.
+
+"""
+
+import logging
+import threading
+import time
+
+from ganeti import rpc
+from ganeti import constants
+
+
+#: Kind of data returned by L{rpc.RpcRunner.call_all_instances_info}
+KIND_INSTANCES = "all_instances_info"
+
+#: Kind of data returned by L{rpc.RpcRunner.call_node_info}
+KIND_NODES = "node_info"
+
+
+class LiveDataCache(object):
+  """Cache for per-node RPC results.
+
+  Entries are keyed by the kind of data, the arguments passed to the RPC
+  call and the node name. Their timestamp is the time when the RPC call was
+  started, so data received from a call is never considered to be newer
+  than it actually is.
+
+  """
+  def __init__(self, cfg, idle_timeout=constants.LIVE_DATA_IDLE_TIMEOUT,
+               _rpc=None, _time_fn=time.time):
+    """Initializes this class.
+
+    @type cfg: L{config.ConfigWriter}
+    @param cfg: Cluster configuration
+    @type idle_timeout: number
+    @param idle_timeout: How long data is kept up to date by the collector
+      after it has last been requested by a query
+
+    """
+    if _rpc is None:
+      _rpc = rpc.RpcRunner(cfg)
+
+    self._cfg = cfg
+    self._idle_timeout = idle_timeout
+    self._time_fn = _time_fn
+    self._fetch_fn = {
+      KIND_INSTANCES: _rpc.call_all_instances_info,
+      KIND_NODES: _rpc.call_node_info,
+      }
+
+    self._lock = threading.Lock()
+    self._cond = threading.Condition(self._lock)
+
+    # (kind, args, node) -> (timestamp, result)
+    self._entries = {}
+
+    # (kind, args, node) -> start time of running RPC call
+    self._pending = {}
+
+    # (kind, args) -> {node: time of last request}
+    self._access = {}
+
+  def GetAllInstancesInfo(self, nodes, hypervisors, max_age):
+    """Returns the list of running instances on the given nodes.
+
+    @type nodes: list
+    @param nodes: Node names
+    @type hypervisors: list
+    @param hypervisors: Hypervisors to query
+    @type max_age: number
+    @param max_age: Maximum age of returned data in seconds
+    @rtype: dict
+    @return: Dictionary of L{rpc.RpcResult} by node name
+
+    """
+    args = (tuple(sorted(hypervisors)), )
+    return self._Get(KIND_INSTANCES, args, nodes, max_age)
+
+  def GetNodeInfo(self, nodes, vg_name, hypervisor_type, max_age):
+    """Returns the runtime information of the given nodes.
+
+    @type nodes: list
+    @param nodes: Node names
+    @type vg_name: string
+    @param vg_name: Volume group name
+    @type hypervisor_type: string
+    @param hypervisor_type: Hypervisor to query
+    @type max_age: number
+    @param max_age: Maximum age of returned data in seconds
+    @rtype: dict
+    @return: Dictionary of L{rpc.RpcResult} by node name
+
+    """
+    return self._Get(KIND_NODES, (vg_name, hypervisor_type), nodes, max_age)
+
+  def _Get(self, kind, args, nodes, max_age, _record_access=True):
+    """Returns cached data, fetching missing or outdated entries.
+
+    """
+    now = self._time_fn()
+    result = {}
+    remaining = frozenset(nodes)
+
+    while remaining:
+      self._lock.acquire()
+      try:
+        if _record_access:
+          access = self._access.setdefault((kind, args), {})
+          for node in remaining:
+            access[node] = now
+          _record_access = False
+
+        while True:
+          fetch = []
+          wait = []
+
+          for node in remaining:
+            key = (kind, args, node)
+
+            entry = self._entries.get(key, None)
+            if entry is not None and (now - entry[0]) <= max_age:
+              result[node] = entry[1]
+              continue
+
+            started = self._pending.get(key, None)
+            if started is not None and (now - started) <= max_age:
+              # Another thread is already retrieving recent enough data
+              wait.append(node)
+              continue
+
+            fetch.append(node)
+
+          if fetch or not wait:
+            break
+
+          self._cond.wait()
+          remaining = frozenset(wait)
+
+        started = self._time_fn()
+        for node in fetch:
+          self._pending[(kind, args, node)] = started
+      finally:
+        self._lock.release()
+
+      if fetch:
+        result.update(self._Fetch(kind, args, fetch, started))
+
+      remaining = frozenset(wait)
+
+    return result
+
+  def _Fetch(self, kind, args, nodes, started):
+    """Retrieves data for a number of nodes and stores it in the cache.
+
+    """
+    data = {}
+    try:
+      data = self._fetch_fn[kind](nodes, *args)
+    finally:
+      self._lock.acquire()
+      try:
+        for node in nodes:
+          key = (kind, args, node)
+
+          if node in data:
+            entry = self._entries.get(key, None)
+            if entry is None or entry[0] <= started:
+              self._entries[key] = (started, data[node])
+
+          # Another thread may have started a newer call in the meantime
+          if self._pending.get(key, None) == started:
+            del self._pending[key]
+
+        self._cond.notifyAll()
+      finally:
+        self._lock.release()
+
+    return data
+
+  def Refresh(self, max_age):
+    """Refreshes all recently requested data older than C{max_age}.
+
+    Data not requested within the idle timeout and data of nodes no longer
+    in the cluster is removed from the cache.
+
+    """
+    now = self._time_fn()
+    known_nodes = frozenset(self._cfg.GetNodeList())
+    work = []
+
+    self._lock.acquire()
+    try:
+      for (kind, args), access in self._access.items():
+        for node, last_access in access.items():
+          if (node not in known_nodes or
+              (now - last_access) > self._idle_timeout):
+            del access[node]
+            self._entries.pop((kind, args, node), None)
+
+        if access:
+          work.append((kind, args, access.keys()))
+        else:
+          del self._access[(kind, args)]
+    finally:
+      self._lock.release()
+
+    for (kind, args, nodes) in work:
+      self._Get(kind, args, nodes, max_age, _record_access=False)
+
+
+class LiveDataCollector(threading.Thread):
+  """Thread periodically refreshing a L{LiveDataCache}.
+
+  """
+  def __init__(self, cache, interval=constants.LIVE_DATA_REFRESH_INTERVAL):
+    """Initializes this class.
+
+    @type cache: L{LiveDataCache}
+    @param cache: Cache to refresh
+    @type interval: number
+    @param interval: Time between refreshs in seconds
+
+    """
+    threading.Thread.__init__(self, name="LiveDataCollector")
+    self.setDaemon(True)
+
+    self._cache = cache
+    self._interval = interval
+    self._stop_event = threading.Event()
+
+  def run(self):
+    """Main loop of the collector.
+
+    """
+    while True:
+      self._stop_event.wait(self._interval)
+      if self._stop_event.isSet():
+        break
+
+      # Data retrieved by a query since the last run doesn't need to be
+      # fetched again
+      try:
+        self._cache.Refresh(self._interval)
+      except Exception: # pylint: disable-msg=W0703
+        logging.exception("Error while refreshing runtime data")
+
+  def Stop(self):
+    """Stops the collector and waits for it to terminate.
+
+    """
+    self._stop_event.set()
+    if self.isAlive():
+      self.join()
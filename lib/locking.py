@@ -33,10 +33,19 @@ import errno
 import weakref
 import logging
 import heapq
+import bisect
+import struct
+
+try:
+  # pylint: disable-msg=F0401
+  import ctypes
+except ImportError:
+  ctypes = None
 
 from ganeti import errors
 from ganeti import utils
 from ganeti import compat
+from ganeti import constants
 
 
 _EXCLUSIVE_TEXT = "exclusive"
@@ -44,6 +53,62 @@ _SHARED_TEXT = "shared"
 
 _DEFAULT_PRIORITY = 0
 
+#: Fields returned by L{SharedLock.GetInfo} from the lock statistics
+_STATS_FIELDS = frozenset([
+  "acquires",
+  "contended",
+  "timeouts",
+  "wait_time",
+  "wait_histogram",
+  "hold_time",
+  "hold_histogram",
+  ])
+
+#: Flag for eventfd(2) setting FD_CLOEXEC on the new descriptor
+_EFD_CLOEXEC = 02000000
+
+#: Value written to an eventfd descriptor to make it readable
+_EVENTFD_INCREMENT = struct.pack("=Q", 1)
+
+
+def _LoadEventFd(_ctypes=ctypes):
+  """Returns a function creating eventfd(2) descriptors, if available.
+
+  @rtype: callable or None
+  @return: Function returning a new descriptor, or None if either ctypes,
+    the C library function or kernel support is missing
+
+  """
+  if _ctypes is None:
+    return None
+
+  try:
+    libc = _ctypes.CDLL("libc.so.6", use_errno=True)
+    fn = libc.eventfd
+  except (EnvironmentError, AttributeError, TypeError):
+    return None
+
+  fn.argtypes = [_ctypes.c_uint, _ctypes.c_int]
+  fn.restype = _ctypes.c_int
+
+  def _Create():
+    fd = fn(0, _EFD_CLOEXEC)
+    if fd < 0:
+      err = _ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+    return fd
+
+  # The C library might provide the function without kernel support
+  try:
+    os.close(_Create())
+  except EnvironmentError:
+    return None
+
+  return _Create
+
+
+_CreateEventFd = _LoadEventFd()
+
 
 def ssynchronized(mylock, shared=0):
   """Shared Synchronization decorator.
@@ -257,7 +322,6 @@ class SingleNotifyPipeCondition(_BaseCondition):
   """
 
   __slots__ = [
-    "_poller",
     "_read_fd",
     "_write_fd",
     "_nwaiters",
@@ -275,7 +339,6 @@ class SingleNotifyPipeCondition(_BaseCondition):
     self._notified = False
     self._read_fd = None
     self._write_fd = None
-    self._poller = None
 
   def _check_unnotified(self):
     """Throws an exception if already notified.
@@ -295,7 +358,6 @@ class SingleNotifyPipeCondition(_BaseCondition):
     if self._write_fd is not None:
       os.close(self._write_fd)
       self._write_fd = None
-    self._poller = None
 
   def wait(self, timeout=None):
     """Wait for a notification.
@@ -309,12 +371,14 @@ class SingleNotifyPipeCondition(_BaseCondition):
 
     self._nwaiters += 1
     try:
-      if self._poller is None:
+      if self._read_fd is None:
         (self._read_fd, self._write_fd) = os.pipe()
-        self._poller = select.poll()
-        self._poller.register(self._read_fd, select.POLLHUP)
 
-      wait_fn = self._waiter_class(self._poller, self._read_fd)
+      # Poll objects must not be shared between threads
+      poller = select.poll()
+      poller.register(self._read_fd, select.POLLHUP)
+
+      wait_fn = self._waiter_class(poller, self._read_fd)
       state = self._release_save()
       try:
         # Wait for notification
@@ -409,7 +473,173 @@ class PipeCondition(_BaseCondition):
     return bool(self._waiters)
 
 
-class _PipeConditionWithMode(PipeCondition):
+class _WakeupFd(object):
+  """One-shot wakeup file descriptor for poll(2).
+
+  An eventfd(2) descriptor is used if the system supports it, otherwise a
+  pipe. Once L{Signal} has been called the descriptor stays readable (or
+  reports a hangup in case of a pipe) until it is closed.
+
+  """
+  __slots__ = [
+    "fd",
+    "_write_fd",
+    ]
+
+  def __init__(self, _create_eventfd=_CreateEventFd):
+    """Initializes this class.
+
+    """
+    object.__init__(self)
+
+    if _create_eventfd is None:
+      (self.fd, self._write_fd) = os.pipe()
+    else:
+      self.fd = _create_eventfd()
+      self._write_fd = None
+
+  def Signal(self):
+    """Makes the descriptor readable.
+
+    """
+    if self._write_fd is None:
+      os.write(self.fd, _EVENTFD_INCREMENT)
+    else:
+      os.close(self._write_fd)
+      self._write_fd = None
+
+  def Close(self):
+    """Closes all file descriptors.
+
+    """
+    if self._write_fd is not None:
+      os.close(self._write_fd)
+      self._write_fd = None
+
+    os.close(self.fd)
+
+
+class SingleNotifyLockCondition(_BaseCondition):
+  """Condition which can only be notified once, using fewer file descriptors.
+
+  This condition has the same semantics as L{SingleNotifyPipeCondition}.
+  Waiting without a timeout blocks on a private lock which is released by
+  L{notifyAll}; no file descriptors are needed for this. Waiters with a
+  timeout share a single L{_WakeupFd} (an eventfd descriptor if available),
+  with each of them using its own poll object.
+
+  """
+  __slots__ = [
+    "_lock_waiters",
+    "_wakeup",
+    "_nwaiters",
+    "_notified",
+    ]
+
+  def __init__(self, lock):
+    """Constructor for SingleNotifyLockCondition
+
+    """
+    _BaseCondition.__init__(self, lock)
+    self._lock_waiters = []
+    self._wakeup = None
+    self._nwaiters = 0
+    self._notified = False
+
+  def _check_unnotified(self):
+    """Throws an exception if already notified.
+
+    """
+    if self._notified:
+      raise RuntimeError("cannot use already notified condition")
+
+  def wait(self, timeout=None):
+    """Wait for a notification.
+
+    @type timeout: float or None
+    @param timeout: Waiting timeout (can be None)
+
+    """
+    self._check_owned()
+    self._check_unnotified()
+
+    if timeout is None:
+      self._WaitLock()
+    else:
+      self._WaitFd(timeout)
+
+  def _WaitLock(self):
+    """Waits for a notification without a timeout.
+
+    """
+    waiter = threading.Lock()
+    waiter.acquire()
+    self._lock_waiters.append(waiter)
+
+    state = self._release_save()
+    try:
+      # Blocks until released by notifyAll
+      waiter.acquire()
+    finally:
+      self._acquire_restore(state)
+
+  def _WaitFd(self, timeout):
+    """Waits for a notification with a timeout.
+
+    """
+    self._nwaiters += 1
+    try:
+      if self._wakeup is None:
+        self._wakeup = _WakeupFd()
+
+      fd = self._wakeup.fd
+
+      # Poll objects must not be shared between threads
+      poller = select.poll()
+      poller.register(fd, select.POLLIN | select.POLLHUP)
+
+      wait_fn = _SingleNotifyPipeConditionWaiter(poller, fd)
+      state = self._release_save()
+      try:
+        wait_fn(timeout)
+      finally:
+        self._acquire_restore(state)
+    finally:
+      self._nwaiters -= 1
+      if self._nwaiters == 0 and self._wakeup is not None:
+        self._wakeup.Close()
+        self._wakeup = None
+
+  def notifyAll(self): # pylint: disable-msg=C0103
+    """Wakes up all waiters.
+
+    """
+    self._check_owned()
+    self._check_unnotified()
+    self._notified = True
+
+    for waiter in self._lock_waiters:
+      waiter.release()
+    self._lock_waiters = []
+
+    if self._wakeup is not None:
+      self._wakeup.Signal()
+
+
+class LockCondition(PipeCondition):
+  """Group-only non-polling condition based on L{SingleNotifyLockCondition}.
+
+  Behaves like L{PipeCondition}, but blocking waits don't use any file
+  descriptors and waits with a timeout use a single eventfd descriptor per
+  notification if the system supports it.
+
+  """
+  __slots__ = []
+
+  _single_condition_class = SingleNotifyLockCondition
+
+
+class _ConditionWithMode(LockCondition):
   __slots__ = [
     "shared",
     ]
@@ -419,7 +649,110 @@ class _PipeConditionWithMode(PipeCondition):
 
     """
     self.shared = shared
-    PipeCondition.__init__(self, lock)
+    LockCondition.__init__(self, lock)
+
+
+class _LockStatistics(object):
+  """Cumulative acquisition statistics of a L{SharedLock}.
+
+  Wait and hold times are recorded in histograms using the bucket bounds
+  from L{constants.LOCK_STATS_HISTOGRAM_BOUNDS}. All methods must be called
+  with the internal lock of the owning lock held.
+
+  """
+  __slots__ = [
+    "acquires",
+    "contended",
+    "timeouts",
+    "wait_time",
+    "wait_histogram",
+    "hold_time",
+    "hold_histogram",
+    "_hold_start",
+    ]
+
+  _BOUNDS = constants.LOCK_STATS_HISTOGRAM_BOUNDS
+
+  def __init__(self):
+    """Initializes this class.
+
+    """
+    self.acquires = 0
+    self.contended = 0
+    self.timeouts = {}
+    self.wait_time = 0.0
+    self.wait_histogram = [0] * (len(self._BOUNDS) + 1)
+    self.hold_time = 0.0
+    self.hold_histogram = [0] * (len(self._BOUNDS) + 1)
+
+    # Thread -> time at which the lock was acquired
+    self._hold_start = {}
+
+  def RecordAcquire(self, thread, now, wait_start):
+    """Records a successful acquire.
+
+    @param thread: Acquiring thread
+    @type now: float
+    @param now: Current time
+    @type wait_start: float or None
+    @param wait_start: Time at which the thread started waiting for the lock,
+      None if it didn't need to wait
+
+    """
+    self.acquires += 1
+    self._hold_start[thread] = now
+
+    if wait_start is None:
+      self.wait_histogram[0] += 1
+    else:
+      self.contended += 1
+      self._RecordWait(now - wait_start)
+
+  def RecordTimeout(self, priority, waited):
+    """Records an acquire which timed out.
+
+    @type priority: int
+    @param priority: Priority of the acquire
+    @type waited: float
+    @param waited: Time spent waiting for the lock
+
+    """
+    self.timeouts[priority] = self.timeouts.get(priority, 0) + 1
+    self.contended += 1
+    self._RecordWait(waited)
+
+  def RecordRelease(self, thread, now):
+    """Records the release of a lock.
+
+    @param thread: Thread which held the lock
+    @type now: float
+    @param now: Current time
+
+    """
+    held = now - self._hold_start.pop(thread)
+    self.hold_time += held
+    self.hold_histogram[bisect.bisect_left(self._BOUNDS, held)] += 1
+
+  def _RecordWait(self, waited):
+    """Adds a wait time to the statistics.
+
+    """
+    self.wait_time += waited
+    self.wait_histogram[bisect.bisect_left(self._BOUNDS, waited)] += 1
+
+  def GetField(self, fname):
+    """Returns a copy of a statistics field.
+
+    @type fname: string
+    @param fname: One of L{_STATS_FIELDS}
+
+    """
+    if fname == "timeouts":
+      return sorted(self.timeouts.items())
+    elif fname in ("wait_histogram", "hold_histogram"):
+      return getattr(self, fname)[:]
+    else:
+      return getattr(self, fname)
 
 
 class SharedLock(object):
@@ -449,13 +782,15 @@ class SharedLock(object):
     "__pending",
     "__pending_by_prio",
     "__pending_shared",
+    "__set_state",
     "__shr",
+    "__stats",
     "name",
     ]
 
-  __condition_class = _PipeConditionWithMode
+  __condition_class = _ConditionWithMode
 
-  def __init__(self, name, monitor=None):
+  def __init__(self, name, monitor=None, _set_state=None):
     """Construct a new SharedLock.
 
     @param name: the name of the lock
@@ -467,6 +802,9 @@ class SharedLock(object):
 
     self.name = name
 
+    # Intention locking state of the lock set this lock is a member of
+    self.__set_state = _set_state
+
     # Internal lock
     self.__lock = threading.Lock()
 
@@ -482,6 +820,9 @@ class SharedLock(object):
     # is this lock in the deleted state?
     self.__deleted = False
 
+    # Acquisition statistics
+    self.__stats = _LockStatistics()
+
     # Register with lock monitor
     if monitor:
       monitor.RegisterLock(self)
@@ -541,6 +882,8 @@ class SharedLock(object):
                                         for i in cond.get_waiting())))
 
           info.append(data)
+        elif fname in _STATS_FIELDS:
+          info.append(self.__stats.GetField(fname))
         else:
           raise errors.OpExecError("Invalid query field '%s'" % fname)
 
@@ -624,23 +967,37 @@ class SharedLock(object):
     finally:
       self.__lock.release()
 
-  def __do_acquire(self, shared):
+  def __do_acquire(self, shared, wait_start):
     """Actually acquire the lock.
 
+    @type wait_start: float or None
+    @param wait_start: Time at which the thread started waiting for the lock,
+      None if it didn't need to wait
+
     """
+    thread = threading.currentThread()
+
     if shared:
-      self.__shr.add(threading.currentThread())
+      self.__shr.add(thread)
     else:
-      self.__exc = threading.currentThread()
+      self.__exc = thread
+
+    self.__stats.RecordAcquire(thread, time.time(), wait_start)
 
   def __can_acquire(self, shared):
     """Determine whether lock can be acquired.
 
     """
     if shared:
-      return self.__exc is None
+      result = self.__exc is None
     else:
-      return len(self.__shr) == 0 and self.__exc is None
+      result = len(self.__shr) == 0 and self.__exc is None
+
+    if result and self.__set_state is not None:
+      # The lock might be owned through its lock set
+      result = self.__set_state.CheckMember(self, shared)
+
+    return result
 
   def __find_first_pending_queue(self):
     """Tries to find the topmost queued entry with pending acquires.
@@ -692,9 +1049,11 @@ class SharedLock(object):
     # Check whether someone else holds the lock or there are pending acquires.
     if not self.__pending and self.__can_acquire(shared):
       # Apparently not, can acquire lock directly.
-      self.__do_acquire(shared)
+      self.__do_acquire(shared, None)
       return True
 
+    wait_start = time.time()
+
     prioqueue = self.__pending_by_prio.get(priority, None)
 
     if shared:
@@ -738,8 +1097,10 @@ class SharedLock(object):
           break
 
       if self.__is_on_top(wait_condition) and self.__can_acquire(shared):
-        self.__do_acquire(shared)
+        self.__do_acquire(shared, wait_start)
         return True
+
+      self.__stats.RecordTimeout(priority, time.time() - wait_start)
     finally:
       # Remove condition from queue if there are no more waiters
       if not wait_condition.has_waiting():
@@ -789,11 +1150,15 @@ class SharedLock(object):
       assert self.__is_exclusive() or self.__is_sharer(), \
         "Cannot release non-owned lock"
 
+      thread = threading.currentThread()
+
       # Autodetect release type
       if self.__is_exclusive():
         self.__exc = None
       else:
-        self.__shr.remove(threading.currentThread())
+        self.__shr.remove(thread)
+
+      self.__stats.RecordRelease(thread, time.time())
 
       # Notify topmost condition in queue
       prioqueue = self.__find_first_pending_queue()
@@ -837,6 +1202,7 @@ class SharedLock(object):
       if acquired:
         self.__deleted = True
         self.__exc = None
+        self.__stats.RecordRelease(threading.currentThread(), time.time())
 
         assert not (self.__exc or self.__shr), "Found owner during deletion"
 
@@ -851,6 +1217,41 @@ class SharedLock(object):
     finally:
       self.__lock.release()
 
+  def _notify_pending(self):
+    """Notifies the topmost pending acquire.
+
+    Used by L{LockSet} after releasing a whole set, which blocked acquires of
+    this lock without holding it.
+
+    """
+    self.__lock.acquire()
+    try:
+      prioqueue = self.__find_first_pending_queue()
+      if prioqueue:
+        prioqueue[0].notifyAll()
+    finally:
+      self.__lock.release()
+
+  def _adopt(self, shared):
+    """Acquires the lock for a thread owning it through its lock set.
+
+    Unlike L{acquire} this doesn't queue behind pending acquires, as those are
+    blocked by the owner of the whole set.
+
+    """
+    self.__lock.acquire()
+    try:
+      self.__check_deleted()
+
+      assert not self.__is_owned(), \
+        "Lock %s is already owned" % self.name
+      assert self.__exc is None and (shared or not self.__shr), \
+        "Lock %s is held by another thread" % self.name
+
+      self.__do_acquire(shared, None)
+    finally:
+      self.__lock.release()
+
   def _release_save(self):
     shared = self.__is_sharer()
     self.release()
@@ -871,6 +1272,214 @@ class _AcquireTimeout(Exception):
   """
 
 
+class _LockSetState(object):
+  """Intention locking state of a L{LockSet}.
+
+  Threads acquiring only some locks of a set register their intention to do
+  so in shared or exclusive mode. A thread acquiring the whole set waits for
+  conflicting intentions to be released, after which it owns all member locks
+  without acquiring them one by one. Member locks consult this state before
+  being acquired and are notified once the whole set is released again.
+
+  While a thread waits for the whole set, no new conflicting intentions are
+  registered, so that whole-set acquires can't be starved by a steady stream
+  of partial acquires.
+
+  """
+  def __init__(self):
+    """Initializes this class.
+
+    """
+    self._lock = threading.Lock()
+
+    # Notified when whole-set acquires stop waiting and when intentions are
+    # removed, respectively
+    self._gate_cond = LockCondition(self._lock)
+    self._drain_cond = LockCondition(self._lock)
+
+    # Mode of the current whole-set owners (0 for exclusive, 1 for shared), or
+    # None if the set isn't owned as a whole; read without the lock by
+    # L{CheckMember}
+    self.granted = None
+    self._owners = set()
+
+    # Number of threads waiting to acquire the whole set, by mode
+    self._pending = [0, 0]
+
+    # Threads owning or acquiring some locks in the set and their mode
+    self._intents = {}
+    self._intent_count = [0, 0]
+
+    # Member locks with acquires blocked by the owners of the whole set
+    self._blocked = set()
+
+  def __add_intent(self, thread, shared):
+    assert thread not in self._intents, "Intention registered twice"
+    self._intents[thread] = shared
+    self._intent_count[shared] += 1
+
+  @staticmethod
+  def __wait(cond, cond_fn, timeout):
+    """Waits until C{cond_fn} returns false or the timeout expires.
+
+    @return: Whether C{cond_fn} returned false before the timeout
+
+    """
+    running_timeout = RunningTimeout(timeout, True)
+
+    while cond_fn():
+      remaining = running_timeout.Remaining()
+      if remaining is not None and remaining <= 0.0:
+        return False
+
+      cond.wait(remaining)
+
+    return True
+
+  def RegisterIntent(self, shared, timeout):
+    """Registers the calling thread's intention to acquire member locks.
+
+    @type shared: integer (0/1) used as a boolean
+    @param shared: Whether member locks will be acquired in shared mode
+    @type timeout: float or None
+    @param timeout: Maximum time to wait for pending whole-set acquires
+    @rtype: bool
+    @return: Whether the intention was registered
+
+    """
+    shared = int(bool(shared))
+    thread = threading.currentThread()
+
+    if shared:
+      blocked_fn = lambda: self._pending[0]
+    else:
+      blocked_fn = lambda: self._pending[0] or self._pending[1]
+
+    self._lock.acquire()
+    try:
+      if not self.__wait(self._gate_cond, blocked_fn, timeout):
+        return False
+
+      self.__add_intent(thread, shared)
+      return True
+    finally:
+      self._lock.release()
+
+  def UnregisterIntent(self):
+    """Removes the calling thread's intention, if any.
+
+    """
+    self._lock.acquire()
+    try:
+      shared = self._intents.pop(threading.currentThread(), None)
+      if shared is not None:
+        self._intent_count[shared] -= 1
+
+        if self._pending[0] or self._pending[1]:
+          self._drain_cond.notifyAll()
+    finally:
+      self._lock.release()
+
+  def AcquireWhole(self, shared, timeout):
+    """Acquires all member locks at once.
+
+    The caller must hold the set-level lock in the same mode.
+
+    @type shared: integer (0/1) used as a boolean
+    @param shared: Whether to acquire in shared mode
+    @type timeout: float or None
+    @param timeout: Maximum time to wait for conflicting intentions
+    @rtype: bool
+    @return: Whether the whole set was acquired
+
+    """
+    shared = int(bool(shared))
+    thread = threading.currentThread()
+
+    if shared:
+      conflict_fn = lambda: self._intent_count[0]
+    else:
+      conflict_fn = lambda: self._intent_count[0] or self._intent_count[1]
+
+    self._lock.acquire()
+    try:
+      assert thread not in self._intents, \
+        "Can't acquire whole set while owning some of its locks"
+      assert self.granted is None or (shared and self.granted == 1)
+
+      self._pending[shared] += 1
+      try:
+        if not self.__wait(self._drain_cond, conflict_fn, timeout):
+          return False
+
+        self.granted = shared
+        self._owners.add(thread)
+        return True
+      finally:
+        self._pending[shared] -= 1
+
+        # Let intentions blocked by this acquire continue
+        self._gate_cond.notifyAll()
+    finally:
+      self._lock.release()
+
+  def ReleaseWhole(self, keep_shared=None):
+    """Releases the whole set owned by the calling thread.
+
+    @type keep_shared: integer (0/1) used as a boolean or None
+    @param keep_shared: If not None, the calling thread continues to own some
+      of the member locks in the given mode (see L{SharedLock._adopt})
+
+    """
+    thread = threading.currentThread()
+
+    self._lock.acquire()
+    try:
+      self._owners.remove(thread)
+
+      if keep_shared is not None:
+        self.__add_intent(thread, int(bool(keep_shared)))
+
+      if self._owners:
+        blocked = []
+      else:
+        self.granted = None
+        blocked = self._blocked
+        self._blocked = set()
+    finally:
+      self._lock.release()
+
+    for lock in blocked:
+      lock._notify_pending()
+
+  def CheckMember(self, lock, shared):
+    """Checks whether a member lock can be acquired.
+
+    Called by L{SharedLock} with its internal lock held.
+
+    @type lock: L{SharedLock}
+    @param lock: Member lock
+    @type shared: integer (0/1) used as a boolean
+    @param shared: Whether the lock is to be acquired in shared mode
+
+    """
+    granted = self.granted
+    if granted is None or (shared and granted == 1):
+      return True
+
+    self._lock.acquire()
+    try:
+      granted = self.granted
+      if granted is None or (shared and granted == 1):
+        return True
+
+      # Notify lock once the whole set has been released
+      self._blocked.add(lock)
+      return False
+    finally:
+      self._lock.release()
+
+
 class LockSet:
   """Implements a set of locks.
 
@@ -881,6 +1490,12 @@ class LockSet:
 
   All the locks needed in the same set must be acquired together, though.
 
+  Acquiring the whole set (L{ALL_SET}) doesn't acquire every member lock.
+  Instead hierarchical intention locking is used: threads acquiring some
+  locks register their intention on the set first (see L{_LockSetState}) and
+  the whole set is acquired at once when no conflicting intentions exist.
+  Member locks only show owners if acquired individually.
+
   @type name: string
   @ivar name: the name of the lockset
 
@@ -901,15 +1516,17 @@ class LockSet:
     self.__monitor = monitor
 
     # Used internally to guarantee coherency.
-    self.__lock = SharedLock(name)
+    self.__lock = SharedLock(self._GetLockName("[lockset]"), monitor=monitor)
+
+    # Intention locking state shared with all member locks
+    self.__state = _LockSetState()
 
     # The lockdict indexes the relationship name -> lock
     # The order-of-locking is implied by the alphabetical order of names
     self.__lockdict = {}
 
     for mname in members:
-      self.__lockdict[mname] = SharedLock(self._GetLockName(mname),
-                                          monitor=monitor)
+      self.__lockdict[mname] = self.__NewLock(mname)
 
     # The owner dict contains the set of locks each thread owns. For
     # performance each thread can access its own key without a global lock on
@@ -926,6 +1543,13 @@ class LockSet:
     """
     return "%s/%s" % (self.name, mname)
 
+  def __NewLock(self, mname):
+    """Creates a new member lock.
+
+    """
+    return SharedLock(self._GetLockName(mname), monitor=self.__monitor,
+                      _set_state=self.__state)
+
   def _is_owned(self):
     """Is the current thread a current level owner?"""
     return threading.currentThread() in self.__owners
@@ -954,6 +1578,7 @@ class LockSet:
     if (not self.__lock._is_owned() and
         not self.__owners[threading.currentThread()]):
       del self.__owners[threading.currentThread()]
+      self.__state.UnregisterIntent()
 
   def _list_owned(self):
     """Get the set of resource names owned by the current thread"""
@@ -1041,13 +1666,21 @@ class LockSet:
         if isinstance(names, basestring):
           names = [names]
 
-        return self.__acquire_inner(names, False, shared, priority,
-                                    running_timeout.Remaining, test_notify)
+        if not self.__state.RegisterIntent(shared,
+                                           running_timeout.Remaining()):
+          raise _AcquireTimeout()
+
+        try:
+          return self.__acquire_inner(names, shared, priority,
+                                      running_timeout.Remaining, test_notify)
+        finally:
+          # The intention is removed together with the last owned lock
+          if not self._is_owned():
+            self.__state.UnregisterIntent()
 
       else:
         # If no names are given acquire the whole set by not letting new names
         # being added before we release, and getting the current list of names.
-        # Some of them may then be deleted later, but we'll cope with this.
         #
         # We'd like to acquire this lock in a shared way, as it's nice if
         # everybody else can use the instances at the same time. If we are
@@ -1058,28 +1691,35 @@ class LockSet:
                                    timeout=running_timeout.Remaining()):
           raise _AcquireTimeout()
         try:
-          # note we own the set-lock
-          self._add_owned()
+          # Wait for threads owning some of the locks in a conflicting mode
+          if not self.__state.AcquireWhole(shared,
+                                           running_timeout.Remaining()):
+            raise _AcquireTimeout()
 
-          return self.__acquire_inner(self.__names(), True, shared, priority,
-                                      running_timeout.Remaining, test_notify)
+          try:
+            # note we own the set-lock and all its members
+            acquired = set(self.__names())
+            self.__owners[threading.currentThread()] = acquired.copy()
+          except:
+            self.__state.ReleaseWhole()
+            raise
         except:
           # We shouldn't have problems adding the lock to the owners list, but
           # if we did we'll try to release this lock and re-raise exception.
           # Of course something is going to be really wrong, after this.
           self.__lock.release()
-          self._del_owned()
+          self.__owners.pop(threading.currentThread(), None)
           raise
 
+        return acquired
+
     except _AcquireTimeout:
       return None
 
-  def __acquire_inner(self, names, want_all, shared, priority,
-                      timeout_fn, test_notify):
+  def __acquire_inner(self, names, shared, priority, timeout_fn, test_notify):
     """Inner logic for acquiring a number of locks.
 
     @param names: Names of the locks to be acquired
-    @param want_all: Whether all locks in the set should be acquired
     @param shared: Whether to acquire in shared mode
     @param timeout_fn: Function returning remaining timeout
     @param priority: Priority for acquiring locks
@@ -1096,11 +1736,6 @@ class LockSet:
       try:
         lock = self.__lockdict[lname] # raises KeyError if lock is not there
       except KeyError:
-        if want_all:
-          # We are acquiring all the set, it doesn't matter if this particular
-          # element is not there anymore.
-          continue
-
         raise errors.LockError("Non-existing lock %s in set %s" %
                                (lname, self.name))
 
@@ -1129,11 +1764,6 @@ class LockSet:
                                      priority=priority,
                                      test_notify=test_notify_fn)
         except errors.LockError:
-          if want_all:
-            # We are acquiring all the set, it doesn't matter if this
-            # particular element is not there anymore.
-            continue
-
           raise errors.LockError("Non-existing lock %s in set %s" %
                                  (lname, self.name))
 
@@ -1193,11 +1823,10 @@ class LockSet:
                "release() on unheld resources %s (set %s)" %
                (names.difference(self._list_owned()), self.name))
 
-    # First of all let's release the "all elements" lock, if set.
-    # After this 'add' can work again
+    # Locks owned through the whole set are not held individually
     if self.__lock._is_owned():
-      self.__lock.release()
-      self._del_owned()
+      self.__release_whole(self._list_owned() - names)
+      return
 
     for lockname in names:
       # If we are sure the lock doesn't leave __lockdict without being
@@ -1205,6 +1834,30 @@ class LockSet:
       self.__lockdict[lockname].release()
       self._del_owned(name=lockname)
 
+  def __release_whole(self, keep):
+    """Releases a whole set acquired by the current thread.
+
+    @type keep: set
+    @param keep: Names of locks to continue owning individually
+
+    """
+    thread = threading.currentThread()
+    shared = self.__lock._is_owned(shared=1)
+
+    if keep:
+      # Nobody else can hold these locks in a conflicting mode
+      for lname in keep:
+        self.__lockdict[lname]._adopt(shared)
+
+      self.__owners[thread] = keep
+      self.__state.ReleaseWhole(keep_shared=shared)
+    else:
+      del self.__owners[thread]
+      self.__state.ReleaseWhole()
+
+    # After this 'add' can work again
+    self.__lock.release()
+
   def add(self, names, acquired=0, shared=0):
     """Add a new set of elements to the set
 
@@ -1232,6 +1885,14 @@ class LockSet:
       release_lock = True
       self.__lock.acquire()
 
+    # Locks added to a set owned as a whole are owned through the set and
+    # aren't acquired individually
+    acquire_locks = acquired and release_lock
+
+    if acquire_locks:
+      # Doesn't block as whole-set acquires need the set-level lock
+      self.__state.RegisterIntent(shared, None)
+
     try:
       invalid_names = set(self.__names()).intersection(names)
       if invalid_names:
@@ -1242,9 +1903,11 @@ class LockSet:
                                (invalid_names, self.name))
 
       for lockname in names:
-        lock = SharedLock(self._GetLockName(lockname), monitor=self.__monitor)
+        lock = self.__NewLock(lockname)
 
-        if acquired:
+        if acquired and not acquire_locks:
+          self._add_owned(name=lockname)
+        elif acquire_locks:
           # No need for priority or timeout here as this lock has just been
           # created
           lock.acquire(shared=shared)
@@ -1264,6 +1927,9 @@ class LockSet:
         self.__lockdict[lockname] = lock
 
     finally:
+      if acquire_locks and not self._is_owned():
+        self.__state.UnregisterIntent()
+
       # Only release __lock if we were not holding it previously.
       if release_lock:
         self.__lock.release()
@@ -1295,33 +1961,51 @@ class LockSet:
       "remove() on acquired lockset %s while not owning all elements" %
       self.name)
 
+    # Locks owned through the whole set are not held individually
+    whole_owned = self.__lock._is_owned()
+    assert not whole_owned or self.__lock._is_owned(shared=0), \
+      "remove() on lockset %s while owning it in shared mode" % self.name
+
+    # Threads not owning any lock in the set need to register their intention
+    # to delete locks, otherwise they could interfere with whole-set acquires
+    register = not self._is_owned()
+    if register:
+      self.__state.RegisterIntent(0, None)
+
     removed = []
 
-    for lname in names:
-      # Calling delete() acquires the lock exclusively if we don't already own
-      # it, and causes all pending and subsequent lock acquires to fail. It's
-      # fine to call it out of order because delete() also implies release(),
-      # and the assertion above guarantees that if we either already hold
-      # everything we want to delete, or we hold none.
-      try:
-        self.__lockdict[lname].delete()
-        removed.append(lname)
-      except (KeyError, errors.LockError):
-        # This cannot happen if we were already holding it, verify:
-        assert not self._is_owned(), ("remove failed while holding lockset %s"
-                                      % self.name)
-      else:
-        # If no LockError was raised we are the ones who deleted the lock.
-        # This means we can safely remove it from lockdict, as any further or
-        # pending delete() or acquire() will fail (and nobody can have the lock
-        # since before our call to delete()).
-        #
-        # This is done in an else clause because if the exception was thrown
-        # it's the job of the one who actually deleted it.
-        del self.__lockdict[lname]
-        # And let's remove it from our private list if we owned it.
-        if self._is_owned():
-          self._del_owned(name=lname)
+    try:
+      for lname in names:
+        # Calling delete() acquires the lock exclusively if we don't already
+        # own it, and causes all pending and subsequent lock acquires to fail.
+        # It's fine to call it out of order because delete() also implies
+        # release(), and the assertion above guarantees that if we either
+        # already hold everything we want to delete, or we hold none.
+        try:
+          lock = self.__lockdict[lname]
+          if whole_owned:
+            lock._adopt(0)
+          lock.delete()
+          removed.append(lname)
+        except (KeyError, errors.LockError):
+          # This cannot happen if we were already holding it, verify:
+          assert not self._is_owned(), ("remove failed while holding lockset"
+                                        " %s" % self.name)
+        else:
+          # If no LockError was raised we are the ones who deleted the lock.
+          # This means we can safely remove it from lockdict, as any further
+          # or pending delete() or acquire() will fail (and nobody can have
+          # the lock since before our call to delete()).
+          #
+          # This is done in an else clause because if the exception was thrown
+          # it's the job of the one who actually deleted it.
+          del self.__lockdict[lname]
+          # And let's remove it from our private list if we owned it.
+          if self._is_owned():
+            self._del_owned(name=lname)
+    finally:
+      if register:
+        self.__state.UnregisterIntent()
 
     return removed
 
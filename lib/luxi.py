@@ -30,6 +30,7 @@ The module is also used by the master daemon.
 """
 
 import socket
+import struct
 import collections
 import time
 import errno
@@ -45,6 +46,8 @@ KEY_METHOD = "method"
 KEY_ARGS = "args"
 KEY_SUCCESS = "success"
 KEY_RESULT = "result"
+KEY_STREAM = "stream"
+KEY_MORE = "more"
 
 REQ_SUBMIT_JOB = "SubmitJob"
 REQ_SUBMIT_MANY_JOBS = "SubmitManyJobs"
@@ -60,8 +63,22 @@ REQ_QUERY_CONFIG_VALUES = "QueryConfigValues"
 REQ_QUERY_CLUSTER_INFO = "QueryClusterInfo"
 REQ_QUERY_TAGS = "QueryTags"
 REQ_QUERY_LOCKS = "QueryLocks"
+REQ_QUERY_QUEUE_STATS = "QueryQueueStats"
 REQ_QUEUE_SET_DRAIN_FLAG = "SetDrainFlag"
 REQ_SET_WATCHER_PAUSE = "SetWatcherPause"
+REQ_SET_FRAMING = "SetFraming"
+
+#: Messages are terminated by L{constants.LUXI_EOM} (the default)
+FRAMING_TERMINATOR = "terminator"
+
+#: Messages are prefixed by their length (see
+#: L{constants.LUXI_LENGTH_PREFIX_FORMAT})
+FRAMING_LENGTH = "length"
+
+FRAMINGS = frozenset([
+  FRAMING_TERMINATOR,
+  FRAMING_LENGTH,
+  ])
 
 DEF_CTMO = 10
 DEF_RWTO = 60
@@ -69,6 +86,14 @@ DEF_RWTO = 60
 # WaitForJobChange timeout
 WFJC_TIMEOUT = (DEF_RWTO - 1) / 2
 
+# Number of rows per message for streamed results
+DEF_CHUNK_SIZE = 1000
+
+_LENGTH_PREFIX_SIZE = struct.calcsize(constants.LUXI_LENGTH_PREFIX_FORMAT)
+
+# Maximum amount of data read at once
+_MAX_RECV_SIZE = 1024 * 1024
+
 
 class ProtocolError(errors.GenericError):
   """Denotes an error in the LUXI protocol."""
@@ -151,6 +176,7 @@ class Transport:
     self.socket = None
     self._buffer = ""
     self._msgs = collections.deque()
+    self._length_prefix = False
 
     try:
       self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -194,22 +220,69 @@ class Transport:
     if self.socket is None:
       raise ProtocolError("Connection is closed")
 
+  def UseLengthPrefix(self):
+    """Switches to length-prefixed messages (L{FRAMING_LENGTH}).
+
+    This must only be called after the master daemon agreed to use this
+    framing and when no more messages are to be received in the old one.
+
+    """
+    assert not (self._buffer or self._msgs), \
+      "Switching framing with pending data"
+    self._length_prefix = True
+
   def Send(self, msg):
     """Send a message.
 
     This just sends a message and doesn't wait for the response.
 
     """
-    if constants.LUXI_EOM in msg:
+    if self._length_prefix:
+      data = struct.pack(constants.LUXI_LENGTH_PREFIX_FORMAT, len(msg)) + msg
+    elif constants.LUXI_EOM in msg:
       raise ProtocolError("Message terminator found in payload")
+    else:
+      data = msg + constants.LUXI_EOM
 
     self._CheckSocket()
     try:
       # TODO: sendall is not guaranteed to send everything
-      self.socket.sendall(msg + constants.LUXI_EOM)
+      self.socket.sendall(data)
     except socket.timeout, err:
       raise TimeoutError("Sending timeout: %s" % str(err))
 
+  def _RecvData(self, size, etime):
+    """Receives at most C{size} bytes from the socket.
+
+    """
+    if time.time() > etime:
+      raise TimeoutError("Extended receive timeout")
+    while True:
+      try:
+        data = self.socket.recv(size)
+      except socket.error, err:
+        if err.args and err.args[0] == errno.EAGAIN:
+          continue
+        raise
+      except socket.timeout, err:
+        raise TimeoutError("Receive timeout: %s" % str(err))
+      break
+    if not data:
+      raise ConnectionClosedError("Connection closed while reading")
+    return data
+
+  def _RecvExactly(self, size, etime):
+    """Receives exactly C{size} bytes from the socket.
+
+    """
+    parts = []
+    count = 0
+    while count < size:
+      data = self._RecvData(min(size - count, _MAX_RECV_SIZE), etime)
+      parts.append(data)
+      count += len(data)
+    return "".join(parts)
+
   def Recv(self):
     """Try to receive a message from the socket.
 
@@ -221,21 +294,14 @@ class Transport:
     """
     self._CheckSocket()
     etime = time.time() + self._rwtimeout
+    if self._length_prefix:
+      (length, ) = struct.unpack(constants.LUXI_LENGTH_PREFIX_FORMAT,
+                                 self._RecvExactly(_LENGTH_PREFIX_SIZE,
+                                                   etime))
+      return self._RecvExactly(length, etime)
+
     while not self._msgs:
-      if time.time() > etime:
-        raise TimeoutError("Extended receive timeout")
-      while True:
-        try:
-          data = self.socket.recv(4096)
-        except socket.error, err:
-          if err.args and err.args[0] == errno.EAGAIN:
-            continue
-          raise
-        except socket.timeout, err:
-          raise TimeoutError("Receive timeout: %s" % str(err))
-        break
-      if not data:
-        raise ConnectionClosedError("Connection closed while reading")
+      data = self._RecvData(4096, etime)
       new_msgs = (self._buffer + data).split(constants.LUXI_EOM)
       self._buffer = new_msgs.pop()
       self._msgs.extend(new_msgs)
@@ -260,6 +326,10 @@ class Transport:
 def ParseRequest(msg):
   """Parses a LUXI request message.
 
+  @rtype: tuple; (string, any, None or int)
+  @return: method name, arguments and the number of rows per message if
+      the result should be streamed (see L{FormatStreamResponse})
+
   """
   try:
     request = serializer.LoadJson(msg)
@@ -274,18 +344,29 @@ def ParseRequest(msg):
 
   method = request.get(KEY_METHOD, None) # pylint: disable-msg=E1103
   args = request.get(KEY_ARGS, None) # pylint: disable-msg=E1103
+  stream = request.get(KEY_STREAM, None) # pylint: disable-msg=E1103
 
   if method is None or args is None:
     logging.error("LUXI request missing method or arguments: %r", msg)
     raise ProtocolError(("Invalid LUXI request (no method or arguments"
                          " in request): %r") % msg)
 
-  return (method, args)
+  if not (stream is None or
+          (isinstance(stream, (int, long)) and stream > 0)):
+    logging.error("LUXI request with invalid chunk size: %r", msg)
+    raise ProtocolError("Invalid LUXI request (invalid chunk size %r)" %
+                        stream)
+
+  return (method, args, stream)
 
 
 def ParseResponse(msg):
   """Parses a LUXI response message.
 
+  @rtype: tuple; (bool, any, bool)
+  @return: success, result and whether more messages belonging to this
+      response follow (see L{FormatStreamResponse})
+
   """
   # Parse the result
   try:
@@ -299,7 +380,7 @@ def ParseResponse(msg):
           KEY_RESULT in data):
     raise ProtocolError("Invalid response from server: %r" % data)
 
-  return (data[KEY_SUCCESS], data[KEY_RESULT])
+  return (data[KEY_SUCCESS], data[KEY_RESULT], bool(data.get(KEY_MORE, False)))
 
 
 def FormatResponse(success, result):
@@ -313,12 +394,48 @@ def FormatResponse(success, result):
 
   logging.debug("LUXI response: %s", response)
 
-  return serializer.DumpJson(response)
+  return serializer.DumpJson(response, indent=False)
+
+
+def FormatStreamResponse(rows, chunk_size):
+  """Formats a successful LUXI response as a series of messages.
+
+  Each message contains up to C{chunk_size} rows of the result. All but the
+  last one are marked with L{KEY_MORE}.
+
+  @type rows: list
+  @param rows: the result
+  @type chunk_size: int
+  @param chunk_size: maximum number of rows per message
+  @return: an iterator returning the messages
+
+  """
+  assert chunk_size > 0
+
+  logging.debug("LUXI streamed response with %s rows", len(rows))
 
+  for start in range(0, max(len(rows), 1), chunk_size):
+    end = start + chunk_size
 
-def FormatRequest(method, args):
+    response = {
+      KEY_SUCCESS: True,
+      KEY_RESULT: rows[start:end],
+      }
+
+    if end < len(rows):
+      response[KEY_MORE] = True
+
+    yield serializer.DumpJson(response, indent=False)
+
+
+def FormatRequest(method, args, stream=None):
   """Formats a LUXI request message.
 
+  @type stream: None or int
+  @param stream: if not None, the maximum number of rows per message if the
+      result is a list (the server may not support streaming and always
+      send the full result in one message)
+
   """
   # Build request
   request = {
@@ -326,6 +443,9 @@ def FormatRequest(method, args):
     KEY_ARGS: args,
     }
 
+  if stream is not None:
+    request[KEY_STREAM] = stream
+
   # Serialize the request
   return serializer.DumpJson(request, indent=False)
 
@@ -341,8 +461,18 @@ def CallLuxiMethod(transport_cb, method, args):
   # Send request and wait for response
   response_msg = transport_cb(request_msg)
 
-  (success, result) = ParseResponse(response_msg)
+  (success, result, more) = ParseResponse(response_msg)
+
+  if more:
+    raise ProtocolError("Received streamed response for normal request")
+
+  return _CheckResult(success, result)
+
+
+def _CheckResult(success, result):
+  """Returns the result of a successful request or raises an exception.
 
+  """
   if success:
     return result
 
@@ -350,6 +480,35 @@ def CallLuxiMethod(transport_cb, method, args):
   raise RequestError(result)
 
 
+def SelectFraming(framings):
+  """Selects the framing to be used from a client's list.
+
+  @type framings: list
+  @param framings: framings supported by the client, in order of preference
+  @rtype: string
+  @return: one of L{FRAMINGS}
+
+  """
+  for framing in framings:
+    if framing in FRAMINGS:
+      return framing
+
+  return FRAMING_TERMINATOR
+
+
+def _QueryArgs(names, fields, use_locking, max_age):
+  """Builds the arguments of an instance or node query.
+
+  The maximum age of runtime data is only sent if given, so that queries
+  for fresh data remain compatible with older master daemons.
+
+  """
+  args = [names, fields, use_locking]
+  if max_age is not None:
+    args.append(max_age)
+  return tuple(args)
+
+
 class Client(object):
   """High-level client implementation.
 
@@ -357,24 +516,30 @@ class Client(object):
   implements data serialization/deserialization.
 
   """
-  def __init__(self, address=None, timeouts=None, transport=Transport):
+  def __init__(self, address=None, timeouts=None, transport=Transport,
+               framing=FRAMING_TERMINATOR):
     """Constructor for the Client class.
 
     Arguments:
       - address: a valid address the the used transport class
       - timeout: a list of timeouts, to be used on connect and read/write
       - transport: a Transport-like class
+      - framing: message framing to negotiate with the master daemon for
+        each connection (one of L{FRAMINGS}); older master daemons only
+        support L{FRAMING_TERMINATOR}
 
 
     If timeout is not passed, the default timeouts of the transport
     class are used.
 
     """
+    assert framing in FRAMINGS
     if address is None:
       address = constants.MASTER_SOCKET
     self.address = address
     self.timeouts = timeouts
     self.transport_class = transport
+    self.framing = framing
     self.transport = None
     self._InitTransport()
 
@@ -383,8 +548,29 @@ class Client(object):
 
     """
     if self.transport is None:
-      self.transport = self.transport_class(self.address,
-                                            timeouts=self.timeouts)
+      transport = self.transport_class(self.address, timeouts=self.timeouts)
+      try:
+        if self.framing != FRAMING_TERMINATOR:
+          self._NegotiateFraming(transport)
+      except Exception:
+        transport.Close()
+        raise
+      self.transport = transport
+
+  def _NegotiateFraming(self, transport):
+    """Negotiates the message framing for a new connection.
+
+    """
+    try:
+      framing = CallLuxiMethod(transport.Call, REQ_SET_FRAMING,
+                               [[self.framing]])
+    except RequestError, err:
+      # Master daemon doesn't know about other framings
+      logging.debug("Framing negotiation failed: %s", err)
+      return
+
+    if framing == FRAMING_LENGTH:
+      transport.UseLengthPrefix()
 
   def _CloseTransport(self):
     """Close the transport, ignoring errors.
@@ -414,6 +600,53 @@ class Client(object):
     """
     return CallLuxiMethod(self._SendMethodCall, method, args)
 
+  def IterMethod(self, method, args, chunk_size=DEF_CHUNK_SIZE):
+    """Send a request returning a list and iterate over its rows.
+
+    The result is streamed by the master daemon in messages of up to
+    C{chunk_size} rows, which are only received and parsed when iterating.
+    Until the iterator is exhausted, other requests sent using this client
+    use a new connection.
+
+    """
+    request_msg = FormatRequest(method, args, stream=chunk_size)
+
+    try:
+      self._InitTransport()
+      transport = self.transport
+      transport.Send(request_msg)
+    except Exception:
+      self._CloseTransport()
+      raise
+
+    # Make sure the connection isn't used for other requests before the
+    # whole response was received
+    self.transport = None
+
+    while True:
+      try:
+        (success, result, more) = ParseResponse(transport.Recv())
+      except Exception:
+        transport.Close()
+        raise
+
+      if not more:
+        # Response complete, the connection can be used again
+        if self.transport is None:
+          self.transport = transport
+        else:
+          transport.Close()
+
+      result = _CheckResult(success, result)
+      if not isinstance(result, list):
+        raise ProtocolError("Result of streamed request is not a list")
+
+      for row in result:
+        yield row
+
+      if not more:
+        break
+
   def SetQueueDrainFlag(self, drain_flag):
     return self.CallMethod(REQ_QUEUE_SET_DRAIN_FLAG, drain_flag)
 
@@ -474,11 +707,29 @@ class Client(object):
   def QueryJobs(self, job_ids, fields):
     return self.CallMethod(REQ_QUERY_JOBS, (job_ids, fields))
 
-  def QueryInstances(self, names, fields, use_locking):
-    return self.CallMethod(REQ_QUERY_INSTANCES, (names, fields, use_locking))
+  def IterQueryJobs(self, job_ids, fields, chunk_size=DEF_CHUNK_SIZE):
+    return self.IterMethod(REQ_QUERY_JOBS, (job_ids, fields),
+                           chunk_size=chunk_size)
 
-  def QueryNodes(self, names, fields, use_locking):
-    return self.CallMethod(REQ_QUERY_NODES, (names, fields, use_locking))
+  def QueryInstances(self, names, fields, use_locking, max_age=None):
+    return self.CallMethod(REQ_QUERY_INSTANCES,
+                           _QueryArgs(names, fields, use_locking, max_age))
+
+  def IterQueryInstances(self, names, fields, use_locking,
+                         chunk_size=DEF_CHUNK_SIZE, max_age=None):
+    return self.IterMethod(REQ_QUERY_INSTANCES,
+                           _QueryArgs(names, fields, use_locking, max_age),
+                           chunk_size=chunk_size)
+
+  def QueryNodes(self, names, fields, use_locking, max_age=None):
+    return self.CallMethod(REQ_QUERY_NODES,
+                           _QueryArgs(names, fields, use_locking, max_age))
+
+  def IterQueryNodes(self, names, fields, use_locking,
+                     chunk_size=DEF_CHUNK_SIZE, max_age=None):
+    return self.IterMethod(REQ_QUERY_NODES,
+                           _QueryArgs(names, fields, use_locking, max_age),
+                           chunk_size=chunk_size)
 
   def QueryExports(self, nodes, use_locking):
     return self.CallMethod(REQ_QUERY_EXPORTS, (nodes, use_locking))
@@ -494,3 +745,6 @@ class Client(object):
 
   def QueryLocks(self, fields, sync):
     return self.CallMethod(REQ_QUERY_LOCKS, (fields, sync))
+
+  def QueryQueueStats(self):
+    return self.CallMethod(REQ_QUERY_QUEUE_STATS, ())
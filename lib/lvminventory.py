@@ -0,0 +1,273 @@
+#
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Node-local inventory of LVM volumes.
+
+Listing volumes, volume groups and their free space used to run a separate
+C{lvs}, C{vgs} or C{pvs} for every query, even though a cluster verification
+asks for most of them at once. An L{LvmSnapshot} runs C{pvs} and C{lvs}
+once each with all fields needed by Ganeti and answers all these queries.
+
+Snapshots are kept for a short time only. Changes done by Ganeti itself
+invalidate them immediately: as the node daemon handles requests in several
+processes, the invalidation writes a new value to a stamp file and every
+process compares it with the value read before its scan.
+
+"""
+
+import errno
+import logging
+import time
+
+from ganeti import utils
+from ganeti import errors
+from ganeti import constants
+
+
+#: Physical volumes, one entry per PV
+KIND_PV = "pv"
+
+#: Volume groups, one entry per VG
+KIND_VG = "vg"
+
+#: Logical volumes, one entry per LV segment
+KIND_LV = "lv"
+
+#: Fields retrieved for volume groups
+VG_FIELDS = ["vg_name", "vg_size", "vg_free", "vg_attr"]
+
+#: Fields retrieved for physical volumes, including those of their VG
+PV_FIELDS = ["pv_name", "pv_size", "pv_used", "pv_free", "pv_attr"] + VG_FIELDS
+
+#: Fields retrieved for logical volumes
+LV_FIELDS = ["lv_name", "vg_name", "lv_size", "lv_attr", "devices"]
+
+_SEP = "|"
+
+
+def _RunLvmCommand(cmd, fields):
+  """Runs an LVM reporting command.
+
+  @type cmd: string
+  @param cmd: One of "pvs" or "lvs"
+  @type fields: list
+  @param fields: Fields to report
+  @rtype: list
+  @return: A dictionary by field name for every line of output
+  @raise errors.CommandError: if the command fails
+
+  """
+  result = utils.RunCmd([cmd, "--noheadings", "--nosuffix", "--units=m",
+                         "--unbuffered", "--separator=%s" % _SEP,
+                         "-o%s" % ",".join(fields)])
+  if result.failed:
+    raise errors.CommandError("Can't get the volume information from %s:"
+                              " %s - %s" %
+                              (cmd, result.fail_reason, result.output))
+
+  data = []
+  for line in result.stdout.splitlines():
+    values = [value.strip() for value in line.strip().split(_SEP)]
+
+    if len(values) != len(fields):
+      logging.warning("Invalid line returned from %s: %s", cmd, line)
+      continue
+
+    data.append(dict(zip(fields, values)))
+
+  return data
+
+
+class LvmSnapshot(object):
+  """Physical and logical volumes at one point in time.
+
+  The commands are only run when their data is first needed.
+
+  """
+  def __init__(self, stamp, _run_fn=_RunLvmCommand):
+    """Initializes this class.
+
+    @param stamp: Value of the stamp file before the data was retrieved
+
+    """
+    self.stamp = stamp
+    self._run_fn = _run_fn
+    self._pvs = None
+    self._lvs = None
+
+  def GetPhysicalVolumes(self):
+    """Returns all physical volumes.
+
+    @rtype: list of dicts
+    @return: Fields listed in L{PV_FIELDS} for every PV; the VG fields are
+      empty for PVs not belonging to a volume group
+
+    """
+    if self._pvs is None:
+      self._pvs = self._run_fn("pvs", PV_FIELDS)
+    return self._pvs
+
+  def GetVolumeGroups(self):
+    """Returns all volume groups.
+
+    @rtype: list of dicts
+    @return: Fields listed in L{VG_FIELDS} for every VG
+
+    """
+    result = []
+    seen = set()
+    for pv in self.GetPhysicalVolumes():
+      vg_name = pv["vg_name"]
+      if not vg_name or vg_name in seen:
+        continue
+      seen.add(vg_name)
+      result.append(dict([(name, pv[name]) for name in VG_FIELDS]))
+    return result
+
+  def GetLogicalVolumes(self):
+    """Returns all logical volumes.
+
+    @rtype: list of dicts
+    @return: Fields listed in L{LV_FIELDS}; logical volumes with several
+      segments are listed once per segment
+
+    """
+    if self._lvs is None:
+      self._lvs = self._run_fn("lvs", LV_FIELDS)
+    return self._lvs
+
+  def Query(self, kind, fields, name=None):
+    """Returns the values of some fields.
+
+    @type kind: string
+    @param kind: One of L{KIND_PV}, L{KIND_VG} or L{KIND_LV}
+    @type fields: list
+    @param fields: Wanted fields
+    @type name: string or None
+    @param name: Only return the entries with this name
+    @rtype: list of lists
+
+    """
+    if kind == KIND_PV:
+      (entries, name_field) = (self.GetPhysicalVolumes(), "pv_name")
+    elif kind == KIND_VG:
+      (entries, name_field) = (self.GetVolumeGroups(), "vg_name")
+    elif kind == KIND_LV:
+      (entries, name_field) = (self.GetLogicalVolumes(), "lv_name")
+    else:
+      raise errors.ProgrammerError("Unknown kind %r" % kind)
+
+    return [[entry[field] for field in fields]
+            for entry in entries
+            if name is None or entry[name_field] == name]
+
+
+class LvmInventory(object):
+  """Keeps a recent L{LvmSnapshot}.
+
+  """
+  def __init__(self, stamp_file, max_age,
+               _time_fn=time.time, _run_fn=_RunLvmCommand):
+    """Initializes this class.
+
+    @type stamp_file: string
+    @param stamp_file: Path to the file changed on every invalidation
+    @type max_age: number
+    @param max_age: For how long a snapshot is used, to notice changes not
+      made by Ganeti
+
+    """
+    self._stamp_file = stamp_file
+    self._max_age = max_age
+    self._time_fn = _time_fn
+    self._run_fn = _run_fn
+    self._snapshot = None
+    self._created = None
+
+  def _ReadStamp(self):
+    """Reads the stamp file.
+
+    @return: The file's contents, None if it can't be read
+
+    """
+    try:
+      return utils.ReadFile(self._stamp_file)
+    except EnvironmentError, err:
+      if err.errno == errno.ENOENT:
+        return ""
+      logging.warning("Can't read LVM inventory stamp file %s: %s",
+                      self._stamp_file, err)
+      return None
+
+  def GetSnapshot(self):
+    """Returns a recent snapshot.
+
+    @rtype: L{LvmSnapshot}
+
+    """
+    stamp = self._ReadStamp()
+    now = self._time_fn()
+
+    snapshot = self._snapshot
+    if (snapshot is None or stamp is None or snapshot.stamp != stamp or
+        (now - self._created) > self._max_age):
+      snapshot = LvmSnapshot(stamp, _run_fn=self._run_fn)
+
+      # Without a stamp, invalidations by other processes can't be noticed
+      if stamp is None:
+        self._snapshot = None
+      else:
+        self._snapshot = snapshot
+        self._created = now
+
+    return snapshot
+
+  def Invalidate(self):
+    """Discards all snapshots after volumes have been changed.
+
+    """
+    self._snapshot = None
+
+    try:
+      utils.WriteFile(self._stamp_file, data=utils.NewUUID())
+    except EnvironmentError, err:
+      logging.error("Can't update LVM inventory stamp file %s: %s",
+                    self._stamp_file, err)
+
+
+_inventory = LvmInventory(constants.LVM_INVENTORY_STAMP_FILE,
+                          constants.LVM_INVENTORY_MAX_AGE)
+
+
+def GetSnapshot():
+  """Returns a recent snapshot of this node's LVM volumes.
+
+  @rtype: L{LvmSnapshot}
+
+  """
+  return _inventory.GetSnapshot()
+
+
+def Invalidate():
+  """Discards snapshots in all processes after LVM volumes were changed.
+
+  """
+  _inventory.Invalidate()
@@ -545,7 +545,12 @@ class HooksMaster(object):
         self.lu.LogWarning("Communication failure to node %s: %s",
                            node_name, msg)
         continue
-      for script, hkr, output in res.payload:
+      for entry in res.payload:
+        # Nodes running an older version don't report durations
+        (script, hkr, output) = entry[:3]
+        if len(entry) > 3 and entry[3] is not None:
+          logging.debug("Hook script %s on %s ran for %.3f seconds",
+                        script, node_name, entry[3])
         if hkr == constants.HKR_FAIL:
           if phase == constants.HOOKS_PHASE_PRE:
             errs.append((node_name, script, output))
@@ -371,7 +371,7 @@ class OpAddNode(OpCode):
 class OpQueryNodes(OpCode):
   """Compute the list of nodes."""
   OP_ID = "OP_NODE_QUERY"
-  __slots__ = ["output_fields", "names", "use_locking"]
+  __slots__ = ["output_fields", "names", "use_locking", "max_age"]
 
 
 class OpQueryNodeVolumes(OpCode):
@@ -619,7 +619,7 @@ class OpRecreateInstanceDisks(OpCode):
 class OpQueryInstances(OpCode):
   """Compute the list of instances."""
   OP_ID = "OP_INSTANCE_QUERY"
-  __slots__ = ["output_fields", "names", "use_locking"]
+  __slots__ = ["output_fields", "names", "use_locking", "max_age"]
 
 
 class OpQueryInstanceData(OpCode):
@@ -217,7 +217,8 @@ def GetClient():
 
   """
   try:
-    return luxi.Client()
+    # Replies to queries can be large, hence length-prefixed framing is used
+    return luxi.Client(framing=luxi.FRAMING_LENGTH)
   except luxi.NoMasterError, err:
     raise http.HttpBadGateway("Master seems to unreachable: %s" % str(err))
   except luxi.PermissionError:
@@ -369,6 +370,22 @@ class R_Generic(object):
     """
     return bool(self._checkIntVariable("bulk"))
 
+  def getMaxAge(self):
+    """Returns the maximum age of runtime data requested by the client.
+
+    @rtype: int or None
+    @return: Maximum age in seconds or None if fresh data should be retrieved
+
+    """
+    if "max_age" not in self.queryargs:
+      return None
+
+    max_age = self._checkIntVariable("max_age")
+    if max_age < 0:
+      raise http.HttpBadRequest("Invalid value for the 'max_age' parameter")
+
+    return max_age
+
   def useForce(self):
     """Check if the request specifies a forced operation.
 
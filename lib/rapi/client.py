@@ -525,11 +525,14 @@ class GanetiRapiClient(object):
     return self._SendRequest(HTTP_DELETE, "/%s/tags" % GANETI_RAPI_VERSION,
                              query, None)
 
-  def GetInstances(self, bulk=False):
+  def GetInstances(self, bulk=False, max_age=None):
     """Gets information about instances on the cluster.
 
     @type bulk: bool
     @param bulk: whether to return all information about all instances
+    @type max_age: int
+    @param max_age: maximum age of runtime data in seconds (None for fresh
+        data)
 
     @rtype: list of dict or list of str
     @return: if bulk is True, info about the instances, else a list of instances
@@ -538,6 +541,8 @@ class GanetiRapiClient(object):
     query = []
     if bulk:
       query.append(("bulk", 1))
+    if max_age is not None:
+      query.append(("max_age", max_age))
 
     instances = self._SendRequest(HTTP_GET,
                                   "/%s/instances" % GANETI_RAPI_VERSION,
@@ -1082,11 +1087,14 @@ class GanetiRapiClient(object):
                              "/%s/jobs/%s" % (GANETI_RAPI_VERSION, job_id),
                              query, None)
 
-  def GetNodes(self, bulk=False):
+  def GetNodes(self, bulk=False, max_age=None):
     """Gets all nodes in the cluster.
 
     @type bulk: bool
     @param bulk: whether to return all information about all instances
+    @type max_age: int
+    @param max_age: maximum age of runtime data in seconds (None for fresh
+        data)
 
     @rtype: list of dict or str
     @return: if bulk is true, info about nodes in the cluster,
@@ -1096,6 +1104,8 @@ class GanetiRapiClient(object):
     query = []
     if bulk:
       query.append(("bulk", 1))
+    if max_age is not None:
+      query.append(("max_age", max_age))
 
     nodes = self._SendRequest(HTTP_GET, "/%s/nodes" % GANETI_RAPI_VERSION,
                               query, None)
@@ -192,7 +192,7 @@ class R_2_jobs(baserlib.R_Generic):
     fields = ["id"]
     cl = baserlib.GetClient()
     # Convert the list of lists to the list of ids
-    result = [job_id for [job_id] in cl.QueryJobs(None, fields)]
+    result = [job_id for [job_id] in cl.IterQueryJobs(None, fields)]
     return baserlib.BuildUriList(result, "/2/jobs/%s",
                                  uri_fields=("id", "uri"))
 
@@ -293,10 +293,11 @@ class R_2_nodes(baserlib.R_Generic):
     client = baserlib.GetClient()
 
     if self.useBulk():
-      bulkdata = client.QueryNodes([], N_FIELDS, False)
+      bulkdata = client.IterQueryNodes([], N_FIELDS, False,
+                                       max_age=self.getMaxAge())
       return baserlib.MapBulkFields(bulkdata, N_FIELDS)
     else:
-      nodesdata = client.QueryNodes([], ["name"], False)
+      nodesdata = client.IterQueryNodes([], ["name"], False)
       nodeslist = [row[0] for row in nodesdata]
       return baserlib.BuildUriList(nodeslist, "/2/nodes/%s",
                                    uri_fields=("id", "uri"))
@@ -315,7 +316,8 @@ class R_2_nodes_name(baserlib.R_Generic):
 
     result = baserlib.HandleItemQueryErrors(client.QueryNodes,
                                             names=[node_name], fields=N_FIELDS,
-                                            use_locking=self.useLocking())
+                                            use_locking=self.useLocking(),
+                                            max_age=self.getMaxAge())
 
     return baserlib.MapFields(N_FIELDS, result[0])
 
@@ -635,10 +637,11 @@ class R_2_instances(baserlib.R_Generic):
 
     use_locking = self.useLocking()
     if self.useBulk():
-      bulkdata = client.QueryInstances([], I_FIELDS, use_locking)
+      bulkdata = client.IterQueryInstances([], I_FIELDS, use_locking,
+                                           max_age=self.getMaxAge())
       return baserlib.MapBulkFields(bulkdata, I_FIELDS)
     else:
-      instancesdata = client.QueryInstances([], ["name"], use_locking)
+      instancesdata = client.IterQueryInstances([], ["name"], use_locking)
       instanceslist = [row[0] for row in instancesdata]
       return baserlib.BuildUriList(instanceslist, "/2/instances/%s",
                                    uri_fields=("id", "uri"))
@@ -742,7 +745,8 @@ class R_2_instances_name(baserlib.R_Generic):
     result = baserlib.HandleItemQueryErrors(client.QueryInstances,
                                             names=[instance_name],
                                             fields=I_FIELDS,
-                                            use_locking=self.useLocking())
+                                            use_locking=self.useLocking(),
+                                            max_age=self.getMaxAge())
 
     return baserlib.MapFields(I_FIELDS, result[0])
 
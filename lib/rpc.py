@@ -76,6 +76,19 @@ _TIMEOUTS = {
 }
 
 
+def GetProcedureTimeout(procedure):
+  """Returns the timeout used by clients of an RPC procedure.
+
+  @type procedure: string
+  @param procedure: the name of the procedure
+  @rtype: number or None
+  @return: the timeout in seconds, None if the procedure is unknown or its
+      timeout depends on the call's arguments
+
+  """
+  return _TIMEOUTS.get(procedure, None)
+
+
 def Init():
   """Initializes the module-global HTTP client manager.
 
@@ -101,6 +114,12 @@ def Shutdown():
   running.
 
   """
+  global _http_pool # pylint: disable-msg=W0603
+
+  if _http_pool is not None:
+    _http_pool.Reset()
+    _http_pool = None
+
   pycurl.global_cleanup()
 
 
@@ -118,23 +137,27 @@ def _ConfigRpcCurl(curl):
   curl.setopt(pycurl.CONNECTTIMEOUT, _RPC_CONNECT_TIMEOUT)
 
 
-class _RpcThreadLocal(threading.local):
-  def GetHttpClientPool(self):
-    """Returns a per-thread HTTP client pool.
+# Process-wide HTTP client pool, shared by all threads so that connections
+# to nodes (which are kept alive by the node daemon) can be reused
+_http_pool = None
+_http_pool_lock = threading.Lock()
 
-    @rtype: L{http.client.HttpClientPool}
 
-    """
-    try:
-      pool = self.hcp
-    except AttributeError:
-      pool = http.client.HttpClientPool(_ConfigRpcCurl)
-      self.hcp = pool
+def _GetHttpClientPool():
+  """Returns the process-wide HTTP client pool.
 
-    return pool
+  @rtype: L{http.client.HttpClientPool}
 
+  """
+  global _http_pool # pylint: disable-msg=W0603
 
-_thread_local = _RpcThreadLocal()
+  _http_pool_lock.acquire()
+  try:
+    if _http_pool is None:
+      _http_pool = http.client.HttpClientPool(_ConfigRpcCurl)
+    return _http_pool
+  finally:
+    _http_pool_lock.release()
 
 
 def _RpcTimeout(secs):
@@ -364,7 +387,7 @@ class Client:
 
     """
     if not http_pool:
-      http_pool = _thread_local.GetHttpClientPool()
+      http_pool = _GetHttpClientPool()
 
     http_pool.ProcessRequests(self._request.values())
 
@@ -951,6 +974,22 @@ class RpcRunner(object):
     return self._SingleNodeCall(node, "blockdev_create",
                                 [bdev.ToDict(), size, owner, on_primary, info])
 
+  @_RpcTimeout(_TMO_SLOW)
+  def call_blockdev_create_multi(self, node, devices, owner, on_primary, info):
+    """Request creation of several block devices.
+
+    The devices are created in the given order and creation stops at the
+    first failure. The payload contains a (success, unique_id or error
+    message) tuple for every device attempted.
+
+    This is a single-node call.
+
+    """
+    return self._SingleNodeCall(node, "blockdev_create_multi",
+                                [[(bdev.ToDict(), size)
+                                  for (bdev, size) in devices],
+                                 owner, on_primary, info])
+
   @_RpcTimeout(_TMO_NORMAL)
   def call_blockdev_remove(self, node, bdev):
     """Request removal of a given block device.
@@ -980,6 +1019,20 @@ class RpcRunner(object):
     return self._SingleNodeCall(node, "blockdev_assemble",
                                 [disk.ToDict(), owner, on_primary])
 
+  @_RpcTimeout(_TMO_SLOW)
+  def call_blockdev_assemble_multi(self, node, disks, owner, on_primary):
+    """Request assembling of several block devices.
+
+    The payload contains a (success, result or error message) tuple for
+    every disk.
+
+    This is a single-node call.
+
+    """
+    return self._SingleNodeCall(node, "blockdev_assemble_multi",
+                                [[disk.ToDict() for disk in disks],
+                                 owner, on_primary])
+
   @_RpcTimeout(_TMO_NORMAL)
   def call_blockdev_shutdown(self, node, disk):
     """Request shutdown of a given block device.
@@ -989,6 +1042,18 @@ class RpcRunner(object):
     """
     return self._SingleNodeCall(node, "blockdev_shutdown", [disk.ToDict()])
 
+  @_RpcTimeout(_TMO_NORMAL)
+  def call_blockdev_shutdown_multi(self, node, disks):
+    """Request shutdown of several block devices.
+
+    The payload contains a (success, error message) tuple for every disk.
+
+    This is a single-node call.
+
+    """
+    return self._SingleNodeCall(node, "blockdev_shutdown_multi",
+                                [[disk.ToDict() for disk in disks]])
+
   @_RpcTimeout(_TMO_NORMAL)
   def call_blockdev_addchildren(self, node, bdev, ndevs):
     """Request adding a list of children to a (mirroring) device.
@@ -1037,6 +1102,27 @@ class RpcRunner(object):
       result.payload = objects.BlockDevStatus.FromDict(result.payload)
     return result
 
+  @_RpcTimeout(_TMO_NORMAL)
+  def call_blockdev_find_multi(self, node, disks):
+    """Request identification of several block devices.
+
+    The payload contains a (success, status or error message) tuple for
+    every disk.
+
+    This is a single-node call.
+
+    """
+    result = self._SingleNodeCall(node, "blockdev_find_multi",
+                                  [[disk.ToDict() for disk in disks]])
+    if not result.fail_msg:
+      payload = []
+      for (success, status) in result.payload:
+        if success and status is not None:
+          status = objects.BlockDevStatus.FromDict(status)
+        payload.append((success, status))
+      result.payload = payload
+    return result
+
   @_RpcTimeout(_TMO_NORMAL)
   def call_blockdev_close(self, node, instance_name, disks):
     """Closes the given block devices.
@@ -1125,6 +1211,33 @@ class RpcRunner(object):
     return cls._StaticMultiNodeCall(node_list, "upload_file", params,
                                     address_list=address_list)
 
+  @classmethod
+  @_RpcTimeout(_TMO_NORMAL)
+  def call_upload_config_delta(cls, node_list, file_name, delta,
+                               address_list=None):
+    """Apply a delta to the configuration file.
+
+    The ownership and permissions of the local file are replicated, as
+    with L{call_upload_file}.
+
+    This is a multi-node call.
+
+    @type node_list: list
+    @param node_list: the list of node names to upload to
+    @type file_name: str
+    @param file_name: the configuration file name
+    @type delta: dict
+    @param delta: the configuration delta
+    @type address_list: list or None
+    @keyword address_list: an optional list of node addresses, in order
+        to optimize the RPC speed
+
+    """
+    st = os.stat(file_name)
+    params = [file_name, delta, st.st_mode, st.st_uid, st.st_gid]
+    return cls._StaticMultiNodeCall(node_list, "upload_config_delta", params,
+                                    address_list=address_list)
+
   @classmethod
   @_RpcTimeout(_TMO_NORMAL)
   def call_write_ssconf_files(cls, node_list, values):
@@ -1364,6 +1477,24 @@ class RpcRunner(object):
                                     [file_name, cls._Compress(content)],
                                     address_list=address_list)
 
+  @classmethod
+  @_RpcTimeout(_TMO_FAST)
+  def call_jobqueue_update_many(cls, node_list, address_list, files):
+    """Update multiple job queue files.
+
+    This is a multi-node call.
+
+    @type files: list of (str, str, bool)
+    @param files: list of (file name, contents, append) tuples
+
+    """
+    return cls._StaticMultiNodeCall(node_list, "jobqueue_update_many",
+                                    [[(file_name, cls._Compress(content),
+                                       append)
+                                      for (file_name, content, append)
+                                      in files]],
+                                    address_list=address_list)
+
   @classmethod
   @_RpcTimeout(_TMO_NORMAL)
   def call_jobqueue_purge(cls, node):
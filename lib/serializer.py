@@ -23,6 +23,10 @@
 This module introduces a simple abstraction over the serialization
 backend (currently json).
 
+The JSON encoder and decoder are taken from the fastest available module,
+i.e. simplejson or Python's json module, preferring those with C
+extensions.
+
 """
 # pylint: disable-msg=C0103
 
@@ -32,53 +36,140 @@ backend (currently json).
 import simplejson
 import re
 
+try:
+  # pylint: disable-msg=F0401
+  import json
+except ImportError:
+  json = None
+
 from ganeti import errors
 from ganeti import utils
 
 
 _JSON_INDENT = 2
 
+# Separators for compact and indented output; with the default item
+# separator (", "), indented output would have spaces at the end of lines
+_JSON_COMPACT_SEPARATORS = (",", ":")
+_JSON_INDENT_SEPARATORS = (",", ": ")
+
 _RE_EOLSP = re.compile('[ \t]+$', re.MULTILINE)
 
 
 def _GetJsonDumpers(_encoder_class=simplejson.JSONEncoder):
   """Returns two JSON functions to serialize data.
 
+  The compact form is meant for data only read by programs, e.g. RPC or
+  LUXI messages, and doesn't sort keys. The indented form has sorted keys
+  and no whitespace at the end of lines.
+
   @rtype: (callable, callable)
   @return: The function to generate a compact form of JSON and another one to
            generate a more readable, indented form of JSON (if supported)
 
   """
-  plain_encoder = _encoder_class(sort_keys=True)
+  try:
+    plain_encoder = _encoder_class(separators=_JSON_COMPACT_SEPARATORS)
+  except TypeError:
+    # Separators not supported
+    plain_encoder = _encoder_class()
+
+  try:
+    indent_encoder = _encoder_class(indent=_JSON_INDENT, sort_keys=True,
+                                    separators=_JSON_INDENT_SEPARATORS)
+  except TypeError:
+    pass
+  else:
+    return (plain_encoder.encode, indent_encoder.encode)
 
-  # Check whether the simplejson module supports indentation
+  # Check whether the module supports indentation
   try:
     indent_encoder = _encoder_class(indent=_JSON_INDENT, sort_keys=True)
   except TypeError:
     # Indentation not supported
-    indent_encoder = plain_encoder
+    indent_encoder = _encoder_class(sort_keys=True)
+    return (plain_encoder.encode, indent_encoder.encode)
+
+  def _DumpIndent(data):
+    return _RE_EOLSP.sub("", indent_encoder.encode(data))
+
+  return (plain_encoder.encode, _DumpIndent)
+
+
+def _HasCFunction(module, submodule, name):
+  """Checks whether a JSON module uses a C function.
+
+  """
+  return getattr(getattr(module, submodule, None), name, None) is not None
+
+
+class _JsonCodec(object):
+  """JSON encoder and decoder of a module.
+
+  @ivar name: the module name
+  @ivar fast_encoder: whether encoding is implemented in C
+  @ivar fast_decoder: whether decoding is implemented in C
+  @ivar str_decoder: whether the decoder returns strings (instead of unicode
+      objects) for ASCII data, like the simplejson module
+
+  """
+  def __init__(self, module):
+    """Initializes this class.
+
+    @param module: the simplejson or json module
+
+    """
+    self.name = module.__name__
+    self.fast_encoder = _HasCFunction(module, "encoder", "c_make_encoder")
+    self.fast_decoder = _HasCFunction(module, "scanner", "c_make_scanner")
+    self.str_decoder = isinstance(module.loads("\"a\""), str)
+
+    (self.DumpCompact, self.DumpIndent) = \
+      _GetJsonDumpers(_encoder_class=module.JSONEncoder)
+    self.Load = module.loads
+
+
+def _SelectJsonCodecs(modules):
+  """Selects the fastest JSON encoder and decoder.
+
+  Decoders returning unicode objects for ASCII data are only used if no
+  other is available, as the rest of the code is used to strings.
+
+  @type modules: list
+  @param modules: JSON modules in order of preference, None for modules
+      which are not available
+  @rtype: tuple; (L{_JsonCodec}, L{_JsonCodec})
+  @return: the codecs used for encoding and for decoding
+
+  """
+  codecs = [_JsonCodec(module) for module in modules if module is not None]
+
+  encoders = [c for c in codecs if c.fast_encoder] + codecs
+  decoders = ([c for c in codecs if c.str_decoder and c.fast_decoder] +
+              [c for c in codecs if c.str_decoder] +
+              codecs)
 
-  return (plain_encoder.encode, indent_encoder.encode)
+  return (encoders[0], decoders[0])
 
 
-(_DumpJson, _DumpJsonIndent) = _GetJsonDumpers()
+(_encoder, _decoder) = _SelectJsonCodecs([simplejson, json])
 
 
 def DumpJson(data, indent=True):
   """Serialize a given object.
 
   @param data: the data to serialize
-  @param indent: whether to indent output (depends on simplejson version)
+  @param indent: whether to indent output (depends on simplejson version);
+      otherwise the output is compact, without sorted keys
 
   @return: the string representation of data
 
   """
   if indent:
-    fn = _DumpJsonIndent
+    txt = _encoder.DumpIndent(data)
   else:
-    fn = _DumpJson
+    txt = _encoder.DumpCompact(data)
 
-  txt = _RE_EOLSP.sub("", fn(data))
   if not txt.endswith('\n'):
     txt += '\n'
 
@@ -93,7 +184,7 @@ def LoadJson(txt):
   @return: the original data
 
   """
-  return simplejson.loads(txt)
+  return _decoder.Load(txt)
 
 
 def DumpSignedJson(data, key, salt=None, key_selector=None):
@@ -37,6 +37,7 @@ import logging
 from ganeti import errors
 from ganeti import constants
 from ganeti import utils
+from ganeti import lvminventory
 
 
 def _ParseSize(value):
@@ -164,14 +165,15 @@ class FileStorage(_Base): # pylint: disable-msg=W0223
 class _LvmBase(_Base): # pylint: disable-msg=W0223
   """Base class for LVM storage containers.
 
+  @cvar LIST_KIND: kind of entities in the L{lvminventory.LvmSnapshot}
   @cvar LIST_FIELDS: list of tuples consisting of three elements: SF_*
       constants, lvm command output fields (list), and conversion
       function or static value (for static value, the lvm output field
-      can be an empty list)
+      can be an empty list); the lvm fields must be retrieved by
+      L{lvminventory}
 
   """
-  LIST_SEP = "|"
-  LIST_COMMAND = None
+  LIST_KIND = None
   LIST_FIELDS = None
 
   def List(self, name, wanted_field_names):
@@ -183,18 +185,18 @@ class _LvmBase(_Base): # pylint: disable-msg=W0223
     # Get needed LVM fields
     lvm_fields = self._GetLvmFields(self.LIST_FIELDS, wanted_field_names)
 
-    # Build LVM command
-    cmd_args = self._BuildListCommand(self.LIST_COMMAND, self.LIST_SEP,
-                                      lvm_fields, name)
+    # Get LVM data from the node's inventory
+    try:
+      lvm_data = lvminventory.GetSnapshot().Query(self.LIST_KIND, lvm_fields,
+                                                  name=name)
+    except errors.CommandError, err:
+      raise errors.StorageError("Failed to list LVM storage: %s" % err)
 
-    # Run LVM command
-    cmd_result = self._RunListCommand(cmd_args)
+    if name is not None and not lvm_data:
+      raise errors.StorageError("Storage unit %r not found" % name)
 
-    # Split and rearrange LVM command output
-    return self._BuildList(self._SplitList(cmd_result, self.LIST_SEP,
-                                           len(lvm_fields)),
-                           self.LIST_FIELDS,
-                           wanted_field_names,
+    # Rearrange LVM data
+    return self._BuildList(lvm_data, self.LIST_FIELDS, wanted_field_names,
                            lvm_fields)
 
   @staticmethod
@@ -273,64 +275,6 @@ class _LvmBase(_Base): # pylint: disable-msg=W0223
 
     return data
 
-  @staticmethod
-  def _BuildListCommand(cmd, sep, options, name):
-    """Builds LVM command line.
-
-    @type cmd: string
-    @param cmd: Command name
-    @type sep: string
-    @param sep: Field separator character
-    @type options: list of strings
-    @param options: Wanted LVM fields
-    @type name: name or None
-    @param name: Name of requested entity
-
-    """
-    args = [cmd,
-            "--noheadings", "--units=m", "--nosuffix",
-            "--separator", sep,
-            "--options", ",".join(options)]
-
-    if name is not None:
-      args.append(name)
-
-    return args
-
-  @staticmethod
-  def _RunListCommand(args):
-    """Run LVM command.
-
-    """
-    result = utils.RunCmd(args)
-
-    if result.failed:
-      raise errors.StorageError("Failed to run %r, command output: %s" %
-                                (args[0], result.output))
-
-    return result.stdout
-
-  @staticmethod
-  def _SplitList(data, sep, fieldcount):
-    """Splits LVM command output into rows and fields.
-
-    @type data: string
-    @param data: LVM command output
-    @type sep: string
-    @param sep: Field separator character
-    @type fieldcount: int
-    @param fieldcount: Expected number of fields
-
-    """
-    for line in data.splitlines():
-      fields = line.strip().split(sep)
-
-      if len(fields) != fieldcount:
-        logging.warning("Invalid line returned from lvm command: %s", line)
-        continue
-
-      yield fields
-
 
 class LvmPvStorage(_LvmBase): # pylint: disable-msg=W0223
   """LVM Physical Volume storage unit.
@@ -344,7 +288,7 @@ class LvmPvStorage(_LvmBase): # pylint: disable-msg=W0223
       logging.warning("Invalid PV attribute: %r", attr)
       return False
 
-  LIST_COMMAND = "pvs"
+  LIST_KIND = lvminventory.KIND_PV
 
   # Make sure to update constants.VALID_STORAGE_FIELDS when changing field
   # definitions.
@@ -375,6 +319,7 @@ class LvmPvStorage(_LvmBase): # pylint: disable-msg=W0223
     args.append(name)
 
     result = utils.RunCmd(args)
+    lvminventory.Invalidate()
     if result.failed:
       raise errors.StorageError("Failed to modify physical volume,"
                                 " pvchange output: %s" %
@@ -398,7 +343,7 @@ class LvmVgStorage(_LvmBase):
   """LVM Volume Group storage unit.
 
   """
-  LIST_COMMAND = "vgs"
+  LIST_KIND = lvminventory.KIND_VG
 
   # Make sure to update constants.VALID_STORAGE_FIELDS when changing field
   # definitions.
@@ -422,6 +367,7 @@ class LvmVgStorage(_LvmBase):
     # the VG is already consistent. This was fixed in later versions, but we
     # cannot depend on it.
     result = utils.RunCmd(["vgreduce", "--removemissing", name])
+    lvminventory.Invalidate()
 
     # Keep output in case something went wrong
     vgreduce_output = result.output
@@ -44,6 +44,7 @@ import resource
 import logging
 import logging.handlers
 import signal
+import threading
 import OpenSSL
 import datetime
 import calendar
@@ -111,21 +112,32 @@ class RunResult(object):
   @ivar failed: True in case the program was
       terminated by a signal or exited with a non-zero exit code
   @ivar fail_reason: a string detailing the termination reason
+  @type timeout: number or None
+  @ivar timeout: the timeout after which the program was killed, or None
+      (if it finished in time)
+  @type duration: float or None
+  @ivar duration: how long the program ran in seconds
 
   """
   __slots__ = ["exit_code", "signal", "stdout", "stderr",
-               "failed", "fail_reason", "cmd"]
+               "failed", "fail_reason", "cmd", "timeout", "duration"]
 
 
-  def __init__(self, exit_code, signal_, stdout, stderr, cmd):
+  def __init__(self, exit_code, signal_, stdout, stderr, cmd, timeout=None,
+               duration=None):
     self.cmd = cmd
     self.exit_code = exit_code
     self.signal = signal_
     self.stdout = stdout
     self.stderr = stderr
-    self.failed = (signal_ is not None or exit_code != 0)
+    self.timeout = timeout
+    self.duration = duration
+    self.failed = (signal_ is not None or exit_code != 0 or
+                   timeout is not None)
 
-    if self.signal is not None:
+    if self.timeout is not None:
+      self.fail_reason = "killed after timeout of %s seconds" % self.timeout
+    elif self.signal is not None:
       self.fail_reason = "terminated by signal %s" % self.signal
     elif self.exit_code is not None:
       self.fail_reason = "exited with exit code %s" % self.exit_code
@@ -162,7 +174,7 @@ def _BuildCmdEnvironment(env, reset):
 
 
 def RunCmd(cmd, env=None, output=None, cwd="/", reset_env=False,
-           interactive=False):
+           interactive=False, timeout=None):
   """Execute a (shell) command.
 
   The command should not read from its standard input, as it will be
@@ -184,6 +196,10 @@ def RunCmd(cmd, env=None, output=None, cwd="/", reset_env=False,
   @type interactive: boolean
   @param interactive: weather we pipe stdin, stdout and stderr
                       (default behaviour) or run the command interactive
+  @type timeout: number
+  @param timeout: if specified, the command is killed if it's still running
+      after this many seconds (not supported together with C{output} or
+      C{interactive})
   @rtype: L{RunResult}
   @return: RunResult instance
   @raise errors.ProgrammerError: if we call this when forks are disabled
@@ -196,6 +212,10 @@ def RunCmd(cmd, env=None, output=None, cwd="/", reset_env=False,
     raise errors.ProgrammerError("Parameters 'output' and 'interactive' can"
                                  " not be provided at the same time")
 
+  if timeout is not None and (output or interactive):
+    raise errors.ProgrammerError("Parameter 'timeout' can not be used"
+                                 " together with 'output' or 'interactive'")
+
   if isinstance(cmd, basestring):
     strcmd = cmd
     shell = True
@@ -211,9 +231,12 @@ def RunCmd(cmd, env=None, output=None, cwd="/", reset_env=False,
 
   cmd_env = _BuildCmdEnvironment(env, reset_env)
 
+  start = time.time()
+  expired_timeout = None
   try:
     if output is None:
-      out, err, status = _RunCmdPipe(cmd, cmd_env, shell, cwd, interactive)
+      (out, err, status, expired_timeout) = \
+        _RunCmdPipe(cmd, cmd_env, shell, cwd, interactive, timeout)
     else:
       status = _RunCmdFile(cmd, cmd_env, shell, output, cwd)
       out = err = ""
@@ -231,7 +254,8 @@ def RunCmd(cmd, env=None, output=None, cwd="/", reset_env=False,
     exitcode = None
     signal_ = -status
 
-  return RunResult(exitcode, signal_, out, err, strcmd)
+  return RunResult(exitcode, signal_, out, err, strcmd,
+                   timeout=expired_timeout, duration=time.time() - start)
 
 
 def StartDaemon(cmd, env=None, cwd="/", output=None, output_fd=None,
@@ -429,7 +453,7 @@ def _StartDaemonChild(errpipe_read, errpipe_write,
   os._exit(1) # pylint: disable-msg=W0212
 
 
-def _RunCmdPipe(cmd, env, via_shell, cwd, interactive):
+def _RunCmdPipe(cmd, env, via_shell, cwd, interactive, timeout=None):
   """Run a command and return its output.
 
   @type  cmd: string or list
@@ -442,8 +466,11 @@ def _RunCmdPipe(cmd, env, via_shell, cwd, interactive):
   @param cwd: the working directory for the program
   @type interactive: boolean
   @param interactive: Run command interactive (without piping)
+  @type timeout: number or None
+  @param timeout: Time after which the command is killed
   @rtype: tuple
-  @return: (out, err, status)
+  @return: (out, err, status, timeout); the last element is C{timeout} if the
+    command was killed, C{None} otherwise
 
   """
   poller = select.poll()
@@ -464,6 +491,7 @@ def _RunCmdPipe(cmd, env, via_shell, cwd, interactive):
 
   out = StringIO()
   err = StringIO()
+  killed = False
   if not interactive:
     child.stdin.close()
     poller.register(child.stdout, select.POLLIN)
@@ -475,8 +503,26 @@ def _RunCmdPipe(cmd, env, via_shell, cwd, interactive):
     for fd in fdmap:
       SetNonblockFlag(fd, True)
 
+    if timeout is not None:
+      deadline = time.time() + timeout
+
     while fdmap:
-      pollresult = RetryOnSignal(poller.poll)
+      if timeout is None:
+        pollresult = RetryOnSignal(poller.poll)
+      else:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          # Processes started by the command could keep the pipes open, hence
+          # they're not read until EOF
+          logging.info("Killing command %s after timeout of %s seconds",
+                       cmd, timeout)
+          IgnoreProcessNotFound(os.kill, child.pid, signal.SIGKILL)
+          child.stdout.close()
+          child.stderr.close()
+          killed = True
+          break
+
+        pollresult = RetryOnSignal(poller.poll, remaining * 1000)
 
       for fd, event in pollresult:
         if event & select.POLLIN or event & select.POLLPRI:
@@ -496,7 +542,12 @@ def _RunCmdPipe(cmd, env, via_shell, cwd, interactive):
   err = err.getvalue()
 
   status = child.wait()
-  return out, err, status
+
+  # The command could have exited on its own before being killed
+  if killed and status == -signal.SIGKILL:
+    return out, err, status, timeout
+
+  return out, err, status, None
 
 
 def _RunCmdFile(cmd, env, via_shell, output, cwd):
@@ -587,7 +638,8 @@ def RetryOnSignal(fn, *args, **kwargs):
         raise
 
 
-def RunParts(dir_name, env=None, reset_env=False):
+def RunParts(dir_name, env=None, reset_env=False, max_parallel=1,
+             timeout=None):
   """Run Scripts or programs in a directory
 
   @type dir_name: string
@@ -596,10 +648,19 @@ def RunParts(dir_name, env=None, reset_env=False):
   @param env: The environment to use
   @type reset_env: boolean
   @param reset_env: whether to reset or keep the default os environment
+  @type max_parallel: int
+  @param max_parallel: how many scripts may run at the same time; with more
+      than one, scripts are not run in order and must not depend on each
+      other, the results are still sorted by name
+  @type timeout: number
+  @param timeout: if specified, scripts still running after this many
+      seconds are killed
   @rtype: list of tuples
   @return: list of (name, (one of RUNDIR_STATUS), RunResult)
 
   """
+  assert max_parallel >= 1
+
   rr = []
 
   try:
@@ -608,20 +669,51 @@ def RunParts(dir_name, env=None, reset_env=False):
     logging.warning("RunParts: skipping %s (cannot list: %s)", dir_name, err)
     return rr
 
+  def _Run(fname):
+    try:
+      result = RunCmd([fname], env=env, reset_env=reset_env, timeout=timeout)
+    except Exception, err: # pylint: disable-msg=W0703
+      return (constants.RUNPARTS_ERR, str(err))
+    return (constants.RUNPARTS_RUN, result)
+
+  scripts = []
+
   for relname in sorted(dir_contents):
     fname = PathJoin(dir_name, relname)
     if not (os.path.isfile(fname) and os.access(fname, os.X_OK) and
             constants.EXT_PLUGIN_MASK.match(relname) is not None):
-      rr.append((relname, constants.RUNPARTS_SKIP, None))
+      rr.append([relname, constants.RUNPARTS_SKIP, None])
     else:
-      try:
-        result = RunCmd([fname], env=env, reset_env=reset_env)
-      except Exception, err: # pylint: disable-msg=W0703
-        rr.append((relname, constants.RUNPARTS_ERR, str(err)))
-      else:
-        rr.append((relname, constants.RUNPARTS_RUN, result))
+      entry = [relname, None, None]
+      rr.append(entry)
+      scripts.append((entry, fname))
+
+  if max_parallel == 1 or len(scripts) < 2:
+    for (entry, fname) in scripts:
+      entry[1:] = _Run(fname)
+  else:
+    lock = threading.Lock()
+
+    def _Worker():
+      while True:
+        lock.acquire()
+        try:
+          if not scripts:
+            break
+          (entry, fname) = scripts.pop(0)
+        finally:
+          lock.release()
+
+        entry[1:] = _Run(fname)
+
+    threads = [threading.Thread(target=_Worker)
+               for _ in range(min(max_parallel, len(scripts)))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
 
-  return rr
+  return [tuple(entry) for entry in rr]
 
 
 def RemoveFile(filename):
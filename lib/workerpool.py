@@ -26,6 +26,7 @@
 import logging
 import threading
 import heapq
+import time
 
 from ganeti import compat
 from ganeti import errors
@@ -34,6 +35,9 @@ from ganeti import errors
 _TERMINATE = object()
 _DEFAULT_PRIORITY = 0
 
+#: Time after which idle surplus workers of an autoscaling pool terminate
+_DEFAULT_IDLE_TIMEOUT = 60.0
+
 
 class DeferTask(Exception):
   """Special exception class to defer a task.
@@ -90,16 +94,33 @@ class BaseWorker(threading.Thread, object):
   def GetCurrentPriority(self):
     """Returns the priority of the current task.
 
-    Should only be called from within L{RunTask}.
+    If the pool ages priorities, this is the priority the task had when it
+    was started. Should only be called from within L{RunTask}.
 
     """
     self.pool._lock.acquire()
     try:
       assert self._HasRunningTaskUnlocked()
 
-      (priority, _, _) = self._current_task
+      return self._current_task.effective_priority
+    finally:
+      self.pool._lock.release()
+
+  def SetWaitingForLocks(self, waiting):
+    """Tells the pool whether the current task is waiting for locks.
+
+    Workers blocked in lock waits don't count towards the minimum number of
+    workers of an autoscaling pool. Should only be called from within
+    L{RunTask}.
 
-      return priority
+    @type waiting: bool
+    @param waiting: Whether the task is waiting for locks
+
+    """
+    self.pool._lock.acquire()
+    try:
+      assert self._HasRunningTaskUnlocked()
+      self.pool._SetWaitingForLocksUnlocked(self, waiting)
     finally:
       self.pool._lock.release()
 
@@ -138,6 +159,7 @@ class BaseWorker(threading.Thread, object):
       assert self._current_task is None
 
       defer = None
+      run_time = 0.0
       try:
         # Wait on lock to be told either to terminate or to do a task
         pool._lock.acquire()
@@ -162,24 +184,23 @@ class BaseWorker(threading.Thread, object):
         finally:
           pool._lock.release()
 
-        (priority, _, args) = self._current_task
+        priority = self._current_task.effective_priority
+        args = self._current_task.args
         try:
           # Run the actual task
           assert defer is None
           logging.debug("Starting task %r, priority %s", args, priority)
           assert self.getName() == self._worker_id
+          start = time.time()
           try:
             self.RunTask(*args) # pylint: disable-msg=W0142
           finally:
             self.SetTaskName(None)
+            run_time = time.time() - start
           logging.debug("Done with task %r, priority %s", args, priority)
         except DeferTask, err:
           defer = err
 
-          if defer.priority is None:
-            # Use same priority
-            defer.priority = priority
-
           logging.debug("Deferring task %r, new priority %s",
                         args, defer.priority)
 
@@ -192,11 +213,13 @@ class BaseWorker(threading.Thread, object):
         # Notify pool
         pool._lock.acquire()
         try:
+          if self._current_task:
+            pool._TaskDoneUnlocked(self, run_time)
+
           if defer:
             assert self._current_task
             # Schedule again for later run
-            (_, _, args) = self._current_task
-            pool._AddTaskUnlocked(args, defer.priority)
+            pool._RequeueTaskUnlocked(self._current_task, defer.priority)
 
           if self._current_task:
             self._current_task = None
@@ -217,25 +240,187 @@ class BaseWorker(threading.Thread, object):
     raise NotImplementedError()
 
 
+class _Task(object):
+  """Task queued in a L{WorkerPool}.
+
+  """
+  __slots__ = [
+    "args",
+    "priority",
+    "effective_priority",
+    "submitter",
+    "added",
+    "queued",
+    "tag",
+    "counter",
+    ]
+
+  def __init__(self, args, priority, submitter, now):
+    """Initializes this class.
+
+    """
+    object.__init__(self)
+    self.args = args
+    self.priority = priority
+    self.effective_priority = priority
+    self.submitter = submitter
+
+    # Time when the task was first added, deferring a task doesn't reset it
+    self.added = now
+
+    # Time when the task was last added to the queue
+    self.queued = now
+
+    self.tag = None
+    self.counter = None
+
+
+class _TaskQueue(object):
+  """Queue of tasks ordered by priority, age and submitter.
+
+  Tasks are started in order of their priority. If an aging interval is
+  given, a task's priority is increased by one for every interval it has
+  been waiting since it was first added. Within one priority tasks of
+  different submitters are interleaved using start-time fair queuing: each
+  task is tagged with the virtual time at which it's due, which is the
+  later of the current virtual time and the tag of the submitter's
+  previous task, plus one. Tasks of the same submitter are always started
+  in the order in which they were added.
+
+  """
+  def __init__(self, aging_interval):
+    """Initializes this class.
+
+    @type aging_interval: number or None
+    @param aging_interval: Time in seconds after which the priority of a
+        waiting task is increased by one, None to disable aging
+
+    """
+    self._aging_interval = aging_interval
+
+    # Priority -> heap of (tag, counter, task)
+    self._queues = {}
+    self._count = 0
+    self._counter = 0
+
+    # Virtual time, the tag of the last task started
+    self._vtime = 0
+
+    # Submitter -> [number of queued tasks, tag of last queued task]
+    self._submitters = {}
+
+  def __len__(self):
+    """Returns the number of queued tasks.
+
+    """
+    return self._count
+
+  def Push(self, task):
+    """Adds a task to the queue.
+
+    @type task: L{_Task}
+
+    """
+    # This counter is used to ensure elements are processed in their
+    # incoming order if all other criteria are equal
+    self._counter += 1
+
+    sub = self._submitters.get(task.submitter, None)
+    if sub is None:
+      sub = self._submitters[task.submitter] = [0, self._vtime]
+
+    task.tag = sub[1] = max(self._vtime, sub[1]) + 1
+    task.counter = self._counter
+    sub[0] += 1
+
+    heapq.heappush(self._queues.setdefault(task.priority, []),
+                   (task.tag, task.counter, task))
+    self._count += 1
+
+  def _GetEffectivePriority(self, task, now):
+    """Returns the priority of a task including aging.
+
+    """
+    if self._aging_interval is None:
+      return task.priority
+
+    return task.priority - int((now - task.added) / self._aging_interval)
+
+  def Pop(self, now):
+    """Removes and returns the next task to be started.
+
+    @type now: float
+    @param now: Current time
+    @rtype: L{_Task}
+
+    """
+    assert self._count > 0
+
+    best = None
+    for (priority, queue) in self._queues.items():
+      (tag, counter, task) = queue[0]
+      key = (self._GetEffectivePriority(task, now), tag, counter)
+      if best is None or key < best[0]:
+        best = (key, priority)
+
+    ((effective_priority, tag, _), priority) = best
+
+    queue = self._queues[priority]
+    (_, _, task) = heapq.heappop(queue)
+    if not queue:
+      del self._queues[priority]
+    self._count -= 1
+
+    self._vtime = max(self._vtime, tag)
+
+    # Submitters without queued tasks don't keep their tag, otherwise they
+    # could save up for later
+    sub = self._submitters[task.submitter]
+    sub[0] -= 1
+    if sub[0] == 0:
+      del self._submitters[task.submitter]
+
+    task.effective_priority = effective_priority
+
+    return task
+
+
 class WorkerPool(object):
   """Worker pool with a queue.
 
   This class is thread-safe.
 
   Tasks are guaranteed to be started in the order in which they're
-  added to the pool. Due to the nature of threading, they're not
-  guaranteed to finish in the same order.
+  added to the pool, unless they have different priorities or
+  submitters (see L{_TaskQueue}). Due to the nature of threading, they're
+  not guaranteed to finish in the same order.
+
+  If a maximum number of workers is given, the pool scales automatically.
+  It then keeps at least C{num_workers} workers which aren't blocked in
+  lock waits (see L{BaseWorker.SetWaitingForLocks}) and starts new workers
+  whenever queued tasks couldn't be started otherwise. Workers exceeding
+  this size terminate after being idle for C{idle_timeout} seconds.
 
   """
-  def __init__(self, name, num_workers, worker_class):
+  def __init__(self, name, num_workers, worker_class, max_workers=None,
+               idle_timeout=_DEFAULT_IDLE_TIMEOUT, aging_interval=None):
     """Constructor for worker pool.
 
     @param num_workers: number of workers to be started
-        (dynamic resizing is not yet implemented)
     @param worker_class: the class to be instantiated for workers;
         should derive from L{BaseWorker}
+    @type max_workers: number or None
+    @param max_workers: maximum number of workers, None to disable
+        autoscaling
+    @type idle_timeout: number
+    @param idle_timeout: time in seconds after which idle surplus workers
+        terminate
+    @type aging_interval: number or None
+    @param aging_interval: time in seconds after which the priority of a
+        waiting task is increased by one, None to disable aging
 
     """
+    assert max_workers is None or max_workers >= num_workers
     # Some of these variables are accessed by BaseWorker
     self._lock = threading.Lock()
     self._pool_to_pool = threading.Condition(self._lock)
@@ -246,19 +431,32 @@ class WorkerPool(object):
     self._last_worker_id = 0
     self._workers = []
     self._quiescing = False
+    self._min_workers = num_workers
+    self._max_workers = max_workers
+    self._idle_timeout = idle_timeout
 
     # Terminating workers
     self._termworkers = []
 
+    # Workers whose task is waiting for locks
+    self._lockwait = set()
+
     # Queued tasks
-    self._counter = 0
-    self._tasks = []
+    self._tasks = _TaskQueue(aging_interval)
+
+    # Statistics
+    self._running = 0
+    self._started = 0
+    self._wait_time = 0.0
+    self._max_wait_time = 0.0
+    self._run_time = 0.0
+
+    # Priority -> [number of started tasks, total and maximum wait time]
+    self._priority_wait = {}
 
     # Start workers
     self.Resize(num_workers)
 
-  # TODO: Implement dynamic resizing?
-
   def _WaitWhileQuiescingUnlocked(self):
     """Wait until the worker pool has finished quiescing.
 
@@ -266,45 +464,72 @@ class WorkerPool(object):
     while self._quiescing:
       self._pool_to_pool.wait()
 
-  def _AddTaskUnlocked(self, args, priority):
+  def _AddTaskUnlocked(self, args, priority, submitter):
     """Adds a task to the internal queue.
 
     @type args: sequence
     @param args: Arguments passed to L{BaseWorker.RunTask}
     @type priority: number
     @param priority: Task priority
+    @param submitter: Submitter of the task
 
     """
     assert isinstance(args, (tuple, list)), "Arguments must be a sequence"
     assert isinstance(priority, (int, long)), "Priority must be numeric"
 
-    # This counter is used to ensure elements are processed in their
-    # incoming order. For processing they're sorted by priority and then
-    # counter.
-    self._counter += 1
+    self._PushTaskUnlocked(_Task(args, priority, submitter, time.time()))
+
+  def _RequeueTaskUnlocked(self, task, priority):
+    """Adds a deferred task to the internal queue again.
+
+    The time the task was first added is kept, so it doesn't lose the
+    priority gained through aging.
+
+    @type task: L{_Task}
+    @param task: Deferred task
+    @type priority: number or None
+    @param priority: New task priority (None means no change)
+
+    """
+    if priority is not None:
+      assert isinstance(priority, (int, long)), "Priority must be numeric"
+      task.priority = priority
 
-    heapq.heappush(self._tasks, (priority, self._counter, args))
+    task.effective_priority = task.priority
+    task.queued = time.time()
+
+    self._PushTaskUnlocked(task)
+
+  def _PushTaskUnlocked(self, task):
+    """Queues a task and notifies a worker.
+
+    """
+    self._tasks.Push(task)
+
+    self._AutoscaleUnlocked()
 
     # Notify a waiting worker
     self._pool_to_worker.notify()
 
-  def AddTask(self, args, priority=_DEFAULT_PRIORITY):
+  def AddTask(self, args, priority=_DEFAULT_PRIORITY, submitter=None):
     """Adds a task to the queue.
 
     @type args: sequence
     @param args: arguments passed to L{BaseWorker.RunTask}
     @type priority: number
     @param priority: Task priority
+    @param submitter: Hashable identifier of the task's submitter, used to
+                      interleave tasks of different submitters
 
     """
     self._lock.acquire()
     try:
       self._WaitWhileQuiescingUnlocked()
-      self._AddTaskUnlocked(args, priority)
+      self._AddTaskUnlocked(args, priority, submitter)
     finally:
       self._lock.release()
 
-  def AddManyTasks(self, tasks, priority=_DEFAULT_PRIORITY):
+  def AddManyTasks(self, tasks, priority=_DEFAULT_PRIORITY, submitter=None):
     """Add a list of tasks to the queue.
 
     @type tasks: list of tuples
@@ -312,6 +537,8 @@ class WorkerPool(object):
     @type priority: number or list of numbers
     @param priority: Priority for all added tasks or a list with the priority
                      for each task
+    @param submitter: Hashable identifier of the tasks' submitter, used to
+                      interleave tasks of different submitters
 
     """
     assert compat.all(isinstance(task, (tuple, list)) for task in tasks), \
@@ -336,7 +563,7 @@ class WorkerPool(object):
       assert len(tasks) == len(priority)
 
       for args, priority in zip(tasks, priority):
-        self._AddTaskUnlocked(args, priority)
+        self._AddTaskUnlocked(args, priority, submitter)
     finally:
       self._lock.release()
 
@@ -354,8 +581,23 @@ class WorkerPool(object):
     if not self._tasks:
       logging.debug("Waiting for tasks")
 
-      # wait() releases the lock and sleeps until notified
-      self._pool_to_worker.wait()
+      if self._IsSurplusWorkerUnlocked():
+        start = time.time()
+
+        # Wait for a limited time only, the worker isn't needed anymore
+        self._pool_to_worker.wait(self._idle_timeout)
+
+        if (not (self._tasks or self._ShouldWorkerTerminateUnlocked(worker)) and
+            (time.time() - start) >= self._idle_timeout and
+            self._IsSurplusWorkerUnlocked()):
+          logging.debug("Terminating idle surplus worker")
+          # The worker exits right away, so it isn't added to the list of
+          # terminating workers (nobody would ever remove it from there)
+          self._workers.remove(worker)
+          return _TERMINATE
+      else:
+        # wait() releases the lock and sleeps until notified
+        self._pool_to_worker.wait()
 
       logging.debug("Notified while waiting")
 
@@ -369,10 +611,78 @@ class WorkerPool(object):
 
     # Get task from queue and tell pool about it
     try:
-      return heapq.heappop(self._tasks)
+      now = time.time()
+      task = self._tasks.Pop(now)
+
+      wait_time = now - task.queued
+      self._running += 1
+      self._started += 1
+      self._wait_time += wait_time
+      self._max_wait_time = max(self._max_wait_time, wait_time)
+
+      prio_wait = self._priority_wait.setdefault(task.priority, [0, 0.0, 0.0])
+      prio_wait[0] += 1
+      prio_wait[1] += wait_time
+      prio_wait[2] = max(prio_wait[2], wait_time)
+
+      return task
     finally:
       self._worker_to_pool.notifyAll()
 
+  def _TaskDoneUnlocked(self, worker, run_time):
+    """Records the end of a task.
+
+    @type worker: L{BaseWorker}
+    @param worker: Worker thread
+    @type run_time: float
+    @param run_time: Time spent running the task
+
+    """
+    assert self._running > 0
+    self._running -= 1
+    self._run_time += run_time
+    self._lockwait.discard(worker)
+
+  def _SetWaitingForLocksUnlocked(self, worker, waiting):
+    """Records whether a worker's task is waiting for locks.
+
+    """
+    if waiting:
+      self._lockwait.add(worker)
+      self._AutoscaleUnlocked()
+    else:
+      self._lockwait.discard(worker)
+
+  def _GetTargetSizeUnlocked(self):
+    """Returns the number of workers an autoscaling pool should have.
+
+    """
+    assert self._max_workers is not None
+
+    size = max(self._min_workers + len(self._lockwait),
+               self._running + len(self._tasks))
+
+    return min(self._max_workers, size)
+
+  def _IsSurplusWorkerUnlocked(self):
+    """Returns whether the pool has more workers than necessary.
+
+    """
+    return (self._max_workers is not None and
+            len(self._workers) > self._GetTargetSizeUnlocked())
+
+  def _AutoscaleUnlocked(self):
+    """Starts new workers if an autoscaling pool needs more of them.
+
+    """
+    if self._max_workers is None:
+      return
+
+    missing = self._GetTargetSizeUnlocked() - len(self._workers)
+    if missing > 0:
+      logging.debug("Starting %s additional workers", missing)
+      self._StartWorkersUnlocked(missing)
+
   def _ShouldWorkerTerminateUnlocked(self, worker):
     """Returns whether a worker should terminate.
 
@@ -431,16 +741,12 @@ class WorkerPool(object):
       pass
 
     elif current_count > num_workers:
-      if num_workers == 0:
-        # Create copy of list to iterate over while lock isn't held.
-        termworkers = self._workers[:]
-        del self._workers[:]
-      else:
-        # TODO: Implement partial downsizing
-        raise NotImplementedError()
-        #termworkers = ...
+      # Workers still running a task terminate once it's done
+      self._termworkers += self._workers[num_workers:]
+      del self._workers[num_workers:]
 
-      self._termworkers += termworkers
+      # Create copy of list to iterate over while lock isn't held.
+      termworkers = self._termworkers[:]
 
       # Notify workers that something has changed
       self._pool_to_worker.notifyAll()
@@ -463,24 +769,71 @@ class WorkerPool(object):
         if not worker.isAlive():
           self._termworkers.remove(worker)
 
-      assert not self._termworkers, "Zombie worker detected"
+      assert not compat.any(worker in self._termworkers
+                            for worker in termworkers), \
+             "Zombie worker detected"
 
     elif current_count < num_workers:
       # Create (num_workers - current_count) new workers
-      for _ in range(num_workers - current_count):
-        worker = self._worker_class(self, self._NewWorkerIdUnlocked())
-        self._workers.append(worker)
-        worker.start()
+      self._StartWorkersUnlocked(num_workers - current_count)
+
+  def _StartWorkersUnlocked(self, count):
+    """Starts a number of new workers.
+
+    """
+    for _ in range(count):
+      worker = self._worker_class(self, self._NewWorkerIdUnlocked())
+      self._workers.append(worker)
+      worker.start()
 
   def Resize(self, num_workers):
     """Changes the number of workers in the pool.
 
+    For autoscaling pools this changes the minimum number of workers.
+
     @param num_workers: the new number of workers
 
     """
     self._lock.acquire()
     try:
-      return self._ResizeUnlocked(num_workers)
+      self._min_workers = num_workers
+      if self._max_workers is not None:
+        self._max_workers = max(self._max_workers, num_workers)
+
+      self._ResizeUnlocked(num_workers)
+      self._AutoscaleUnlocked()
+    finally:
+      self._lock.release()
+
+  def GetStats(self):
+    """Returns the size of the pool and statistics about its tasks.
+
+    @rtype: dict
+    @return: Dictionary with the current number of workers, the number of
+        running tasks (of which "lock_waiting" are waiting for locks), the
+        number of queued tasks and, for all started tasks, their count and
+        the total and maximum time they spent queued and running; the
+        queue wait times are also listed per priority (under the
+        "priority_wait" key, as a list of [priority, started tasks, total
+        wait time, maximum wait time] sorted by priority)
+
+    """
+    self._lock.acquire()
+    try:
+      return {
+        "workers": len(self._workers),
+        "min_workers": self._min_workers,
+        "max_workers": self._max_workers,
+        "running": self._running,
+        "lock_waiting": len(self._lockwait),
+        "queued": len(self._tasks),
+        "started": self._started,
+        "wait_time": self._wait_time,
+        "max_wait_time": self._max_wait_time,
+        "run_time": self._run_time,
+        "priority_wait": [[priority] + values for (priority, values) in
+                          sorted(self._priority_wait.items())],
+        }
     finally:
       self._lock.release()
 
@@ -494,6 +847,9 @@ class WorkerPool(object):
 
     self._lock.acquire()
     try:
+      # Don't start new workers anymore
+      self._max_workers = None
+
       self._ResizeUnlocked(0)
 
       if self._tasks:
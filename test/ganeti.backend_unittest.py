@@ -94,5 +94,36 @@ class TestNodeVerify(testutils.GanetiTestCase):
                 "Result from netutils.TcpPing corrupted")
 
 
+class TestRunMulti(unittest.TestCase):
+  def _Fn(self, value):
+    self.calls.append(value)
+    if value == "fail":
+      raise backend.RPCFail("failed")
+    if value == "error":
+      raise ValueError("error")
+    return value.upper()
+
+  def setUp(self):
+    self.calls = []
+
+  def test(self):
+    result = backend._RunMulti(self._Fn, [("a", ), ("fail", ), ("error", ),
+                                          ("b", )])
+    self.assertEqual(result[:2], [(True, "A"), (False, "failed")])
+    self.assertFalse(result[2][0])
+    self.assertTrue("error" in result[2][1])
+    self.assertEqual(result[3], (True, "B"))
+    self.assertEqual(self.calls, ["a", "fail", "error", "b"])
+
+  def testStopOnError(self):
+    result = backend._RunMulti(self._Fn, [("a", ), ("fail", ), ("b", )],
+                               stop_on_error=True)
+    self.assertEqual(result, [(True, "A"), (False, "failed")])
+    self.assertEqual(self.calls, ["a", "fail"])
+
+  def testEmpty(self):
+    self.assertEqual(backend._RunMulti(self._Fn, []), [])
+
+
 if __name__ == "__main__":
   testutils.GanetiTestProgram()
@@ -30,10 +30,14 @@ import shutil
 
 from ganeti import mcpu
 from ganeti import cmdlib
+from ganeti import config
+from ganeti import constants
+from ganeti import objects
 from ganeti import opcodes
 from ganeti import errors
 from ganeti import utils
 from ganeti import luxi
+from ganeti import rpc
 
 import testutils
 import mocks
@@ -148,6 +152,258 @@ class TestIAllocatorChecks(testutils.GanetiTestCase):
     self.assertRaises(errors.OpPrereqError, c_i)
 
 
+class TestQuerySnapshot(unittest.TestCase):
+  def setUp(self):
+    cluster = objects.Cluster(master_node="node1.example.com",
+                              enabled_hypervisors=[constants.HT_FAKE])
+    cluster.UpgradeConfig()
+
+    nodes = {}
+    for (name, mc) in [("node1.example.com", True),
+                       ("node2.example.com", False),
+                       ("node10.example.com", False)]:
+      nodes[name] = objects.Node(name=name, primary_ip="192.0.2.1",
+                                 secondary_ip="192.0.2.2",
+                                 master_candidate=mc, offline=False,
+                                 drained=False)
+
+    instances = {}
+    for (name, pnode, snode) in [
+      ("inst2.example.com", "node1.example.com", None),
+      ("inst1.example.com", "node2.example.com", "node1.example.com"),
+      ("inst10.example.com", "node1.example.com", None),
+      ]:
+      if snode is None:
+        template = constants.DT_PLAIN
+        disks = [objects.Disk(dev_type=constants.LD_LV, size=1024,
+                              logical_id=("xenvg", name))]
+      else:
+        template = constants.DT_DRBD8
+        disks = [objects.Disk(dev_type=constants.LD_DRBD8, size=2048,
+                              logical_id=(pnode, snode, 11000, 0, 0, "x"),
+                              children=[])]
+      instances[name] = objects.Instance(name=name, primary_node=pnode,
+                                         os="debian", admin_up=False,
+                                         hypervisor=constants.HT_FAKE,
+                                         disk_template=template,
+                                         disks=disks,
+                                         nics=[objects.NIC(mac="aa:00:00:00:00:01",
+                                                           nicparams={})],
+                                         hvparams={}, beparams={})
+      instances[name].UpgradeConfig()
+
+    self.snapshot = config.ConfigSnapshot(1, cluster, {
+      "nodes": nodes,
+      "instances": instances,
+      "nodegroups": {},
+      })
+
+  def testInstances(self):
+    op = opcodes.OpQueryInstances(output_fields=["name", "pnode", "snodes",
+                                                 "disk.sizes", "be/memory",
+                                                 "mac"],
+                                  names=[], use_locking=False)
+    self.assertTrue(cmdlib.LUQueryInstances.IsStaticQuery(op.output_fields))
+    result = cmdlib.LUQueryInstances.QuerySnapshot(self.snapshot, op)
+    memory = constants.BEC_DEFAULTS[constants.BE_MEMORY]
+    self.assertEqual(result, [
+      ["inst1.example.com", "node2.example.com", ["node1.example.com"],
+       [2048], memory, "aa:00:00:00:00:01"],
+      ["inst2.example.com", "node1.example.com", [], [1024], memory,
+       "aa:00:00:00:00:01"],
+      ["inst10.example.com", "node1.example.com", [], [1024], memory,
+       "aa:00:00:00:00:01"],
+      ])
+
+    # Order of given names is kept
+    op = opcodes.OpQueryInstances(output_fields=["name"],
+                                  names=["inst10", "inst1.example.com"])
+    self.assertEqual(cmdlib.LUQueryInstances.QuerySnapshot(self.snapshot, op),
+                     [["inst10.example.com"], ["inst1.example.com"]])
+
+    op = opcodes.OpQueryInstances(output_fields=["name"],
+                                  names=["inst3.example.com"])
+    self.assertRaises(errors.OpPrereqError,
+                      cmdlib.LUQueryInstances.QuerySnapshot, self.snapshot, op)
+
+  def testInstancesInvalid(self):
+    self.assertFalse(cmdlib.LUQueryInstances.IsStaticQuery(["name",
+                                                            "oper_ram"]))
+    self.assertFalse(cmdlib.LUQueryInstances.IsStaticQuery(["foobar"]))
+
+    for fields in [["name", "status"], ["no-such-field"]]:
+      op = opcodes.OpQueryInstances(output_fields=fields, names=[])
+      self.assertRaises((errors.OpPrereqError, errors.ProgrammerError),
+                        cmdlib.LUQueryInstances.QuerySnapshot,
+                        self.snapshot, op)
+
+    op = opcodes.OpQueryInstances(output_fields="name", names=[])
+    self.assertRaises(errors.OpPrereqError,
+                      cmdlib.LUQueryInstances.QuerySnapshot, self.snapshot, op)
+
+  def testNodes(self):
+    op = opcodes.OpQueryNodes(output_fields=["name", "pinst_list", "sinst_cnt",
+                                             "role", "master"],
+                              names=[], use_locking=False)
+    self.assertTrue(cmdlib.LUQueryNodes.IsStaticQuery(op.output_fields))
+    self.assertFalse(cmdlib.LUQueryNodes.IsStaticQuery(["name", "mfree"]))
+    result = cmdlib.LUQueryNodes.QuerySnapshot(self.snapshot, op)
+    result[0][1].sort()
+    self.assertEqual(result, [
+      ["node1.example.com", ["inst10.example.com", "inst2.example.com"], 1,
+       "M", True],
+      ["node2.example.com", ["inst1.example.com"], 0, "R", False],
+      ["node10.example.com", [], 0, "R", False],
+      ])
+
+    op = opcodes.OpQueryNodes(output_fields=["name"],
+                              names=["node2", "node1.example.com"])
+    self.assertEqual(cmdlib.LUQueryNodes.QuerySnapshot(self.snapshot, op),
+                     [["node1.example.com"], ["node2.example.com"]])
+
+    op = opcodes.OpQueryNodes(output_fields=["name"], names=["node3"])
+    self.assertRaises(errors.OpPrereqError,
+                      cmdlib.LUQueryNodes.QuerySnapshot, self.snapshot, op)
+
+
+class _FakeDiskLU:
+  """Fake logical unit recording block device RPC calls.
+
+  """
+  def __init__(self, fail=None):
+    self.calls = []
+    self.warnings = []
+    self.fail = fail
+    self.cfg = self
+    self.rpc = self
+    self.proc = self
+
+  def SetDiskID(self, disk, node):
+    disk.physical_id = (node, disk.logical_id)
+
+  def LogWarning(self, msg, *args, **kwargs):
+    self.warnings.append(msg % args)
+
+  def _Call(self, name, node, disks):
+    self.calls.append((name, node, [disk.physical_id for disk in disks]))
+    payload = []
+    for disk in disks:
+      if (node, disk.logical_id) == self.fail:
+        payload.append((False, "failed"))
+      else:
+        payload.append((True, "/dev/%s" % disk.iv_name))
+    return rpc.RpcResult(data=(True, payload), node=node)
+
+  def call_blockdev_assemble_multi(self, node, disks, owner, on_primary):
+    return self._Call(("assemble", on_primary), node, disks)
+
+  def call_blockdev_shutdown_multi(self, node, disks):
+    return self._Call("shutdown", node, disks)
+
+  def call_blockdev_create_multi(self, node, devices, owner, on_primary, info):
+    return self._Call(("create", on_primary), node,
+                      [disk for (disk, _) in devices])
+
+
+class TestDiskBatching(unittest.TestCase):
+  def setUp(self):
+    disks = []
+    for idx in range(3):
+      data = objects.Disk(dev_type=constants.LD_LV, size=1024,
+                          logical_id=("xenvg", "data%d" % idx))
+      meta = objects.Disk(dev_type=constants.LD_LV, size=128,
+                          logical_id=("xenvg", "meta%d" % idx))
+      disks.append(objects.Disk(dev_type=constants.LD_DRBD8, size=1024,
+                                logical_id=("node1", "node2", 11000 + idx,
+                                            idx, idx, "secret"),
+                                children=[data, meta],
+                                iv_name="disk/%d" % idx))
+    self.instance = objects.Instance(name="inst1", primary_node="node1",
+                                     disk_template=constants.DT_DRBD8,
+                                     disks=disks)
+
+  def testSplitMultiResult(self):
+    result = rpc.RpcResult(data=(True, [(True, 1), (False, "err")]))
+    self.assertEqual(cmdlib._SplitMultiResult(result, 2),
+                     [(None, 1), ("err", None)])
+    result = rpc.RpcResult(offline=True)
+    self.assertEqual(cmdlib._SplitMultiResult(result, 2),
+                     [("Node is marked offline", None)] * 2)
+
+  def testGetBlockDevsToCreate(self):
+    disk = self.instance.disks[0]
+    self.assertEqual(cmdlib._GetBlockDevsToCreate(disk, False),
+                     [disk.children[0], disk.children[1], disk])
+    fdisk = objects.Disk(dev_type=constants.LD_FILE, size=1024,
+                         logical_id=(constants.FD_LOOP, "/tmp/disk0"))
+    self.assertEqual(cmdlib._GetBlockDevsToCreate(fdisk, False), [])
+    self.assertEqual(cmdlib._GetBlockDevsToCreate(fdisk, True), [fdisk])
+
+  def testAssemble(self):
+    lu = _FakeDiskLU()
+    (disks_ok, device_info) = \
+      cmdlib._AssembleInstanceDisks(lu, self.instance)
+    self.assertTrue(disks_ok)
+    self.assertEqual(device_info, [
+      ("node1", "disk/0", "/dev/disk/0"),
+      ("node1", "disk/1", "/dev/disk/1"),
+      ("node1", "disk/2", "/dev/disk/2"),
+      ])
+
+    # One call per node and pass
+    self.assertEqual([(name, node) for (name, node, _) in lu.calls], [
+      (("assemble", False), "node1"),
+      (("assemble", False), "node2"),
+      (("assemble", True), "node1"),
+      ])
+    self.assertEqual(lu.calls[1][2],
+                     [("node2", disk.logical_id)
+                      for disk in self.instance.disks])
+
+  def testAssembleFailure(self):
+    lu = _FakeDiskLU(fail=("node2", self.instance.disks[1].logical_id))
+    (disks_ok, _) = cmdlib._AssembleInstanceDisks(lu, self.instance)
+    self.assertFalse(disks_ok)
+    self.assertEqual(len(lu.warnings), 1)
+    self.assertTrue("disk/1 on node node2" in lu.warnings[0])
+
+    lu = _FakeDiskLU(fail=("node2", self.instance.disks[1].logical_id))
+    (disks_ok, _) = cmdlib._AssembleInstanceDisks(lu, self.instance,
+                                                  ignore_secondaries=True)
+    self.assertTrue(disks_ok)
+
+  def testShutdown(self):
+    lu = _FakeDiskLU(fail=("node1", self.instance.disks[2].logical_id))
+    self.assertFalse(cmdlib._ShutdownInstanceDisks(lu, self.instance))
+    self.assertEqual([(name, node) for (name, node, _) in lu.calls],
+                     [("shutdown", "node1"), ("shutdown", "node2")])
+    self.assertTrue(cmdlib._ShutdownInstanceDisks(lu, self.instance,
+                                                  ignore_primary=True))
+
+  def testCreate(self):
+    lu = _FakeDiskLU()
+    cmdlib._CreateDisks(lu, self.instance, to_skip=[1])
+    self.assertEqual([(name, node) for (name, node, _) in lu.calls], [
+      (("create", True), "node1"),
+      (("create", False), "node2"),
+      ])
+    # Children are created before their parents
+    self.assertEqual(lu.calls[1][2], [
+      ("node2", ("xenvg", "data0")),
+      ("node2", ("xenvg", "meta0")),
+      ("node2", self.instance.disks[0].logical_id),
+      ("node2", ("xenvg", "data2")),
+      ("node2", ("xenvg", "meta2")),
+      ("node2", self.instance.disks[2].logical_id),
+      ])
+
+  def testCreateFailure(self):
+    lu = _FakeDiskLU(fail=("node1", ("xenvg", "meta1")))
+    self.assertRaises(errors.OpExecError, cmdlib._CreateDisks,
+                      lu, self.instance)
+    self.assertEqual(len(lu.calls), 1)
+
+
 class TestLUTestJobqueue(unittest.TestCase):
   def test(self):
     self.assert_(cmdlib.LUTestJobqueue._CLIENT_CONNECT_TIMEOUT <
@@ -28,6 +28,8 @@ import time
 import tempfile
 import os.path
 import socket
+import threading
+import logging
 
 from ganeti import bootstrap
 from ganeti import config
@@ -36,6 +38,11 @@ from ganeti import errors
 from ganeti import objects
 from ganeti import utils
 from ganeti import netutils
+from ganeti import serializer
+from ganeti import compat
+from ganeti import backend
+from ganeti import cmdlib
+from ganeti import opcodes
 
 import testutils
 import mocks
@@ -45,12 +52,45 @@ def _StubGetEntResolver():
   return mocks.FakeGetentResolver()
 
 
+def _InitCluster(cfg_file):
+  """Initializes a cluster configuration in the given file"""
+  me = netutils.Hostname()
+  ip = constants.IP4_ADDRESS_LOCALHOST
+
+  cluster_config = objects.Cluster(
+    serial_no=1,
+    rsahostkeypub="",
+    highest_used_port=(constants.FIRST_DRBD_PORT - 1),
+    mac_prefix="aa:00:00",
+    volume_group_name="xenvg",
+    drbd_usermode_helper="/bin/true",
+    nicparams={constants.PP_DEFAULT: constants.NICC_DEFAULTS},
+    tcpudp_port_pool=set(),
+    enabled_hypervisors=[constants.HT_FAKE],
+    master_node=me.name,
+    master_ip="127.0.0.1",
+    master_netdev=constants.DEFAULT_BRIDGE,
+    cluster_name="cluster.local",
+    file_storage_dir="/tmp",
+    uid_pool=[],
+    )
+
+  master_node_config = objects.Node(name=me.name,
+                                    primary_ip=me.ip,
+                                    secondary_ip=ip,
+                                    serial_no=1,
+                                    master_candidate=True)
+
+  bootstrap.InitConfig(constants.CONFIG_VERSION,
+                       cluster_config, master_node_config, cfg_file)
+
+
 class TestConfigRunner(unittest.TestCase):
   """Testing case for HooksRunner"""
   def setUp(self):
     fd, self.cfg_file = tempfile.mkstemp()
     os.close(fd)
-    self._init_cluster(self.cfg_file)
+    _InitCluster(self.cfg_file)
 
   def tearDown(self):
     try:
@@ -64,38 +104,6 @@ class TestConfigRunner(unittest.TestCase):
                               _getents=_StubGetEntResolver)
     return cfg
 
-  def _init_cluster(self, cfg):
-    """Initializes the cfg object"""
-    me = netutils.Hostname()
-    ip = constants.IP4_ADDRESS_LOCALHOST
-
-    cluster_config = objects.Cluster(
-      serial_no=1,
-      rsahostkeypub="",
-      highest_used_port=(constants.FIRST_DRBD_PORT - 1),
-      mac_prefix="aa:00:00",
-      volume_group_name="xenvg",
-      drbd_usermode_helper="/bin/true",
-      nicparams={constants.PP_DEFAULT: constants.NICC_DEFAULTS},
-      tcpudp_port_pool=set(),
-      enabled_hypervisors=[constants.HT_FAKE],
-      master_node=me.name,
-      master_ip="127.0.0.1",
-      master_netdev=constants.DEFAULT_BRIDGE,
-      cluster_name="cluster.local",
-      file_storage_dir="/tmp",
-      uid_pool=[],
-      )
-
-    master_node_config = objects.Node(name=me.name,
-                                      primary_ip=me.ip,
-                                      secondary_ip=ip,
-                                      serial_no=1,
-                                      master_candidate=True)
-
-    bootstrap.InitConfig(constants.CONFIG_VERSION,
-                         cluster_config, master_node_config, self.cfg_file)
-
   def _create_instance(self):
     """Create and return an instance object"""
     inst = objects.Instance(name="test.example.com", disks=[], nics=[],
@@ -167,6 +175,268 @@ class TestConfigRunner(unittest.TestCase):
     self.failUnlessRaises(errors.ConfigurationError, cfg.Update, fake_instance,
                           None)
 
+  def testConfigDelta(self):
+    """Test configuration deltas"""
+    inst = self._create_instance()
+    cfg = self._get_object()
+    deltas = []
+    cfg._DistributeConfig = \
+      lambda feedback_fn, delta=None: deltas.append(delta)
+
+    # the first write after reading the configuration is a full one
+    cfg.AddInstance(inst, "my-job")
+    self.assertEqual(deltas, [None])
+
+    data = serializer.Load(utils.ReadFile(self.cfg_file))
+
+    cfg.MarkInstanceUp(inst.name)
+    cfg.RenameInstance(inst.name, "test2.example.com")
+    cfg.AllocatePort()
+    self.assertEqual(len(deltas), 4)
+
+    for delta in deltas[1:]:
+      self.assertEqual(delta["base_serial"], data["serial_no"])
+      backend._ApplyConfigDelta(data, delta)
+      txt = serializer.Dump(data)
+      self.assertEqual(compat.sha1_hash(txt).hexdigest(), delta["hash"])
+      data = serializer.Load(txt)
+
+    self.assertEqual(deltas[1]["update"]["instances"].keys(),
+                     ["test.example.com"])
+    self.assertFalse("cluster" in deltas[1]["set"])
+    self.assertEqual(deltas[2]["remove"]["instances"], ["test.example.com"])
+    self.assertEqual(deltas[2]["update"]["instances"].keys(),
+                     ["test2.example.com"])
+    self.assertTrue("cluster" in deltas[3]["set"])
+    self.assertEqual(data, serializer.Load(utils.ReadFile(self.cfg_file)))
+
+    # a delta for another serial number must not be applied
+    self.assertRaises(backend.RPCFail, backend._ApplyConfigDelta,
+                      data, deltas[1])
+
+    # after re-reading the configuration, the whole file must be sent
+    cfg._OpenConfig()
+    cfg.MarkInstanceDown("test2.example.com")
+    self.assertEqual(deltas[-1], None)
+
+  def testGroupCommit(self):
+    """Test group commit of configuration writes"""
+    cfg = config.ConfigWriter(cfg_file=self.cfg_file, offline=True,
+                              _getents=_StubGetEntResolver,
+                              group_commit_delay=0.2)
+    write_count = cfg.write_count
+    errs = []
+
+    def _AddPort(port):
+      try:
+        cfg.AddTcpUdpPort(port)
+        # the modification must be on disk once the call returns
+        data = serializer.Load(utils.ReadFile(self.cfg_file))
+        self.assertTrue(port in data["cluster"]["tcpudp_port_pool"])
+      except Exception, err: # pylint: disable-msg=W0703
+        errs.append(err)
+
+    ports = range(20000, 20010)
+    threads = [threading.Thread(target=_AddPort, args=(port, ))
+               for port in ports]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(errs, [])
+    self.assertTrue(cfg.write_count - write_count < len(ports))
+    self.assertEqual(cfg.GetPortList(), set(ports))
+
+  def testSnapshot(self):
+    """Test configuration snapshots"""
+    cfg = self._get_object()
+    master = cfg.GetMasterNode()
+    snap1 = cfg.GetSnapshot()
+    self.assertEqual(snap1.GetInstanceList(), [])
+    self.assertEqual(snap1.GetNodeList(), [master])
+    self.assertEqual(snap1.GetMasterNode(), master)
+
+    inst = self._create_instance()
+    cfg.AddInstance(inst, "my-job")
+    inst2 = self._create_instance()
+    inst2.name = "test2.example.com"
+    cfg.AddInstance(inst2, "my-job")
+    snap2 = cfg.GetSnapshot()
+    self.assertEqual(snap1.GetInstanceList(), [])
+    self.assertEqual(sorted(snap2.GetInstanceList()),
+                     [inst.name, inst2.name])
+    self.assertEqual(snap2.serial_no, cfg._config_data.serial_no)
+    self.assertEqual(snap2.ExpandInstanceName("test2"), inst2.name)
+    self.assertEqual(snap2.ExpandNodeName(master.split(".")[0]), master)
+
+    # Snapshots contain copies
+    sinst = snap2.GetAllInstancesInfo()[inst.name]
+    self.assertFalse(sinst is cfg.GetInstanceInfo(inst.name))
+    self.assertFalse(sinst.admin_up)
+
+    cfg.MarkInstanceUp(inst.name)
+    snap3 = cfg.GetSnapshot()
+    self.assertTrue(snap3.GetAllInstancesInfo()[inst.name].admin_up)
+    self.assertFalse(sinst.admin_up)
+
+    # Unmodified objects are shared
+    self.assertTrue(snap3.GetAllInstancesInfo()[inst2.name] is
+                    snap2.GetAllInstancesInfo()[inst2.name])
+    self.assertTrue(snap3.GetClusterInfo() is snap2.GetClusterInfo())
+    self.assertTrue(snap3.GetAllNodesInfo()[master] is
+                    snap2.GetAllNodesInfo()[master])
+
+    cfg.AllocatePort()
+    snap4 = cfg.GetSnapshot()
+    self.assertFalse(snap4.GetClusterInfo() is snap3.GetClusterInfo())
+    self.assertEqual(snap4.GetClusterInfo().highest_used_port,
+                     cfg.GetClusterInfo().highest_used_port)
+
+    cfg.RemoveInstance(inst2.name)
+    self.assertEqual(cfg.GetSnapshot().GetInstanceList(), [inst.name])
+    self.assertEqual(len(snap3.GetInstanceList()), 2)
+
+    # After re-reading the configuration, all objects are copied
+    cfg._OpenConfig()
+    snap5 = cfg.GetSnapshot()
+    self.assertEqual(snap5.serial_no, cfg._config_data.serial_no)
+    self.assertFalse(snap5.GetClusterInfo() is snap4.GetClusterInfo())
+    # The first write after reading the configuration copies all objects
+    cfg.MarkInstanceDown(inst.name)
+    self.assertFalse(cfg.GetSnapshot().GetClusterInfo() is
+                     snap5.GetClusterInfo())
+
+  def testSnapshotWithoutLock(self):
+    """Test using snapshots while the configuration lock is held"""
+    cfg = self._get_object()
+    cfg.AddInstance(self._create_instance(), "my-job")
+    result = []
+
+    def _Query():
+      result.append(cfg.GetSnapshot().GetInstanceList())
+
+    config._config_lock.acquire()
+    try:
+      thread = threading.Thread(target=_Query)
+      thread.start()
+      thread.join(10)
+      self.assertFalse(thread.isAlive())
+    finally:
+      config._config_lock.release()
+
+    self.assertEqual(result, [["test.example.com"]])
+
+  def testIncrementalVerify(self):
+    """Test verification of modified objects on write"""
+    cfg = self._get_object()
+    inst = self._create_instance()
+    cfg.AddInstance(inst, "my-job")
+    base_errors = cfg.VerifyConfig()
+
+    errs = []
+    inst = cfg.GetInstanceInfo(inst.name)
+    inst.primary_node = "no-such-node.example.com"
+    cfg.Update(inst, errs.append)
+    self.assertTrue(errs)
+    self.assertTrue(compat.any("invalid primary node" in msg
+                               for msg in errs))
+
+    # duplicate MACs are found through the resource index
+    inst.primary_node = cfg.GetMasterNode()
+    inst.nics = [objects.NIC(mac="aa:00:00:00:00:01"),
+                 objects.NIC(mac="aa:00:00:00:00:01")]
+    del errs[:]
+    cfg.Update(inst, errs.append)
+    self.assertEqual(len(errs), 1)
+    self.assertTrue("duplicate mac aa:00:00:00:00:01" in errs[0])
+    self.assertEqual(len(cfg.VerifyConfig()), len(base_errors) + 1)
+
+    del errs[:]
+    cfg._last_full_verify = 0
+    cfg.Update(inst, errs.append)
+    self.assertEqual(len(errs), 1)
+    self.assertTrue("mac aa:00:00:00:00:01 duplicate" in errs[0])
+
+  def _CreateDrbdInstance(self, cfg, name, minors, mac):
+    """Creates an instance with a DRBD disk on the master node"""
+    master = cfg.GetMasterNode()
+    lvs = [objects.Disk(dev_type=constants.LD_LV, size=128,
+                        logical_id=("xenvg", "%s.disk0_%s" % (name, suffix)))
+           for suffix in ["data", "meta"]]
+    drbd = objects.Disk(dev_type=constants.LD_DRBD8, size=128,
+                        logical_id=(master, master, 11000 + minors[0],
+                                    minors[0], minors[1], "secret-" + name),
+                        children=lvs, iv_name="disk/0")
+    return objects.Instance(name=name, disks=[drbd],
+                            nics=[objects.NIC(mac=mac)],
+                            disk_template=constants.DT_DRBD8,
+                            primary_node=master)
+
+  def testResourceIndex(self):
+    """Test the instance resource index"""
+    cfg = self._get_object()
+    master = cfg.GetMasterNode()
+
+    inst = self._CreateDrbdInstance(cfg, "inst1.example.com", (0, 1),
+                                    "aa:00:00:00:00:01")
+    cfg.AddInstance(inst, "my-job")
+    self.assertTrue("aa:00:00:00:00:01" in cfg._AllMACs())
+    self.assertTrue("inst1.example.com.disk0_data" in cfg._AllLVs())
+    self.assertTrue("secret-inst1.example.com" in cfg._AllDRBDSecrets())
+    self.assertTrue(inst.uuid in cfg._AllIDs(False))
+    self.assertTrue("inst1.example.com" in cfg._AllIDs(False))
+    self.assertRaises(errors.ReservationError, cfg.ReserveMAC,
+                      "aa:00:00:00:00:01", "my-job")
+    self.assertEqual(cfg.ComputeDRBDMap(),
+                     {master: {0: "inst1.example.com",
+                               1: "inst1.example.com"}})
+    self.assertEqual(cfg.AllocateDRBDMinor([master], "inst2.example.com"),
+                     [2])
+    cfg.ReleaseDRBDMinors("inst2.example.com")
+
+    # changes to the instance's disks are picked up on update
+    inst = cfg.GetInstanceInfo("inst1.example.com")
+    inst.disks[0].logical_id = inst.disks[0].logical_id[:3] + (4, 5, "s2")
+    cfg.Update(inst, None)
+    self.assertEqual(cfg.ComputeDRBDMap(),
+                     {master: {4: "inst1.example.com",
+                               5: "inst1.example.com"}})
+    self.assertFalse("secret-inst1.example.com" in cfg._AllDRBDSecrets())
+    self.assertTrue("s2" in cfg._AllDRBDSecrets())
+
+    cfg.RenameInstance("inst1.example.com", "inst3.example.com")
+    self.assertEqual(cfg.ComputeDRBDMap(),
+                     {master: {4: "inst3.example.com",
+                               5: "inst3.example.com"}})
+
+    # a duplicate minor is found by the incremental verification
+    errs = []
+    inst = self._CreateDrbdInstance(cfg, "inst4.example.com", (5, 6),
+                                    "aa:00:00:00:00:04")
+    cfg.AddInstance(inst, "my-job")
+    cfg.Update(cfg.GetInstanceInfo("inst4.example.com"), errs.append)
+    self.assertEqual(len(errs), 1)
+    self.assertTrue("DRBD minor 5" in errs[0])
+    self.assertRaises(errors.ConfigurationError, cfg.AllocateDRBDMinor,
+                      [master], "inst5.example.com")
+
+    cfg.RemoveInstance("inst4.example.com")
+    cfg.RemoveInstance("inst3.example.com")
+    self.assertEqual(cfg.ComputeDRBDMap(), {master: {}})
+    self.assertFalse(cfg._AllMACs())
+    self.assertFalse(cfg._AllLVs())
+    self.assertFalse(cfg._AllDRBDSecrets())
+
+    # the index is rebuilt when loading the configuration
+    cfg.AddInstance(self._CreateDrbdInstance(cfg, "inst6.example.com", (7, 8),
+                                             "aa:00:00:00:00:06"), "my-job")
+    cfg = self._get_object()
+    self.assertEqual(cfg.ComputeDRBDMap(),
+                     {master: {7: "inst6.example.com",
+                               8: "inst6.example.com"}})
+    self.assertTrue("aa:00:00:00:00:06" in cfg._AllMACs())
+
   def testNICParameterSyntaxCheck(self):
     """Test the NIC's CheckParameterSyntax function"""
     mode = constants.NIC_MODE
@@ -186,5 +456,84 @@ class TestConfigRunner(unittest.TestCase):
                       CheckSyntax, {mode: m_bridged, link: ''})
 
 
+class TestConfigWriteBenchmark(unittest.TestCase):
+  """Measures the configuration write latency against the instance count"""
+  def setUp(self):
+    fd, self.cfg_file = tempfile.mkstemp()
+    os.close(fd)
+
+  def tearDown(self):
+    utils.RemoveFile(self.cfg_file)
+
+  @staticmethod
+  def _Time(fn, count):
+    start = time.time()
+    for _ in range(count):
+      fn()
+    return (time.time() - start) / count
+
+  def _MakeConfig(self, inst_count):
+    _InitCluster(self.cfg_file)
+    cfg = config.ConfigWriter(cfg_file=self.cfg_file, offline=True,
+                              _getents=_StubGetEntResolver)
+    node = cfg.GetMasterNode()
+    for idx in range(inst_count):
+      mac = "aa:00:00:%02x:%02x:%02x" % (idx >> 16, (idx >> 8) & 0xff,
+                                         idx & 0xff)
+      disk = objects.Disk(dev_type=constants.LD_LV, size=1024,
+                          logical_id=("xenvg", "disk%d" % idx),
+                          iv_name="disk/0", mode=constants.DISK_RDWR)
+      inst = objects.Instance(name="inst%d.example.com" % idx,
+                              uuid=utils.NewUUID(), disks=[disk],
+                              nics=[objects.NIC(mac=mac, nicparams={})],
+                              disk_template=constants.DT_PLAIN,
+                              primary_node=node, admin_up=False,
+                              hypervisor=constants.HT_FAKE, hvparams={},
+                              beparams={}, serial_no=1)
+      cfg._config_data.instances[inst.name] = inst
+    cfg._index.Rebuild(cfg._config_data.instances)
+    cfg._dirty.MarkAll()
+    cfg._WriteConfig()
+    return cfg
+
+  def test(self):
+    name = "inst0.example.com"
+
+    for inst_count in [10, 100, 1000]:
+      cfg = self._MakeConfig(inst_count)
+
+      def _Toggle():
+        cfg.MarkInstanceUp(name)
+        cfg.MarkInstanceDown(name)
+
+      write = self._Time(_Toggle, 5) / 2
+
+      dirty = config._ConfigDirtyTracker()
+      dirty.Reset()
+      dirty.Mark("instances", name)
+      modified = self._Time(lambda: cfg._UnlockedVerifyModified(dirty), 5)
+      full = self._Time(cfg._UnlockedVerifyConfig, 5)
+
+      logging.info("%s instances: write %.2fms, verification of modified"
+                   " objects %.3fms, full verification %.3fms",
+                   inst_count, write * 1000, modified * 1000, full * 1000)
+
+      gen_mac = self._Time(lambda: cfg.GenerateMAC("my-job"), 5)
+      gen_id = self._Time(lambda: cfg.GenerateUniqueID("my-job"), 5)
+      drbd_map = self._Time(cfg.ComputeDRBDMap, 5)
+      logging.info("%s instances: MAC generation %.3fms, UUID generation"
+                   " %.3fms, DRBD map %.3fms", inst_count, gen_mac * 1000,
+                   gen_id * 1000, drbd_map * 1000)
+
+      fields = ["name", "pnode", "admin_state", "disk.sizes"]
+      op = opcodes.OpQueryInstances(output_fields=fields, names=[])
+      query = self._Time(lambda: cmdlib.LUQueryInstances.QuerySnapshot(
+        cfg.GetSnapshot(), op), 5)
+      self.assertEqual(len(cmdlib.LUQueryInstances.QuerySnapshot(
+        cfg.GetSnapshot(), op)), inst_count)
+      logging.info("%s instances: query from snapshot %.3fms", inst_count,
+                   query * 1000)
+
+
 if __name__ == '__main__':
   testutils.GanetiTestProgram()
@@ -32,6 +32,7 @@ import shutil
 from ganeti import daemon
 from ganeti import errors
 from ganeti import constants
+from ganeti import compat
 from ganeti import utils
 
 import testutils
@@ -528,6 +529,58 @@ class TestAsyncStreamServerTCP(testutils.GanetiTestCase):
     self.assertEquals(client1.recv(4096), "r0\3r1\3r2\3")
     self.assertRaises(socket.error, client2.recv, 4096)
 
+  def testSendMessageIterator(self):
+    self.connect_terminate_count = None
+    self.message_terminate_count = 1
+    client1 = self.getClient()
+    client1.send("one\3")
+    self.mainloop.Run()
+    sent = []
+    self.connections[0].send_message(iter(["r0", "r1", "r2"]),
+                                     sent_fn=compat.partial(sent.append, 1))
+    self.assertEqual(sent, [])
+    while self.connections[0].writable():
+      self.connections[0].handle_write()
+    self.assertEqual(sent, [1])
+    self.assertEqual(self.connections[0].send_count, 1)
+    client1.setblocking(0)
+    self.assertEquals(client1.recv(4096), "r0\3r1\3r2\3")
+
+  def testLengthPrefix(self):
+    self.connect_terminate_count = None
+    self.message_terminate_count = 1
+    client1 = self.getClient()
+    client1.send("one\3")
+    self.mainloop.Run()
+    self.assertEquals(self.messages[0], ["one"])
+
+    # Switch after the reply
+    self.connections[0].send_message("r0", sent_fn=compat.partial(
+      self.connections[0].use_length_prefix, ">H"))
+    while self.connections[0].writable():
+      self.connections[0].handle_write()
+    self.assertEqual(client1.recv(4096), "r0\3")
+
+    self.message_terminate_count = 4
+    client1.send("\0\x05t\3w\3o\0\0\0\x02")
+    client1.send("\3\3\0\x03f")
+    client1.send("ou")
+    self.mainloop.Run()
+    self.assertEquals(self.messages[0], ["one", "t\3w\3o", "", "\3\3",
+                                         "fou"])
+
+    self.connections[0].send_message("r1")
+    self.connections[0].send_message(["", "r\3"])
+    while self.connections[0].writable():
+      self.connections[0].handle_write()
+    # Messages may be sent in several segments
+    expected = "\0\x02r1\0\0\0\x02r\3"
+    client1.settimeout(10)
+    data = ""
+    while len(data) < len(expected):
+      data += client1.recv(4096)
+    self.assertEqual(data, expected)
+
   def testLimitedUnhandledMessages(self):
     self.connect_terminate_count = None
     self.message_terminate_count = 3
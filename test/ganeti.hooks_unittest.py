@@ -76,10 +76,23 @@ class TestHooksRunner(unittest.TestCase):
   def _rname(self, fname):
     return "/".join(fname.split("/")[-2:])
 
+  def _RunHooks(self, phase, env, hr=None):
+    """Runs hooks, checks and removes the durations from the results."""
+    if hr is None:
+      hr = self.hr
+    results = []
+    for (script, hkr, output, duration) in hr.RunHooks(self.hpath, phase, env):
+      if hkr == HKR_SKIP:
+        self.assertEqual(duration, None)
+      else:
+        self.assertTrue(duration >= 0)
+      results.append((script, hkr, output))
+    return results
+
   def testEmpty(self):
     """Test no hooks"""
     for phase in (constants.HOOKS_PHASE_PRE, constants.HOOKS_PHASE_POST):
-      self.failUnlessEqual(self.hr.RunHooks(self.hpath, phase, {}), [])
+      self.failUnlessEqual(self._RunHooks(phase, {}), [])
 
   def testSkipNonExec(self):
     """Test skip non-exec file"""
@@ -88,7 +101,7 @@ class TestHooksRunner(unittest.TestCase):
       f = open(fname, "w")
       f.close()
       self.torm.append((fname, False))
-      self.failUnlessEqual(self.hr.RunHooks(self.hpath, phase, {}),
+      self.failUnlessEqual(self._RunHooks(phase, {}),
                            [(self._rname(fname), HKR_SKIP, "")])
 
   def testSkipInvalidName(self):
@@ -100,7 +113,7 @@ class TestHooksRunner(unittest.TestCase):
       f.close()
       os.chmod(fname, 0700)
       self.torm.append((fname, False))
-      self.failUnlessEqual(self.hr.RunHooks(self.hpath, phase, {}),
+      self.failUnlessEqual(self._RunHooks(phase, {}),
                            [(self._rname(fname), HKR_SKIP, "")])
 
   def testSkipDir(self):
@@ -109,7 +122,7 @@ class TestHooksRunner(unittest.TestCase):
       fname = "%s/testdir" % self.ph_dirs[phase]
       os.mkdir(fname)
       self.torm.append((fname, True))
-      self.failUnlessEqual(self.hr.RunHooks(self.hpath, phase, {}),
+      self.failUnlessEqual(self._RunHooks(phase, {}),
                            [(self._rname(fname), HKR_SKIP, "")])
 
   def testSuccess(self):
@@ -121,7 +134,7 @@ class TestHooksRunner(unittest.TestCase):
       f.close()
       self.torm.append((fname, False))
       os.chmod(fname, 0700)
-      self.failUnlessEqual(self.hr.RunHooks(self.hpath, phase, {}),
+      self.failUnlessEqual(self._RunHooks(phase, {}),
                            [(self._rname(fname), HKR_SUCCESS, "")])
 
   def testSymlink(self):
@@ -130,7 +143,7 @@ class TestHooksRunner(unittest.TestCase):
       fname = "%s/success" % self.ph_dirs[phase]
       os.symlink("/bin/true", fname)
       self.torm.append((fname, False))
-      self.failUnlessEqual(self.hr.RunHooks(self.hpath, phase, {}),
+      self.failUnlessEqual(self._RunHooks(phase, {}),
                            [(self._rname(fname), HKR_SUCCESS, "")])
 
   def testFail(self):
@@ -142,7 +155,7 @@ class TestHooksRunner(unittest.TestCase):
       f.close()
       self.torm.append((fname, False))
       os.chmod(fname, 0700)
-      self.failUnlessEqual(self.hr.RunHooks(self.hpath, phase, {}),
+      self.failUnlessEqual(self._RunHooks(phase, {}),
                            [(self._rname(fname), HKR_FAIL, "")])
 
   def testCombined(self):
@@ -160,7 +173,7 @@ class TestHooksRunner(unittest.TestCase):
         self.torm.append((fname, False))
         os.chmod(fname, 0700)
         expect.append((self._rname(fname), rs, ""))
-      self.failUnlessEqual(self.hr.RunHooks(self.hpath, phase, {}), expect)
+      self.failUnlessEqual(self._RunHooks(phase, {}), expect)
 
   def testOrdering(self):
     for phase in (constants.HOOKS_PHASE_PRE, constants.HOOKS_PHASE_POST):
@@ -176,7 +189,7 @@ class TestHooksRunner(unittest.TestCase):
         self.torm.append((fname, False))
         expect.append((self._rname(fname), HKR_SUCCESS, ""))
       expect.sort()
-      self.failUnlessEqual(self.hr.RunHooks(self.hpath, phase, {}), expect)
+      self.failUnlessEqual(self._RunHooks(phase, {}), expect)
 
   def testEnv(self):
     """Test environment execution"""
@@ -187,9 +200,64 @@ class TestHooksRunner(unittest.TestCase):
       self.torm.append((fname, False))
       env_snt = {"PHASE": phase}
       env_exp = "PHASE=%s" % phase
-      self.failUnlessEqual(self.hr.RunHooks(self.hpath, phase, env_snt),
+      self.failUnlessEqual(self._RunHooks(phase, env_snt),
                            [(self._rname(fname), HKR_SUCCESS, env_exp)])
 
+  def testParallel(self):
+    """Test running scripts concurrently"""
+    hr = backend.HooksRunner(hooks_base_dir=self.tmpdir, max_parallel=3)
+    phase = constants.HOOKS_PHASE_PRE
+    expect = []
+    for i in range(3):
+      fname = "%s/%02d-wait" % (self.ph_dirs[phase], 20 - i)
+      # Each script waits for all others to have started
+      f = open(fname, "w")
+      f.write("#!/bin/sh\n"
+              "touch %s/started-%s\n"
+              "for i in $(seq 1 500); do\n"
+              "  [ $(ls %s | grep -c started) -eq 3 ] && exit 0\n"
+              "  sleep 0.01\n"
+              "done\n"
+              "exit 1\n" % (self.logdir, i, self.logdir))
+      f.close()
+      os.chmod(fname, 0700)
+      self.torm.append((fname, False))
+      self.torm.append(("%s/started-%s" % (self.logdir, i), False))
+      expect.append((self._rname(fname), HKR_SUCCESS, ""))
+
+    fname = "%s/30-skip.x" % self.ph_dirs[phase]
+    os.symlink("/bin/true", fname)
+    self.torm.append((fname, False))
+    expect.append((self._rname(fname), HKR_SKIP, ""))
+
+    expect.sort()
+    self.failUnlessEqual(self._RunHooks(phase, {}, hr=hr), expect)
+
+  def testTimeout(self):
+    """Test killing scripts after a timeout"""
+    hr = backend.HooksRunner(hooks_base_dir=self.tmpdir, timeout=0.2)
+    phase = constants.HOOKS_PHASE_POST
+    for (fbase, data) in [("00fast", "exit 0"),
+                          ("10slow", "echo starting\nexec sleep 60")]:
+      fname = "%s/%s" % (self.ph_dirs[phase], fbase)
+      f = open(fname, "w")
+      f.write("#!/bin/sh\n%s\n" % data)
+      f.close()
+      os.chmod(fname, 0700)
+      self.torm.append((fname, False))
+
+    start = time.time()
+    results = hr.RunHooks(self.hpath, phase, {})
+    self.assertTrue(time.time() - start < 30)
+
+    self.assertEqual(results[0][:3], ("fake-post.d/00fast", HKR_SUCCESS, ""))
+    (script, hkr, output, duration) = results[1]
+    self.assertEqual(script, "fake-post.d/10slow")
+    self.assertEqual(hkr, HKR_FAIL)
+    self.assertTrue(output.startswith("starting"))
+    self.assertTrue("timeout" in output)
+    self.assertTrue(duration >= 0.2)
+
 
 class TestHooksMaster(unittest.TestCase):
   """Testing case for HooksMaster"""
@@ -235,6 +303,22 @@ class TestHooksMaster(unittest.TestCase):
                            node=node, call='FakeScriptOk'))
                  for node in node_list])
 
+  @staticmethod
+  def _call_script_durations(node_list, hpath, phase, env):
+    """Fake call_hooks_runner function.
+
+    @rtype: dict of node -> L{rpc.RpcResult} with script results including
+        durations
+    @return: script execution from all nodes
+
+    """
+    rr = rpc.RpcResult
+    return dict([(node, rr((True, [("utest", constants.HKR_SUCCESS, "ok", 0.1),
+                                   ("uskip", constants.HKR_SKIP, "", None),
+                                   ("ufail", constants.HKR_FAIL, "err", 2.0)]),
+                           node=node, call='FakeScriptDurations'))
+                 for node in node_list])
+
   def setUp(self):
     self.op = opcodes.OpCode()
     self.context = FakeContext()
@@ -270,6 +354,14 @@ class TestHooksMaster(unittest.TestCase):
     for phase in (constants.HOOKS_PHASE_PRE, constants.HOOKS_PHASE_POST):
       hm.RunPhase(phase)
 
+  def testScriptDurations(self):
+    """Test results including durations"""
+    hm = mcpu.HooksMaster(self._call_script_durations, self.lu)
+    self.failUnlessRaises(errors.HooksAbort,
+                          hm.RunPhase, constants.HOOKS_PHASE_PRE)
+    results = hm.RunPhase(constants.HOOKS_PHASE_POST)
+    self.assertEqual(results["localhost"].payload[0][3], 0.1)
+
 
 if __name__ == '__main__':
   testutils.GanetiTestProgram()
@@ -26,8 +26,15 @@ import os
 import unittest
 import time
 import tempfile
+import signal
+import socket
+import logging
+import shutil
+import pycurl
 
 from ganeti import http
+from ganeti import daemon
+from ganeti import utils
 
 import ganeti.http.server
 import ganeti.http.client
@@ -395,5 +402,273 @@ class TestClient(unittest.TestCase):
     self.assertFalse(pool._pool)
 
 
+class _FakeHttpClient:
+  def __init__(self, curl_config_fn):
+    self.closed = False
+
+  def Close(self):
+    self.closed = True
+
+
+class _FakeHttpClientPool(http.client.HttpClientPool):
+  @staticmethod
+  def _GetHttpClientCreator():
+    return _FakeHttpClient
+
+
+class TestClientPool(unittest.TestCase):
+  def setUp(self):
+    self.now = 100.0
+    self.pool = _FakeHttpClientPool(None, _time_fn=lambda: self.now)
+
+  def testReuse(self):
+    pc1 = self.pool._Get("node1/1811")
+    pc2 = self.pool._Get("node1/1811")
+    self.assertNotEqual(pc1, pc2)
+    self.pool._Return([pc1, pc2])
+    self.assertEqual(self.pool._pool, { "node1/1811": [pc1, pc2], })
+
+    # The most recently returned client comes first
+    self.assertEqual(self.pool._Get("node1/1811"), pc2)
+    self.assertEqual(self.pool._Get("node1/1811"), pc1)
+    self.assertFalse(self.pool._pool)
+
+    pc3 = self.pool._Get("node2/1811")
+    self.assertNotEqual(pc3, pc1)
+    self.assertNotEqual(pc3, pc2)
+
+  def testExpire(self):
+    pc1 = self.pool._Get("node1/1811")
+    pc2 = self.pool._Get("node2/1811")
+    self.pool._Return([pc1, pc2])
+
+    self.now += self.pool._MAX_IDLE_TIME / 2
+    pc2 = self.pool._Get("node2/1811")
+    self.pool._Return([pc2])
+
+    self.now += self.pool._MAX_IDLE_TIME
+    self.assertFalse(pc1.client.closed)
+    pc3 = self.pool._Get("node3/1811")
+    self.pool._Return([pc3])
+    self.assertTrue(pc1.client.closed)
+    self.assertFalse(pc2.client.closed)
+    self.assertEqual(self.pool._pool, {
+      "node2/1811": [pc2],
+      "node3/1811": [pc3],
+      })
+
+  def testReset(self):
+    pc1 = self.pool._Get("node1/1811")
+    pc2 = self.pool._Get("node2/1811")
+    self.pool._Return([pc1])
+    self.pool.Reset()
+    self.assertFalse(self.pool._pool)
+    self.assertTrue(pc1.client.closed)
+    self.assertFalse(pc2.client.closed)
+
+
+class TestListenQueueLength(unittest.TestCase):
+  def test(self):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    clients = []
+    try:
+      sock.bind(("127.0.0.1", 0))
+      sock.listen(5)
+
+      self.assertEqual(http.server._GetListenQueueLength(sock), 0)
+
+      for _ in range(3):
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        clients.append(client)
+        client.connect(sock.getsockname())
+
+      self.assertEqual(http.server._GetListenQueueLength(sock), 3)
+
+      sock.accept()[0].close()
+      self.assertEqual(http.server._GetListenQueueLength(sock), 2)
+    finally:
+      for client in clients:
+        client.close()
+      sock.close()
+
+
+class _EchoHttpServer(http.server.HttpServer):
+  def GetRequestTimeout(self, req):
+    if req.request_path == "/quicksleep":
+      return 0.5
+    return http.server.HttpServer.GetRequestTimeout(self, req)
+
+  def HandleRequest(self, req):
+    if req.request_path in ("/sleep", "/quicksleep"):
+      time.sleep(float(req.request_body))
+    return req.request_body
+
+
+class _TestServerBase(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.certfile = utils.PathJoin(self.tmpdir, "cert.pem")
+    utils.GenerateSelfSignedSslCert(self.certfile)
+    self.ssl_params = http.HttpSslParams(ssl_key_path=self.certfile,
+                                         ssl_cert_path=self.certfile)
+    pycurl.global_init(pycurl.GLOBAL_ALL)
+
+  def tearDown(self):
+    pycurl.global_cleanup()
+    shutil.rmtree(self.tmpdir)
+
+  def _StartServer(self, keep_alive, workers=0, request_timeout=None):
+    # Find a free port
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+      sock.bind(("127.0.0.1", 0))
+      port = sock.getsockname()[1]
+    finally:
+      sock.close()
+
+    pid = os.fork()
+    if pid == 0:
+      try:
+        mainloop = daemon.Mainloop()
+        server = _EchoHttpServer(mainloop, "127.0.0.1", port,
+                                 ssl_params=self.ssl_params,
+                                 ssl_verify_peer=False, keep_alive=keep_alive,
+                                 workers=workers,
+                                 request_timeout=request_timeout)
+        server.WORKER_CHECK_INTERVAL = 0.1
+        server.Start()
+        try:
+          mainloop.Run()
+        finally:
+          server.Stop()
+      finally:
+        os._exit(0)
+
+    # Wait for the server to accept connections
+    def _Connect():
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      try:
+        try:
+          sock.connect(("127.0.0.1", port))
+        except socket.error:
+          raise utils.RetryAgain()
+      finally:
+        sock.close()
+    utils.Retry(_Connect, 0.05, 10.0)
+
+    return (pid, port)
+
+  def _ConfigCurl(self, curl):
+    curl.setopt(pycurl.CAINFO, self.certfile)
+    curl.setopt(pycurl.SSL_VERIFYHOST, 0)
+    curl.setopt(pycurl.SSL_VERIFYPEER, True)
+    curl.setopt(pycurl.SSLCERTTYPE, "PEM")
+    curl.setopt(pycurl.SSLCERT, self.certfile)
+    curl.setopt(pycurl.SSLKEYTYPE, "PEM")
+    curl.setopt(pycurl.SSLKEY, self.certfile)
+
+  def _StopServer(self, pid):
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+
+  def _MakeRequest(self, port, path, data):
+    return http.client.HttpClientRequest("127.0.0.1", port, http.HTTP_PUT,
+                                         path, post_data=data,
+                                         headers=["Content-type: %s" %
+                                                  http.HTTP_APP_JSON])
+
+
+class TestWorkers(_TestServerBase):
+  def testParallel(self):
+    (pid, port) = self._StartServer(True, workers=2)
+    try:
+      pool = http.client.HttpClientPool(self._ConfigCurl)
+      for _ in range(3):
+        # More requests than workers
+        reqs = [self._MakeRequest(port, "/sleep", "0.1") for _ in range(5)]
+        pool.ProcessRequests(reqs)
+        for req in reqs:
+          self.assertTrue(req.success, msg=req.error)
+          self.assertEqual(req.resp_body, "0.1")
+      pool.Reset()
+    finally:
+      self._StopServer(pid)
+
+  def testRequestTimeout(self):
+    (pid, port) = self._StartServer(False, workers=1, request_timeout=0.5)
+    try:
+      pool = http.client.HttpClientPool(self._ConfigCurl)
+
+      req = self._MakeRequest(port, "/sleep", "30")
+      start = time.time()
+      pool.ProcessRequests([req])
+      self.assertFalse(req.success)
+      self.assertTrue(time.time() - start < 10)
+
+      # The killed worker must have been replaced
+      req = self._MakeRequest(port, "/echo", "data")
+      pool.ProcessRequests([req])
+      self.assertTrue(req.success, msg=req.error)
+      self.assertEqual(req.resp_body, "data")
+      pool.Reset()
+    finally:
+      self._StopServer(pid)
+
+  def testPerRequestTimeout(self):
+    (pid, port) = self._StartServer(False, workers=1, request_timeout=3600)
+    try:
+      pool = http.client.HttpClientPool(self._ConfigCurl)
+
+      # Requests can have a shorter timeout than the server
+      req = self._MakeRequest(port, "/quicksleep", "30")
+      start = time.time()
+      pool.ProcessRequests([req])
+      self.assertFalse(req.success)
+      self.assertTrue(time.time() - start < 10)
+
+      req = self._MakeRequest(port, "/sleep", "1")
+      pool.ProcessRequests([req])
+      self.assertTrue(req.success, msg=req.error)
+      self.assertEqual(req.resp_body, "1")
+      pool.Reset()
+    finally:
+      self._StopServer(pid)
+
+
+class TestRpcBenchmark(_TestServerBase):
+  """Measures the number of requests per second to a local server.
+
+  """
+  DURATION = 1.0
+
+  def _Run(self, keep_alive, workers):
+    (pid, port) = self._StartServer(keep_alive, workers=workers)
+    try:
+      pool = http.client.HttpClientPool(self._ConfigCurl)
+      count = 0
+      start = time.time()
+      while time.time() - start < self.DURATION:
+        data = "request %s" % count
+        req = self._MakeRequest(port, "/echo", data)
+        pool.ProcessRequests([req])
+        self.assertTrue(req.success, msg=req.error)
+        self.assertEqual(req.resp_status_code, http.HTTP_OK)
+        self.assertEqual(req.resp_body, data)
+        count += 1
+      duration = time.time() - start
+      pool.Reset()
+    finally:
+      self._StopServer(pid)
+
+    return count / duration
+
+  def test(self):
+    for workers in [0, 4]:
+      for keep_alive in [False, True]:
+        rate = self._Run(keep_alive, workers)
+        logging.info("Requests per second with workers=%s, keep_alive=%s:"
+                     " %.1f", workers, keep_alive, rate)
+
+
 if __name__ == '__main__':
   testutils.GanetiTestProgram()
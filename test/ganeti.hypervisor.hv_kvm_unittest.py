@@ -21,12 +21,22 @@
 
 """Script for testing the hypervisor.hv_kvm module"""
 
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 from ganeti import constants
 from ganeti import compat
 from ganeti import objects
 from ganeti import errors
+from ganeti import utils
 
 from ganeti.hypervisor import hv_kvm
 
@@ -80,5 +90,292 @@ class TestWriteNetScript(unittest.TestCase):
                       inst, nic, 2)
 
 
+class TestParseKVMCmdline(unittest.TestCase):
+  def test(self):
+    cmdline = "\x00".join(["/usr/bin/kvm", "-enable-kvm", "-m", "512",
+                           "-smp", "2", "-pidfile", "/var/run/inst1.pid",
+                           "-name", "inst1.example.com", ""])
+    self.assertEqual(hv_kvm._ParseKVMCmdline(cmdline),
+                     ("inst1.example.com", 512, 2))
+
+  def testNoInstance(self):
+    self.assertEqual(hv_kvm._ParseKVMCmdline("/bin/sleep\x0010\x00"),
+                     (None, 0, 0))
+
+  def testMissingValue(self):
+    self.assertEqual(hv_kvm._ParseKVMCmdline("kvm\x00-m\x00128\x00-name"),
+                     (None, 128, 0))
+    self.assertRaises(ValueError, hv_kvm._ParseKVMCmdline, "kvm\x00-m\x00x")
+
+
+class TestInstanceInfoCache(unittest.TestCase):
+  def test(self):
+    cache = hv_kvm._InstanceInfoCache()
+    cache.Add(100, "1234", ("inst1", 128, 1))
+    cache.Add(200, "1300", ("inst2", 256, 2))
+    self.assertEqual(cache.Get(100, "1234"), ("inst1", 128, 1))
+
+    # Reused process ID
+    self.assertEqual(cache.Get(100, "9999"), None)
+    self.assertEqual(cache.Get(300, "1234"), None)
+
+    cache.RemoveInstance("inst1")
+    self.assertEqual(cache.Get(100, "1234"), None)
+    self.assertEqual(cache.Get(200, "1300"), ("inst2", 256, 2))
+
+    cache.Prune(set([100]))
+    self.assertEqual(cache.Get(200, "1300"), None)
+
+
+class _FakePidsHypervisor(hv_kvm.KVMHypervisor):
+  def __init__(self, pids_dir):
+    # Don't create the runtime directories
+    self._monitors = {}
+    self._PIDS_DIR = pids_dir
+
+  def _InstancePidFile(self, instance_name):
+    return utils.PathJoin(self._PIDS_DIR, instance_name)
+
+
+class TestGetAllInstancesInfo(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    _FakePidsHypervisor._info_cache = hv_kvm._InstanceInfoCache()
+    self.hv = _FakePidsHypervisor(self.tmpdir)
+    self.procs = []
+
+  def tearDown(self):
+    for proc in self.procs:
+      if proc.poll() is None:
+        os.kill(proc.pid, 9)
+        proc.wait()
+    shutil.rmtree(self.tmpdir)
+
+  def _StartFakeInstance(self, name, memory, vcpus):
+    # Arguments following the script are ignored by Python, but show up in
+    # the process' command line like KVM's
+    proc = subprocess.Popen([sys.executable, "-c",
+                             "import time; time.sleep(300)",
+                             "-m", str(memory), "-smp", str(vcpus),
+                             "-name", name])
+    self.procs.append(proc)
+    utils.WriteFile(utils.PathJoin(self.tmpdir, name), data="%s\n" % proc.pid)
+
+    # Wait for the command line to be visible
+    cmdline_file = "/proc/%s/cmdline" % proc.pid
+    for _ in range(1000):
+      if "-name" in utils.ReadFile(cmdline_file):
+        break
+      time.sleep(0.01)
+
+    return proc
+
+  def test(self):
+    proc1 = self._StartFakeInstance("inst1", 128, 1)
+    proc2 = self._StartFakeInstance("inst2", 256, 4)
+
+    # Stale pid file
+    utils.WriteFile(utils.PathJoin(self.tmpdir, "inst3"), data="0\n")
+
+    # Process belonging to another instance
+    utils.WriteFile(utils.PathJoin(self.tmpdir, "inst4"),
+                    data="%s\n" % proc1.pid)
+
+    expected = [
+      ("inst1", proc1.pid, 128, 1, "---b-", "0"),
+      ("inst2", proc2.pid, 256, 4, "---b-", "0"),
+      ]
+
+    self.assertEqual(sorted(self.hv.GetAllInstancesInfo()), expected)
+    self.assertEqual(self.hv.GetInstanceInfo("inst2"), expected[1])
+    self.assertEqual(self.hv.GetInstanceInfo("inst4"), None)
+
+    # Further queries are answered from the cache
+    start_time = hv_kvm._GetProcessStartTime(proc1.pid)
+    self.hv._info_cache.Add(proc1.pid, start_time, ("inst1", 1024, 8))
+    self.assertEqual(sorted(self.hv.GetAllInstancesInfo())[0],
+                     ("inst1", proc1.pid, 1024, 8, "---b-", "0"))
+
+    # Stopped instances are removed from the cache
+    os.kill(proc1.pid, 9)
+    proc1.wait()
+    self.assertEqual(self.hv.GetAllInstancesInfo(), expected[1:])
+    self.assertEqual(self.hv._info_cache.Get(proc1.pid, start_time), None)
+
+  def testStartTime(self):
+    self.assertEqual(hv_kvm._GetProcessStartTime(os.getpid()),
+                     hv_kvm._GetProcessStartTime(os.getpid()))
+
+    proc = self._StartFakeInstance("inst1", 128, 1)
+    self.assertTrue(hv_kvm._GetProcessStartTime(proc.pid).isdigit())
+    os.kill(proc.pid, 9)
+    proc.wait()
+    self.assertEqual(hv_kvm._GetProcessStartTime(proc.pid), None)
+
+
+class TestMonitorResponseParser(unittest.TestCase):
+  def testGreeting(self):
+    parser = hv_kvm._MonitorResponseParser()
+    self.assertFalse(parser.Feed("QEMU 0.12.5 monitor - type 'help' for"
+                                 " more information\r\n(qemu"))
+    self.assertTrue(parser.Feed(") "))
+    self.assertEqual(parser.GetOutput(), "")
+
+  def testOutput(self):
+    parser = hv_kvm._MonitorResponseParser()
+    for data in ["info mig", "rate\r\nMigration status: active\r",
+                 "\ntransferred ram: 10 kbytes\r\n", "(qemu) "]:
+      self.assertEqual(parser.Feed(data), data == "(qemu) ")
+    self.assertEqual(parser.GetOutput(),
+                     "Migration status: active\ntransferred ram: 10 kbytes\n")
+
+  def testNoOutput(self):
+    parser = hv_kvm._MonitorResponseParser()
+    self.assertTrue(parser.Feed("system_powerdown\r\n(qemu) "))
+    self.assertEqual(parser.GetOutput(), "")
+
+  def testPromptInOutput(self):
+    parser = hv_kvm._MonitorResponseParser()
+    self.assertFalse(parser.Feed("info version\r\n(qemu) 0.12"))
+    self.assertTrue(parser.Feed("\r\n(qemu) "))
+    self.assertEqual(parser.GetOutput(), "(qemu) 0.12\n")
+
+
+class _FakeMonitor(threading.Thread):
+  """Minimal imitation of the KVM human monitor.
+
+  Connections are accepted one after another, like the real monitor does.
+
+  """
+  def __init__(self, path):
+    threading.Thread.__init__(self)
+    self.setDaemon(True)
+    self.connections = 0
+    self.commands = []
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._sock.bind(path)
+    self._sock.listen(1)
+
+  def run(self):
+    while True:
+      try:
+        (conn, _) = self._sock.accept()
+      except socket.error:
+        break
+
+      self.connections += 1
+      try:
+        self._Serve(conn)
+      finally:
+        conn.close()
+
+  def _Serve(self, conn):
+    conn.sendall("QEMU 0.12.5 monitor - type 'help' for more information\r\n"
+                 "(qemu) ")
+    buf = ""
+    while True:
+      data = conn.recv(4096)
+      if not data:
+        break
+
+      buf += data
+      while "\n" in buf:
+        (command, buf) = buf.split("\n", 1)
+        self.commands.append(command)
+        if command == "quit":
+          return
+        conn.sendall("%s\r\nreply %s\r\n(qemu) " % (command, command))
+
+  def Stop(self):
+    self._sock.shutdown(socket.SHUT_RDWR)
+    self._sock.close()
+
+
+class _FakeMonitorHypervisor(hv_kvm.KVMHypervisor):
+  def __init__(self, path):
+    # Don't create the runtime directories
+    self._monitors = {}
+    self._path = path
+
+  def _InstanceMonitor(self, instance_name):
+    return self._path
+
+
+class _MonitorTestBase(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, "monitor")
+    self.monitor = _FakeMonitor(self.path)
+    self.monitor.start()
+    self.hv = _FakeMonitorHypervisor(self.path)
+
+  def tearDown(self):
+    self.hv._CloseMonitor("inst1")
+    self.monitor.Stop()
+    shutil.rmtree(self.tmpdir)
+
+
+class TestMonitorConnection(_MonitorTestBase):
+  def testReuse(self):
+    for i in range(10):
+      self.assertEqual(self.hv._CallMonitorCommand("inst1", "info %s" % i),
+                       "reply info %s\n" % i)
+    self.assertEqual(self.monitor.connections, 1)
+    self.assertEqual(self.monitor.commands,
+                     ["info %s" % i for i in range(10)])
+
+  def testReconnect(self):
+    self.assertEqual(self.hv._CallMonitorCommand("inst1", "info status"),
+                     "reply info status\n")
+
+    # The monitor closed the connection, e.g. because the instance restarted
+    self.assertRaises(errors.HypervisorError,
+                      self.hv._CallMonitorCommand, "inst1", "quit")
+    self.assertFalse(self.hv._monitors)
+
+    self.assertEqual(self.hv._CallMonitorCommand("inst1", "info status"),
+                     "reply info status\n")
+    self.assertEqual(self.monitor.connections, 2)
+
+  def testClose(self):
+    self.hv._CallMonitorCommand("inst1", "info status")
+    self.hv._CloseMonitor("inst1")
+    self.hv._CloseMonitor("inst1")
+    self.hv._CallMonitorCommand("inst1", "info status")
+    self.assertEqual(self.monitor.connections, 2)
+
+  def testNoMonitor(self):
+    hv = _FakeMonitorHypervisor(os.path.join(self.tmpdir, "missing"))
+    self.assertRaises(errors.HypervisorError,
+                      hv._CallMonitorCommand, "inst1", "info status")
+    self.assertFalse(hv._monitors)
+
+
+class TestMonitorBenchmark(_MonitorTestBase):
+  _COUNT = 200
+
+  def test(self):
+    start = time.time()
+    for _ in range(self._COUNT):
+      self.assertEqual(self.hv._CallMonitorCommand("inst1", "info migrate"),
+                       "reply info migrate\n")
+    persistent = time.time() - start
+
+    start = time.time()
+    for _ in range(self._COUNT):
+      self.assertEqual(self.hv._CallMonitorCommand("inst1", "info migrate"),
+                       "reply info migrate\n")
+      self.hv._CloseMonitor("inst1")
+    reconnect = time.time() - start
+
+    # The first command of the second run still uses the persistent connection
+    self.assertEqual(self.monitor.connections, self._COUNT)
+
+    logging.info("%s monitor commands: persistent connection %.3f ms/command,"
+                 " new connection per command %.3f ms/command",
+                 self._COUNT, persistent * 1000 / self._COUNT,
+                 reconnect * 1000 / self._COUNT)
+
+
 if __name__ == "__main__":
   testutils.GanetiTestProgram()
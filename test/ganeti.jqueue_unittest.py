@@ -28,10 +28,14 @@ import tempfile
 import shutil
 import errno
 import itertools
+import threading
+
+from ganeti import serializer
 
 from ganeti import constants
 from ganeti import utils
 from ganeti import errors
+from ganeti import rpc
 from ganeti import jqueue
 from ganeti import opcodes
 from ganeti import compat
@@ -133,6 +137,425 @@ class TestJobChangesChecker(unittest.TestCase):
     self.assertEqual(log_entries, [[0, "Hello World"], [1, "Foo Bar"]])
 
 
+class TestJobIdIndex(unittest.TestCase):
+  def testInitial(self):
+    index = jqueue._JobIdIndex(["10", "9", "100", "1"])
+    self.assertEqual(len(index), 4)
+    self.assertEqual(index.GetAll(), ["1", "9", "10", "100"])
+    self.assertTrue("9" in index)
+    self.assertFalse("2" in index)
+
+  def testAddRemove(self):
+    index = jqueue._JobIdIndex()
+    self.assertEqual(index.GetAll(), [])
+
+    for job_id in ["5", "6", "7", "2", "6"]:
+      index.Add(job_id)
+    self.assertEqual(index.GetAll(), ["2", "5", "6", "7"])
+
+    index.Remove("6")
+    index.Remove("6")
+    index.Remove("1000")
+    self.assertEqual(index.GetAll(), ["2", "5", "7"])
+    self.assertEqual(len(index), 3)
+    self.assertFalse("6" in index)
+
+    index.Add("1000")
+    self.assertEqual(index.GetAll(), ["2", "5", "7", "1000"])
+
+  def testCopy(self):
+    index = jqueue._JobIdIndex(["1"])
+    result = index.GetAll()
+    index.Add("2")
+    self.assertEqual(result, ["1"])
+
+
+class _FakeAgedJob:
+  def __init__(self, job_id, received, start=None, end=None):
+    self.id = job_id
+    self.received_timestamp = (received, 0)
+    self.start_timestamp = self.end_timestamp = None
+    if start is not None:
+      self.start_timestamp = (start, 0)
+    if end is not None:
+      self.end_timestamp = (end, 0)
+
+
+class TestJobAgeIndex(unittest.TestCase):
+  def testJobAge(self):
+    fn = jqueue._JobAgeIndex.GetJobAge
+    self.assertEqual(fn(_FakeAgedJob("1", 10)), 10)
+    self.assertEqual(fn(_FakeAgedJob("1", 10, start=20)), 20)
+    self.assertEqual(fn(_FakeAgedJob("1", 10, start=20, end=30)), 30)
+    self.assertEqual(fn(_FakeAgedJob("1", 10, end=30)), 30)
+
+  def testOlderThan(self):
+    index = jqueue._JobAgeIndex()
+    self.assertEqual(index.GetOlderThan(None), [])
+
+    index.Add(_FakeAgedJob("9", 1, end=300))
+    index.Add(_FakeAgedJob("10", 1, end=100))
+    index.Add(_FakeAgedJob("2", 1, end=100))
+    index.Add(_FakeAgedJob("3", 50))
+    self.assertEqual(len(index), 4)
+
+    self.assertEqual(index.GetOlderThan(None), ["3", "2", "10", "9"])
+    self.assertEqual(index.GetOlderThan(50), [])
+    self.assertEqual(index.GetOlderThan(51), ["3"])
+    self.assertEqual(index.GetOlderThan(101), ["3", "2", "10"])
+    self.assertEqual(index.GetOlderThan(1000), ["3", "2", "10", "9"])
+
+  def testAddRemove(self):
+    index = jqueue._JobAgeIndex()
+    index.Add(_FakeAgedJob("1", 10))
+    index.Add(_FakeAgedJob("2", 20))
+
+    # re-adding a job updates its age
+    index.Add(_FakeAgedJob("1", 10, end=30))
+    self.assertEqual(len(index), 2)
+    self.assertEqual(index.GetOlderThan(None), ["2", "1"])
+
+    index.Remove("2")
+    index.Remove("2")
+    index.Remove("1000")
+    self.assertEqual(len(index), 1)
+    self.assertEqual(index.GetOlderThan(None), ["1"])
+
+
+class _FakeCachedJob:
+  def __init__(self, job_id):
+    self.id = job_id
+
+
+class TestFinishedJobsCache(unittest.TestCase):
+  def testCount(self):
+    cache = jqueue._FinishedJobsCache(3, 1000)
+    jobs = [_FakeCachedJob(str(i)) for i in range(5)]
+    for job in jobs[:3]:
+      cache.Add(job, 10)
+
+    # make job 0 the most recently used one
+    self.assertEqual(cache.Get("0"), jobs[0])
+    cache.Add(jobs[3], 10)
+    self.assertEqual(cache.Get("1"), None)
+    self.assertEqual(cache.Get("0"), jobs[0])
+    self.assertEqual(cache.Get("2"), jobs[2])
+    self.assertEqual(cache.Get("3"), jobs[3])
+
+    stats = cache.GetStats()
+    self.assertEqual(stats["count"], 3)
+    self.assertEqual(stats["size"], 30)
+    self.assertEqual(stats["hits"], 4)
+    self.assertEqual(stats["misses"], 1)
+
+  def testSize(self):
+    cache = jqueue._FinishedJobsCache(100, 100)
+    jobs = [_FakeCachedJob(str(i)) for i in range(5)]
+
+    # too big to be cached at all
+    cache.Add(jobs[0], 101)
+    self.assertEqual(cache.Get("0"), None)
+
+    cache.Add(jobs[1], 40)
+    cache.Add(jobs[2], 40)
+    cache.Add(jobs[3], 40)
+    self.assertEqual(cache.Get("1"), None)
+    self.assertEqual(cache.GetStats()["size"], 80)
+
+    # replacing a job updates its size
+    cache.Add(jobs[2], 10)
+    self.assertEqual(cache.GetStats()["size"], 50)
+
+    cache.Remove("2")
+    cache.Remove("2")
+    self.assertEqual(cache.Get("2"), None)
+    self.assertEqual(cache.Get("3"), jobs[3])
+    self.assertEqual(cache.GetStats()["size"], 40)
+
+  def testManyAccesses(self):
+    cache = jqueue._FinishedJobsCache(2, 1000)
+    (job_a, job_b, job_c) = [_FakeCachedJob(name) for name in "abc"]
+    cache.Add(job_a, 1)
+    cache.Add(job_b, 1)
+    for _ in range(1000):
+      self.assertEqual(cache.Get("a"), job_a)
+    cache.Add(job_c, 1)
+    self.assertEqual(cache.Get("b"), None)
+    self.assertEqual(cache.Get("a"), job_a)
+    self.assertEqual(cache.Get("c"), job_c)
+
+
+class TestQueueFileReplicator(unittest.TestCase):
+  def setUp(self):
+    self.sent = []
+    self.sent_event = threading.Event()
+    self.fail_send = False
+    self.failed_nodes = []
+
+  def tearDown(self):
+    self.rep.Stop()
+
+  def _Send(self, files, nodes=None):
+    if self.fail_send:
+      raise errors.GenericError("sending failed")
+    if nodes is None:
+      self.sent.append(files)
+    else:
+      self.sent.append((files, nodes))
+    self.sent_event.set()
+    return self.failed_nodes
+
+  def testSynchronous(self):
+    self.rep = jqueue._QueueFileReplicator(self._Send, 3600)
+    self.rep.Defer("/job-1", "a")
+    self.rep.Defer("/job-2", "b")
+    self.rep.Defer("/job-1", "c")
+    self.assertEqual(self.sent, [])
+
+    self.rep.Send([("/job-3", "d")])
+    self.assertEqual(self.sent,
+                     [[("/job-1", "c", False), ("/job-2", "b", False),
+                       ("/job-3", "d", False)]])
+
+    # a synchronous update replaces a deferred one for the same file
+    self.rep.Defer("/job-3", "e")
+    self.rep.Defer("/job-3.log", "x", append=True)
+    self.rep.Send([("/job-3", "f"), ("/job-3.log", "g")])
+    self.assertEqual(self.sent[1:], [[("/job-3", "f", False),
+                                      ("/job-3.log", "g", False)]])
+
+    self.rep.Flush()
+    self.assertEqual(len(self.sent), 2)
+
+  def testAppend(self):
+    self.rep = jqueue._QueueFileReplicator(self._Send, 3600)
+
+    self.rep.Defer("/job-1.log", "a", append=True)
+    self.rep.Defer("/job-1.log", "b", append=True)
+    self.rep.Defer("/job-2.log", "", append=False)
+    self.rep.Defer("/job-2.log", "c", append=True)
+    self.rep.Flush()
+    self.assertEqual(self.sent, [[("/job-1.log", "ab", True),
+                                  ("/job-2.log", "c", False)]])
+
+  def testSendFailure(self):
+    self.rep = jqueue._QueueFileReplicator(self._Send, 3600)
+
+    self.rep.Defer("/job-1.log", "a", append=True)
+    self.rep.Defer("/job-2", "b")
+    self.rep.Defer("/job-3", "c")
+    self.fail_send = True
+    self.assertRaises(errors.GenericError, self.rep.Flush)
+    self.fail_send = False
+
+    # Unsent updates are kept; newer ones take precedence or are appended
+    self.rep.Defer("/job-1.log", "d", append=True)
+    self.rep.Defer("/job-2", "e")
+    self.rep.Flush()
+    self.assertEqual(self.sent, [[("/job-1.log", "ad", True),
+                                  ("/job-2", "e", False),
+                                  ("/job-3", "c", False)]])
+
+  def testNodeFailure(self):
+    self.rep = jqueue._QueueFileReplicator(self._Send, 3600)
+
+    self.rep.Defer("/job-1.log", "a", append=True)
+    self.rep.Defer("/job-2", "b")
+    self.failed_nodes = ["node2"]
+    self.rep.Flush()
+    self.failed_nodes = []
+    self.assertTrue(self.rep.HasStaleNodes("/job-1.log"))
+    self.assertTrue(self.rep.HasStaleNodes("/job-2"))
+
+    # Successful appends don't make up for the missed one
+    self.rep.Defer("/job-1.log", "c", append=True)
+    self.rep.Flush()
+    self.assertTrue(self.rep.HasStaleNodes("/job-1.log"))
+
+    # A whole file heals with its next update
+    self.rep.Send([("/job-2", "d")])
+    self.assertFalse(self.rep.HasStaleNodes("/job-2"))
+
+    # Appended files are sent in full to the nodes which missed an update
+    del self.sent[:]
+    self.rep.Send([("/job-1", "e")],
+                  resend=[("/job-1.log", "ac"), ("/job-3.log", "x")])
+    self.assertEqual(self.sent, [
+      [("/job-1", "e", False)],
+      ([("/job-1.log", "ac", False)], ["node2"]),
+      ])
+    self.assertFalse(self.rep.HasStaleNodes("/job-1.log"))
+
+  def testForget(self):
+    self.rep = jqueue._QueueFileReplicator(self._Send, 3600)
+    self.failed_nodes = ["node2", "node3"]
+    self.rep.Send([("/job-1", "a"), ("/job-2", "b")])
+    self.failed_nodes = []
+
+    self.rep.Forget(file_names=["/job-1"])
+    self.assertFalse(self.rep.HasStaleNodes("/job-1"))
+    self.rep.Forget(node="node2")
+    self.assertTrue(self.rep.HasStaleNodes("/job-2"))
+    self.rep.Forget(node="node3")
+    self.assertFalse(self.rep.HasStaleNodes("/job-2"))
+
+  def testBackground(self):
+    self.rep = jqueue._QueueFileReplicator(self._Send, 0.01)
+    self.rep.Defer("/job-1", "a")
+    self.sent_event.wait(60.0)
+    self.assertEqual(self.sent, [[("/job-1", "a", False)]])
+
+  def testStop(self):
+    self.rep = jqueue._QueueFileReplicator(self._Send, 3600)
+    self.rep.Defer("/job-1", "a")
+    self.rep.Stop()
+    self.assertEqual(self.sent, [[("/job-1", "a", False)]])
+
+
+class TestCheckRpcResult(unittest.TestCase):
+  def test(self):
+    result = {
+      "node1": rpc.RpcResult(data=(True, None), node="node1"),
+      "node2": rpc.RpcResult(data=(False, "error"), node="node2"),
+      "node3": rpc.RpcResult(offline=True, node="node3"),
+      }
+    self.assertEqual(jqueue.JobQueue._CheckRpcResult(result,
+                                                     ["node1", "node2",
+                                                      "node3"], "Test"),
+                     ["node2", "node3"])
+
+
+class _FakeReplicator:
+  def __init__(self, stale):
+    self.stale = stale
+
+  def HasStaleNodes(self, file_name):
+    return file_name in self.stale
+
+
+class _FakeQueueForUpdate(jqueue.JobQueue):
+  # pylint: disable-msg=W0231
+  def __init__(self, tmpdir, replicator):
+    self._tmpdir = tmpdir
+    self._queue_filelock = True
+    self._replicator = replicator
+    self.updates = []
+
+  def _GetJobPath(self, job_id):
+    return utils.PathJoin(self._tmpdir, "job-%s" % job_id)
+
+  def _UpdateJobQueueFiles(self, files, replicate, resend=None):
+    self.updates.append((files, replicate, resend))
+
+
+class _FakeJobForUpdate:
+  def __init__(self, job_id):
+    self.id = job_id
+    self.ops = []
+
+  def Serialize(self, include_log=True):
+    assert not include_log
+    return {"id": self.id}
+
+  def CalcStatus(self):
+    return constants.JOB_STATUS_RUNNING
+
+
+class TestUpdateJobResend(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.log_path = utils.PathJoin(self.tmpdir, "job-1.log")
+    utils.WriteFile(self.log_path, data="entries\n")
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test(self):
+    queue = _FakeQueueForUpdate(self.tmpdir, _FakeReplicator([]))
+    queue.UpdateJobUnlocked(_FakeJobForUpdate(1))
+    self.assertEqual(queue.updates[-1][2], [])
+
+    # The complete log segment is sent to nodes which missed appends
+    queue = _FakeQueueForUpdate(self.tmpdir,
+                                _FakeReplicator([self.log_path]))
+    queue.UpdateJobUnlocked(_FakeJobForUpdate(1))
+    self.assertEqual(queue.updates[-1][2], [(self.log_path, "entries\n")])
+
+    # But only when replicating right away
+    queue.UpdateJobUnlocked(_FakeJobForUpdate(1), replicate=False)
+    self.assertEqual(queue.updates[-1][2], [])
+
+
+class TestLogSegment(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = utils.PathJoin(self.tmpdir, "job-1.log")
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _MakeEntries(self, count):
+    return [(i % 3, [i + 1, [1234, i], constants.ELOG_MESSAGE,
+                     "Message %s\nwith newline" % i])
+            for i in range(count)]
+
+  def testMissing(self):
+    self.assertEqual(jqueue._ReadLogSegment(self.path), ([], 0))
+    self.assertEqual(jqueue._ReadLogSegment(self.path, newer_than=10),
+                     ([], 0))
+
+  def testReadAll(self):
+    entries = self._MakeEntries(100)
+    data = jqueue._FormatLogEntries(entries)
+    self.assertEqual(len(data.splitlines()), 100)
+    utils.WriteFile(self.path, data=data)
+    self.assertEqual(jqueue._ReadLogSegment(self.path),
+                     (entries, len(data)))
+
+  def testReadTail(self):
+    entries = self._MakeEntries(1000)
+    data = jqueue._FormatLogEntries(entries)
+    utils.WriteFile(self.path, data=data)
+
+    for newer_than in [0, 1, 10, 500, 998, 999, 1000, 2000]:
+      (result, size) = jqueue._ReadLogSegment(self.path,
+                                              newer_than=newer_than,
+                                              _block_size=100)
+      self.assertEqual(result, entries[newer_than:])
+      if newer_than > 500:
+        # only the end of the file was read
+        self.assertTrue(size < len(data) / 2)
+
+  def testIncompleteLine(self):
+    entries = self._MakeEntries(10)
+    data = jqueue._FormatLogEntries(entries)
+    utils.WriteFile(self.path, data=data + "[1, 11, [1234")
+    self.assertEqual(jqueue._ReadLogSegment(self.path)[0], entries)
+    self.assertEqual(jqueue._ReadLogSegment(self.path, newer_than=5)[0],
+                     entries[5:])
+
+  def testRestore(self):
+    job = jqueue._QueuedJob(None, 1, [opcodes.OpTestDelay(),
+                                      opcodes.OpTestDelay()])
+    job.ops[0].log.append((1, [1234, 0], constants.ELOG_MESSAGE, "first"))
+    job.log_serial = 1
+
+    state = job.Serialize(include_log=False)
+    self.assertEqual([op["log"] for op in state["ops"]], [[], []])
+
+    state = serializer.LoadJson(serializer.DumpJson(job.Serialize()))
+    restored = jqueue._QueuedJob.Restore(None, state)
+    self.assertEqual(restored.log_serial, 1)
+
+    # entries already in the job file are ignored
+    restored.RestoreLogEntries([(0, [1, [1234, 0], "message", "first"]),
+                                (1, [2, [1234, 1], "message", "second"])])
+    self.assertEqual(restored.log_serial, 2)
+    self.assertEqual(restored.GetLogEntries(None),
+                     [[1, [1234, 0], "message", "first"],
+                      [2, [1234, 1], "message", "second"]])
+
+
 class TestJobChangesWaiter(unittest.TestCase):
   def setUp(self):
     self.tmpdir = tempfile.mkdtemp()
@@ -443,6 +866,11 @@ class _FakeQueueForProc:
     # TODO: Ensure job is updated at the correct places
     pass
 
+  def AppendJobLogUnlocked(self, job, entries):
+    assert self._acquired
+    for (op_idx, entry) in entries:
+      assert entry in job.ops[op_idx].log
+
 
 class _FakeExecOpCodeForProc:
   def __init__(self, before_start, after_start):
@@ -827,6 +1255,57 @@ class TestJobProcessor(unittest.TestCase, _JobProcessorTestUtils):
     self.assertRaises(errors.ProgrammerError,
                       jqueue._JobProcessor(queue, opexec, job))
 
+  def testLockWaitNotification(self):
+    ops = [opcodes.OpTestDummy(result="Res%s" % i, fail=(i == 1))
+           for i in range(2)]
+
+    queue = _FakeQueueForProc()
+    job = self._CreateJob(queue, 1833, ops)
+    calls = []
+
+    def _BeforeStart(timeout, priority):
+      self.assertEqual(calls[-1], True)
+
+    def _AfterStart(op, cbs):
+      self.assertEqual(calls[-1], False)
+
+    opexec = _FakeExecOpCodeForProc(_BeforeStart, _AfterStart)
+
+    self.assertFalse(jqueue._JobProcessor(queue, opexec, job,
+                                          lock_wait_fn=calls.append)())
+    self.assertEqual(calls, [True, False, False])
+
+    self.assert_(jqueue._JobProcessor(queue, opexec, job,
+                                      lock_wait_fn=calls.append)())
+    self.assertEqual(calls, 2 * [True, False, False])
+    self.assertEqual(job.CalcStatus(), constants.JOB_STATUS_ERROR)
+
+  def testPoolPriority(self):
+    queue = _FakeQueueForProc()
+
+    for (pool_priority, expected) in [
+      (None, constants.OP_PRIO_LOW),
+      (constants.OP_PRIO_LOWEST, constants.OP_PRIO_LOW),
+      (constants.OP_PRIO_NORMAL, constants.OP_PRIO_NORMAL),
+      (constants.OP_PRIO_HIGHEST - 5, constants.OP_PRIO_HIGHEST),
+      ]:
+      ops = [opcodes.OpTestDummy(result="Res", fail=False,
+                                 priority=constants.OP_PRIO_LOW)]
+      job = self._CreateJob(queue, 9201, ops)
+      priorities = []
+
+      def _BeforeStart(timeout, priority):
+        priorities.append(priority)
+
+      opexec = _FakeExecOpCodeForProc(_BeforeStart, None)
+
+      self.assert_(jqueue._JobProcessor(queue, opexec, job,
+                                        pool_priority=pool_priority)())
+      self.assertEqual(priorities, [expected])
+
+      # The opcode's own priority isn't changed
+      self.assertEqual(job.ops[0].priority, constants.OP_PRIO_LOW)
+
   def testLogMessages(self):
     # Tests the "Feedback" callback function
     queue = _FakeQueueForProc()
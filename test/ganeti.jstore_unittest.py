@@ -0,0 +1,106 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Script for testing ganeti.jstore"""
+
+import os
+import unittest
+import tempfile
+import shutil
+
+from ganeti import constants
+from ganeti import utils
+from ganeti import jstore
+
+import testutils
+import mocks
+
+
+class TestArchiveIndex(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.archive_dir = utils.PathJoin(self.tmpdir, "archive")
+    self.index_file = utils.PathJoin(self.archive_dir, "index")
+    os.mkdir(self.archive_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _Archive(self, job_id):
+    subdir = utils.PathJoin(self.archive_dir, str(int(job_id) / 10000))
+    utils.EnsureDirs([(subdir, 0700)])
+    utils.WriteFile(utils.PathJoin(subdir, "job-%s" % job_id), data="{}")
+
+  def _Read(self):
+    return jstore.ReadArchiveIndex(index_file=self.index_file,
+                                   archive_dir=self.archive_dir,
+                                   _getents=mocks.FakeGetentResolver)
+
+  def testEmpty(self):
+    self.assertEqual(self._Read(), set())
+    self.assertEqual(utils.ReadFile(self.index_file), "")
+
+  def testRebuild(self):
+    for job_id in ["1", "20", "10001"]:
+      self._Archive(job_id)
+    utils.WriteFile(utils.PathJoin(self.archive_dir, "0", "foo"), data="")
+    utils.WriteFile(utils.PathJoin(self.archive_dir, "job-2"), data="")
+
+    self.assertEqual(jstore.ScanArchivedJobs(archive_dir=self.archive_dir),
+                     set(["1", "20", "10001"]))
+    self.assertEqual(self._Read(), set(["1", "20", "10001"]))
+    self.assertEqual(utils.ReadFile(self.index_file), "1\n20\n10001\n")
+
+    # once the index exists, the directories are no longer scanned
+    self._Archive("30")
+    self.assertEqual(self._Read(), set(["1", "20", "10001"]))
+
+  def testAppend(self):
+    # appending to a missing index does nothing
+    jstore.AppendArchiveIndex(["1"], index_file=self.index_file)
+    self.assertFalse(os.path.exists(self.index_file))
+
+    self._Archive("1")
+    self.assertEqual(self._Read(), set(["1"]))
+    jstore.AppendArchiveIndex([], index_file=self.index_file)
+    jstore.AppendArchiveIndex(["2", "3"], index_file=self.index_file)
+    self.assertEqual(self._Read(), set(["1", "2", "3"]))
+
+
+class TestGetArchivedJobIDFromPath(unittest.TestCase):
+  def test(self):
+    archive_dir = constants.JOB_QUEUE_ARCHIVE_DIR
+    self.assertEqual(jstore.GetArchivedJobIDFromPath(archive_dir +
+                                                     "/1/job-12345"),
+                     "12345")
+    self.assertEqual(jstore.GetArchivedJobIDFromPath(archive_dir +
+                                                     "//0/job-5"),
+                     "5")
+    for path in [constants.QUEUE_DIR + "/job-1",
+                 archive_dir + "/job-1",
+                 archive_dir + "/0/foo",
+                 archive_dir + "/0/1/job-1",
+                 constants.JOB_QUEUE_ARCHIVE_INDEX_FILE]:
+      self.assertEqual(jstore.GetArchivedJobIDFromPath(path), None)
+
+
+if __name__ == "__main__":
+  testutils.GanetiTestProgram()
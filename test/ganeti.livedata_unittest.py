@@ -0,0 +1,227 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Script for testing ganeti.livedata"""
+
+import threading
+import unittest
+
+from ganeti import errors
+from ganeti import livedata
+
+import testutils
+
+
+class _FakeConfig:
+  def __init__(self, nodes):
+    self.nodes = nodes
+
+  def GetNodeList(self):
+    return self.nodes
+
+
+class _FakeRpc:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.calls = []
+    self.block = None
+
+  def _Call(self, name, nodes, args):
+    self.lock.acquire()
+    try:
+      self.calls.append((name, sorted(nodes), args))
+      number = len(self.calls)
+    finally:
+      self.lock.release()
+
+    if self.block:
+      (started, release) = self.block
+      started.set()
+      release.wait()
+
+    return dict([(node, (name, node, args, number)) for node in nodes])
+
+  def call_all_instances_info(self, nodes, hypervisors):
+    return self._Call(livedata.KIND_INSTANCES, nodes, hypervisors)
+
+  def call_node_info(self, nodes, vg_name, hypervisor_type):
+    return self._Call(livedata.KIND_NODES, nodes, (vg_name, hypervisor_type))
+
+
+class _FakeTime:
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class TestLiveDataCache(unittest.TestCase):
+  def setUp(self):
+    self.cfg = _FakeConfig(["node1", "node2", "node3"])
+    self.rpc = _FakeRpc()
+    self.time = _FakeTime()
+    self.cache = livedata.LiveDataCache(self.cfg, idle_timeout=100,
+                                        _rpc=self.rpc, _time_fn=self.time)
+
+  def testFresh(self):
+    for i in range(3):
+      result = self.cache.GetNodeInfo(["node1", "node2"], "xenvg", "kvm", 0)
+      self.assertEqual(sorted(result.keys()), ["node1", "node2"])
+      self.assertEqual(result["node1"][3], i + 1)
+      self.time.now += 0.1
+
+    self.assertEqual(len(self.rpc.calls), 3)
+
+  def testMaxAge(self):
+    result = self.cache.GetNodeInfo(["node1", "node2"], "xenvg", "kvm", 10)
+    self.assertEqual(result["node2"], (livedata.KIND_NODES, "node2",
+                                       ("xenvg", "kvm"), 1))
+
+    # Cached data is reused, only missing nodes are fetched
+    self.time.now += 5
+    result = self.cache.GetNodeInfo(["node2", "node3"], "xenvg", "kvm", 10)
+    self.assertEqual(result["node2"][3], 1)
+    self.assertEqual(result["node3"][3], 2)
+    self.assertEqual(self.rpc.calls[-1],
+                     (livedata.KIND_NODES, ["node3"], ("xenvg", "kvm")))
+
+    # Different arguments don't share data
+    result = self.cache.GetNodeInfo(["node2"], "othervg", "kvm", 10)
+    self.assertEqual(result["node2"][3], 3)
+
+    # Outdated data is refreshed
+    self.time.now += 6
+    result = self.cache.GetNodeInfo(["node1", "node2", "node3"],
+                                    "xenvg", "kvm", 10)
+    self.assertEqual(result["node1"][3], 4)
+    self.assertEqual(result["node2"][3], 4)
+    self.assertEqual(result["node3"][3], 2)
+    self.assertEqual(len(self.rpc.calls), 4)
+
+  def testInstancesHypervisorOrder(self):
+    self.cache.GetAllInstancesInfo(["node1"], ["xen-pvm", "kvm"], 60)
+    self.cache.GetAllInstancesInfo(["node1"], ["kvm", "xen-pvm"], 60)
+    self.assertEqual(self.rpc.calls, [
+      (livedata.KIND_INSTANCES, ["node1"], ("kvm", "xen-pvm")),
+      ])
+
+  def testFailedFetch(self):
+    def _Fail(nodes, *_):
+      raise errors.GenericError("failed")
+
+    self.cache._fetch_fn[livedata.KIND_NODES] = _Fail
+    self.assertRaises(errors.GenericError, self.cache.GetNodeInfo,
+                      ["node1"], "xenvg", "kvm", 10)
+
+    # Nothing was cached and the next query fetches the data again
+    self.cache._fetch_fn[livedata.KIND_NODES] = self.rpc.call_node_info
+    result = self.cache.GetNodeInfo(["node1"], "xenvg", "kvm", 10)
+    self.assertEqual(result["node1"][3], 1)
+
+  def testConcurrentQueries(self):
+    started = threading.Event()
+    release = threading.Event()
+    self.rpc.block = (started, release)
+
+    results = []
+
+    def _Query(nodes):
+      results.append(self.cache.GetAllInstancesInfo(nodes, ["kvm"], 10))
+
+    first = threading.Thread(target=_Query, args=(["node1", "node2"], ))
+    first.start()
+    started.wait()
+
+    # The second query waits for the running call instead of starting its own
+    # one for node1
+    second = threading.Thread(target=_Query, args=(["node1"], ))
+    second.start()
+
+    release.set()
+    first.join()
+    second.join()
+
+    self.assertEqual(len(self.rpc.calls), 1)
+    self.assertEqual(results[0]["node1"], results[1]["node1"])
+
+  def testRefresh(self):
+    self.cache.GetNodeInfo(["node1", "node2"], "xenvg", "kvm", 10)
+    self.cache.GetAllInstancesInfo(["node3"], ["kvm"], 10)
+    self.assertEqual(len(self.rpc.calls), 2)
+
+    # Data is still recent enough
+    self.time.now += 5
+    self.cache.Refresh(10)
+    self.assertEqual(len(self.rpc.calls), 2)
+
+    self.time.now += 6
+    self.cache.Refresh(10)
+    self.assertEqual(sorted(self.rpc.calls[2:]), [
+      (livedata.KIND_INSTANCES, ["node3"], ("kvm", )),
+      (livedata.KIND_NODES, ["node1", "node2"], ("xenvg", "kvm")),
+      ])
+
+    # Refreshed data is used by queries
+    result = self.cache.GetNodeInfo(["node1"], "xenvg", "kvm", 10)
+    self.assertEqual(len(self.rpc.calls), 4)
+    self.assertTrue(result["node1"][3] > 2)
+
+  def testRefreshRemovesUnused(self):
+    self.cache.GetNodeInfo(["node1", "node2"], "xenvg", "kvm", 10)
+    self.time.now += 50
+    self.cache.GetNodeInfo(["node1"], "xenvg", "kvm", 100)
+
+    # Node removed from cluster
+    self.cfg.nodes = ["node2", "node3"]
+
+    # node2 wasn't requested within the idle timeout
+    self.time.now += 60
+    self.cache.Refresh(10)
+    self.assertEqual(len(self.rpc.calls), 1)
+    self.assertFalse(self.cache._entries)
+    self.assertFalse(self.cache._access)
+
+
+class TestLiveDataCollector(unittest.TestCase):
+  def test(self):
+    refreshed = threading.Event()
+
+    class _FakeCache:
+      def Refresh(self, max_age):
+        self.max_age = max_age
+        refreshed.set()
+
+    cache = _FakeCache()
+    collector = livedata.LiveDataCollector(cache, interval=0.01)
+    collector.start()
+    try:
+      refreshed.wait(10.0)
+      self.assertTrue(refreshed.isSet())
+      self.assertEqual(cache.max_age, 0.01)
+    finally:
+      collector.Stop()
+
+    self.assertFalse(collector.isAlive())
+
+
+if __name__ == "__main__":
+  testutils.GanetiTestProgram()
@@ -23,17 +23,20 @@
 
 
 import os
+import select
 import unittest
 import time
 import Queue
 import threading
 import random
 import itertools
+import logging
 
 from ganeti import locking
 from ganeti import errors
 from ganeti import utils
 from ganeti import compat
+from ganeti import constants
 
 import testutils
 
@@ -257,6 +260,139 @@ class TestPipeCondition(_ConditionTestCase):
     self.assertRaises(Queue.Empty, self.done.get_nowait)
 
 
+class TestSingleNotifyLockCondition(TestSingleNotifyPipeCondition):
+  """SingleNotifyLockCondition tests"""
+
+  def setUp(self):
+    _ConditionTestCase.setUp(self, locking.SingleNotifyLockCondition)
+
+  def testTimeoutNotification(self):
+    def _NotifyAll():
+      self.cond.acquire()
+      self.done.put("NA")
+      self.cond.notifyAll()
+      self.cond.release()
+
+    self.cond.acquire()
+    self._addThread(target=_NotifyAll)
+    self.cond.wait(60.0)
+    self.assertEqual(self.done.get_nowait(), "NA")
+    self.cond.release()
+    self._waitThreads()
+
+  def testNoFdForBlockingWait(self):
+    self.cond.acquire()
+    self._addThread(target=self._NotifyAfterWait)
+    self.cond.wait()
+    self.assertEqual(self.done.get(True, 1), "no fd")
+    self.cond.release()
+    self._waitThreads()
+
+  def _NotifyAfterWait(self):
+    while True:
+      self.cond.acquire()
+      try:
+        if self.cond._lock_waiters:
+          if self.cond._wakeup is None:
+            self.done.put("no fd")
+          self.cond.notifyAll()
+          break
+      finally:
+        self.cond.release()
+      time.sleep(0.01)
+
+  def testFdClosed(self):
+    self.cond.acquire()
+    self.cond.wait(0.01)
+    self.assertEqual(self.cond._wakeup, None)
+    self.cond.release()
+
+
+class TestWakeupFd(unittest.TestCase):
+  def _Test(self, wakeup):
+    self.assertFalse(self._Poll(wakeup.fd, 0))
+    wakeup.Signal()
+    self.assertTrue(self._Poll(wakeup.fd, 0))
+    self.assertTrue(self._Poll(wakeup.fd, 0))
+    wakeup.Close()
+
+  def _Poll(self, fd, timeout):
+    poller = select.poll()
+    poller.register(fd, select.POLLIN | select.POLLHUP)
+    return poller.poll(timeout)
+
+  def testPipe(self):
+    self._Test(locking._WakeupFd(_create_eventfd=None))
+
+  def testDefault(self):
+    self._Test(locking._WakeupFd())
+
+
+class TestLockCondition(TestPipeCondition):
+  """LockCondition tests"""
+
+  def setUp(self):
+    _ConditionTestCase.setUp(self, locking.LockCondition)
+
+
+class TestConditionBenchmark(unittest.TestCase):
+  """Measures wait/notify throughput of conditions.
+
+  The thread count corresponds to the job queue workers plus the master
+  daemon's client request workers. The threads pass a token around, each of
+  them waiting until it's its turn, so every notification wakes up all other
+  threads.
+
+  """
+  REPEAT = 3
+  THREADS = 25 + 16
+  ROUNDS = 20
+
+  def _Measure(self, cls, timeout):
+    lock = threading.Lock()
+    cond = cls(lock)
+    state = {
+      "token": 0,
+      }
+    errs = []
+
+    def _Worker(idx):
+      try:
+        lock.acquire()
+        try:
+          for _ in range(self.ROUNDS):
+            while state["token"] % self.THREADS != idx:
+              cond.wait(timeout)
+            state["token"] += 1
+            cond.notifyAll()
+        finally:
+          lock.release()
+      except Exception, err: # pylint: disable-msg=W0703
+        errs.append(err)
+
+    start = time.time()
+    for _ in range(self.REPEAT):
+      state["token"] = 0
+      threads = [threading.Thread(target=_Worker, args=(i, ))
+                 for i in range(self.THREADS)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join(60)
+        self.assertFalse(thread.isAlive())
+      self.assertEqual(state["token"], self.THREADS * self.ROUNDS)
+
+    self.assertEqual(errs, [])
+
+    return (self.REPEAT * self.THREADS * self.ROUNDS) / (time.time() - start)
+
+  def test(self):
+    for timeout in [None, 60.0]:
+      for cls in [locking.PipeCondition, locking.LockCondition]:
+        logging.info("%s, timeout %s: %.0f notifications/s", cls.__name__,
+                     timeout, self._Measure(cls, timeout))
+
+
 class TestSharedLock(_ThreadedTestCase):
   """SharedLock tests"""
 
@@ -835,6 +971,13 @@ class TestSharedLockInPipeCondition(TestSharedLockInCondition):
     self.cond = locking.PipeCondition(self.sl)
 
 
+class TestSharedLockInLockCondition(TestSharedLockInCondition):
+  """SharedLock as a lock condition lock tests"""
+
+  def setCondition(self):
+    self.cond = locking.LockCondition(self.sl)
+
+
 class TestSSynchronizedDecorator(_ThreadedTestCase):
   """Shared Lock Synchronized decorator test"""
 
@@ -1412,6 +1555,168 @@ class TestLockSet(_ThreadedTestCase):
     self.assertRaises(Queue.Empty, self.done.get_nowait)
     self.assertRaises(Queue.Empty, done_two.get_nowait)
 
+  def testWholeSetIntentions(self):
+    def _TryAcquire(names, shared):
+      result = self.ls.acquire(names, shared=shared, timeout=0.05)
+      self.done.put(result)
+      if result is not None:
+        self.ls.release()
+
+    def _CheckAcquire(names, shared, expected):
+      thread = threading.Thread(target=_TryAcquire, args=(names, shared))
+      thread.start()
+      thread.join(60)
+      self.assertEqual(self.done.get_nowait(), expected)
+
+    # Some locks held exclusively by another thread
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def _HoldLocks():
+      self.ls.acquire(["one"], shared=0)
+      acquired.set()
+      release.wait()
+      self.ls.release()
+
+    self._addThread(target=_HoldLocks)
+    acquired.wait()
+
+    _CheckAcquire(locking.ALL_SET, 1, None)
+    _CheckAcquire(locking.ALL_SET, 0, None)
+    _CheckAcquire(["two"], 0, set(["two"]))
+
+    release.set()
+    self._waitThreads()
+
+    # Whole set in shared mode
+    self.assertEqual(self.ls.acquire(locking.ALL_SET, shared=1),
+                     set(self.resources))
+    _CheckAcquire(["two"], 1, set(["two"]))
+    _CheckAcquire(["two"], 0, None)
+    _CheckAcquire(locking.ALL_SET, 1, set(self.resources))
+    _CheckAcquire(locking.ALL_SET, 0, None)
+
+    # Keep some locks, others become available again
+    self.ls.release(names=["one", "three"])
+    self.assertEqual(self.ls._list_owned(), set(["two"]))
+    _CheckAcquire(["one", "three"], 0, set(["one", "three"]))
+    _CheckAcquire(["two"], 1, set(["two"]))
+    _CheckAcquire(["two"], 0, None)
+    _CheckAcquire(locking.ALL_SET, 0, None)
+    self.ls.release()
+
+    # Whole set in exclusive mode
+    self.assertEqual(self.ls.acquire(locking.ALL_SET, shared=0),
+                     set(self.resources))
+    _CheckAcquire(["one"], 1, None)
+    _CheckAcquire(locking.ALL_SET, 1, None)
+
+    # Adding and removing locks
+    self.ls.add(["four"], acquired=1)
+    self.assertEqual(self.ls.remove(["one", "four"]), ["one", "four"])
+    self.assertEqual(self.ls._list_owned(), set(["two", "three"]))
+    self.ls.release()
+
+    self.assertFalse(self.ls._is_owned())
+    _CheckAcquire(locking.ALL_SET, 0, set(["two", "three"]))
+
+  def testWholeSetBlocksNewAcquires(self):
+    # Thread waiting for the whole set blocks new partial acquires, so that
+    # it can't be starved
+    self.ls.acquire(["one"], shared=1)
+
+    def _AcquireAll():
+      self.assert_(self.ls.acquire(locking.ALL_SET, shared=0))
+      self.done.put("all")
+      self.ls.release()
+
+    self._addThread(target=_AcquireAll)
+
+    # Wait for whole-set acquire to be pending
+    def _CheckPending():
+      if not self.ls._LockSet__state._pending[0]:
+        raise utils.RetryAgain()
+    utils.Retry(_CheckPending, 0.01, 10.0)
+
+    def _Acquire():
+      self.assert_(self.ls.acquire(["two"], shared=1))
+      self.done.put("two")
+      self.ls.release()
+
+    self._addThread(target=_Acquire)
+    self.assertRaises(Queue.Empty, self.done.get, True, 0.1)
+
+    self.ls.release()
+    self._waitThreads()
+    self.assertEqual(self.done.get_nowait(), "all")
+    self.assertEqual(self.done.get_nowait(), "two")
+
+  def testWholeSetPriority(self):
+    # Acquires waiting for a whole set are queued on the member locks
+    self.assert_(self.ls.acquire(locking.ALL_SET, shared=0))
+
+    first = threading.Event()
+    prev = first
+
+    def _Acquire(prev, next, priority):
+      prev.wait()
+      self.assert_(self.ls.acquire(["one"], priority=priority,
+                                   test_notify=lambda _: next.set()))
+      self.done.put(priority)
+      self.ls.release()
+
+    priorities = range(10)
+    random.Random(1234).shuffle(priorities)
+
+    for priority in priorities:
+      ev = threading.Event()
+      self._addThread(target=_Acquire, args=(prev, ev, priority))
+      prev = ev
+
+    first.set()
+    prev.wait()
+
+    self.ls.release()
+    self._waitThreads()
+
+    self.assertEqual([self.done.get_nowait() for _ in priorities],
+                     range(10))
+
+
+class TestLockSetBenchmark(unittest.TestCase):
+  """Measures acquiring and releasing whole lock sets.
+
+  """
+  REPEAT = 5
+
+  def _Measure(self, fn):
+    start = time.time()
+    for _ in range(self.REPEAT):
+      fn()
+    return (time.time() - start) / self.REPEAT
+
+  def test(self):
+    for count in [10, 100, 1000, 5000]:
+      names = ["inst%05d.example.com" % i for i in range(count)]
+      ls = locking.LockSet(names, "instances")
+
+      for shared in [0, 1]:
+        def _AcquireWhole():
+          self.assertEqual(len(ls.acquire(locking.ALL_SET, shared=shared)),
+                           count)
+          ls.release()
+
+        def _AcquireAllNames():
+          self.assertEqual(len(ls.acquire(names, shared=shared)), count)
+          ls.release()
+
+        whole = self._Measure(_AcquireWhole)
+        individual = self._Measure(_AcquireAllNames)
+
+        logging.info("%s locks, %s: whole set %.3f ms, all names %.3f ms",
+                     count, ["exclusive", "shared"][shared], whole * 1000,
+                     individual * 1000)
+
 
 class TestGanetiLockManager(_ThreadedTestCase):
 
@@ -1753,6 +2058,72 @@ class TestLockMonitor(_ThreadedTestCase):
                      [[lock.name, "deleted", None]])
     self.assertEqual(len(self.lm._locks), 1)
 
+  def testStatistics(self):
+    fields = ["name", "acquires", "contended", "timeouts", "wait_histogram",
+              "hold_histogram"]
+    nbuckets = len(constants.LOCK_STATS_HISTOGRAM_BOUNDS) + 1
+
+    lock = locking.SharedLock("StatsLock", monitor=self.lm)
+
+    self.assertEqual(self.lm.QueryLocks(fields, False),
+                     [[lock.name, 0, 0, [], [0] * nbuckets, [0] * nbuckets]])
+
+    for shared in [0, 1, 1]:
+      lock.acquire(shared=shared)
+      lock.release()
+
+    (name, acquires, contended, timeouts, wait_hist, hold_hist) = \
+      self.lm.QueryLocks(fields, False)[0]
+    self.assertEqual(name, lock.name)
+    self.assertEqual(acquires, 3)
+    self.assertEqual(contended, 0)
+    self.assertEqual(timeouts, [])
+    self.assertEqual(wait_hist[0], 3)
+    self.assertEqual(sum(hold_hist), 3)
+
+    # Timed out acquires are counted by priority
+    def _TryAcquire(priority):
+      self.assertFalse(lock.acquire(shared=1, timeout=0.01,
+                                    priority=priority))
+
+    lock.acquire()
+    try:
+      for priority in [0, 10, 10]:
+        self._addThread(target=_TryAcquire, args=(priority, ))
+        self._waitThreads()
+    finally:
+      lock.release()
+
+    # A contended acquire records its wait time
+    ev = threading.Event()
+
+    def _Acquire():
+      lock.acquire(test_notify=ev.set)
+      lock.release()
+
+    lock.acquire()
+    try:
+      self._addThread(target=_Acquire)
+      ev.wait()
+      time.sleep(0.02)
+    finally:
+      lock.release()
+    self._waitThreads()
+
+    (acquires, contended, timeouts, wait_time, wait_hist, hold_time,
+     hold_hist) = \
+      self.lm.QueryLocks(["acquires", "contended", "timeouts", "wait_time",
+                          "wait_histogram", "hold_time", "hold_histogram"],
+                         False)[0]
+    self.assertEqual(acquires, 6)
+    self.assertEqual(contended, 4)
+    self.assertEqual(timeouts, [(0, 1), (10, 2)])
+    self.assertEqual(sum(wait_hist), 9)
+    self.assertEqual(wait_hist[0], 5)
+    self.assert_(wait_time > 0.01)
+    self.assertEqual(sum(hold_hist), 6)
+    self.assert_(hold_time > 0.02)
+
   def testPending(self):
     def _Acquire(lock, shared, prev, next):
       prev.wait()
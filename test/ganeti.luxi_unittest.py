@@ -22,8 +22,17 @@
 """Script for unittesting the luxi module"""
 
 
+import os
+import time
+import shutil
+import socket
+import struct
+import logging
+import tempfile
+import threading
 import unittest
 
+from ganeti import constants
 from ganeti import luxi
 from ganeti import serializer
 
@@ -38,7 +47,21 @@ class TestLuxiParsing(testutils.GanetiTestCase):
       })
 
     self.assertEqualValues(luxi.ParseRequest(msg),
-                           ("foo", ["bar", "baz", 123]))
+                           ("foo", ["bar", "baz", 123], None))
+
+    msg = serializer.DumpJson({
+      luxi.KEY_METHOD: "foo",
+      luxi.KEY_ARGS: [],
+      luxi.KEY_STREAM: 100,
+      })
+    self.assertEqualValues(luxi.ParseRequest(msg), ("foo", [], 100))
+
+    # Invalid chunk size
+    for stream in [0, -1, "1", [], 1.5]:
+      self.assertRaises(luxi.ProtocolError, luxi.ParseRequest,
+                        serializer.DumpJson({ luxi.KEY_METHOD: "foo",
+                                              luxi.KEY_ARGS: [],
+                                              luxi.KEY_STREAM: stream, }))
 
     self.assertRaises(luxi.ProtocolError, luxi.ParseRequest,
                       "this\"is {invalid, ]json data")
@@ -65,7 +88,14 @@ class TestLuxiParsing(testutils.GanetiTestCase):
       luxi.KEY_RESULT: None,
       })
 
-    self.assertEqual(luxi.ParseResponse(msg), (True, None))
+    self.assertEqual(luxi.ParseResponse(msg), (True, None, False))
+
+    msg = serializer.DumpJson({
+      luxi.KEY_SUCCESS: True,
+      luxi.KEY_RESULT: [1, 2],
+      luxi.KEY_MORE: True,
+      })
+    self.assertEqual(luxi.ParseResponse(msg), (True, [1, 2], True))
 
     self.assertRaises(luxi.ProtocolError, luxi.ParseResponse,
                       "this\"is {invalid, ]json data")
@@ -109,6 +139,284 @@ class TestLuxiParsing(testutils.GanetiTestCase):
                                luxi.KEY_ARGS: args,
                              })
 
+    msgdata = serializer.LoadJson(luxi.FormatRequest("a", [], stream=10))
+    self.assertEqual(msgdata[luxi.KEY_STREAM], 10)
+    self.assertEqual(luxi.ParseRequest(luxi.FormatRequest("a", [])),
+                     ("a", [], None))
+
+  def testFormatStreamResponse(self):
+    for (count, chunk_size, msgcount) in [(0, 10, 1), (1, 10, 1), (10, 10, 1),
+                                          (11, 10, 2), (25, 5, 5),
+                                          (25, 1, 25)]:
+      rows = [[i, "row%s" % i] for i in range(count)]
+      msgs = list(luxi.FormatStreamResponse(rows, chunk_size))
+      self.assertEqual(len(msgs), msgcount)
+
+      received = []
+      for (idx, msg) in enumerate(msgs):
+        (success, result, more) = luxi.ParseResponse(msg)
+        self.assertTrue(success)
+        self.assertTrue(len(result) <= chunk_size)
+        self.assertEqual(more, idx < len(msgs) - 1)
+        received.extend(result)
+
+      self.assertEqual(received, rows)
+
+  def testSelectFraming(self):
+    self.assertEqual(luxi.SelectFraming([]), luxi.FRAMING_TERMINATOR)
+    self.assertEqual(luxi.SelectFraming(["foo", luxi.FRAMING_LENGTH]),
+                     luxi.FRAMING_LENGTH)
+    self.assertEqual(luxi.SelectFraming([luxi.FRAMING_TERMINATOR,
+                                         luxi.FRAMING_LENGTH]),
+                     luxi.FRAMING_TERMINATOR)
+
+
+class _FakeTransport:
+  def __init__(self, address, timeouts=None):
+    self.address = address
+    self.timeouts = timeouts
+    self.sent = []
+    self.responses = []
+    self.closed = False
+    self.length_prefix = False
+
+  def Send(self, msg):
+    assert not self.closed
+    self.sent.append(luxi.ParseRequest(msg))
+
+  def Recv(self):
+    assert not self.closed
+    return self.responses.pop(0)
+
+  def Call(self, msg):
+    self.Send(msg)
+    return self.Recv()
+
+  def Close(self):
+    self.closed = True
+
+  def UseLengthPrefix(self):
+    self.length_prefix = True
+
+
+class _FakeTransportFactory:
+  def __init__(self, responses):
+    self.responses = responses
+    self.transports = []
+
+  def __call__(self, address, timeouts=None):
+    transport = _FakeTransport(address, timeouts=timeouts)
+    transport.responses.extend(self.responses.pop(0))
+    self.transports.append(transport)
+    return transport
+
+
+class TestClient(unittest.TestCase):
+  def testNegotiateFraming(self):
+    fn = _FakeTransportFactory([
+      [luxi.FormatResponse(True, luxi.FRAMING_LENGTH),
+       luxi.FormatResponse(True, [1, 2])],
+      ])
+    client = luxi.Client(address="master", transport=fn,
+                         framing=luxi.FRAMING_LENGTH)
+    self.assertEqual(client.CallMethod("Foo", []), [1, 2])
+    (transport, ) = fn.transports
+    self.assertTrue(transport.length_prefix)
+    self.assertEqual(transport.sent, [
+      (luxi.REQ_SET_FRAMING, [[luxi.FRAMING_LENGTH]], None),
+      ("Foo", [], None),
+      ])
+
+  def testNegotiateFramingOldServer(self):
+    fn = _FakeTransportFactory([
+      [luxi.FormatResponse(False, "Caught exception: Invalid operation"),
+       luxi.FormatResponse(True, "ok")],
+      ])
+    client = luxi.Client(address="master", transport=fn,
+                         framing=luxi.FRAMING_LENGTH)
+    self.assertEqual(client.CallMethod("Foo", []), "ok")
+    self.assertFalse(fn.transports[0].length_prefix)
+
+  def testNoNegotiation(self):
+    fn = _FakeTransportFactory([[luxi.FormatResponse(True, None)]])
+    client = luxi.Client(address="master", transport=fn)
+    self.assertEqual(client.CallMethod("Foo", [1]), None)
+    self.assertEqual(fn.transports[0].sent, [("Foo", [1], None)])
+
+  def testIterMethod(self):
+    rows = [[i] for i in range(25)]
+    fn = _FakeTransportFactory([
+      list(luxi.FormatStreamResponse(rows, 10)) +
+      [luxi.FormatResponse(True, "next")],
+      ])
+    client = luxi.Client(address="master", transport=fn)
+    self.assertEqual(list(client.IterMethod("Foo", [], chunk_size=10)), rows)
+    self.assertEqual(fn.transports[0].sent, [("Foo", [], 10)])
+    # Connection is used again
+    self.assertEqual(client.CallMethod("Bar", []), "next")
+    self.assertEqual(len(fn.transports), 1)
+
+  def testIterMethodOldServer(self):
+    fn = _FakeTransportFactory([[luxi.FormatResponse(True, [[1], [2]])]])
+    client = luxi.Client(address="master", transport=fn)
+    self.assertEqual(list(client.IterQueryJobs(None, ["id"])), [[1], [2]])
+
+  def testIterMethodError(self):
+    fn = _FakeTransportFactory([
+      [luxi.FormatResponse(False, "error"),
+       luxi.FormatResponse(True, {})],
+      ])
+    client = luxi.Client(address="master", transport=fn)
+    self.assertRaises(luxi.RequestError, list,
+                      client.IterQueryNodes(None, ["name"], False))
+    self.assertRaises(luxi.ProtocolError, list,
+                      client.IterQueryNodes(None, ["name"], False))
+
+  def testIterMethodInterleaved(self):
+    rows = [[i] for i in range(10)]
+    fn = _FakeTransportFactory([
+      list(luxi.FormatStreamResponse(rows, 3)),
+      [luxi.FormatResponse(True, None)],
+      ])
+    client = luxi.Client(address="master", transport=fn)
+    it = client.IterQueryInstances(None, ["name"], False, chunk_size=3)
+    self.assertEqual(it.next(), [0])
+    # Another request while streaming uses a new connection
+    self.assertEqual(client.CallMethod("Foo", []), None)
+    self.assertEqual(len(fn.transports), 2)
+    self.assertEqual(list(it), rows[1:])
+    # Streaming connection was closed as the client has another one
+    self.assertTrue(fn.transports[0].closed)
+    self.assertFalse(fn.transports[1].closed)
+
+
+class _TransportTestBase(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.address = os.path.join(self.tmpdir, "master.sock")
+    self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.listener.bind(self.address)
+    self.listener.listen(1)
+
+  def tearDown(self):
+    self.listener.close()
+    shutil.rmtree(self.tmpdir)
+
+  def _Serve(self, fn):
+    """Runs a function with the server side of a new connection.
+
+    """
+    def _Run():
+      (conn, _) = self.listener.accept()
+      try:
+        fn(conn)
+      finally:
+        conn.close()
+
+    thread = threading.Thread(target=_Run)
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+  @staticmethod
+  def _RecvExactly(conn, size):
+    data = ""
+    while len(data) < size:
+      buf = conn.recv(size - len(data))
+      assert buf
+      data += buf
+    return data
+
+  @staticmethod
+  def _FrameLength(msg):
+    return struct.pack(constants.LUXI_LENGTH_PREFIX_FORMAT, len(msg)) + msg
+
+
+class TestTransport(_TransportTestBase):
+  def testTerminator(self):
+    def _Server(conn):
+      data = self._RecvExactly(conn, 4)
+      self.assertEqual(data, "foo" + constants.LUXI_EOM)
+      conn.sendall("bar" + constants.LUXI_EOM + "baz" + constants.LUXI_EOM)
+
+    thread = self._Serve(_Server)
+    transport = luxi.Transport(self.address)
+    try:
+      self.assertEqual(transport.Call("foo"), "bar")
+      self.assertEqual(transport.Recv(), "baz")
+      self.assertRaises(luxi.ProtocolError, transport.Send,
+                        "a" + constants.LUXI_EOM)
+    finally:
+      transport.Close()
+    thread.join()
+
+  def testLengthPrefix(self):
+    big = "x" * (3 * 1024 * 1024 + 17)
+
+    def _Server(conn):
+      data = self._RecvExactly(conn, len(self._FrameLength("foo\3")))
+      self.assertEqual(data, self._FrameLength("foo\3"))
+      # Send in pieces
+      data = (self._FrameLength("") + self._FrameLength("a\3b") +
+              self._FrameLength(big))
+      for i in range(0, len(data), 1000000):
+        conn.sendall(data[i:i + 1000000])
+        time.sleep(0.01)
+
+    thread = self._Serve(_Server)
+    transport = luxi.Transport(self.address)
+    try:
+      transport.UseLengthPrefix()
+      transport.Send("foo\3")
+      self.assertEqual(transport.Recv(), "")
+      self.assertEqual(transport.Recv(), "a\3b")
+      self.assertEqual(transport.Recv(), big)
+      self.assertRaises(luxi.ConnectionClosedError, transport.Recv)
+    finally:
+      transport.Close()
+    thread.join()
+
+
+class TestTransportBenchmark(_TransportTestBase):
+  """Measures receiving a large reply with both framings.
+
+  """
+  def _Run(self, length_prefix, msg):
+    if length_prefix:
+      data = self._FrameLength(msg)
+    else:
+      data = msg + constants.LUXI_EOM
+
+    def _Server(conn):
+      self._RecvExactly(conn, 1)
+      conn.sendall(data)
+
+    thread = self._Serve(_Server)
+    transport = luxi.Transport(self.address)
+    try:
+      if length_prefix:
+        transport.UseLengthPrefix()
+      start = time.time()
+      transport.socket.sendall("\0")
+      self.assertEqual(transport.Recv(), msg)
+      duration = time.time() - start
+    finally:
+      transport.Close()
+    thread.join()
+
+    return duration
+
+  def test(self):
+    rows = [["inst%05d.example.com" % i, "running", 512, ["node1", "node2"]]
+            for i in range(50000)]
+    msg = luxi.FormatResponse(True, rows)
+
+    for length_prefix in [False, True]:
+      duration = self._Run(length_prefix, msg)
+      logging.info("Received %d bytes with %s in %.1f ms", len(msg),
+                   ("terminator", "length prefix")[length_prefix],
+                   duration * 1000)
+
 
 if __name__ == "__main__":
   testutils.GanetiTestProgram()
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Script for testing ganeti.lvminventory"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ganeti import errors
+from ganeti import lvminventory
+
+import testutils
+
+
+_PVS = [
+  ("/dev/sda3", "100.00", "60.00", "40.00", "a-", "xenvg", "300.00", "140.00",
+   "wz--n-"),
+  ("/dev/sdb1", "200.00", "100.00", "100.00", "a-", "xenvg", "300.00",
+   "140.00", "wz--n-"),
+  ("/dev/sdc1", "50.00", "0", "50.00", "--", "", "0", "0", ""),
+  ("/dev/sdd1", "20.00", "0", "20.00", "a-", "othervg", "20.00", "20.00",
+   "r---n-"),
+  ]
+
+_LVS = [
+  ("disk0", "xenvg", "60.00", "-wi-ao", "/dev/sda3(0)"),
+  ("disk1", "xenvg", "100.00", "-wi-a-", "/dev/sdb1(0)"),
+  ("disk1", "xenvg", "100.00", "-wi-a-", "/dev/sda3(256)"),
+  ]
+
+
+class _FakeLvm:
+  def __init__(self):
+    self.calls = []
+    self.fail = False
+
+  def __call__(self, cmd, fields):
+    self.calls.append(cmd)
+    if self.fail:
+      raise errors.CommandError("%s failed" % cmd)
+    if cmd == "pvs":
+      data = _PVS
+    else:
+      data = _LVS
+    return [dict(zip(fields, values)) for values in data]
+
+
+class _FakeTime:
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class TestLvmSnapshot(unittest.TestCase):
+  def setUp(self):
+    self.lvm = _FakeLvm()
+    self.snapshot = lvminventory.LvmSnapshot("", _run_fn=self.lvm)
+
+  def testVolumeGroups(self):
+    self.assertEqual(self.snapshot.GetVolumeGroups(), [
+      {"vg_name": "xenvg", "vg_size": "300.00", "vg_free": "140.00",
+       "vg_attr": "wz--n-"},
+      {"vg_name": "othervg", "vg_size": "20.00", "vg_free": "20.00",
+       "vg_attr": "r---n-"},
+      ])
+    self.assertEqual(self.lvm.calls, ["pvs"])
+
+  def testQuery(self):
+    self.assertEqual(self.snapshot.Query(lvminventory.KIND_PV,
+                                         ["pv_name", "vg_name"],
+                                         name="/dev/sdb1"),
+                     [["/dev/sdb1", "xenvg"]])
+    self.assertEqual(self.snapshot.Query(lvminventory.KIND_VG,
+                                         ["vg_free", "vg_name"]),
+                     [["140.00", "xenvg"], ["20.00", "othervg"]])
+    self.assertEqual(self.snapshot.Query(lvminventory.KIND_LV, ["devices"],
+                                         name="disk1"),
+                     [["/dev/sdb1(0)"], ["/dev/sda3(256)"]])
+    self.assertEqual(self.snapshot.Query(lvminventory.KIND_LV, ["lv_name"],
+                                         name="disk9"), [])
+    self.assertRaises(errors.ProgrammerError, self.snapshot.Query,
+                      "foo", ["name"])
+
+    # Every command was run only once
+    self.assertEqual(self.lvm.calls, ["pvs", "lvs"])
+
+  def testFailure(self):
+    self.lvm.fail = True
+    self.assertRaises(errors.CommandError, self.snapshot.GetLogicalVolumes)
+    self.lvm.fail = False
+    self.assertEqual(len(self.snapshot.GetLogicalVolumes()), 3)
+    self.assertEqual(self.lvm.calls, ["lvs", "lvs"])
+
+
+class TestLvmInventory(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.stamp_file = os.path.join(self.tmpdir, "stamp")
+    self.lvm = _FakeLvm()
+    self.time = _FakeTime()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _NewInventory(self):
+    return lvminventory.LvmInventory(self.stamp_file, 10,
+                                     _time_fn=self.time, _run_fn=self.lvm)
+
+  def testMaxAge(self):
+    inv = self._NewInventory()
+    snapshot = inv.GetSnapshot()
+    snapshot.GetPhysicalVolumes()
+
+    self.time.now += 10
+    self.assertTrue(inv.GetSnapshot() is snapshot)
+    inv.GetSnapshot().GetPhysicalVolumes()
+    self.assertEqual(self.lvm.calls, ["pvs"])
+
+    self.time.now += 1
+    self.assertFalse(inv.GetSnapshot() is snapshot)
+    inv.GetSnapshot().GetPhysicalVolumes()
+    self.assertEqual(self.lvm.calls, ["pvs", "pvs"])
+
+  def testInvalidate(self):
+    inv = self._NewInventory()
+    snapshot = inv.GetSnapshot()
+    inv.Invalidate()
+    self.assertFalse(inv.GetSnapshot() is snapshot)
+    self.assertTrue(os.path.exists(self.stamp_file))
+
+  def testInvalidateOtherProcess(self):
+    # Node daemon workers have their own inventories, sharing the stamp file
+    inv1 = self._NewInventory()
+    inv2 = self._NewInventory()
+
+    snapshot1 = inv1.GetSnapshot()
+    snapshot2 = inv2.GetSnapshot()
+    self.assertTrue(inv1.GetSnapshot() is snapshot1)
+
+    inv2.Invalidate()
+    self.assertFalse(inv1.GetSnapshot() is snapshot1)
+    self.assertFalse(inv2.GetSnapshot() is snapshot2)
+
+    # New snapshots are kept again
+    snapshot1 = inv1.GetSnapshot()
+    self.assertTrue(inv1.GetSnapshot() is snapshot1)
+
+  def testUnreadableStamp(self):
+    # Without a readable stamp file, snapshots are never reused
+    os.mkdir(self.stamp_file)
+    inv = self._NewInventory()
+    self.assertFalse(inv.GetSnapshot() is inv.GetSnapshot())
+
+
+if __name__ == "__main__":
+  testutils.GanetiTestProgram()
@@ -44,6 +44,12 @@ class TestTimeouts(unittest.TestCase):
                       if not (rpc._TIMEOUTS[name] is None or
                               rpc._TIMEOUTS[name] > 0)])
 
+  def testGetProcedureTimeout(self):
+    self.assertEqual(rpc.GetProcedureTimeout("blockdev_find"),
+                     rpc._TIMEOUTS["blockdev_find"])
+    self.assertEqual(rpc.GetProcedureTimeout("test_delay"), None)
+    self.assertEqual(rpc.GetProcedureTimeout("no_such_procedure"), None)
+
 
 class FakeHttpPool:
   def __init__(self, response_fn):
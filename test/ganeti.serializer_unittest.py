@@ -22,8 +22,19 @@
 """Script for unittesting the serializer module"""
 
 
+import re
+import time
+import logging
 import unittest
 
+import simplejson
+
+try:
+  # pylint: disable-msg=F0401
+  import json
+except ImportError:
+  json = None
+
 from ganeti import serializer
 from ganeti import errors
 
@@ -107,5 +118,201 @@ class TestSerializer(testutils.GanetiTestCase):
                       serializer.DumpJson(tdata), "mykey")
 
 
+def _GetJsonModules():
+  return [module for module in [simplejson, json] if module is not None]
+
+
+class TestJsonCodec(testutils.GanetiTestCase):
+  def testRoundtrip(self):
+    for module in _GetJsonModules():
+      codec = serializer._JsonCodec(module)
+      self.assertEqual(codec.name, module.__name__)
+      for data in TestSerializer._TESTDATA:
+        for fn in [codec.DumpCompact, codec.DumpIndent]:
+          self.assertEqualValues(codec.Load(fn(data)), data)
+
+  def testIndent(self):
+    data = {"a": [1, 2, {"x": None}], "b": "foo", "c": {}}
+
+    for module in _GetJsonModules():
+      codec = serializer._JsonCodec(module)
+      txt = codec.DumpIndent(data)
+      self.assertFalse(re.search(r"[ \t]$", txt, re.M))
+      self.assertTrue("\n" in txt)
+      self.assertTrue(txt.index('"a"') < txt.index('"b"') < txt.index('"c"'))
+
+  def testCompact(self):
+    data = {"a": [1, 2, {"x": None}], "b": "foo bar"}
+
+    for module in _GetJsonModules():
+      codec = serializer._JsonCodec(module)
+      txt = codec.DumpCompact(data)
+      self.assertFalse("\n" in txt)
+      self.assertEqual(txt.count(" "), 1)
+      self.assertEqual(codec.Load(txt), data)
+
+  def testDumpJson(self):
+    data = {"foo": [1, 2, 3]}
+    self.assertEqual(serializer.DumpJson(data, indent=False),
+                     "{\"foo\":[1,2,3]}\n")
+    self.assertFalse(re.search(r"[ \t]$", serializer.DumpJson(data), re.M))
+
+  def testStrDecoder(self):
+    self.assertTrue(isinstance(serializer.LoadJson("\"abc\""), str))
+    self.assertTrue(isinstance(serializer.LoadJson("[\"abc\"]")[0], str))
+
+
+class _FakeEncoder:
+  def __init__(self, sort_keys=False):
+    self.sort_keys = sort_keys
+
+  def encode(self, data):
+    return simplejson.dumps(data, sort_keys=self.sort_keys)
+
+
+class _FakeJsonModule:
+  def __init__(self, name, fast_encoder, fast_decoder, str_decoder):
+    self.__name__ = name
+    self.JSONEncoder = _FakeEncoder
+    if fast_encoder:
+      self.encoder = self._Fast("c_make_encoder")
+    if fast_decoder:
+      self.scanner = self._Fast("c_make_scanner")
+    self._str_decoder = str_decoder
+
+  class _Fast:
+    def __init__(self, name):
+      setattr(self, name, object())
+
+  def loads(self, txt):
+    result = simplejson.loads(txt)
+    if not self._str_decoder and isinstance(result, str):
+      result = unicode(result)
+    return result
+
+
+class TestSelectJsonCodecs(unittest.TestCase):
+  def _Select(self, modules):
+    (encoder, decoder) = serializer._SelectJsonCodecs(modules)
+    return (encoder.name, decoder.name)
+
+  def testSingle(self):
+    for (fenc, fdec, strdec) in [(False, False, False), (True, True, True)]:
+      mod = _FakeJsonModule("a", fenc, fdec, strdec)
+      self.assertEqual(self._Select([None, mod, None]), ("a", "a"))
+
+  def testPreferFast(self):
+    slow = _FakeJsonModule("slow", False, False, True)
+    fast = _FakeJsonModule("fast", True, True, True)
+    self.assertEqual(self._Select([slow, fast]), ("fast", "fast"))
+    self.assertEqual(self._Select([fast, slow]), ("fast", "fast"))
+
+  def testOrder(self):
+    first = _FakeJsonModule("first", True, True, True)
+    second = _FakeJsonModule("second", True, True, True)
+    self.assertEqual(self._Select([first, second]), ("first", "first"))
+
+  def testUnicodeDecoder(self):
+    unidec = _FakeJsonModule("unicode", True, True, False)
+    slow = _FakeJsonModule("slow", False, False, True)
+    self.assertEqual(self._Select([unidec, slow]), ("unicode", "slow"))
+    self.assertEqual(self._Select([unidec]), ("unicode", "unicode"))
+
+  def testNoIndent(self):
+    mod = _FakeJsonModule("noindent", False, False, True)
+    (encoder, _) = serializer._SelectJsonCodecs([mod])
+    data = {"b": 1, "a": [None]}
+    self.assertEqual(simplejson.loads(encoder.DumpIndent(data)), data)
+    self.assertEqual(simplejson.loads(encoder.DumpCompact(data)), data)
+
+
+class TestSerializerBenchmark(unittest.TestCase):
+  """Measures the speed of the available JSON modules.
+
+  """
+  REPEAT = 5
+
+  @staticmethod
+  def _GetConfigData():
+    instances = {}
+    for i in range(500):
+      name = "inst%04d.example.com" % i
+      instances[name] = {
+        "name": name,
+        "primary_node": "node%03d.example.com" % (i % 40),
+        "os": "debootstrap+default",
+        "hypervisor": "xen-pvm",
+        "hvparams": {},
+        "beparams": {"memory": 512, "vcpus": 1, "auto_balance": True},
+        "admin_up": True,
+        "nics": [{"mac": "aa:00:00:%02x:%02x:01" % (i / 256, i % 256),
+                  "ip": None, "nicparams": {}}],
+        "disks": [{"dev_type": "drbd8", "size": 10240, "mode": "rw",
+                   "logical_id": ["node1", "node2", 11000 + i, 0, 1,
+                                  "secret%d" % i],
+                   "children": [{"dev_type": "lvm", "size": 10240,
+                                 "logical_id": ["xenvg", "disk%d" % i]}],
+                   "iv_name": "disk/0"}],
+        "disk_template": "drbd",
+        "network_port": None,
+        "tags": ["tag1", "tag2"],
+        "serial_no": i,
+        "ctime": 1285000000.123 + i,
+        "mtime": 1285000000.456 + i,
+        "uuid": "2c8f6a6b-3a3c-4c3e-9f0e-%012d" % i,
+        }
+    return {
+      "version": 2020000,
+      "cluster": {"cluster_name": "cluster.example.com"},
+      "instances": instances,
+      "serial_no": 1,
+      }
+
+  @staticmethod
+  def _GetJobData():
+    ops = []
+    for i in range(20):
+      ops.append({
+        "input": {"OP_ID": "OP_INSTANCE_STARTUP",
+                  "instance_name": "inst%04d.example.com" % i,
+                  "force": False, "beparams": {}, "hvparams": {}},
+        "status": "success",
+        "result": None,
+        "log": [[j, [1285000000, 123456], "message",
+                 "Step %d of instance %d" % (j, i)] for j in range(20)],
+        "start_timestamp": [1285000000, 1],
+        "exec_timestamp": [1285000000, 2],
+        "end_timestamp": [1285000001, 3],
+        "priority": 0,
+        })
+    return {"id": 1234, "ops": ops, "received_timestamp": [1285000000, 0],
+            "start_timestamp": None, "end_timestamp": None}
+
+  def _Measure(self, fn, data):
+    start = time.time()
+    for _ in range(self.REPEAT):
+      result = fn(data)
+    return (result, (time.time() - start) / self.REPEAT)
+
+  def test(self):
+    payloads = [
+      ("config", self._GetConfigData()),
+      ("job", self._GetJobData()),
+      ]
+
+    for (payload_name, data) in payloads:
+      for module in _GetJsonModules():
+        codec = serializer._JsonCodec(module)
+        for (mode, fn) in [("indented", codec.DumpIndent),
+                           ("compact", codec.DumpCompact)]:
+          (txt, duration) = self._Measure(fn, data)
+          (loaded, load_duration) = self._Measure(codec.Load, txt)
+          self.assertEqual(loaded, data)
+          logging.info("%s, %s (%s, %s): %d bytes, dump %.2f ms,"
+                       " load %.2f ms", payload_name, module.__name__,
+                       mode, ("slow", "fast")[codec.fast_encoder], len(txt),
+                       duration * 1000, load_duration * 1000)
+
+
 if __name__ == '__main__':
   testutils.GanetiTestProgram()
@@ -333,6 +333,29 @@ class TestRunCmd(testutils.GanetiTestCase):
     self.failUnlessEqual(RunCmd(["env"], reset_env=True,
                                 env={"FOO": "bar",}).stdout.strip(), "FOO=bar")
 
+  def testTimeout(self):
+    """Test killing a command after a timeout"""
+    result = RunCmd(["/bin/sh", "-c", "echo -n start; exec sleep 60"],
+                    timeout=0.1)
+    self.assertTrue(result.failed)
+    self.assertEqual(result.timeout, 0.1)
+    self.assertEqual(result.signal, 9)
+    self.assertEqual(result.stdout, "start")
+    self.assertTrue("timeout" in result.fail_reason)
+    self.assertTrue(result.duration < 30)
+
+  def testTimeoutNotReached(self):
+    """Test a command finishing before its timeout"""
+    result = RunCmd(["echo", "-n", self.magic], timeout=60)
+    self.assertFalse(result.failed)
+    self.assertEqual(result.timeout, None)
+    self.assertEqual(result.stdout, self.magic)
+    self.assertTrue(result.duration >= 0)
+
+  def testTimeoutWithOutputFile(self):
+    self.assertRaises(errors.ProgrammerError, RunCmd, ["true"],
+                      output=self.fname, timeout=10)
+
 
 class TestRunParts(unittest.TestCase):
   """Testing case for the RunParts function"""
@@ -459,6 +482,47 @@ class TestRunParts(unittest.TestCase):
     self.failUnlessEqual(runresult.exit_code, 0)
     self.failUnless(not runresult.failed)
 
+  def testParallel(self):
+    """Test concurrent execution"""
+    names = ["10test", "20test", "30test", "40test"]
+    startdir = tempfile.mkdtemp(prefix="ganeti-test")
+    try:
+      for relname in names:
+        fname = os.path.join(self.rundir, relname)
+        # Each script waits until all of them have started
+        utils.WriteFile(fname, data=("#!/bin/sh\n"
+                                     "touch %s/%s\n"
+                                     "for i in $(seq 1 500); do\n"
+                                     "  [ $(ls %s | wc -l) -eq 4 ] &&"
+                                     " { echo -n %s; exit 0; }\n"
+                                     "  sleep 0.01\n"
+                                     "done\n"
+                                     "exit 1\n" %
+                                     (startdir, relname, startdir, relname)))
+        os.chmod(fname, stat.S_IREAD | stat.S_IEXEC)
+
+      results = RunParts(self.rundir, reset_env=True, max_parallel=4)
+    finally:
+      shutil.rmtree(startdir)
+
+    self.assertEqual([relname for (relname, _, _) in results], names)
+    for (relname, status, runresult) in results:
+      self.assertEqual(status, constants.RUNPARTS_RUN)
+      self.assertFalse(runresult.failed)
+      self.assertEqual(runresult.output, relname)
+
+  def testTimeout(self):
+    """Test killing scripts after a timeout"""
+    fname = os.path.join(self.rundir, "00test")
+    utils.WriteFile(fname, data="#!/bin/sh\nexec sleep 60\n")
+    os.chmod(fname, stat.S_IREAD | stat.S_IEXEC)
+    (relname, status, runresult) = RunParts(self.rundir, reset_env=True,
+                                            timeout=0.1)[0]
+    self.assertEqual(relname, "00test")
+    self.assertEqual(status, constants.RUNPARTS_RUN)
+    self.assertTrue(runresult.failed)
+    self.assertEqual(runresult.timeout, 0.1)
+
 
 class TestStartDaemon(testutils.GanetiTestCase):
   def setUp(self):
@@ -30,6 +30,7 @@ import random
 
 from ganeti import workerpool
 from ganeti import errors
+from ganeti import compat
 
 import testutils
 
@@ -469,5 +470,275 @@ class TestWorkerpool(unittest.TestCase):
       self._CheckWorkerCount(wp, 0)
 
 
+class BlockingContext:
+  def __init__(self, lock_wait=False):
+    self.lock_wait = lock_wait
+    self.release = threading.Event()
+    self.lock = threading.Condition(threading.Lock())
+    self.started = 0
+
+  def WaitStarted(self, count):
+    self.lock.acquire()
+    try:
+      while self.started < count:
+        self.lock.wait(1.0)
+    finally:
+      self.lock.release()
+
+
+class BlockingWorker(workerpool.BaseWorker):
+  def RunTask(self, ctx):
+    if ctx.lock_wait:
+      self.SetWaitingForLocks(True)
+
+    ctx.lock.acquire()
+    try:
+      ctx.started += 1
+      ctx.lock.notifyAll()
+    finally:
+      ctx.lock.release()
+
+    ctx.release.wait()
+
+
+class TestAutoscaling(unittest.TestCase):
+  def _GetWorkerCount(self, wp):
+    return wp.GetStats()["workers"]
+
+  def _WaitForWorkerCount(self, wp, count):
+    for _ in range(500):
+      if self._GetWorkerCount(wp) == count:
+        break
+      time.sleep(0.01)
+    self.assertEqual(self._GetWorkerCount(wp), count)
+
+  def testQueueDepth(self):
+    wp = workerpool.WorkerPool("Test", 2, BlockingWorker, max_workers=5,
+                               idle_timeout=0.1)
+    try:
+      ctx = BlockingContext()
+      self.assertEqual(self._GetWorkerCount(wp), 2)
+
+      wp.AddManyTasks([(ctx, ) for _ in range(4)])
+      ctx.WaitStarted(4)
+      self.assertEqual(self._GetWorkerCount(wp), 4)
+
+      # Limited by maximum
+      wp.AddManyTasks([(ctx, ) for _ in range(3)])
+      ctx.WaitStarted(5)
+
+      stats = wp.GetStats()
+      self.assertEqual(stats["workers"], 5)
+      self.assertEqual(stats["running"], 5)
+      self.assertEqual(stats["queued"], 2)
+      self.assertEqual(stats["lock_waiting"], 0)
+      self.assertEqual((stats["min_workers"], stats["max_workers"]), (2, 5))
+
+      ctx.release.set()
+      wp.Quiesce()
+
+      stats = wp.GetStats()
+      self.assertEqual(stats["started"], 7)
+      self.assertEqual(stats["running"], 0)
+      self.assert_(stats["max_wait_time"] > 0.0)
+      self.assert_(stats["wait_time"] >= stats["max_wait_time"])
+
+      # Idle surplus workers terminate
+      self._WaitForWorkerCount(wp, 2)
+    finally:
+      wp.TerminateWorkers()
+
+    self.assertEqual(self._GetWorkerCount(wp), 0)
+    self.assertFalse(wp._termworkers)
+
+  def testIdleCycles(self):
+    wp = workerpool.WorkerPool("Test", 1, BlockingWorker, max_workers=10,
+                               idle_timeout=0.1)
+    try:
+      for _ in range(3):
+        ctx = BlockingContext()
+        wp.AddManyTasks([(ctx, ) for _ in range(10)])
+        ctx.WaitStarted(10)
+        self.assertEqual(self._GetWorkerCount(wp), 10)
+
+        ctx.release.set()
+        wp.Quiesce()
+
+        # Surplus workers terminate without being kept around
+        self._WaitForWorkerCount(wp, 1)
+        self.assertFalse(wp._termworkers)
+    finally:
+      wp.TerminateWorkers()
+
+    self.assertEqual(self._GetWorkerCount(wp), 0)
+    self.assertFalse(wp._termworkers)
+
+  def testLockWait(self):
+    wp = workerpool.WorkerPool("Test", 2, BlockingWorker, max_workers=10)
+    try:
+      ctx = BlockingContext(lock_wait=True)
+      wp.AddManyTasks([(ctx, ) for _ in range(3)])
+      ctx.WaitStarted(3)
+
+      # Two workers not waiting for locks are kept available
+      stats = wp.GetStats()
+      self.assertEqual(stats["lock_waiting"], 3)
+      self.assertEqual(stats["workers"], 5)
+
+      ctx.release.set()
+      wp.Quiesce()
+      self.assertEqual(wp.GetStats()["lock_waiting"], 0)
+    finally:
+      wp.TerminateWorkers()
+
+  def testFixedSize(self):
+    wp = workerpool.WorkerPool("Test", 2, BlockingWorker)
+    try:
+      ctx = BlockingContext(lock_wait=True)
+      wp.AddManyTasks([(ctx, ) for _ in range(3)])
+      ctx.WaitStarted(2)
+
+      stats = wp.GetStats()
+      self.assertEqual(stats["workers"], 2)
+      self.assertEqual(stats["queued"], 1)
+      self.assertEqual(stats["max_workers"], None)
+
+      ctx.release.set()
+      wp.Quiesce()
+    finally:
+      wp.TerminateWorkers()
+
+  def testResize(self):
+    wp = workerpool.WorkerPool("Test", 5, CountingBaseWorker)
+    try:
+      self.assertEqual(self._GetWorkerCount(wp), 5)
+      wp.Resize(2)
+      self.assertEqual(self._GetWorkerCount(wp), 2)
+      self.assertFalse(wp._termworkers)
+
+      ctx = CountingContext()
+      wp.AddManyTasks([(ctx, "Hello world %s" % i, ) for i in range(10)])
+      wp.Quiesce()
+      self.assertEqual(ctx.GetDoneTasks(), 10)
+    finally:
+      wp.TerminateWorkers()
+
+
+class TestTaskQueue(unittest.TestCase):
+  def _Push(self, queue, name, priority=0, submitter=None, now=0.0):
+    queue.Push(workerpool._Task((name, ), priority, submitter, now))
+
+  def _PopAll(self, queue, now=0.0):
+    result = []
+    while queue:
+      task = queue.Pop(now)
+      result.append((task.args[0], task.effective_priority))
+    return result
+
+  def testPriorityOrder(self):
+    queue = workerpool._TaskQueue(None)
+    for (name, priority) in [("a", 10), ("b", 0), ("c", 10), ("d", -5)]:
+      self._Push(queue, name, priority=priority)
+    self.assertEqual(len(queue), 4)
+    self.assertEqual(self._PopAll(queue, now=1000.0),
+                     [("d", -5), ("b", 0), ("a", 10), ("c", 10)])
+
+  def testAging(self):
+    queue = workerpool._TaskQueue(10.0)
+    self._Push(queue, "low", priority=10, now=0.0)
+    self._Push(queue, "normal1", priority=0, now=55.0)
+    self._Push(queue, "normal2", priority=0, now=105.0)
+
+    # After 109 seconds the low-priority task has gained 10 levels, but
+    # "normal1" was queued earlier
+    self.assertEqual(self._PopAll(queue, now=109.0),
+                     [("normal1", -5), ("low", 0), ("normal2", 0)])
+
+  def testFairQueuing(self):
+    queue = workerpool._TaskQueue(None)
+    for i in range(5):
+      self._Push(queue, "flood%s" % i, submitter="flood")
+    self._Push(queue, "single", submitter="watcher")
+    self._Push(queue, "other", submitter=None)
+
+    self.assertEqual([name for (name, _) in self._PopAll(queue)],
+                     ["flood0", "single", "other", "flood1", "flood2",
+                      "flood3", "flood4"])
+    self.assertFalse(queue._submitters)
+
+  def testNoSavedUpTags(self):
+    queue = workerpool._TaskQueue(None)
+    for i in range(3):
+      self._Push(queue, "a%s" % i, submitter="a")
+    self.assertEqual(len(self._PopAll(queue)), 3)
+
+    # An idle submitter doesn't get precedence later on
+    for i in range(3):
+      self._Push(queue, "b%s" % i, submitter="b")
+    self._Push(queue, "a3", submitter="a")
+    self.assertEqual([name for (name, _) in self._PopAll(queue)],
+                     ["b0", "a3", "b1", "b2"])
+
+
+class AgingContext:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.result = []
+    self.deferred = set()
+    self.started = threading.Event()
+    self.release = threading.Event()
+
+
+class AgingWorker(workerpool.BaseWorker):
+  def RunTask(self, ctx, name):
+    if name == "block":
+      ctx.started.set()
+      ctx.release.wait()
+      return
+
+    ctx.lock.acquire()
+    try:
+      if name.startswith("defer") and name not in ctx.deferred:
+        ctx.deferred.add(name)
+        raise workerpool.DeferTask()
+
+      ctx.result.append((name, self.GetCurrentPriority()))
+    finally:
+      ctx.lock.release()
+
+
+class TestPriorityAging(unittest.TestCase):
+  def test(self):
+    wp = workerpool.WorkerPool("Test", 1, AgingWorker, aging_interval=0.05)
+    try:
+      ctx = AgingContext()
+
+      # Keep the worker busy while adding tasks
+      wp.AddTask((ctx, "block"), priority=-100)
+      ctx.started.wait()
+
+      wp.AddTask((ctx, "defer-low"), priority=10)
+      wp.AddTask((ctx, "low"), priority=10)
+      time.sleep(0.6)
+      wp.AddManyTasks([(ctx, "normal%s" % i) for i in range(3)])
+
+      ctx.release.set()
+      wp.Quiesce()
+
+      names = [name for (name, _) in ctx.result]
+      self.assertEqual(names[:2], ["low", "defer-low"])
+      self.assertEqual(sorted(names[2:]), ["normal0", "normal1", "normal2"])
+
+      # The deferred task has kept its age
+      self.assert_(compat.all(prio <= 0 for (_, prio) in ctx.result[:2]))
+
+      stats = wp.GetStats()
+      self.assertEqual([values[:2] for values in stats["priority_wait"]],
+                       [[-100, 1], [0, 3], [10, 3]])
+      self.assert_(stats["priority_wait"][2][3] >= 0.5)
+    finally:
+      wp.TerminateWorkers()
+
+
 if __name__ == '__main__':
   testutils.GanetiTestProgram()